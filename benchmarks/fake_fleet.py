@@ -0,0 +1,497 @@
+"""
+In-process fleet of fake SSH devices for benchmarking the shutdown.
+
+Every device is a paramiko ``ServerInterface`` listening on its own loopback
+address (127.1.x.y, which Linux routes to the local host) and emulates either
+an Ubuntu guest (``sudo -S poweroff`` with its password prompt) or an ESXi
+server (``poweroff`` and the ``vim-cmd`` commands sent by RemoteDeviceManager).
+Handshake latency, command latency, the time a guest takes to go down and a
+failure rate are configurable per fleet.
+
+A powered off device stops answering: its listener is replaced by one whose
+accept queue is full, so TCP probes time out as they would against a host
+that is really off instead of being refused.
+
+Processes forked while a fleet runs (for example the shards of a sharded
+shutdown) close their copies of its sockets, which would otherwise keep the
+listeners of powered off devices accepting connections.
+"""
+import io
+import json
+import logging
+import os
+import queue
+import random
+import re
+import selectors
+import socket
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+import paramiko
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519
+
+
+_GETALLVMS_HEADER = "Vmid   Name   File   Guest OS   Version   Annotation"
+_STATES_MARKER = "--- power states ---"
+_DISCOVERY_MARKER = "--- discovery ---"
+_FOR_IDS = re.compile(r"^for id in ([\d ]*);")
+
+# Generating an RSA key takes a while, every device of a process shares the
+# same host keys
+_host_keys: List[paramiko.PKey] = []
+_host_key_lock = threading.Lock()
+
+
+# Fleets serving connections, whose sockets forked children must close
+_running_fleets: List["FakeFleet"] = []
+
+
+def _close_fleet_sockets_in_child() -> None:
+    for fleet in _running_fleets:
+        fleet.running = False
+        for host in fleet.hosts:
+            for sock in [host.listener] + host.blackhole + [
+                    transport.sock for transport in host.transports]:
+                if sock is not None:
+                    sock.close()
+        fleet.selector.close()
+        fleet.wakeup_recv.close()
+        fleet.wakeup_send.close()
+    _running_fleets.clear()
+
+
+os.register_at_fork(after_in_child=_close_fleet_sockets_in_child)
+
+
+def generate_ed25519_key(path: Optional[str] = None) -> paramiko.Ed25519Key:
+    """Generate an ed25519 key, which paramiko cannot generate or save
+    itself, and write it to ``path`` in the OpenSSH format if given."""
+    text = ed25519.Ed25519PrivateKey.generate().private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.OpenSSH,
+        serialization.NoEncryption()).decode("utf-8")
+    if path is not None:
+        with open(os.open(path, os.O_WRONLY | os.O_CREAT, 0o600), "w") as f:
+            f.write(text)
+    return paramiko.Ed25519Key(file_obj=io.StringIO(text))
+
+
+def _get_host_keys() -> List[paramiko.PKey]:
+    """Return the RSA and ed25519 host keys, as an ESXi server offers both."""
+    with _host_key_lock:
+        if not _host_keys:
+            _host_keys.extend([paramiko.RSAKey.generate(2048),
+                               generate_ed25519_key()])
+        return _host_keys
+
+
+@dataclass
+class FakeHostProfile:
+    """Timing and reliability of the fake devices, in seconds."""
+    handshake_latency: float = 0.01
+    exec_latency: float = 0.005
+    # Time a guest takes to go down after accepting its shutdown
+    shutdown_latency: float = 0.5
+    # Time a device takes to accept SSH connections after its power-on
+    boot_latency: float = 1.0
+    # Probability that a connection is dropped, or a command fails
+    failure_rate: float = 0.0
+
+
+class _FakeSSHServer(paramiko.ServerInterface):
+    """Authenticate one connection and run its commands on the device."""
+
+    def __init__(self, host: "FakeHost"):
+        self.host = host
+
+    def get_allowed_auths(self, username):
+        if self.host.fleet.authorized_keys:
+            return "publickey,password"
+        return "password"
+
+    def check_auth_publickey(self, username, key):
+        if (username == self.host.username
+                and key in self.host.fleet.authorized_keys):
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_auth_password(self, username, password):
+        if username == self.host.username and password == self.host.password:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self.host.run_command,
+                         args=(channel, command.decode("utf-8")),
+                         daemon=True).start()
+        return True
+
+
+class FakeHost:
+    """A fake device answering SSH on a loopback address."""
+
+    def __init__(self, fleet: "FakeFleet", name: str, ip: str, port: int,
+                 username: str, password: str):
+        self.fleet = fleet
+        self.name = name
+        self.ip = ip
+        self.port = port
+        self.username = username
+        self.password = password
+        self.powered_on = True
+        # Seconds after the start of the fleet clock at which the device
+        # received its shutdown or poweroff
+        self.poweroff_received: Optional[float] = None
+        self.listener: Optional[socket.socket] = None
+        self.transports: List[paramiko.Transport] = []
+        self.blackhole: List[socket.socket] = []
+        self.lock = threading.Lock()
+
+    def listen(self) -> socket.socket:
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((self.ip, self.port))
+        self.listener.listen(64)
+        self.listener.setblocking(False)
+        return self.listener
+
+    def serve(self, sock: socket.socket) -> None:
+        """Run the SSH server side of an accepted connection."""
+        profile = self.fleet.profile
+        if random.random() < profile.failure_rate:
+            sock.close()
+            return
+        time.sleep(profile.handshake_latency)
+        transport = paramiko.Transport(sock)
+        transport.set_log_channel("fake_fleet.transport")
+        for host_key in _get_host_keys():
+            transport.add_server_key(host_key)
+        with self.lock:
+            if not self.powered_on:
+                transport.close()
+                return
+            self.transports.append(transport)
+        try:
+            transport.start_server(server=_FakeSSHServer(self))
+        except (paramiko.SSHException, EOFError, OSError):
+            transport.close()
+
+    def record_poweroff(self) -> None:
+        with self.lock:
+            if self.poweroff_received is None:
+                self.poweroff_received = time.monotonic() - self.fleet.started
+
+    def run_command(self, channel: paramiko.Channel, command: str) -> None:
+        time.sleep(self.fleet.profile.exec_latency)
+        try:
+            status = self.execute(channel, command)
+            channel.send_exit_status(status)
+        except (OSError, EOFError, paramiko.SSHException):
+            pass
+        finally:
+            channel.close()
+
+    def execute(self, channel: paramiko.Channel, command: str) -> int:
+        """Run a command and return its exit status."""
+        channel.sendall_stderr(f"sh: {command.split()[0]}: not found\n")
+        return 127
+
+    def power_off(self, delay: float = 0.0) -> None:
+        """Go down after ``delay`` seconds."""
+        if delay > 0:
+            timer = threading.Timer(delay, self.power_off)
+            timer.daemon = True
+            timer.start()
+            return
+
+        with self.lock:
+            if not self.powered_on:
+                return
+            self.powered_on = False
+            transports, self.transports = self.transports, []
+        for transport in transports:
+            transport.close()
+        self.fleet.retire(self)
+
+    def power_on(self, delay: float = 0.0) -> None:
+        """Come back up after ``delay`` seconds."""
+        if delay > 0:
+            timer = threading.Timer(delay, self.power_on)
+            timer.daemon = True
+            timer.start()
+            return
+
+        with self.lock:
+            if self.powered_on:
+                return
+            self.powered_on = True
+        self.fleet.revive(self)
+
+    def go_dark(self) -> None:
+        """Replace the listener by one that never answers."""
+        self.listener.close()
+        # Keep the address bound with a full accept queue so that probes
+        # time out instead of being refused
+        blackhole = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        blackhole.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        blackhole.bind((self.ip, self.port))
+        blackhole.listen(0)
+        self.blackhole = [blackhole]
+        for _ in range(2):
+            filler = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            filler.setblocking(False)
+            filler.connect_ex((self.ip, self.port))
+            self.blackhole.append(filler)
+
+    def wake(self) -> socket.socket:
+        """Replace the listener that never answers by a live one."""
+        for sock in self.blackhole:
+            sock.close()
+        self.blackhole = []
+        return self.listen()
+
+    def close(self) -> None:
+        with self.lock:
+            self.powered_on = False
+            transports, self.transports = self.transports, []
+        for transport in transports:
+            transport.close()
+        for sock in self.blackhole + [self.listener]:
+            if sock is not None:
+                sock.close()
+
+
+class FakeGuest(FakeHost):
+    """An Ubuntu guest accepting ``sudo -S poweroff``."""
+
+    def execute(self, channel, command):
+        if command != "sudo -S poweroff":
+            return super().execute(channel, command)
+        channel.sendall_stderr(f"[sudo] password for {self.username}: ")
+        password = b""
+        while not password.endswith(b"\n"):
+            data = channel.recv(1024)
+            if not data:
+                return 1
+            password += data
+        if (password.decode("utf-8").strip() != self.password
+                or random.random() < self.fleet.profile.failure_rate):
+            channel.sendall_stderr("\nSorry, try again.\n")
+            return 1
+        self.record_poweroff()
+        self.power_off(self.fleet.profile.shutdown_latency)
+        return 0
+
+
+class FakeESXi(FakeHost):
+    """An ESXi server answering ``poweroff`` and the ``vim-cmd`` commands."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.vms: Dict[str, FakeGuest] = {}
+
+    def listing(self) -> str:
+        rows = [f"{vm_id}   {vm.name}   [datastore1] {vm.name}/{vm.name}.vmx"
+                "   ubuntu64Guest   vmx-19"
+                for vm_id, vm in self.vms.items()]
+        return "\n".join([_GETALLVMS_HEADER] + rows) + "\n"
+
+    def execute(self, channel, command):
+        if command == "poweroff":
+            self.record_poweroff()
+            self.power_off(0.05)
+            return 0
+        if command == "vim-cmd vmsvc/getallvms":
+            channel.sendall(self.listing())
+            return 0
+        if _STATES_MARKER in command:
+            states = [f"{vm_id} Powered {'on' if vm.powered_on else 'off'}"
+                      for vm_id, vm in self.vms.items()]
+            channel.sendall(self.listing() + _STATES_MARKER + "\n"
+                            + "\n".join(states) + "\n")
+            return 0
+
+        if _DISCOVERY_MARKER in command:
+            details = [f"{vm_id}|Powered {'on' if vm.powered_on else 'off'}|"
+                       f"{vm.ip if vm.powered_on else ''}"
+                       for vm_id, vm in self.vms.items()]
+            channel.sendall(self.listing() + _DISCOVERY_MARKER + "\n"
+                            + "\n".join(details) + "\n")
+            return 0
+
+        match = _FOR_IDS.match(command)
+        if not match:
+            return super().execute(channel, command)
+        graceful = "power.shutdown" in command
+        outcomes = []
+        for vm_id in match.group(1).split():
+            vm = self.vms.get(vm_id)
+            if "power.on" in command:
+                if vm is None or vm.powered_on:
+                    outcomes.append(f"{vm_id} skipped")
+                else:
+                    vm.power_on(self.fleet.profile.boot_latency)
+                    outcomes.append(f"{vm_id} on")
+            elif vm is None or not vm.powered_on:
+                outcomes.append(f"{vm_id} skipped")
+            elif random.random() < self.fleet.profile.failure_rate:
+                outcomes.append(f"{vm_id} failed")
+            else:
+                vm.record_poweroff()
+                vm.power_off(self.fleet.profile.shutdown_latency
+                             if graceful else 0.0)
+                outcomes.append(f"{vm_id} {'shutdown' if graceful else 'off'}")
+        channel.sendall("\n".join(outcomes) + "\n")
+        return 0
+
+
+@dataclass
+class FakeFleet:
+    """A set of fake ESXi servers and guests served from one process.
+
+    Args:
+        esxi_count: Number of ESXi servers
+        vms_per_esxi: Number of guests on every ESXi server
+        profile: Timing and reliability of every device
+        port: SSH port of every device
+        hypervisor_share: Share of ESXi servers using the hypervisor strategy
+        authorized_keys: Public keys every device accepts besides its password
+    """
+    esxi_count: int
+    vms_per_esxi: int
+    profile: FakeHostProfile = field(default_factory=FakeHostProfile)
+    port: int = 2222
+    hypervisor_share: float = 0.0
+    authorized_keys: List[paramiko.PKey] = field(default_factory=list)
+    started: float = 0.0
+
+    def __post_init__(self):
+        self.esxi: List[FakeESXi] = []
+        self.selector = selectors.DefaultSelector()
+        # Devices going down or coming back up are handed to the accept
+        # loop, which owns the selector, through a queue and a wakeup socket
+        self.retired: queue.SimpleQueue = queue.SimpleQueue()
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.running = False
+        self.thread: Optional[threading.Thread] = None
+        addresses = (f"127.1.{index // 250}.{index % 250 + 1}"
+                     for index in range(self.esxi_count * (self.vms_per_esxi + 1)))
+        for s in range(self.esxi_count):
+            server = FakeESXi(self, f"esxi-{s:04d}", next(addresses), self.port,
+                              "root", f"esxi-pw-{s}")
+            for v in range(self.vms_per_esxi):
+                server.vms[str(v + 1)] = FakeGuest(
+                    self, f"vm-{s:04d}-{v:03d}", next(addresses), self.port,
+                    "admin", f"vm-pw-{s}-{v}")
+            self.esxi.append(server)
+        logging.getLogger("fake_fleet.transport").setLevel(logging.CRITICAL)
+
+    @property
+    def hosts(self) -> List[FakeHost]:
+        return [host for server in self.esxi
+                for host in [server] + list(server.vms.values())]
+
+    def strategy(self, index: int) -> str:
+        hypervisor = int(self.esxi_count * self.hypervisor_share)
+        return "hypervisor" if index < hypervisor else "guest"
+
+    def config(self, startup: Optional[Dict] = None, **shutdown) -> Dict:
+        """Return a conf.json mapping describing the fleet."""
+        return {
+            "shutdown": shutdown,
+            "startup": startup or {},
+            "esxi_servers": [
+                {
+                    "name": server.name, "ip": server.ip, "port": server.port,
+                    "username": server.username, "password": server.password,
+                    "vm_shutdown_strategy": self.strategy(index),
+                    "vms": [
+                        {"name": vm.name, "ip": vm.ip, "port": vm.port,
+                         "username": vm.username, "password": vm.password}
+                        for vm in server.vms.values()
+                    ],
+                }
+                for index, server in enumerate(self.esxi)
+            ],
+        }
+
+    def write_config(self, path: str, startup: Optional[Dict] = None,
+                     **shutdown) -> None:
+        with open(path, "w") as f:
+            json.dump(self.config(startup, **shutdown), f, indent=2)
+
+    def start(self) -> None:
+        """Listen on every device address and start accepting."""
+        _get_host_keys()
+        for host in self.hosts:
+            self.selector.register(host.listen(), selectors.EVENT_READ, host)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ, None)
+        self.running = True
+        self.thread = threading.Thread(target=self._accept_loop,
+                                       name="fake-fleet", daemon=True)
+        self.thread.start()
+        _running_fleets.append(self)
+        self.started = time.monotonic()
+
+    def reset_clock(self) -> None:
+        self.started = time.monotonic()
+
+    def retire(self, host: FakeHost) -> None:
+        """Stop accepting connections for a device that went down."""
+        self.retired.put((host, False))
+        self.wakeup_send.send(b"x")
+
+    def revive(self, host: FakeHost) -> None:
+        """Accept connections again for a device that came back up."""
+        self.retired.put((host, True))
+        self.wakeup_send.send(b"x")
+
+    def power_off_all(self) -> None:
+        """Take every device down at once, as an outage would."""
+        for host in self.hosts:
+            host.power_off()
+
+    def _accept_loop(self) -> None:
+        while self.running:
+            for key, _ in self.selector.select(timeout=0.1):
+                host = key.data
+                if host is None:
+                    self.wakeup_recv.recv(4096)
+                    while not self.retired.empty():
+                        changed, powered_on = self.retired.get()
+                        if powered_on:
+                            self.selector.register(
+                                changed.wake(), selectors.EVENT_READ, changed)
+                        else:
+                            self.selector.unregister(changed.listener)
+                            changed.go_dark()
+                    continue
+                try:
+                    sock, _ = key.fileobj.accept()
+                except OSError:
+                    continue
+                sock.setblocking(True)
+                # As sshd does, or every handshake waits on delayed ACKs
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                threading.Thread(target=host.serve, args=(sock,),
+                                 daemon=True).start()
+
+    def stop(self) -> None:
+        _running_fleets[:] = [fleet for fleet in _running_fleets
+                              if fleet is not self]
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+        for host in self.hosts:
+            host.close()
+        self.selector.close()
+        self.wakeup_recv.close()
+        self.wakeup_send.close()
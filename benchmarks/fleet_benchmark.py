@@ -0,0 +1,195 @@
+"""
+Shutdown benchmark against a fake fleet of SSH devices.
+
+For every fleet size, starts a ``FakeFleet`` on loopback addresses, writes a
+matching ``conf/conf.json`` in a scratch directory and runs
+``esxi_control_system.shutdown_infrastructure`` against it, then reports the
+wall time, the p50/p99 latency from the start of the run until each device
+received its shutdown or poweroff, the throughput in devices per second and
+the average duration of every remote phase from the run report.
+
+With ``--recovery``, the ESXi servers then come back after ``--boot-latency``
+seconds, as when power returns, and ``startup_infrastructure`` brings the
+fleet back up; the time to fully recovered is reported too.
+
+Usage:
+    python benchmarks/fleet_benchmark.py --sizes 10,100,500,2000
+    python benchmarks/fleet_benchmark.py --sizes 200 --hypervisor-share 0.5 \\
+        --handshake-latency 0.05 --failure-rate 0.01 --json
+    python benchmarks/fleet_benchmark.py --sizes 100,500 --recovery
+
+Linux only: devices listen on 127.1.x.y, which other systems do not route to
+the local host. Large fleets need about four file descriptors per device.
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+
+# Written by every run, relative to its working directory
+REPORT_FILE = os.path.join("run", "shutdown_report.json")
+STARTUP_REPORT_FILE = os.path.join("run", "startup_report.json")
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCHMARK_DIR), "src"))
+sys.path.insert(0, BENCHMARK_DIR)
+
+import esxi_control_system  # noqa: E402
+from fake_fleet import FakeFleet, FakeHostProfile  # noqa: E402
+
+
+def percentile(values, share):
+    """Return the nearest-rank percentile of a list of values."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(math.ceil(share * len(ordered)) - 1, 0)]
+
+
+def run_size(size, args, profile):
+    """Shut a fleet of ``size`` devices down and return its measurements."""
+    esxi_count = max(math.ceil(size / (args.vms_per_host + 1)), 1)
+    fleet = FakeFleet(esxi_count, args.vms_per_host, profile, port=args.port,
+                      hypervisor_share=args.hypervisor_share)
+    previous_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        for directory in ("conf", "logs", "run"):
+            os.makedirs(os.path.join(workdir, directory))
+        fleet.write_config(
+            os.path.join(workdir, esxi_control_system.CONF_FILE),
+            poll_interval=args.poll_interval,
+            probe_timeout=args.probe_timeout,
+            vm_poweroff_timeout=args.vm_poweroff_timeout,
+            startup={"poll_interval": args.poll_interval})
+        os.chdir(workdir)
+        fleet.start()
+        try:
+            fleet.reset_clock()
+            started = time.perf_counter()
+            success = esxi_control_system.shutdown_infrastructure(
+                max_workers=args.max_workers,
+                per_host_workers=args.per_host_workers,
+                processes=args.processes)
+            wall_time = time.perf_counter() - started
+            with open(REPORT_FILE) as f:
+                remote_phases = json.load(f)["remote_phases"]
+            recovery = None
+            if args.recovery:
+                for server in fleet.esxi:
+                    server.power_on(args.boot_latency)
+                recovered = esxi_control_system.startup_infrastructure(
+                    max_workers=args.max_workers)
+                with open(STARTUP_REPORT_FILE) as f:
+                    report = json.load(f)
+                recovery = {
+                    "success": recovered,
+                    "up": sum(host.powered_on for host in fleet.hosts),
+                    "recovery_s": report["phases"].get("recovery"),
+                    "remote_phases": report["remote_phases"],
+                }
+        finally:
+            os.chdir(previous_dir)
+            fleet.stop()
+
+    latencies = [host.poweroff_received for host in fleet.hosts
+                 if host.poweroff_received is not None]
+    return {
+        "devices": len(fleet.hosts),
+        "esxi_servers": esxi_count,
+        "success": success,
+        "powered_off": len(latencies),
+        "wall_time_s": wall_time,
+        "p50_ms": (percentile(latencies, 0.50) or 0) * 1000,
+        "p99_ms": (percentile(latencies, 0.99) or 0) * 1000,
+        "mean_ms": (statistics.mean(latencies) if latencies else 0) * 1000,
+        "throughput_per_s": len(latencies) / wall_time if wall_time else 0,
+        "remote_phases": remote_phases,
+        "recovery": recovery,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--sizes", default="10,100,500,2000",
+                        help="Comma separated fleet sizes, in devices.")
+    parser.add_argument("--vms-per-host", type=int, default=9,
+                        help="Guests on every ESXi server (default: 9).")
+    parser.add_argument("--hypervisor-share", type=float, default=0.0,
+                        help="Share of ESXi servers using the hypervisor "
+                             "strategy (default: 0).")
+    parser.add_argument("--handshake-latency", type=float, default=0.01)
+    parser.add_argument("--exec-latency", type=float, default=0.005)
+    parser.add_argument("--shutdown-latency", type=float, default=0.5,
+                        help="Seconds a guest takes to go down.")
+    parser.add_argument("--failure-rate", type=float, default=0.0,
+                        help="Probability that a connection or command fails.")
+    parser.add_argument("--max-workers", type=int, default=None)
+    parser.add_argument("--per-host-workers", type=int, default=None)
+    parser.add_argument("--processes", type=int, default=None,
+                        help="Worker processes sharing the ESXi servers.")
+    parser.add_argument("--poll-interval", type=float, default=0.5)
+    parser.add_argument("--probe-timeout", type=float, default=0.3)
+    parser.add_argument("--vm-poweroff-timeout", type=float, default=30)
+    parser.add_argument("--recovery", action="store_true",
+                        help="Bring the fleet back up after the shutdown.")
+    parser.add_argument("--boot-latency", type=float, default=1.0,
+                        help="Seconds a device takes to boot.")
+    parser.add_argument("--port", type=int, default=2222,
+                        help="SSH port of the fake devices (default: 2222).")
+    parser.add_argument("--log-file", default=None,
+                        help="Log the runs to this file, at DEBUG level.")
+    parser.add_argument("--json", action="store_true",
+                        help="Print the results as JSON.")
+    args = parser.parse_args()
+
+    if args.log_file:
+        logging.basicConfig(filename=args.log_file, level=logging.DEBUG,
+                            format="%(asctime)s - %(levelname)s - %(message)s")
+    else:
+        logging.disable(logging.CRITICAL)
+
+    # Every device costs a listener, a server and a client socket
+    _, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard_limit, hard_limit))
+
+    profile = FakeHostProfile(
+        handshake_latency=args.handshake_latency,
+        exec_latency=args.exec_latency,
+        shutdown_latency=args.shutdown_latency,
+        boot_latency=args.boot_latency,
+        failure_rate=args.failure_rate)
+    results = [run_size(int(size), args, profile)
+               for size in args.sizes.split(",")]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return 0
+
+    print(f"{'devices':>8} {'esxi':>5} {'off':>6} {'ok':>3} {'wall s':>8} "
+          f"{'p50 ms':>8} {'p99 ms':>8} {'dev/s':>8}")
+    for result in results:
+        print(f"{result['devices']:>8} {result['esxi_servers']:>5} "
+              f"{result['powered_off']:>6} {'yes' if result['success'] else 'no':>3} "
+              f"{result['wall_time_s']:>8.2f} {result['p50_ms']:>8.0f} "
+              f"{result['p99_ms']:>8.0f} {result['throughput_per_s']:>8.1f}")
+        print("         " + ", ".join(
+            f"{phase} {total['count']}x avg "
+            f"{total['seconds'] / total['count'] * 1000:.0f} ms"
+            for phase, total in result["remote_phases"].items()))
+        recovery = result["recovery"]
+        if recovery is not None:
+            print(f"         recovery: {recovery['up']} up, "
+                  f"{'ok' if recovery['success'] else 'incomplete'}, "
+                  f"fully recovered in "
+                  + (f"{recovery['recovery_s']:.2f} s"
+                     if recovery['recovery_s'] is not None else "-"))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
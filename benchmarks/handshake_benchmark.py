@@ -0,0 +1,150 @@
+"""
+SSH handshake benchmark of the SSH profiles.
+
+Connects repeatedly to a fake device with ``RemoteDeviceManager.ssh_connect``
+under several SSH profiles and reports, for each, the p50/p99 latency of a
+connection (TCP connect, key exchange, host key check and authentication) and
+the client CPU time it took. The fake device is served from a forked process,
+so the CPU time is the client's own.
+
+Profiles compared:
+    password    password auth, paramiko's default algorithms, host keys
+                learned again by every connection (no ssh_profile)
+    ed25519     ed25519 key auth, default algorithms
+    tuned       ed25519 key auth, curve25519 kex, ed25519 host keys,
+                aes128-gcm and a persisted known-hosts cache
+    compressed  the tuned profile with zlib compression
+
+Usage:
+    python benchmarks/handshake_benchmark.py --connections 200
+    python benchmarks/handshake_benchmark.py --handshake-latency 0.02 --json
+
+Linux only, like the fleet benchmark.
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCHMARK_DIR), "src"))
+sys.path.insert(0, BENCHMARK_DIR)
+
+from config_manager.config_manager import SSHProfile  # noqa: E402
+from remote_manager.remote_manager import RemoteDeviceManager  # noqa: E402
+from fake_fleet import (FakeFleet, FakeHostProfile,  # noqa: E402
+                        generate_ed25519_key)
+from fleet_benchmark import percentile  # noqa: E402
+
+
+def build_profiles(key_file, known_hosts):
+    """Return the compared profiles by name, None for no profile."""
+    tuned = dict(key_file=key_file,
+                 kex=["curve25519-sha256@libssh.org"],
+                 ciphers=["aes128-gcm@openssh.com"],
+                 macs=["hmac-sha2-256-etm@openssh.com"],
+                 key_types=["ssh-ed25519"],
+                 known_hosts=known_hosts)
+    return {
+        "password": None,
+        "ed25519": SSHProfile(key_file=key_file),
+        "tuned": SSHProfile(**tuned),
+        "compressed": SSHProfile(compress=True, **tuned),
+    }
+
+
+def serve_fleet(fleet):
+    """Serve the fleet from a forked process, return its pid."""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        fleet.start()
+        os.write(write_fd, b"x")
+        # Runs until the benchmark kills it
+        while True:
+            time.sleep(3600)
+    os.close(write_fd)
+    os.read(read_fd, 1)
+    os.close(read_fd)
+    return pid
+
+
+def run_profile(host, profile, connections):
+    """Connect ``connections`` times and return the measurements."""
+    RemoteDeviceManager.configure_ssh_profiles(
+        {} if profile is None else {(host.ip, host.port): profile})
+    password = host.password if profile is None else None
+    latencies = []
+    failures = 0
+    cpu_started = time.process_time()
+    for _ in range(connections):
+        started = time.perf_counter()
+        client = RemoteDeviceManager.ssh_connect(
+            host.ip, host.username, password, host.port)
+        latencies.append(time.perf_counter() - started)
+        if client:
+            client.close()
+        else:
+            failures += 1
+    cpu = time.process_time() - cpu_started
+    return {
+        "connections": connections,
+        "failures": failures,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "mean_ms": statistics.mean(latencies) * 1000,
+        "cpu_ms": cpu / connections * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--connections", type=int, default=100,
+                        help="Connections per profile")
+    parser.add_argument("--warmup", type=int, default=5,
+                        help="Unmeasured connections per profile")
+    parser.add_argument("--handshake-latency", type=float, default=0.0,
+                        help="Seconds the fake device waits before its banner")
+    parser.add_argument("--port", type=int, default=2222)
+    parser.add_argument("--json", action="store_true",
+                        help="Print the results as JSON")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        key_file = os.path.join(workdir, "id_ed25519")
+        fleet = FakeFleet(1, 0, FakeHostProfile(
+            handshake_latency=args.handshake_latency), port=args.port,
+            authorized_keys=[generate_ed25519_key(key_file)])
+        host = fleet.esxi[0]
+        pid = serve_fleet(fleet)
+        try:
+            profiles = build_profiles(
+                key_file, os.path.join(workdir, "known_hosts"))
+            for name, profile in profiles.items():
+                # Also loads the key and learns the host key, once per run
+                run_profile(host, profile, args.warmup)
+                results[name] = run_profile(host, profile, args.connections)
+        finally:
+            os.kill(pid, 9)
+            os.waitpid(pid, 0)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'profile':<12} {'p50 ms':>8} {'p99 ms':>8} {'mean ms':>8} "
+          f"{'cpu ms':>8} {'failed':>7}")
+    for name, result in results.items():
+        print(f"{name:<12} {result['p50_ms']:>8.2f} {result['p99_ms']:>8.2f} "
+              f"{result['mean_ms']:>8.2f} {result['cpu_ms']:>8.2f} "
+              f"{result['failures']:>7}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""
+Startup benchmark of the esxi_control_system entry point.
+
+Measures the wall time from process start to exit of ``esxi_control_system -s``
+while a stand-in daemon answers on the trigger socket, which is the path a UPS
+hook takes in production, and breaks the import time of that run down per
+module from ``-X importtime``.
+
+Usage:
+    python benchmarks/startup_benchmark.py                    # source build
+    python benchmarks/startup_benchmark.py --exe bin/esxi_control_system
+    python benchmarks/startup_benchmark.py --max-ms 150      # fail if slower
+
+The frozen build only reports an import breakdown when it was built with
+``pyinstaller --python-option "X importtime"`` (see ``make build_importtime``).
+"""
+import argparse
+import json
+import os
+import socketserver
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENTRY_POINT = os.path.join(REPO_DIR, "src", "esxi_control_system.py")
+SOCKET_FILE = os.path.join("run", "esxi_control_system.sock")
+
+
+class _DaemonStandIn(socketserver.StreamRequestHandler):
+    """Answer every trigger like a daemon that shut everything down."""
+
+    def handle(self):
+        self.rfile.readline()
+        self.wfile.write(b"OK\n")
+
+
+def parse_importtime(stderr):
+    """Parse ``-X importtime`` output into (module, self_us, cumulative_us)."""
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        # Nested imports are indented below the module importing them
+        modules.append((name[1:].rstrip(), int(self_us), int(cumulative_us)))
+    return modules
+
+
+def run_once(command, workdir, env):
+    """Run the command once and return its wall time and stderr."""
+    started = time.perf_counter()
+    result = subprocess.run(command, cwd=workdir, env=env, check=False,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            text=True)
+    elapsed = time.perf_counter() - started
+    if result.stdout.strip() != "True":
+        raise RuntimeError(
+            f"{' '.join(command)} failed: {result.stdout}{result.stderr}")
+    return elapsed, result.stderr
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--exe", help="Frozen executable to benchmark instead "
+                                      "of the source entry point.")
+    parser.add_argument("--runs", type=int, default=20,
+                        help="Number of measured runs (default: 20).")
+    parser.add_argument("--top", type=int, default=15,
+                        help="Number of modules in the import breakdown.")
+    parser.add_argument("--max-ms", type=float, default=None,
+                        help="Exit with status 1 if the median startup time "
+                             "exceeds this many milliseconds.")
+    parser.add_argument("--json", action="store_true",
+                        help="Print the results as JSON.")
+    args = parser.parse_args()
+
+    if args.exe:
+        command = [os.path.abspath(args.exe), "-s"]
+        importtime_command = command
+    else:
+        command = [sys.executable, ENTRY_POINT, "-s"]
+        importtime_command = [sys.executable, "-X", "importtime",
+                              ENTRY_POINT, "-s"]
+
+    with tempfile.TemporaryDirectory() as workdir:
+        # The entry point expects logs/ and run/ in its working directory
+        os.makedirs(os.path.join(workdir, "logs"))
+        os.makedirs(os.path.join(workdir, "run"))
+        server = socketserver.UnixStreamServer(
+            os.path.join(workdir, SOCKET_FILE), _DaemonStandIn)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        env = dict(os.environ, PYTHONDONTWRITEBYTECODE="1")
+        try:
+            # One warm-up run fills the OS page cache
+            run_once(command, workdir, env)
+            timings = [run_once(command, workdir, env)[0]
+                       for _ in range(args.runs)]
+            _, stderr = run_once(importtime_command, workdir, env)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    modules = parse_importtime(stderr)
+    top_level = [module for module in modules if not module[0].startswith(" ")]
+    results = {
+        "build": "frozen" if args.exe else "source",
+        "runs": args.runs,
+        "startup_ms": {
+            "min": min(timings) * 1000,
+            "median": statistics.median(timings) * 1000,
+            "max": max(timings) * 1000,
+        },
+        "import_ms": sum(cumulative for _, _, cumulative in top_level) / 1000,
+        "slowest_imports": [
+            {"module": name.strip(), "self_ms": self_us / 1000,
+             "cumulative_ms": cumulative_us / 1000}
+            for name, self_us, cumulative_us in sorted(
+                modules, key=lambda module: module[2], reverse=True)[:args.top]
+        ],
+    }
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        startup = results["startup_ms"]
+        print(f"{results['build']} build, {args.runs} runs of '-s' against a "
+              f"listening daemon")
+        print(f"startup: min {startup['min']:.1f} ms, median "
+              f"{startup['median']:.1f} ms, max {startup['max']:.1f} ms")
+        if modules:
+            print(f"imports: {results['import_ms']:.1f} ms in total, slowest:")
+            print(f"  {'cumulative':>10}  {'self':>8}  module")
+            for module in results["slowest_imports"]:
+                print(f"  {module['cumulative_ms']:8.1f}ms  "
+                      f"{module['self_ms']:6.1f}ms  {module['module']}")
+        else:
+            print("imports: no -X importtime output (frozen build without the "
+                  "importtime option)")
+
+    if args.max_ms is not None and results["startup_ms"]["median"] > args.max_ms:
+        print(f"Median startup exceeds {args.max_ms} ms", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,85 +1,861 @@
-from dataclasses import dataclass
-from typing import Dict, List, Optional
+from dataclasses import dataclass, field, replace
+from typing import Dict, List, Optional, Set, Tuple, Union
 from pathlib import Path
+import hashlib
 import json
-from tabulate import tabulate
+import logging
+import os
+import pickle
+import tempfile
 
 
-@dataclass
-class VMConfig:
-    name: str
-    ip: str
-    username: str
-    password: str
+# How the VMs of an ESXi server are shut down: "guest" logs into every VM
+# and runs poweroff, "hypervisor" shuts them all down from the ESXi server
+VM_SHUTDOWN_STRATEGIES = ('guest', 'hypervisor')
 
+# A device of the shutdown graph: (ESXi server name, VM name), with None as
+# the VM name for the ESXi server itself
+DeviceKey = Tuple[str, Optional[str]]
 
-@dataclass
+# Formats of the log file records
+LOG_FORMATS = ('text', 'json')
+
+# Bumped whenever the cached model changes, so stale caches are ignored
+_CACHE_FORMAT = 13
+# Group and other write permission bits
+_WRITABLE_BY_OTHERS = 0o022
+
+
+def _is_private(stat_result: os.stat_result) -> bool:
+    """True if a file or directory is owned by the effective user and only
+    writable by it, so that no one else could have planted its content."""
+    return (stat_result.st_uid == os.geteuid()
+            and not stat_result.st_mode & _WRITABLE_BY_OTHERS)
+
+
+@dataclass(slots=True)
+class VMConfig:
+    name: str
+    # None for a discovered VM whose guest IP is unknown
+    ip: Optional[str]
+    # Only required by the "guest" shutdown strategy
+    username: Optional[str] = None
+    password: Optional[str] = None
+    port: int = 22
+    ssh_profile: str = 'default'
+    # Devices this VM needs running: it is shut down before all of them
+    depends_on: List[str] = field(default_factory=list)
+    # VMs are shut down after every VM with a lower priority
+    priority: int = 0
+
+
+@dataclass(slots=True)
 class ESXiConfig:
     name: str
     ip: str
     username: str
     password: str
     vms: List[VMConfig]
+    vm_shutdown_strategy: str = 'guest'
+    port: int = 22
+    ssh_profile: str = 'default'
+    # Devices this server needs running: it is shut down before all of them
+    depends_on: List[str] = field(default_factory=list)
+    # ESXi servers are shut down after every server with a lower priority
+    priority: int = 0
+
+
+@dataclass
+class SSHProfile:
+    # Private key (for example ed25519) tried before the password, if any
+    key_file: Optional[str] = None
+    key_passphrase: Optional[str] = None
+    # Algorithms offered in order of preference, paramiko's defaults if empty
+    kex: List[str] = field(default_factory=list)
+    ciphers: List[str] = field(default_factory=list)
+    macs: List[str] = field(default_factory=list)
+    key_types: List[str] = field(default_factory=list)
+    compress: bool = False
+    # known_hosts file host keys are verified against and learned into;
+    # if None, host keys are accepted and forgotten after every connection
+    known_hosts: Optional[str] = None
+    # Reject hosts missing from known_hosts instead of learning their key
+    strict_host_keys: bool = False
+
+
+@dataclass
+class ShutdownConfig:
+    max_workers: int = 8
+    per_host_workers: int = 4
+    vm_poweroff_timeout: float = 120
+    poll_interval: float = 2
+    probe_mode: str = "tcp"
+    probe_timeout: float = 1.0
+    connect_timeout: float = 5
+    auth_timeout: float = 10
+    exec_timeout: float = 15
+    # Parts of a --deadline budget kept for the ESXi power-off, and before
+    # that for the hard power-off of VMs that ignored their guest shutdown
+    esxi_reserve: float = 30
+    hard_off_reserve: float = 15
+    # Worker processes sharing the ESXi servers, 1 runs in-process
+    processes: int = 1
+    # Attempts of every power-off command, retried after a jittered
+    # exponential backoff within what is left of a --deadline budget
+    retry_attempts: int = 3
+    retry_base_delay: float = 1
+    retry_max_delay: float = 10
+    # Failed attempts in a row on an unreachable host after which it is not
+    # retried anymore
+    breaker_threshold: int = 2
+
+
+@dataclass
+class StartupConfig:
+    # Seconds an ESXi server may take to accept SSH sessions again
+    host_timeout: float = 900
+    # Seconds a VM may take to accept SSH connections after its power-on
+    ready_timeout: float = 300
+    poll_interval: float = 5
+
+
+@dataclass
+class DaemonConfig:
+    keepalive_interval: int = 30
+    refresh_interval: float = 60
+
+
+@dataclass
+class ReportConfig:
+    # Where the report of every shutdown run is written, not written if None
+    json_file: Optional[str] = "run/shutdown_report.json"
+    # Prometheus textfile, for example in the node_exporter collector directory
+    prometheus_file: Optional[str] = "run/shutdown_report.prom"
+    # The same files for every startup run
+    startup_json_file: Optional[str] = "run/startup_report.json"
+    startup_prometheus_file: Optional[str] = "run/startup_report.prom"
+    # Latencies learned from every shutdown report, for --plan
+    history_file: Optional[str] = "run/latency_history.json"
+
+
+@dataclass
+class JournalConfig:
+    # Journal of the device states of shutdown runs, not kept if None
+    file: Optional[str] = "run/shutdown_journal.jsonl"
+    # Lock file serializing shutdown runs, runs are not serialized if None
+    lock_file: Optional[str] = "run/shutdown.lock"
+    # Seconds after its last entry during which a run resumes the journal
+    resume_window: float = 900
+
+
+@dataclass
+class DiscoveryConfig:
+    # Merge the VMs discovered on the ESXi servers into the inventory
+    enabled: bool = False
+    # Snapshot of the last discovery, used by shutdowns while fresh
+    cache_file: str = "run/inventory.json"
+    # Seconds a server's discovered VMs are trusted after their discovery
+    ttl: float = 900
+    # Seconds between the background discoveries of the daemon
+    refresh_interval: float = 300
+
+
+@dataclass
+class DistributedConfig:
+    # Address the coordinator listens on and the agents connect to
+    host: str = "127.0.0.1"
+    port: int = 7420
+    # Agents the coordinator waits for, at most join_timeout seconds, before
+    # splitting the inventory between the ones that joined
+    agents: int = 2
+    join_timeout: float = 30
+    heartbeat_interval: float = 2
+    # Seconds without a message after which the shard of an agent is
+    # reassigned to the others
+    agent_timeout: float = 10
+    # Shared by the coordinator and the agents to sign every message; peers
+    # cannot join without it
+    secret: Optional[str] = None
+
+
+@dataclass
+class LoggingConfig:
+    format: str = "text"
+    level: str = "DEBUG"
+    # The log file is rotated past max_bytes, keeping backup_count old files
+    max_bytes: int = 10 * 1024 * 1024
+    backup_count: int = 5
+    # Levels of individual loggers; configured ones are merged over these
+    levels: Dict[str, str] = field(
+        default_factory=lambda: {"paramiko": "WARNING"})
 
 
 class ConfigManager:
-    def __init__(self, config_path: str):
+    def __init__(self, config_path: str, cache_path: Optional[str] = None):
         """Initialize the configuration manager.
 
         Args:
             config_path: Path to the configuration file
+            cache_path: Path of the parsed configuration cache, no cache
+                is used if None
         """
         self.config_path = Path(config_path)
+        self.cache_path = Path(cache_path) if cache_path else None
         self.esxi_servers: List[ESXiConfig] = []
+        self.ssh_profiles: Dict[str, SSHProfile] = {'default': SSHProfile()}
+        self.shutdown = ShutdownConfig()
+        self.startup = StartupConfig()
+        self.daemon = DaemonConfig()
+        self.report = ReportConfig()
+        self.journal = JournalConfig()
+        self.discovery = DiscoveryConfig()
+        self.distributed = DistributedConfig()
+        self.logging = LoggingConfig()
+        # Inventory of the configuration file, before any discovery merge
+        self._configured_servers: Optional[List[ESXiConfig]] = None
+
+    @property
+    def esxi_servers(self) -> List[ESXiConfig]:
+        return self._esxi_servers
+
+    @esxi_servers.setter
+    def esxi_servers(self, servers: List[ESXiConfig]) -> None:
+        self._esxi_servers = servers
+        self._build_indexes()
+
+    def _build_indexes(self) -> None:
+        """Index the inventory by name and IP for constant time lookups."""
+        self._servers_by_name: Dict[str, ESXiConfig] = {}
+        self._vms_by_name: Dict[Tuple[str, str], VMConfig] = {}
+        self._hosts_by_vm: Dict[str, ESXiConfig] = {}
+        self._devices_by_ip: Dict[str, Union[ESXiConfig, VMConfig]] = {}
+        self._shutdown_graph: Optional[Dict[DeviceKey, Set[DeviceKey]]] = None
+        # setdefault keeps the first match, as a scan of the lists would
+        for server in self._esxi_servers:
+            self._servers_by_name.setdefault(server.name, server)
+            self._devices_by_ip.setdefault(server.ip, server)
+            for vm in server.vms:
+                self._vms_by_name.setdefault((server.name, vm.name), vm)
+                self._hosts_by_vm.setdefault(vm.name, server)
+                if vm.ip is not None:
+                    self._devices_by_ip.setdefault(vm.ip, vm)
 
     def load_config(self) -> None:
-        """Load and parse the configuration file."""
+        """Load and parse the configuration file.
+
+        With a cache path, the parsed and validated configuration is stored
+        on disk and reused as long as the configuration file keeps the same
+        modification time and size, or failing that the same SHA-256 hash.
+        The cache holds the credentials of the configuration and is written
+        readable by its owner only; a cache that someone else could have
+        written is ignored.
+        """
         if not self.config_path.exists():
             raise FileNotFoundError(
                 f"Configuration file not found: {self.config_path}")
 
+        stat = self.config_path.stat()
+        cached = self._read_cache()
+        if cached is not None and (cached['mtime_ns'], cached['size']) == (
+                stat.st_mtime_ns, stat.st_size):
+            self._apply_cache(cached)
+            return
+
         try:
             with open(self.config_path, 'r') as f:
-                config_data = json.load(f)
-
-            self.esxi_servers = []
-            for server in config_data.get('esxi_servers', []):
-                vms = [
-                    VMConfig(
-                        name=vm['name'],
-                        ip=vm['ip'],
-                        username=vm['username'],
-                        password=vm['password']
-                    )
-                    for vm in server.get('vms', [])
-                ]
-
-                self.esxi_servers.append(
-                    ESXiConfig(
-                        name=server['name'],
-                        ip=server['ip'],
-                        username=server['username'],
-                        password=server['password'],
-                        vms=vms
-                    )
-                )
+                content = f.read()
+            digest = hashlib.sha256(content.encode('utf-8')).hexdigest()
+            if cached is not None and cached['sha256'] == digest:
+                self._apply_cache(cached)
+            else:
+                self._parse(json.loads(content))
 
         except json.JSONDecodeError as e:
             raise ValueError(f"Invalid JSON format in config file: {e}")
         except KeyError as e:
             raise ValueError(f"Missing required field in config file: {e}")
+        except TypeError as e:
+            raise ValueError(f"Unknown field in config file: {e}")
+
+        self._write_cache(stat, digest)
+
+    def _parse(self, config_data: Dict) -> None:
+        """Build and validate the configuration from its raw mapping."""
+        self.ssh_profiles = self._parse_ssh_profiles(
+            config_data.get('ssh_profiles', {}))
+
+        def password(device: Dict, required: bool) -> Optional[str]:
+            # A device authenticating with a key needs no password
+            profile = self.ssh_profiles.get(
+                device.get('ssh_profile', 'default'))
+            if required and (profile is None or profile.key_file is None):
+                return device['password']
+            return device.get('password')
+
+        esxi_servers = []
+        for server in config_data.get('esxi_servers', []):
+            strategy = server.get('vm_shutdown_strategy', 'guest')
+            if strategy not in VM_SHUTDOWN_STRATEGIES:
+                raise ValueError(
+                    f"Invalid vm_shutdown_strategy for {server['name']}: "
+                    f"{strategy}")
+
+            vms = [
+                VMConfig(
+                    name=vm['name'],
+                    ip=vm['ip'],
+                    username=(vm['username'] if strategy == 'guest'
+                              else vm.get('username')),
+                    password=password(vm, strategy == 'guest'),
+                    port=vm.get('port', 22),
+                    ssh_profile=vm.get('ssh_profile', 'default'),
+                    depends_on=vm.get('depends_on', []),
+                    priority=vm.get('priority', 0)
+                )
+                for vm in server.get('vms', [])
+            ]
+
+            esxi_servers.append(
+                ESXiConfig(
+                    name=server['name'],
+                    ip=server['ip'],
+                    username=server['username'],
+                    password=password(server, True),
+                    vms=vms,
+                    vm_shutdown_strategy=strategy,
+                    port=server.get('port', 22),
+                    ssh_profile=server.get('ssh_profile', 'default'),
+                    depends_on=server.get('depends_on', []),
+                    priority=server.get('priority', 0)
+                )
+            )
+
+        self.esxi_servers = esxi_servers
+        self._configured_servers = None
+        # Fail at load time rather than in the middle of a shutdown
+        self.build_shutdown_graph()
+
+        self.shutdown = self._parse_shutdown(config_data.get('shutdown', {}))
+        self.startup = self._parse_startup(config_data.get('startup', {}))
+        self.daemon = self._parse_daemon(config_data.get('daemon', {}))
+        self.report = self._parse_report(config_data.get('report', {}))
+        self.journal = self._parse_journal(config_data.get('journal', {}))
+        self.discovery = self._parse_discovery(config_data.get('discovery', {}))
+        self.distributed = self._parse_distributed(
+            config_data.get('distributed', {}))
+        self.logging = self._parse_logging(config_data.get('logging', {}))
+
+    def _read_cache(self) -> Optional[Dict]:
+        """Return the cached configuration, or None if there is none.
+
+        Unpickling runs code, so the cache is only read if both the file and
+        its directory belong to the effective user and are not writable by
+        anyone else.
+        """
+        if self.cache_path is None:
+            return None
+        try:
+            with open(self.cache_path, 'rb') as f:
+                if not (_is_private(os.fstat(f.fileno()))
+                        and _is_private(os.stat(self.cache_path.parent))):
+                    logging.warning(
+                        "Ignoring configuration cache %s: it or its directory "
+                        "is not owned by this user or is writable by others.",
+                        self.cache_path)
+                    return None
+                cached = pickle.load(f)
+            if (cached.get('format') == _CACHE_FORMAT
+                    and cached.get('config_path') == str(self.config_path)):
+                return cached
+        except Exception:
+            # A missing, truncated or outdated cache is simply rebuilt
+            pass
+        return None
+
+    def _apply_cache(self, cached: Dict) -> None:
+        self.esxi_servers = cached['esxi_servers']
+        self._configured_servers = None
+        self.ssh_profiles = cached['ssh_profiles']
+        self._shutdown_graph = cached['shutdown_graph']
+        self.shutdown = cached['shutdown']
+        self.startup = cached['startup']
+        self.daemon = cached['daemon']
+        self.report = cached['report']
+        self.journal = cached['journal']
+        self.discovery = cached['discovery']
+        self.distributed = cached['distributed']
+        self.logging = cached['logging']
+
+    def _write_cache(self, stat: os.stat_result, digest: str) -> None:
+        """Store the parsed configuration, keyed by the file it came from."""
+        if self.cache_path is None:
+            return
+        cached = {
+            'format': _CACHE_FORMAT,
+            'config_path': str(self.config_path),
+            'mtime_ns': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'sha256': digest,
+            'esxi_servers': self.esxi_servers,
+            'shutdown_graph': self.build_shutdown_graph(),
+            'ssh_profiles': self.ssh_profiles,
+            'shutdown': self.shutdown,
+            'startup': self.startup,
+            'daemon': self.daemon,
+            'report': self.report,
+            'journal': self.journal,
+            'discovery': self.discovery,
+            'distributed': self.distributed,
+            'logging': self.logging,
+        }
+        try:
+            self.cache_path.parent.mkdir(mode=0o700, parents=True,
+                                         exist_ok=True)
+            # mkstemp creates the file readable by its owner only
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_path.parent,
+                                            prefix=self.cache_path.name)
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(cached, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.cache_path)
+        except OSError:
+            # The cache only speeds up the next load
+            pass
+
+    @staticmethod
+    def _parse_ssh_profiles(profiles_data: Dict) -> Dict[str, SSHProfile]:
+        """Parse the optional ssh_profiles section of the configuration.
+
+        Args:
+            profiles_data: Raw ``ssh_profiles`` mapping from the config file
+
+        Returns:
+            Dict[str, SSHProfile]: Profiles by name, always with a
+            ``default`` profile used by devices naming none
+        """
+        profiles = {'default': SSHProfile()}
+        for name, profile_data in profiles_data.items():
+            profile = SSHProfile(**profile_data)
+            for field_name in ('key_file', 'key_passphrase', 'known_hosts'):
+                value = getattr(profile, field_name)
+                if value is not None and (not isinstance(value, str)
+                                          or not value):
+                    raise ValueError(f"Invalid value for ssh_profiles.{name}."
+                                     f"{field_name}: {value}")
+            for field_name in ('kex', 'ciphers', 'macs', 'key_types'):
+                value = getattr(profile, field_name)
+                if (not isinstance(value, list)
+                        or not all(isinstance(item, str) for item in value)):
+                    raise ValueError(f"Invalid value for ssh_profiles.{name}."
+                                     f"{field_name}: {value}")
+            for field_name in ('compress', 'strict_host_keys'):
+                value = getattr(profile, field_name)
+                if not isinstance(value, bool):
+                    raise ValueError(f"Invalid value for ssh_profiles.{name}."
+                                     f"{field_name}: {value}")
+            if profile.strict_host_keys and profile.known_hosts is None:
+                raise ValueError(f"ssh_profiles.{name}.strict_host_keys "
+                                 "requires known_hosts")
+            profiles[name] = profile
+        return profiles
+
+    @staticmethod
+    def _parse_shutdown(shutdown_data: Dict) -> ShutdownConfig:
+        """Parse the optional shutdown section of the configuration.
+
+        Args:
+            shutdown_data: Raw ``shutdown`` mapping from the config file
+
+        Returns:
+            ShutdownConfig: Parsed settings, with defaults for missing keys
+        """
+        shutdown = ShutdownConfig(**shutdown_data)
+        for field_name in ('max_workers', 'per_host_workers', 'processes',
+                           'retry_attempts', 'breaker_threshold'):
+            value = getattr(shutdown, field_name)
+            if not isinstance(value, int) or value < 1:
+                raise ValueError(
+                    f"Invalid value for shutdown.{field_name}: {value}")
+        if shutdown.probe_mode not in ('tcp', 'icmp'):
+            raise ValueError(
+                f"Invalid value for shutdown.probe_mode: {shutdown.probe_mode}")
+        for field_name in ('vm_poweroff_timeout', 'poll_interval',
+                           'probe_timeout', 'connect_timeout', 'auth_timeout',
+                           'exec_timeout', 'esxi_reserve', 'hard_off_reserve',
+                           'retry_base_delay', 'retry_max_delay'):
+            value = getattr(shutdown, field_name)
+            if not isinstance(value, (int, float)) or value <= 0:
+                raise ValueError(
+                    f"Invalid value for shutdown.{field_name}: {value}")
+        if shutdown.retry_max_delay < shutdown.retry_base_delay:
+            raise ValueError("shutdown.retry_max_delay must not be shorter "
+                             "than shutdown.retry_base_delay")
+        return shutdown
+
+    @staticmethod
+    def _parse_startup(startup_data: Dict) -> StartupConfig:
+        """Parse the optional startup section of the configuration.
+
+        Args:
+            startup_data: Raw ``startup`` mapping from the config file
+
+        Returns:
+            StartupConfig: Parsed settings, with defaults for missing keys
+        """
+        startup = StartupConfig(**startup_data)
+        for field_name in ('host_timeout', 'ready_timeout', 'poll_interval'):
+            value = getattr(startup, field_name)
+            if not isinstance(value, (int, float)) or value <= 0:
+                raise ValueError(
+                    f"Invalid value for startup.{field_name}: {value}")
+        return startup
+
+    @staticmethod
+    def _parse_daemon(daemon_data: Dict) -> DaemonConfig:
+        """Parse the optional daemon section of the configuration.
+
+        Args:
+            daemon_data: Raw ``daemon`` mapping from the config file
+
+        Returns:
+            DaemonConfig: Parsed settings, with defaults for missing keys
+        """
+        daemon = DaemonConfig(**daemon_data)
+        for field_name in ('keepalive_interval', 'refresh_interval'):
+            value = getattr(daemon, field_name)
+            if not isinstance(value, (int, float)) or value <= 0:
+                raise ValueError(
+                    f"Invalid value for daemon.{field_name}: {value}")
+        return daemon
+
+    @staticmethod
+    def _parse_report(report_data: Dict) -> ReportConfig:
+        """Parse the optional report section of the configuration.
+
+        Args:
+            report_data: Raw ``report`` mapping from the config file
+
+        Returns:
+            ReportConfig: Parsed settings, with defaults for missing keys
+        """
+        report = ReportConfig(**report_data)
+        for field_name in ('json_file', 'prometheus_file', 'startup_json_file',
+                           'startup_prometheus_file', 'history_file'):
+            value = getattr(report, field_name)
+            if value is not None and (not isinstance(value, str) or not value):
+                raise ValueError(
+                    f"Invalid value for report.{field_name}: {value}")
+        return report
+
+    @staticmethod
+    def _parse_journal(journal_data: Dict) -> JournalConfig:
+        """Parse the optional journal section of the configuration.
+
+        Args:
+            journal_data: Raw ``journal`` mapping from the config file
+
+        Returns:
+            JournalConfig: Parsed settings, with defaults for missing keys
+        """
+        journal = JournalConfig(**journal_data)
+        for field_name in ('file', 'lock_file'):
+            value = getattr(journal, field_name)
+            if value is not None and (not isinstance(value, str) or not value):
+                raise ValueError(
+                    f"Invalid value for journal.{field_name}: {value}")
+        if (not isinstance(journal.resume_window, (int, float))
+                or journal.resume_window <= 0):
+            raise ValueError(f"Invalid value for journal.resume_window: "
+                             f"{journal.resume_window}")
+        return journal
+
+    @staticmethod
+    def _parse_discovery(discovery_data: Dict) -> DiscoveryConfig:
+        """Parse the optional discovery section of the configuration.
+
+        Args:
+            discovery_data: Raw ``discovery`` mapping from the config file
+
+        Returns:
+            DiscoveryConfig: Parsed settings, with defaults for missing keys
+        """
+        discovery = DiscoveryConfig(**discovery_data)
+        if not isinstance(discovery.enabled, bool):
+            raise ValueError(
+                f"Invalid value for discovery.enabled: {discovery.enabled}")
+        if not isinstance(discovery.cache_file, str) or not discovery.cache_file:
+            raise ValueError(f"Invalid value for discovery.cache_file: "
+                             f"{discovery.cache_file}")
+        for field_name in ('ttl', 'refresh_interval'):
+            value = getattr(discovery, field_name)
+            if not isinstance(value, (int, float)) or value <= 0:
+                raise ValueError(
+                    f"Invalid value for discovery.{field_name}: {value}")
+        return discovery
+
+    @staticmethod
+    def _parse_distributed(distributed_data: Dict) -> DistributedConfig:
+        """Parse the optional distributed section of the configuration.
+
+        Args:
+            distributed_data: Raw ``distributed`` mapping from the config file
+
+        Returns:
+            DistributedConfig: Parsed settings, with defaults for missing keys
+        """
+        distributed = DistributedConfig(**distributed_data)
+        if not isinstance(distributed.host, str) or not distributed.host:
+            raise ValueError(
+                f"Invalid value for distributed.host: {distributed.host}")
+        for field_name in ('port', 'agents'):
+            value = getattr(distributed, field_name)
+            if not isinstance(value, int) or value < 1:
+                raise ValueError(
+                    f"Invalid value for distributed.{field_name}: {value}")
+        for field_name in ('join_timeout', 'heartbeat_interval',
+                           'agent_timeout'):
+            value = getattr(distributed, field_name)
+            if not isinstance(value, (int, float)) or value <= 0:
+                raise ValueError(
+                    f"Invalid value for distributed.{field_name}: {value}")
+        if distributed.secret is not None and (
+                not isinstance(distributed.secret, str)
+                or not distributed.secret):
+            raise ValueError("Invalid value for distributed.secret")
+        if distributed.agent_timeout <= distributed.heartbeat_interval:
+            raise ValueError("distributed.agent_timeout must be longer than "
+                             "distributed.heartbeat_interval")
+        return distributed
+
+    @staticmethod
+    def _parse_logging(logging_data: Dict) -> LoggingConfig:
+        """Parse the optional logging section of the configuration.
+
+        Args:
+            logging_data: Raw ``logging`` mapping from the config file
+
+        Returns:
+            LoggingConfig: Parsed settings, with defaults for missing keys
+        """
+        logging_data = dict(logging_data)
+        levels = dict(LoggingConfig().levels)
+        levels.update(logging_data.pop('levels', {}))
+        settings = LoggingConfig(levels=levels, **logging_data)
+        if settings.format not in LOG_FORMATS:
+            raise ValueError(
+                f"Invalid value for logging.format: {settings.format}")
+        for field_name in ('max_bytes', 'backup_count'):
+            value = getattr(settings, field_name)
+            if not isinstance(value, int) or value < 0:
+                raise ValueError(
+                    f"Invalid value for logging.{field_name}: {value}")
+        for name, level in [('level', settings.level)] + [
+                (f"levels.{logger}", level)
+                for logger, level in settings.levels.items()]:
+            if not (isinstance(level, str)
+                    and isinstance(logging.getLevelName(level.upper()), int)):
+                raise ValueError(
+                    f"Invalid value for logging.{name}: {level}")
+        settings.level = settings.level.upper()
+        settings.levels = {logger: level.upper()
+                           for logger, level in settings.levels.items()}
+        return settings
+
+    def build_startup_graph(self) -> Dict[DeviceKey, Set[DeviceKey]]:
+        """Build the startup dependency graph of the infrastructure.
+
+        The shutdown graph reversed: every device is mapped to the devices
+        that must be up before it is started, so an ESXi server comes
+        before its VMs and a device after the devices in its ``depends_on``.
+
+        Returns:
+            Dict[DeviceKey, Set[DeviceKey]]: Prerequisites of every device
+        """
+        graph: Dict[DeviceKey, Set[DeviceKey]] = {
+            key: set() for key in self.build_shutdown_graph()}
+        for key, prerequisites in self.build_shutdown_graph().items():
+            for prerequisite in prerequisites:
+                graph[prerequisite].add(key)
+        return graph
+
+    def build_shutdown_graph(self) -> Dict[DeviceKey, Set[DeviceKey]]:
+        """Build the shutdown dependency graph of the infrastructure.
+
+        The graph is built once per assignment of ``esxi_servers``.
+
+        Every device is mapped to the devices that must be down before it is
+        shut down: the VMs of an ESXi server come before the server, a device
+        comes before the devices listed in its ``depends_on``, and a VM (or
+        ESXi server) comes after every VM (or ESXi server) of the next lower
+        ``priority``.
+
+        Returns:
+            Dict[DeviceKey, Set[DeviceKey]]: Prerequisites of every device
+
+        Raises:
+            ValueError: If a dependency is unknown, ambiguous or circular
+        """
+        if self._shutdown_graph is not None:
+            return self._shutdown_graph
+
+        graph: Dict[DeviceKey, Set[DeviceKey]] = {}
+        by_name: Dict[str, List[DeviceKey]] = {}
+        devices = []
+        for server in self.esxi_servers:
+            graph[(server.name, None)] = {(server.name, vm.name)
+                                          for vm in server.vms}
+            by_name.setdefault(server.name, []).append((server.name, None))
+            devices.append(((server.name, None), server))
+            for vm in server.vms:
+                graph[(server.name, vm.name)] = set()
+                by_name.setdefault(vm.name, []).append((server.name, vm.name))
+                devices.append(((server.name, vm.name), vm))
+
+        for key, device in devices:
+            if not isinstance(device.port, int) or not 0 < device.port < 65536:
+                raise ValueError(f"Invalid port for {device.name}: {device.port}")
+            if device.ssh_profile not in self.ssh_profiles:
+                raise ValueError(
+                    f"Unknown ssh_profile of {device.name}: {device.ssh_profile}")
+            if not isinstance(device.priority, int):
+                raise ValueError(
+                    f"Invalid priority for {device.name}: {device.priority}")
+            if (not isinstance(device.depends_on, list)
+                    or not all(isinstance(name, str)
+                               for name in device.depends_on)):
+                raise ValueError(
+                    f"Invalid depends_on for {device.name}: {device.depends_on}")
+            for name in device.depends_on:
+                matches = by_name.get(name, [])
+                if len(matches) != 1:
+                    problem = "Ambiguous" if matches else "Unknown"
+                    raise ValueError(
+                        f"{problem} dependency of {device.name}: {name}")
+                # The needed device goes down after the one needing it
+                graph[matches[0]].add(key)
+
+        for is_server in (True, False):
+            levels: Dict[int, List[DeviceKey]] = {}
+            for key, device in devices:
+                if (key[1] is None) == is_server:
+                    levels.setdefault(device.priority, []).append(key)
+            ordered = sorted(levels)
+            for lower, higher in zip(ordered, ordered[1:]):
+                for key in levels[higher]:
+                    graph[key].update(levels[lower])
+
+        cycle = self._find_cycle(graph)
+        if cycle:
+            raise ValueError("Circular shutdown dependency: " + " -> ".join(
+                vm_name or server_name for server_name, vm_name in cycle))
+        self._shutdown_graph = graph
+        return graph
+
+    @staticmethod
+    def _find_cycle(graph: Dict[DeviceKey, Set[DeviceKey]]) -> List[DeviceKey]:
+        """Return one cycle of the graph, or an empty list if it has none."""
+        visiting, done = [], set()
+
+        def visit(key):
+            if key in done:
+                return []
+            if key in visiting:
+                return visiting[visiting.index(key):] + [key]
+            visiting.append(key)
+            for prerequisite in graph[key]:
+                cycle = visit(prerequisite)
+                if cycle:
+                    return cycle
+            visiting.pop()
+            done.add(key)
+            return []
+
+        for key in graph:
+            cycle = visit(key)
+            if cycle:
+                return cycle
+        return []
+
+    def merge_inventory(self, inventory: Dict[str, Dict[str, Optional[str]]]) -> None:
+        """Merge the VMs discovered on the ESXi servers into the inventory.
+
+        Discovered VMs missing from the configuration file are added to the
+        server they run on, without guest credentials: they are shut down
+        from their ESXi server. A configured VM keeps its settings, but is
+        moved to the server it was discovered on if its own server no longer
+        runs it. Servers missing from the inventory keep their configured
+        VMs. Every merge starts over from the configuration file, so VMs
+        gone from a later discovery are dropped again.
+
+        Args:
+            inventory: Guest IP (None if unknown) of every discovered VM by
+                VM name, by ESXi server name
+
+        Raises:
+            ValueError: If the merged inventory has no valid shutdown graph,
+                in which case the inventory is left as it was
+        """
+        if self._configured_servers is None:
+            self._configured_servers = self.esxi_servers
+        configured = self._configured_servers
+        configured_names = {vm.name for server in configured
+                            for vm in server.vms}
+        discovered_on: Dict[str, List[str]] = {}
+        for server_name, vms in inventory.items():
+            for vm_name in vms:
+                discovered_on.setdefault(vm_name, []).append(server_name)
+
+        merged = {server.name: [] for server in configured}
+        for server in configured:
+            for vm in server.vms:
+                destination = server.name
+                hosts = [name for name in discovered_on.get(vm.name, [])
+                         if name in merged]
+                if (server.name in inventory and server.name not in hosts
+                        and len(hosts) == 1):
+                    destination = hosts[0]
+                    logging.info("VM %s moved from ESXi server %s to %s.",
+                                 vm.name, server.name, destination)
+                merged[destination].append(vm)
+        for server in configured:
+            for vm_name, ip in inventory.get(server.name, {}).items():
+                if vm_name not in configured_names:
+                    merged[server.name].append(VMConfig(name=vm_name, ip=ip))
+
+        previous = self.esxi_servers
+        self.esxi_servers = [replace(server, vms=merged[server.name])
+                             for server in configured]
+        try:
+            self.build_shutdown_graph()
+        except ValueError:
+            self.esxi_servers = previous
+            raise
+
+    def ssh_profiles_by_address(self) -> Dict[Tuple[str, int], SSHProfile]:
+        """Return the SSH profile of every device by ``(ip, port)``."""
+        profiles = {}
+        for server in self.esxi_servers:
+            for device in [server] + server.vms:
+                if device.ip is None:
+                    continue
+                profiles.setdefault((device.ip, device.port),
+                                    self.ssh_profiles[device.ssh_profile])
+        return profiles
 
     def get_server_by_name(self, server_name: str) -> Optional[ESXiConfig]:
         """Get server configuration by server name."""
-        return next((server for server in self.esxi_servers
-                    if server.name == server_name), None)
+        return self._servers_by_name.get(server_name)
 
     def get_vm_by_name(self, server_name: str, vm_name: str) -> Optional[VMConfig]:
         """Get VM configuration by server name and VM name."""
-        server = self.get_server_by_name(server_name)
-        if server:
-            return next((vm for vm in server.vms if vm.name == vm_name), None)
-        return None
+        return self._vms_by_name.get((server_name, vm_name))
+
+    def get_host_of_vm(self, vm_name: str) -> Optional[ESXiConfig]:
+        """Get the configuration of the ESXi server hosting a VM."""
+        return self._hosts_by_vm.get(vm_name)
+
+    def get_device_by_ip(self, ip: str) -> Optional[Union[ESXiConfig, VMConfig]]:
+        """Get the ESXi server or VM configuration with the given IP."""
+        return self._devices_by_ip.get(ip)
 
     def display_all_servers(self, show_passwords: bool = False) -> None:
         """Display all ESXi servers and their VMs in a formatted table.
@@ -87,6 +863,8 @@ class ConfigManager:
         Args:
             show_passwords: Whether to display password information
         """
+        from tabulate import tabulate
+
         print("\n=== ESXi Servers Configuration ===\n")
 
         for server in self.esxi_servers:
@@ -123,6 +901,8 @@ class ConfigManager:
             server_name: Name of the server to display
             show_passwords: Whether to display password information
         """
+        from tabulate import tabulate
+
         server = self.get_server_by_name(server_name)
         if not server:
             print(f"Server '{server_name}' not found in configuration.")
@@ -158,6 +938,8 @@ class ConfigManager:
 
     def get_servers_summary(self) -> None:
         """Display a summary of all ESXi servers and their VM counts."""
+        from tabulate import tabulate
+
         print("\n=== ESXi Servers Summary ===\n")
 
         headers = ["Server Name", "IP", "Total VMs"]
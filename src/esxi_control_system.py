@@ -1,15 +1,23 @@
 import os
 import sys
+import time
 import argparse
 import logging
-import time
-from typing import List, Tuple
-from config_manager.config_manager import ConfigManager
-from remote_manager.remote_manager import RemoteDeviceManager
+# Startup time is battery time: the configuration, orchestration and SSH
+# modules (paramiko and its cryptography stack) are imported by the code
+# paths that use them, so signalling a running daemon never loads them.
+from infrastructure_manager.daemon import (DAEMON_TIMEOUT, PING_COMMAND,
+                                          SHUTDOWN_COMMAND, send_daemon_command)
 
 
 LOG_FILE = "logs/esxi_control_system.logs"
 CONF_FILE = "conf/conf.json"
+CONF_CACHE_FILE = "run/conf.cache"
+SOCKET_FILE = "run/esxi_control_system.sock"
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+
+# File handler fed by the background logging thread, see configure_logging
+_log_handler = None
 
 
 # Determine the directory where the executable is located
@@ -18,18 +26,81 @@ if getattr(sys, 'frozen', False):  # Check if running as a PyInstaller bundled e
 else:  # Running in a regular Python environment
     base_dir = os.path.dirname(os.path.abspath(__file__))
 
-# Ensure the logs directory exists
-log_dir = os.path.dirname(LOG_FILE)
-if not os.path.exists(log_dir):
-    print(f'[-] Error: logs directory does not exists.')
-    sys.exit(0)
 
-# Configure logging
-logging.basicConfig(
-    filename=LOG_FILE,
-    level=logging.DEBUG,
-    format="%(asctime)s - %(levelname)s - %(message)s"
-)
+class JsonLineFormatter(logging.Formatter):
+    """Format every record as a single line JSON object."""
+
+    def __init__(self):
+        super().__init__()
+        import json
+        self._dumps = json.dumps
+
+    def format(self, record):
+        created = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created))
+        entry = {
+            "time": f"{created}.{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return self._dumps(entry)
+
+
+def configure_logging():
+    """Log to the log file, exiting if its directory does not exist.
+
+    Threads only put their records on a queue; a single listener thread
+    writes them to the log file, so no shutdown worker ever waits for the
+    disk or for another thread's write. The file starts unrotated in the
+    text format until ``apply_logging_settings`` is given the configuration.
+    """
+    global _log_handler
+    import atexit
+    import queue
+    import logging.handlers
+
+    log_dir = os.path.dirname(LOG_FILE)
+    if not os.path.exists(log_dir):
+        print(f'[-] Error: logs directory does not exists.')
+        sys.exit(0)
+
+    _log_handler = logging.handlers.RotatingFileHandler(LOG_FILE)
+    _log_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(
+        records, _log_handler, respect_handler_level=True)
+    listener.start()
+    # Stopping drains the queue, no record is lost at exit
+    atexit.register(listener.stop)
+
+    root = logging.getLogger()
+    root.setLevel(logging.DEBUG)
+    root.addHandler(logging.handlers.QueueHandler(records))
+
+
+def apply_logging_settings(settings):
+    """Apply the logging section of the configuration.
+
+    Args:
+        settings: The ``LoggingConfig`` of the loaded configuration
+    """
+    logging.getLogger().setLevel(settings.level)
+    for name, level in settings.levels.items():
+        logging.getLogger(name).setLevel(level)
+
+    if _log_handler is None:
+        return
+    _log_handler.acquire()
+    try:
+        _log_handler.maxBytes = settings.max_bytes
+        _log_handler.backupCount = settings.backup_count
+        _log_handler.setFormatter(JsonLineFormatter() if settings.format == "json"
+                                  else logging.Formatter(LOG_FORMAT))
+    finally:
+        _log_handler.release()
 
 
 def get_command_line_arguments():
@@ -53,74 +124,409 @@ def get_command_line_arguments():
         required=False
     )
 
-    return parser.parse_args()
+    parser.add_argument(
+        "-d", "--daemon",
+        help="Run as a warm-standby daemon that keeps SSH sessions to every device "
+             "open and shuts the infrastructure down when triggered with -s.",
+        action="store_true",
+        required=False
+    )
 
+    parser.add_argument(
+        "--startup",
+        help="Bring the infrastructure back up after an outage: wait for every "
+             "ESXi server to accept SSH sessions, then power its VMs on in the "
+             "reverse order of the shutdown.",
+        action="store_true",
+        required=False
+    )
 
-def shutdown_infrastructure(wait_time: int = 20) -> bool:
-    """Shutdown all VMs and ESXi servers in the correct order.
+    parser.add_argument(
+        "--coordinator",
+        help="Shut the infrastructure down from several controllers: wait for "
+             "the agents configured in the distributed section, split the ESXi "
+             "servers between them and reassign those of agents that go quiet.",
+        action="store_true",
+        required=False
+    )
+
+    parser.add_argument(
+        "--agent",
+        help="Run as the named agent of a distributed shutdown: wait for the "
+             "coordinator, then shut down the ESXi servers it assigns.",
+        metavar="NAME",
+        default=None
+    )
+
+    parser.add_argument(
+        "--plan",
+        help="Predict the shutdown without contacting any device: simulate it "
+             "under the concurrency settings with the latencies of earlier "
+             "runs and print the predicted duration, the critical path and "
+             "the devices that put the --deadline at risk.",
+        action="store_true",
+        required=False
+    )
+
+    parser.add_argument(
+        "--discover",
+        help="Discover the VMs of every ESXi server and refresh the inventory "
+             "snapshot that shutdowns merge with the configuration file.",
+        action="store_true",
+        required=False
+    )
+
+    parser.add_argument(
+        "-w", "--max-workers",
+        help="Maximum number of devices processed concurrently "
+             "(overrides shutdown.max_workers in the configuration file).",
+        type=int,
+        default=None
+    )
+
+    parser.add_argument(
+        "--per-host-workers",
+        help="Maximum number of VMs processed concurrently on a single ESXi server "
+             "(overrides shutdown.per_host_workers in the configuration file).",
+        type=int,
+        default=None
+    )
+
+    parser.add_argument(
+        "-p", "--processes",
+        help="Number of worker processes the ESXi servers are split between, "
+             "for fleets too large for a single process "
+             "(overrides shutdown.processes in the configuration file).",
+        type=int,
+        default=None
+    )
+
+    parser.add_argument(
+        "--deadline",
+        help="Seconds the whole shutdown may take, for example the remaining UPS "
+             "runtime. VMs still running near the end are hard powered off from "
+             "their ESXi server so that every ESXi server is powered off in time.",
+        type=float,
+        default=None
+    )
+
+    return parser.parse_args()
 
-    Args:
-        wait_time: Time to wait between VM shutdown and ESXi shutdown (seconds)
+
+def load_configuration():
+    """Load the configuration file and apply its remote operation settings.
 
     Returns:
-        bool: True if shutdown was successful, False if critical errors occurred
+        ConfigManager: The loaded configuration, or None if it could not be loaded
     """
+    from config_manager.config_manager import ConfigManager
+    from remote_manager.remote_manager import RemoteDeviceManager
+
     try:
-        config = ConfigManager(CONF_FILE)
+        config = ConfigManager(CONF_FILE, cache_path=CONF_CACHE_FILE)
         config.load_config()
+        RemoteDeviceManager.configure_ssh_profiles(
+            config.ssh_profiles_by_address())
     except Exception as e:
         logging.error("Failed to load configuration: %s", str(e))
-        return False
+        return None
 
-    shutdown_results: List[Tuple[str, bool]] = []
-    critical_error = False
+    apply_logging_settings(config.logging)
+    RemoteDeviceManager.configure_timeouts(
+        connect=config.shutdown.connect_timeout,
+        auth=config.shutdown.auth_timeout,
+        exec_timeout=config.shutdown.exec_timeout
+    )
+    return config
+
+
+def shutdown_infrastructure(max_workers: int = None,
+                            per_host_workers: int = None,
+                            deadline: float = None,
+                            processes: int = None) -> bool:
+    """Shutdown all VMs and ESXi servers in the correct order.
 
-    # First, shutdown all VMs across all ESXi servers
-    logging.info("Starting VM shutdown sequence...")
-    for server in config.esxi_servers:
-        logging.info("Processing VMs on ESXi server: %s", server.name)
+    Args:
+        max_workers: Global concurrency limit, defaults to the configuration
+        per_host_workers: Per ESXi server concurrency limit, defaults to the configuration
+        deadline: Seconds the whole shutdown may take, unlimited if None
+        processes: Number of worker processes, defaults to the configuration
 
-        for vm in server.vms:
-            logging.info("Attempting to shutdown VM: %s (%s)",
-                         vm.name, vm.ip)
-            success = RemoteDeviceManager.poweroff_ubuntu_vm(
-                vm.ip, vm.username, vm.password
+    Returns:
+        bool: True if shutdown was successful, False if critical errors occurred
+    """
+    loading = time.monotonic()
+    config = load_configuration()
+    if config is None:
+        return False
+    load_seconds = time.monotonic() - loading
+
+    from infrastructure_manager.discovery import apply_inventory
+    from infrastructure_manager.infrastructure_manager import InfrastructureManager
+    from infrastructure_manager.journal import serialized_run
+    from remote_manager.remote_manager import RemoteDeviceManager
+
+    # The snapshot is only read, discoveries run ahead of the shutdown
+    apply_inventory(config)
+    waiting = time.monotonic()
+    # A second run waits for the first one, then resumes it if it crashed
+    # or returns its result if it finished
+    with serialized_run(config.journal) as journal:
+        if journal is not None and journal.completed is not None:
+            logging.info("A shutdown finished less than %s seconds ago, not "
+                         "running it again.", config.journal.resume_window)
+            return journal.completed
+        if deadline is not None:
+            deadline = max(deadline - (time.monotonic() - waiting), 0.0)
+        processes = processes or config.shutdown.processes
+        if processes > 1:
+            from infrastructure_manager.sharding import ShardedInfrastructureManager
+            manager = ShardedInfrastructureManager(
+                config, RemoteDeviceManager, processes,
+                max_workers=max_workers,
+                per_host_workers=per_host_workers,
+                journal=journal
             )
-            shutdown_results.append((f"VM {vm.name}", success))
-
-            if not success:
-                logging.warning(
-                    "Failed to shutdown VM: %s (%s)", vm.name, vm.ip
-                )
-
-    # Wait for VMs to shutdown completely
-    logging.info(
-        "Waiting %s seconds for VMs to shutdown completely...", wait_time)
-    time.sleep(wait_time)
-
-    # Then, shutdown ESXi servers
-    logging.info("Starting ESXi servers shutdown sequence...")
-    for server in config.esxi_servers:
-        logging.info("Attempting to shutdown ESXi server: %s", server.name)
-        success = RemoteDeviceManager.poweroff_esxi_server(
-            server.ip, server.username, server.password
-        )
-        shutdown_results.append((f"ESXi {server.name}", success))
-
-        if not success:
-            logging.error(
-                "Failed to shutdown ESXi server: %s (%s)",
-                server.name, server.ip
+        else:
+            manager = InfrastructureManager(
+                config, RemoteDeviceManager,
+                max_workers=max_workers,
+                per_host_workers=per_host_workers,
+                journal=journal
             )
-            critical_error = True
+        success = manager.shutdown(deadline=deadline)
+        if journal is not None:
+            journal.complete(success)
+    manager.report.phases['load_config'] = load_seconds
+    manager.report.write(config.report.json_file,
+                         config.report.prometheus_file)
+    if config.report.history_file is not None:
+        from infrastructure_manager.plan import LatencyHistory
+        LatencyHistory(config.report.history_file).update(manager.report)
+    return success
+
+
+def plan_shutdown(max_workers: int = None, per_host_workers: int = None,
+                  deadline: float = None, processes: int = None) -> bool:
+    """Predict the shutdown from the latencies of earlier runs, offline.
+
+    Prints the plan as JSON: the predicted wall time, the critical path and
+    the devices at risk. No device is contacted.
+
+    Args:
+        max_workers: Global concurrency limit, defaults to the configuration
+        per_host_workers: Per ESXi server concurrency limit, defaults to the configuration
+        deadline: Seconds the shutdown may take, for example the UPS runtime
+        processes: Number of worker processes, defaults to the configuration
+
+    Returns:
+        bool: False if the plan does not fit within the deadline or the
+        configuration could not be loaded, True otherwise
+    """
+    config = load_configuration()
+    if config is None:
+        return False
+
+    import json
+    from infrastructure_manager.discovery import apply_inventory
+    from infrastructure_manager.plan import LatencyHistory, ShutdownPlanner
+
+    apply_inventory(config)
+    plan = ShutdownPlanner(
+        config, LatencyHistory(config.report.history_file),
+        max_workers=max_workers, per_host_workers=per_host_workers,
+        processes=processes).plan(deadline=deadline)
+    print(json.dumps(plan.to_dict(), indent=2))
+    return plan.fits is not False
+
+
+def startup_infrastructure(max_workers: int = None) -> bool:
+    """Power the infrastructure back on in dependency order.
+
+    Args:
+        max_workers: Global concurrency limit, defaults to the configuration
+
+    Returns:
+        bool: True if every device came back up, False otherwise
+    """
+    loading = time.monotonic()
+    config = load_configuration()
+    if config is None:
+        return False
+    load_seconds = time.monotonic() - loading
+
+    from infrastructure_manager.discovery import apply_inventory
+    from infrastructure_manager.journal import serialized_run
+    from infrastructure_manager.startup import StartupManager
+    from remote_manager.remote_manager import RemoteDeviceManager
+
+    # VMs that were running before the outage, however old the snapshot
+    apply_inventory(config, startup=True)
+    # Never powers on what a running shutdown is taking down
+    with serialized_run(config.journal) as journal:
+        if journal is not None:
+            journal.reset()
+        manager = StartupManager(config, RemoteDeviceManager,
+                                 max_workers=max_workers)
+        success = manager.startup()
+    manager.report.phases['load_config'] = load_seconds
+    manager.report.write(config.report.startup_json_file,
+                         config.report.startup_prometheus_file)
+    return success
+
+
+def coordinate_shutdown(deadline: float = None) -> bool:
+    """Shutdown the infrastructure from the agents of a distributed run.
+
+    Falls back to an in-process shutdown when no agent joins.
+
+    Args:
+        deadline: Seconds the whole shutdown may take, unlimited if None
+
+    Returns:
+        bool: True if shutdown was successful, False if critical errors occurred
+    """
+    started = time.monotonic()
+    config = load_configuration()
+    if config is None:
+        return False
+
+    from infrastructure_manager.discovery import apply_inventory
+    from infrastructure_manager.distributed import DistributedCoordinator
+
+    apply_inventory(config)
+    coordinator = DistributedCoordinator(config)
+    coordinator.listen()
+    if not coordinator.wait_for_agents():
+        coordinator.close()
+        logging.warning("No agent joined, shutting down in-process.")
+        if deadline is not None:
+            deadline = max(deadline - (time.monotonic() - started), 0.0)
+        return shutdown_infrastructure(deadline=deadline)
+    if deadline is not None:
+        deadline = max(deadline - (time.monotonic() - started), 0.0)
+    success = coordinator.shutdown(deadline=deadline)
+    coordinator.report.write(config.report.json_file,
+                             config.report.prometheus_file)
+    if config.report.history_file is not None:
+        from infrastructure_manager.plan import LatencyHistory
+        LatencyHistory(config.report.history_file).update(coordinator.report)
+    return success
+
+
+def run_agent(name: str, max_workers: int = None,
+              per_host_workers: int = None) -> bool:
+    """Run as an agent of a distributed shutdown until the coordinator is done.
 
-    # Log summary
-    logging.info("\nShutdown Summary:")
-    for device, success in shutdown_results:
-        status = "SUCCESS" if success else "FAILED"
-        logging.info("%s: %s", device, status)
+    Args:
+        name: Name of the agent, unique among the agents
+        max_workers: Concurrency limit of every assignment, defaults to the configuration
+        per_host_workers: Per ESXi server concurrency limit, defaults to the configuration
+
+    Returns:
+        bool: True if every assigned server was shut down, False otherwise
+    """
+    config = load_configuration()
+    if config is None:
+        return False
+
+    from infrastructure_manager.discovery import apply_inventory
+    from infrastructure_manager.distributed import ShutdownAgent
+    from remote_manager.remote_manager import RemoteDeviceManager
+
+    apply_inventory(config)
+    return ShutdownAgent(config, RemoteDeviceManager, name,
+                         max_workers=max_workers,
+                         per_host_workers=per_host_workers).serve()
+
+
+def discover_inventory() -> bool:
+    """Discover the VMs of every ESXi server and refresh the inventory snapshot.
+
+    Returns:
+        bool: True if every ESXi server was discovered, False otherwise
+    """
+    config = load_configuration()
+    if config is None:
+        return False
+
+    from infrastructure_manager.discovery import InventoryCache
+    from remote_manager.remote_manager import RemoteDeviceManager
+
+    settings = config.discovery
+    if not settings.enabled:
+        logging.warning("Discovery is disabled in the configuration, the "
+                        "snapshot is refreshed but not used by shutdowns.")
+    try:
+        discovered = InventoryCache(settings.cache_file, settings.ttl).refresh(
+            config, RemoteDeviceManager,
+            max_workers=config.shutdown.max_workers)
+    finally:
+        RemoteDeviceManager.close_all_connections()
+    return len(discovered) == len(config.esxi_servers)
+
+
+def run_daemon() -> bool:
+    """Run the warm-standby daemon until it has shut the infrastructure down.
+
+    Returns:
+        bool: False if the daemon could not be started, True otherwise
+    """
+    config = load_configuration()
+    if config is None:
+        return False
+
+    from infrastructure_manager.daemon import ShutdownDaemon
+    from infrastructure_manager.discovery import apply_inventory
+    from remote_manager.remote_manager import RemoteDeviceManager
+
+    # Serves the snapshot left by earlier discoveries until its own first one
+    apply_inventory(config)
+    ShutdownDaemon(config, RemoteDeviceManager, SOCKET_FILE).serve_forever()
+    return True
+
+
+def trigger_shutdown(max_workers: int = None, per_host_workers: int = None,
+                     deadline: float = None, processes: int = None) -> bool:
+    """Shutdown the infrastructure through the daemon, or in-process without one.
+
+    Args:
+        max_workers: Global concurrency limit, defaults to the configuration
+        per_host_workers: Per ESXi server concurrency limit, defaults to the configuration
+        deadline: Seconds the whole shutdown may take, unlimited if None
+        processes: Number of worker processes without a daemon, defaults
+            to the configuration
+
+    Returns:
+        bool: True if shutdown was successful, False if critical errors occurred
+    """
+    started = time.monotonic()
+    # A daemon that cannot answer a PING would hold the shutdown forever
+    if send_daemon_command(SOCKET_FILE, PING_COMMAND) == "PONG":
+        command = SHUTDOWN_COMMAND
+        timeout = None
+        if deadline is not None:
+            deadline = max(deadline - (time.monotonic() - started), 0.0)
+            command = f"{SHUTDOWN_COMMAND} {deadline:.3f}"
+            timeout = deadline + DAEMON_TIMEOUT
+        reply = send_daemon_command(SOCKET_FILE, command, timeout=timeout)
+        if reply is None:
+            # The daemon is most likely still shutting down, a second run
+            # would only queue behind it on the run lock
+            logging.error("The daemon on %s did not report the outcome of "
+                          "the shutdown in time.", SOCKET_FILE)
+            return False
+        logging.info("Shutdown handled by the daemon: %s", reply)
+        return reply == "OK"
 
-    return not critical_error
+    logging.info("No daemon answering on %s, shutting down in-process.",
+                 SOCKET_FILE)
+    if deadline is not None:
+        deadline = max(deadline - (time.monotonic() - started), 0.0)
+    return shutdown_infrastructure(max_workers=max_workers,
+                                   per_host_workers=per_host_workers,
+                                   deadline=deadline,
+                                   processes=processes)
 
 
 def main():
@@ -136,9 +542,43 @@ def main():
     """
     try:
         args = get_command_line_arguments()
+        configure_logging()
+
+        if args.daemon:
+            return run_daemon()
+
+        if args.startup:
+            success = startup_infrastructure(max_workers=args.max_workers)
+            print(success)
+            return success
+
+        if args.agent:
+            success = run_agent(args.agent, max_workers=args.max_workers,
+                                per_host_workers=args.per_host_workers)
+            print(success)
+            return success
+
+        if args.coordinator:
+            success = coordinate_shutdown(deadline=args.deadline)
+            print(success)
+            return success
+
+        if args.plan:
+            return plan_shutdown(max_workers=args.max_workers,
+                                 per_host_workers=args.per_host_workers,
+                                 deadline=args.deadline,
+                                 processes=args.processes)
+
+        if args.discover:
+            success = discover_inventory()
+            print(success)
+            return success
 
         if args.shutdown:
-            if shutdown_infrastructure():
+            if trigger_shutdown(max_workers=args.max_workers,
+                                per_host_workers=args.per_host_workers,
+                                deadline=args.deadline,
+                                processes=args.processes):
                 print(True)
                 return True
             else:
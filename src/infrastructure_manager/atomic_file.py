@@ -0,0 +1,35 @@
+"""
+Module for replacing files atomically.
+"""
+import os
+import tempfile
+from typing import Optional
+
+
+def write_atomically(path: str, text: str, mode: Optional[int] = None) -> None:
+    """Replace a file with new text, so that readers never see a partial file.
+
+    The text is written to a temporary file next to ``path`` that is renamed
+    over it; the temporary file is removed if anything fails on the way.
+
+    Args:
+        path: Path of the file, whose directory is created if missing
+        text: New content of the file
+        mode: Permissions of the file, readable by its owner only if None
+
+    Raises:
+        OSError: If the file could not be written
+    """
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory,
+                                    prefix=os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
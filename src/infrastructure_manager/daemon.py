@@ -0,0 +1,257 @@
+"""
+Module for running the shutdown orchestration as a warm-standby daemon.
+"""
+import logging
+import os
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+
+SHUTDOWN_COMMAND = "SHUTDOWN"
+PING_COMMAND = "PING"
+# Seconds a daemon has to accept a command, and to answer a PING
+DAEMON_TIMEOUT = 5
+
+
+class _TriggerHandler(socketserver.StreamRequestHandler):
+    """Handle a single command received on the daemon socket."""
+
+    def handle(self):
+        # SHUTDOWN may carry the deadline of the run: "SHUTDOWN <seconds>"
+        command, _, argument = self.rfile.readline().decode(
+            'utf-8').strip().upper().partition(' ')
+        deadline = None
+        if command == SHUTDOWN_COMMAND and argument:
+            try:
+                deadline = float(argument)
+            except ValueError:
+                command = f"{command} {argument}"
+
+        if command == PING_COMMAND:
+            reply = "PONG"
+        elif command == SHUTDOWN_COMMAND:
+            logging.info("Shutdown trigger received on daemon socket.")
+            success = self.server.shutdown_daemon.trigger_shutdown(deadline)
+            reply = "OK" if success else "FAILED"
+        else:
+            logging.error("Unknown daemon command: %s", command)
+            reply = "ERROR"
+        self.wfile.write(f"{reply}\n".encode('utf-8'))
+
+        if command == SHUTDOWN_COMMAND:
+            # The infrastructure is going down, there is nothing left to keep
+            # warm; a service manager can start a fresh daemon once it is back.
+            threading.Thread(target=self.server.shutdown_daemon.stop,
+                             daemon=True).start()
+
+
+class _TriggerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+# pylint: disable=W0718
+class ShutdownDaemon:
+    """
+    Keep authenticated SSH sessions to the whole infrastructure open and run
+    the shutdown as soon as a trigger arrives on a local Unix socket.
+
+    With discovery enabled, the VMs of the ESXi servers are also discovered
+    in the background and merged into the inventory, so a trigger finds the
+    inventory up to date instead of discovering it.
+    """
+
+    def __init__(self, config, remote_manager, socket_path: str):
+        """Initialize the shutdown daemon.
+
+        Args:
+            config: A loaded ``ConfigManager`` instance
+            remote_manager: Object exposing ``get_connection`` and the
+                operations used by ``InfrastructureManager``
+            socket_path: Path of the Unix socket to listen on
+        """
+        self.config = config
+        self.remote_manager = remote_manager
+        self.socket_path = socket_path
+        self.keepalive_interval = config.daemon.keepalive_interval
+        self.refresh_interval = config.daemon.refresh_interval
+        self._stop = threading.Event()
+        self._shutdown_lock = threading.Lock()
+        self._shutdown_result: Optional[bool] = None
+        self._server = None
+
+    def _devices(self):
+        """Yield the connection parameters of every host and VM."""
+        for server in self.config.esxi_servers:
+            yield server.ip, server.username, server.password, server.port
+            for vm in server.vms:
+                # VMs without credentials are shut down from their server
+                if vm.username is not None:
+                    yield vm.ip, vm.username, vm.password, vm.port
+
+    def _warm_connection(self, host, username, password, port) -> bool:
+        ssh_client = self.remote_manager.get_connection(
+            host, username, password, port)
+        if not ssh_client:
+            return False
+        ssh_client.get_transport().set_keepalive(self.keepalive_interval)
+        return True
+
+    def warm_up(self) -> int:
+        """Open (or revive) the pooled session of every device.
+
+        Returns:
+            int: Number of devices with a live session
+        """
+        devices = list(self._devices())
+        max_workers = self.config.shutdown.max_workers
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(
+                lambda device: self._warm_connection(*device), devices))
+        connected = sum(results)
+        logging.info("Daemon holds live sessions to %s of %s devices.",
+                     connected, len(devices))
+        return connected
+
+    def discover(self) -> None:
+        """Refresh the inventory snapshot and merge it into the inventory."""
+        from .discovery import InventoryCache, apply_inventory
+
+        settings = self.config.discovery
+        InventoryCache(settings.cache_file, settings.ttl).refresh(
+            self.config, self.remote_manager,
+            max_workers=self.config.shutdown.max_workers)
+        # A shutdown reads the inventory under this lock
+        with self._shutdown_lock:
+            if self._shutdown_result is None and not self._stop.is_set():
+                apply_inventory(self.config)
+
+    def _maintain(self) -> None:
+        """Open every session, then periodically reconnect dropped ones.
+
+        Discoveries run on the same thread, at most every
+        ``discovery.refresh_interval`` seconds.
+        """
+        next_discovery = time.monotonic()
+        while not self._stop.is_set():
+            if (self.config.discovery.enabled
+                    and time.monotonic() >= next_discovery):
+                next_discovery = (time.monotonic()
+                                  + self.config.discovery.refresh_interval)
+                try:
+                    self.discover()
+                except Exception as e:
+                    logging.error("Failed to discover the inventory: %s",
+                                  str(e))
+            try:
+                self.warm_up()
+            except Exception as e:
+                logging.error("Failed to refresh daemon sessions: %s", str(e))
+            self._stop.wait(self.refresh_interval)
+
+    def trigger_shutdown(self, deadline: Optional[float] = None) -> bool:
+        """Run the infrastructure shutdown once.
+
+        Concurrent or repeated triggers wait for the first run and share
+        its result instead of starting a second shutdown.
+
+        Args:
+            deadline: Seconds the shutdown may take, unlimited if None
+        """
+        # Imported here so that signalling a daemon does not load the
+        # orchestration (this module is imported by every CLI start)
+        from .infrastructure_manager import InfrastructureManager
+        from .journal import serialized_run
+        from .plan import LatencyHistory
+
+        with self._shutdown_lock:
+            if self._shutdown_result is None:
+                self._stop.set()
+                with serialized_run(self.config.journal) as journal:
+                    if journal is not None and journal.completed is not None:
+                        logging.info(
+                            "A shutdown finished less than %s seconds ago, "
+                            "not running it again.",
+                            self.config.journal.resume_window)
+                        self._shutdown_result = journal.completed
+                        return self._shutdown_result
+                    manager = InfrastructureManager(
+                        self.config, self.remote_manager, journal=journal)
+                    self._shutdown_result = manager.shutdown(deadline=deadline)
+                    if journal is not None:
+                        journal.complete(self._shutdown_result)
+                manager.report.write(self.config.report.json_file,
+                                     self.config.report.prometheus_file)
+                if self.config.report.history_file is not None:
+                    LatencyHistory(self.config.report.history_file).update(
+                        manager.report)
+            return self._shutdown_result
+
+    def serve_forever(self) -> None:
+        """Warm up the sessions and serve triggers until stopped."""
+        socket_dir = os.path.dirname(self.socket_path)
+        if socket_dir:
+            os.makedirs(socket_dir, exist_ok=True)
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+        old_umask = os.umask(0o177)
+        try:
+            self._server = _TriggerServer(self.socket_path, _TriggerHandler)
+        finally:
+            os.umask(old_umask)
+        self._server.shutdown_daemon = self
+        logging.info("Daemon listening on %s.", self.socket_path)
+
+        # Listen before warming up so that a trigger arriving meanwhile is
+        # served with whatever sessions are already open.
+        threading.Thread(target=self._maintain, name="daemon-refresh",
+                         daemon=True).start()
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+    def stop(self) -> None:
+        """Stop serving triggers and refreshing sessions."""
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+
+
+def send_daemon_command(socket_path: str, command: str,
+                        timeout: Optional[float] = DAEMON_TIMEOUT) -> Optional[str]:
+    """
+    Send a command to a running daemon and wait for its reply.
+
+    Args:
+        socket_path: Path of the daemon Unix socket
+        command: One of ``SHUTDOWN``, ``SHUTDOWN <deadline seconds>`` or
+            ``PING``
+        timeout: Seconds to wait for the reply, forever if None. The
+            connection itself never waits more than ``DAEMON_TIMEOUT``.
+
+    Returns:
+        Optional[str]: The reply of the daemon, or None when no daemon is
+        listening on the socket or it did not answer in time
+    """
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(DAEMON_TIMEOUT if timeout is None
+                              else min(timeout, DAEMON_TIMEOUT))
+            client.connect(socket_path)
+            client.settimeout(timeout)
+            client.sendall(f"{command}\n".encode('utf-8'))
+            with client.makefile('rb') as reply:
+                return reply.readline().decode('utf-8').strip()
+    except (FileNotFoundError, ConnectionRefusedError):
+        return None
+    except socket.timeout:
+        logging.error("Daemon on %s did not answer %s in time.",
+                      socket_path, command)
+        return None
@@ -0,0 +1,172 @@
+"""
+Module for discovering the VMs of the ESXi servers ahead of a shutdown.
+"""
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+from .atomic_file import write_atomically
+
+
+# pylint: disable=W0718
+class InventoryCache:
+    """
+    Snapshot of the VMs discovered on every ESXi server, kept in a JSON file.
+
+    Discoveries run ahead of time, from the daemon or ``--discover``, so a
+    shutdown only reads the snapshot and never waits for one. Every server
+    has its own discovery time: a server that could not be queried keeps
+    its earlier entry until it is ``ttl`` seconds old, after which its
+    configured VMs are used alone.
+    """
+
+    def __init__(self, path: str, ttl: float = 900):
+        """Initialize the inventory cache.
+
+        Args:
+            path: Path of the snapshot file
+            ttl: Seconds the VMs of a server are trusted after their discovery
+        """
+        self.path = path
+        self.ttl = ttl
+
+    def read(self) -> Dict[str, Dict]:
+        """Return the entry of every server of the snapshot, stale or not.
+
+        An entry holds the ``discovered_at`` time of the server and its
+        ``vms``, with the ``power_state`` and ``ip`` of every VM by name.
+        """
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                servers = json.load(f)['servers']
+        except FileNotFoundError:
+            return {}
+        except (ValueError, KeyError, TypeError, OSError) as e:
+            logging.warning("Ignoring unreadable inventory snapshot %s: %s",
+                            self.path, str(e))
+            return {}
+        return servers if isinstance(servers, dict) else {}
+
+    def load(self, running_only: bool = False,
+             expire: bool = True) -> Dict[str, Dict[str, Optional[str]]]:
+        """Return the fresh part of the snapshot, for ``merge_inventory``.
+
+        Args:
+            running_only: Leave out the VMs that were not powered on when
+                they were discovered
+            expire: Leave out the servers discovered more than ``ttl``
+                seconds ago; a startup uses the last snapshot taken before
+                the outage, however old
+
+        Returns:
+            Dict[str, Dict[str, Optional[str]]]: Guest IP of every VM by VM
+            name, by the name of every server discovered within the TTL
+        """
+        now = time.time()
+        inventory = {}
+        for server_name, entry in self.read().items():
+            try:
+                age = now - float(entry['discovered_at'])
+                vms = {name: vm.get('ip') for name, vm in entry['vms'].items()
+                       if not running_only
+                       or vm.get('power_state') == 'Powered on'}
+            except (AttributeError, KeyError, TypeError, ValueError):
+                continue
+            if expire and age > self.ttl:
+                logging.warning("Discovered VMs of ESXi server %s are %.0f "
+                                "seconds old, using its configured VMs only.",
+                                server_name, age)
+                continue
+            inventory[server_name] = vms
+        return inventory
+
+    def refresh(self, config, remote_manager, max_workers: int = 8) -> Dict[str, Dict]:
+        """Discover the VMs of every ESXi server and update the snapshot.
+
+        Servers are queried in parallel, each over a single session. The
+        snapshot is replaced atomically, so a shutdown reading it meanwhile
+        sees either the old or the new one.
+
+        Args:
+            config: A loaded ``ConfigManager`` instance
+            remote_manager: Object exposing ``discover_esxi_vms``
+            max_workers: Number of servers queried concurrently
+
+        Returns:
+            Dict[str, Dict]: Entries of the servers discovered by this
+            refresh, keyed by server name
+        """
+        servers = config.esxi_servers
+
+        def discover(server):
+            try:
+                return remote_manager.discover_esxi_vms(
+                    server.ip, server.username, server.password,
+                    port=server.port)
+            except Exception as e:
+                logging.error("Unexpected error discovering VMs on %s: %s",
+                              server.name, str(e))
+                return None
+
+        with ThreadPoolExecutor(
+                max_workers=max(1, min(max_workers, len(servers)))) as executor:
+            results = list(executor.map(discover, servers))
+
+        discovered = {}
+        for server, vms in zip(servers, results):
+            if vms is None:
+                logging.warning("Failed to discover the VMs of ESXi server "
+                                "%s, keeping its earlier snapshot.",
+                                server.name)
+                continue
+            discovered[server.name] = {
+                'discovered_at': time.time(),
+                'vms': {vm.name: {'power_state': vm.power_state, 'ip': vm.ip}
+                        for vm in vms.values()}}
+            logging.info("Discovered %s VMs on ESXi server %s.",
+                         len(vms), server.name)
+
+        snapshot = {name: entry for name, entry in self.read().items()
+                    if config.get_server_by_name(name) is not None}
+        snapshot.update(discovered)
+        self._write(snapshot)
+        return discovered
+
+    def _write(self, servers: Dict[str, Dict]) -> None:
+        try:
+            write_atomically(self.path,
+                             json.dumps({'servers': servers}, indent=2))
+        except OSError as e:
+            logging.error("Failed to write inventory snapshot %s: %s",
+                          self.path, str(e))
+
+
+def apply_inventory(config, startup: bool = False) -> bool:
+    """Merge the fresh snapshot of the discovery into a configuration.
+
+    Args:
+        config: A loaded ``ConfigManager`` instance
+        startup: Merge the VMs that were running when the snapshot was
+            taken, however old it is, to bring back what the outage stopped
+
+    Returns:
+        bool: True if discovered VMs were merged, False if discovery is
+        disabled, no server has a fresh snapshot or the merge failed
+    """
+    if not config.discovery.enabled:
+        return False
+    cache = InventoryCache(config.discovery.cache_file, config.discovery.ttl)
+    inventory = cache.load(running_only=startup, expire=not startup)
+    if not inventory:
+        logging.warning("No %sinventory snapshot in %s, using the "
+                        "configured VMs only.", "" if startup else "fresh ",
+                        cache.path)
+        return False
+    try:
+        config.merge_inventory(inventory)
+    except ValueError as e:
+        logging.error("Failed to merge the discovered VMs: %s", str(e))
+        return False
+    return True
@@ -0,0 +1,750 @@
+"""
+Module for shutting the infrastructure down from several controllers.
+"""
+import bisect
+import copy
+import hashlib
+import hmac
+import json
+import logging
+import queue
+import socket
+import threading
+import time
+from collections import namedtuple
+from typing import Dict, List, Optional
+
+from .infrastructure_manager import InfrastructureManager, critical_path
+from .journal import CONFIRMED_OFF
+from .run_report import RunReport
+
+
+# Points of every agent on the hash ring, which evens out the shards
+_RING_REPLICAS = 64
+# Seconds the coordinator waits for the results of the agents once every
+# ESXi server is down, and for the agents past a deadline
+_RESULT_GRACE = 5
+
+# Remote operation timed by an agent, as rebuilt from its report
+_RemoteSpan = namedtuple('_RemoteSpan', 'host phase start duration ok')
+
+
+class HashRing:
+    """
+    Consistent hashing of ESXi servers onto agents.
+
+    Every agent owns many points of the ring and a server goes to the agent
+    owning the first point after its hash. Removing an agent only moves the
+    servers it had, to the agents owning the next points, so a reassignment
+    leaves every other shard untouched.
+    """
+
+    def __init__(self, nodes=(), replicas: int = _RING_REPLICAS):
+        """Initialize the hash ring.
+
+        Args:
+            nodes: Names of the agents
+            replicas: Points of every agent on the ring
+        """
+        self.replicas = replicas
+        # Sorted (hash, node) points
+        self._points: List = []
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.sha1(value.encode('utf-8')).digest()[:8],
+                              'big')
+
+    def add(self, node: str) -> None:
+        for replica in range(self.replicas):
+            bisect.insort(self._points, (self._hash(f"{node}#{replica}"), node))
+
+    def remove(self, node: str) -> None:
+        self._points = [point for point in self._points if point[1] != node]
+
+    def node_for(self, key: str) -> Optional[str]:
+        """Return the agent owning a key, None if the ring is empty."""
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, (self._hash(key),))
+        return self._points[index % len(self._points)][1]
+
+
+def _signature(message: Dict, secret: str) -> str:
+    """Return the HMAC-SHA256 of a message, keyed with the shared secret."""
+    return hmac.new(secret.encode('utf-8'),
+                    json.dumps(message, sort_keys=True).encode('utf-8'),
+                    hashlib.sha256).hexdigest()
+
+
+class _Connection:
+    """Newline-delimited JSON messages over a TCP connection.
+
+    Every message carries the ``mac`` of its other fields, keyed with the
+    shared secret. A message without the right one ends the connection as
+    if the peer had closed it, and so does any message without a secret.
+    """
+
+    def __init__(self, sock: socket.socket, secret: Optional[str]):
+        self.sock = sock
+        self.secret = secret
+        self.reader = sock.makefile('r', encoding='utf-8')
+        self.lock = threading.Lock()
+
+    def send(self, message: Dict) -> bool:
+        if self.secret is not None:
+            message = dict(message, mac=_signature(message, self.secret))
+        data = (json.dumps(message) + '\n').encode('utf-8')
+        try:
+            with self.lock:
+                self.sock.sendall(data)
+            return True
+        except OSError:
+            return False
+
+    def receive(self) -> Optional[Dict]:
+        """Return the next message, None once the connection is closed."""
+        try:
+            line = self.reader.readline()
+            message = json.loads(line) if line else None
+        except (OSError, ValueError):
+            return None
+        if message is None:
+            return None
+        mac = message.pop('mac', None) if isinstance(message, dict) else None
+        if (self.secret is None or not isinstance(mac, str)
+                or not hmac.compare_digest(
+                    mac, _signature(message, self.secret))):
+            logging.warning("Dropping a peer that sent a message without "
+                            "a valid signature.")
+            return None
+        return message
+
+    def close(self) -> None:
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+def _key(value) -> tuple:
+    """Return the device key sent as a JSON ``[server, vm]`` list."""
+    return value[0], value[1]
+
+
+class _Agent:
+    """State of an agent connected to the coordinator."""
+
+    def __init__(self, name: str, connection: _Connection):
+        self.name = name
+        self.connection = connection
+        self.alive = True
+        self.last_seen = time.monotonic()
+        # Servers assigned to the agent that are not down yet
+        self.servers: List[str] = []
+        # Assignments the agent did not send the results of yet
+        self.running = 0
+
+
+# pylint: disable=W0718
+class DistributedCoordinator(InfrastructureManager):
+    """
+    Split the shutdown between agents running on several controllers.
+
+    Agents (``ShutdownAgent``) connect to the coordinator over TCP and are
+    each assigned the ESXi servers that consistent hashing of the server
+    names gives them, every server staying with its VMs. As in a sharded
+    shutdown, every device that goes down is relayed to the other agents,
+    which may depend on it. Agents send a heartbeat every
+    ``heartbeat_interval`` seconds; an agent that disconnects or stays quiet
+    for ``agent_timeout`` seconds is given up on and the servers it did not
+    finish are reassigned to the remaining agents, with the devices it
+    already shut down skipped. The coordinator itself never contacts a
+    device.
+
+    The protocol is one JSON object per line, signed with the
+    ``distributed.secret`` shared by every controller; an agent whose
+    ``hello`` is not signed with it is rejected. Agents send ``hello`` (with
+    their name), ``heartbeat``, ``finished`` (a device key and its success)
+    and ``done`` (the results and report of an assignment); the coordinator
+    sends ``assign`` (servers, devices already off and the deadline left),
+    ``finished`` (a device of another agent), ``heartbeat`` and ``stop``.
+    """
+
+    def __init__(self, config, remote_manager=None, settings=None):
+        """Initialize the distributed coordinator.
+
+        Args:
+            config: A loaded ``ConfigManager`` instance
+            remote_manager: Unused, devices are only contacted by the agents
+            settings: ``DistributedConfig`` to use, defaults to the
+                ``distributed`` section of the configuration
+        """
+        super().__init__(config, remote_manager)
+        self.settings = settings or config.distributed
+        self.address = None
+        self.agents: Dict[str, _Agent] = {}
+        # Servers moved from an agent that was given up on
+        self.reassigned: List[str] = []
+        self._listener: Optional[socket.socket] = None
+        self._events: queue.Queue = queue.Queue()
+        self._ring: Optional[HashRing] = None
+        self._graph: Dict = {}
+        self._started: Optional[float] = None
+        self._deadline: Optional[float] = None
+        self._heartbeat_at = 0.0
+        self.finished_at: Dict = {}
+        self.results: Dict = {}
+        self.agent_results: List[Dict] = []
+
+    def listen(self) -> None:
+        """Start accepting agents on the configured address."""
+        self._listener = socket.create_server(
+            (self.settings.host, self.settings.port))
+        self.address = self._listener.getsockname()[:2]
+        if self.settings.secret is None:
+            logging.error("distributed.secret is not set, no agent can join.")
+        threading.Thread(target=self._accept_loop, name="coordinator-accept",
+                         daemon=True).start()
+        logging.info("Coordinator listening on %s:%s.", *self.address)
+
+    def close(self) -> None:
+        """Stop accepting agents and disconnect the ones connected."""
+        if self._listener is not None:
+            self._listener.close()
+        for agent in self.alive_agents():
+            agent.connection.send({'type': 'stop'})
+            agent.connection.close()
+
+    def _accept_loop(self) -> None:
+        while True:
+            try:
+                sock, _ = self._listener.accept()
+            except OSError:
+                return
+            # A quiet agent never blocks the coordinator for long
+            sock.settimeout(self.settings.agent_timeout)
+            threading.Thread(target=self._read_loop,
+                             args=(_Connection(sock, self.settings.secret),),
+                             daemon=True).start()
+
+    def _read_loop(self, connection: _Connection) -> None:
+        """Queue the messages of an agent for the coordinator thread."""
+        hello = connection.receive()
+        if not hello or hello.get('type') != 'hello' or not hello.get('agent'):
+            connection.close()
+            return
+        name = hello['agent']
+        self._events.put(('joined', name, connection, None))
+        while True:
+            message = connection.receive()
+            self._events.put(('message' if message is not None else 'lost',
+                              name, connection, message))
+            if message is None:
+                return
+
+    def alive_agents(self) -> List[_Agent]:
+        return [agent for agent in self.agents.values() if agent.alive]
+
+    def wait_for_agents(self) -> int:
+        """Wait until the expected agents joined, or the join timeout.
+
+        Returns:
+            int: Number of agents connected
+        """
+        if self._listener is None:
+            self.listen()
+        give_up = time.monotonic() + self.settings.join_timeout
+        while len(self.alive_agents()) < self.settings.agents:
+            remaining = give_up - time.monotonic()
+            if remaining <= 0:
+                break
+            self._next_event(min(remaining, 0.5))
+        joined = self.alive_agents()
+        logging.info("%s of %s agents joined: %s", len(joined),
+                     self.settings.agents,
+                     ", ".join(agent.name for agent in joined))
+        return len(joined)
+
+    def _next_event(self, timeout: float) -> None:
+        """Handle the next event of an agent, then check every agent."""
+        try:
+            event = self._events.get(timeout=timeout)
+        except queue.Empty:
+            event = None
+        if event is not None:
+            kind, name, connection, message = event
+            agent = self.agents.get(name)
+            if kind == 'joined':
+                self._on_joined(name, connection)
+            elif (agent is not None and agent.alive
+                  and agent.connection is connection):
+                # Late messages of an agent given up on are ignored
+                agent.last_seen = time.monotonic()
+                if kind == 'lost':
+                    self._lose(agent, "disconnected")
+                else:
+                    self._on_message(agent, message)
+        self._check_agents()
+
+    def _on_joined(self, name: str, connection: _Connection) -> None:
+        agent = self.agents.get(name)
+        if agent is not None and agent.alive:
+            logging.error("Rejecting a second agent named %s.", name)
+            connection.close()
+            return
+        logging.info("Agent %s joined.", name)
+        self.agents[name] = _Agent(name, connection)
+        if self._ring is not None:
+            # Late agents only take over the servers of lost ones
+            self._ring.add(name)
+
+    def _on_message(self, agent: _Agent, message: Dict) -> None:
+        kind = message.get('type')
+        if kind == 'finished':
+            self._finish(_key(message['key']), bool(message['success']),
+                         agent)
+        elif kind == 'done':
+            agent.running -= 1
+            agent.servers = [name for name in agent.servers
+                             if name not in message['servers']]
+            self.agent_results.append(message)
+
+    def _check_agents(self) -> None:
+        """Give up on quiet agents and keep the connected ones alive."""
+        now = time.monotonic()
+        for agent in self.alive_agents():
+            quiet = now - agent.last_seen
+            if quiet > self.settings.agent_timeout:
+                self._lose(agent, f"was quiet for {quiet:.1f} seconds")
+        if now >= self._heartbeat_at:
+            self._heartbeat_at = now + self.settings.heartbeat_interval
+            for agent in self.alive_agents():
+                agent.connection.send({'type': 'heartbeat'})
+
+    def _finish(self, key, success: bool, source: Optional[_Agent]) -> None:
+        """Record that a device is down and relay it to the other agents."""
+        if key in self.finished_at:
+            self.results[key] = self.results[key] or success
+            return
+        self.finished_at[key] = time.monotonic()
+        self.results[key] = success
+        for agent in self.alive_agents():
+            if agent is not source:
+                agent.connection.send({'type': 'finished', 'key': list(key)})
+        server_name, vm_name = key
+        server = self.config.get_server_by_name(server_name)
+        if vm_name is None and server is not None:
+            # VMs cannot outlive their ESXi server, those not reported down
+            # were forced off with it
+            for vm in server.vms:
+                self._finish((server_name, vm.name), False, source)
+
+    def _assign(self, agent: _Agent, servers: List[str]) -> None:
+        remaining = (None if self._deadline is None else max(
+            self._deadline - (time.monotonic() - self._started), 0.0))
+        off = [list(key) for key, success in self.results.items()
+               if success and key[0] in servers]
+        logging.info("Assigning ESXi servers %s to agent %s.",
+                     ", ".join(servers), agent.name)
+        agent.servers += servers
+        agent.running += 1
+        if not agent.connection.send({'type': 'assign', 'servers': servers,
+                                      'off': off, 'deadline': remaining}):
+            self._lose(agent, "is unreachable")
+
+    def _distribute(self, servers: List[str]) -> None:
+        """Assign servers to the agents the hash ring gives them to."""
+        shards: Dict[str, List[str]] = {}
+        for server_name in servers:
+            node = self._ring.node_for(server_name)
+            if node is None:
+                logging.error("No agent left, the remaining devices of ESXi "
+                              "servers %s count as failed.",
+                              ", ".join(servers))
+                for name in servers:
+                    self._fail_server(name)
+                return
+            shards.setdefault(node, []).append(server_name)
+        for node, names in shards.items():
+            self._assign(self.agents[node], names)
+
+    def _fail_server(self, server_name: str) -> None:
+        server = self.config.get_server_by_name(server_name)
+        for vm in server.vms:
+            self._finish((server_name, vm.name), False, None)
+        self._finish((server_name, None), False, None)
+
+    def _lose(self, agent: _Agent, reason: str) -> None:
+        """Give up on an agent and reassign the servers it did not finish."""
+        agent.alive = False
+        agent.connection.close()
+        servers = [name for name in agent.servers
+                   if (name, None) not in self.finished_at]
+        agent.servers = []
+        agent.running = 0
+        if self._ring is None:
+            logging.warning("Agent %s %s before the shutdown.", agent.name,
+                            reason)
+            return
+        self._ring.remove(agent.name)
+        if not servers:
+            logging.warning("Agent %s %s after finishing its servers.",
+                            agent.name, reason)
+            return
+        logging.error("Agent %s %s, reassigning ESXi servers %s.",
+                      agent.name, reason, ", ".join(servers))
+        self.reassigned += servers
+        self._distribute(servers)
+
+    def _complete(self, esxi_keys, settled_at: Optional[float]) -> bool:
+        if any(key not in self.finished_at for key in esxi_keys):
+            return False
+        # Results still on their way are waited for, but not forever
+        return (not any(agent.running for agent in self.alive_agents())
+                or (settled_at is not None
+                    and time.monotonic() > settled_at + _RESULT_GRACE))
+
+    def shutdown(self, deadline: Optional[float] = None, link=None) -> bool:
+        """Shutdown all VMs and ESXi servers from the connected agents.
+
+        Waits for the agents first if none has joined yet.
+
+        Args:
+            deadline: Seconds the whole shutdown may take, unlimited if None
+            link: Not supported, a distributed run cannot be a shard itself
+
+        Returns:
+            bool: True if shutdown was successful, False if critical errors occurred
+        """
+        if link is not None:
+            raise ValueError("A distributed shutdown cannot be linked to shards")
+        timestamp = time.time()
+        started = self._started = time.monotonic()
+        self._deadline = deadline
+        self.phases = {}
+        if not self.alive_agents():
+            self.wait_for_agents()
+        self.phases['join'] = time.monotonic() - started
+
+        self._graph = self.config.build_shutdown_graph()
+        self._ring = HashRing(agent.name for agent in self.alive_agents())
+        logging.info("Starting distributed shutdown of %s ESXi servers with "
+                     "%s agents...", len(self.config.esxi_servers),
+                     len(self.alive_agents()))
+        self._distribute([server.name for server in self.config.esxi_servers])
+
+        esxi_keys = [(server.name, None) for server in self.config.esxi_servers]
+        settled_at = None
+        try:
+            while not self._complete(esxi_keys, settled_at):
+                self._next_event(0.5)
+                if settled_at is None and all(key in self.finished_at
+                                              for key in esxi_keys):
+                    settled_at = time.monotonic()
+                if (deadline is not None and time.monotonic()
+                        > started + deadline + _RESULT_GRACE):
+                    logging.error("Deadline passed, the devices not reported "
+                                  "down count as failed.")
+                    for server in self.config.esxi_servers:
+                        self._fail_server(server.name)
+        finally:
+            self.close()
+        self.phases['shutdown'] = (time.monotonic() - started
+                                   - self.phases['join'])
+
+        self.shutdown_results = [
+            (f"VM {vm.name}", self.results.get((server.name, vm.name), False))
+            for server in self.config.esxi_servers for vm in server.vms
+        ]
+        self.shutdown_results += [
+            (f"ESXi {server.name}", self.results.get((server.name, None), False))
+            for server in self.config.esxi_servers
+        ]
+        for result in self.agent_results:
+            self.poweroff_durations.update(result['poweroff_durations'])
+            self.escalated_vms += result['escalated_vms']
+        self.critical_path = critical_path(self._graph, self.finished_at,
+                                           started)
+        critical_error = not all(self.results.get(key, False)
+                                 for key in esxi_keys)
+        self._log_summary()
+        self.report = self._merge_reports(timestamp, started,
+                                          not critical_error)
+        return not critical_error
+
+    def _merge_reports(self, timestamp: float, started: float,
+                       success: bool) -> RunReport:
+        """Merge the reports of the agents into the report of the run."""
+        devices: Dict[str, Dict] = {}
+        spans = set()
+        for result in self.agent_results:
+            report = result.get('report')
+            if report is None:
+                continue
+            # Agents run on other hosts, only their wall clocks compare
+            shift = report['timestamp'] - timestamp
+            for device in report['devices']:
+                # A reassigned server is reported by its last agent
+                devices[device['device']] = dict(device, timeline={
+                    event: None if offset is None else offset + shift
+                    for event, offset in device['timeline'].items()})
+            spans.update(_RemoteSpan(span['host'], span['phase'],
+                                     started + shift + span['start'],
+                                     span['seconds'], span['ok'])
+                         for span in report['spans'])
+        return RunReport(success=success, timestamp=timestamp, origin=started,
+                         duration=time.monotonic() - started,
+                         phases=dict(self.phases),
+                         devices=list(devices.values()),
+                         spans=sorted(spans, key=lambda span: span.start),
+                         critical_path=list(self.critical_path))
+
+
+class _AgentLink:
+    """Connection of a run of an agent to the others, see ``shutdown(link=)``."""
+
+    def __init__(self, agent: "ShutdownAgent", foreign: set):
+        self.agent = agent
+        # Devices of other agents the run waits for
+        self.foreign = foreign
+        self.inbox: queue.Queue = queue.Queue()
+
+    def finished(self, key, success: bool, at: float) -> None:
+        self.agent.send({'type': 'finished', 'key': list(key),
+                         'success': success})
+
+    def receive(self):
+        return self.inbox.get()
+
+
+class _SharedSessions:
+    """Remote manager of the concurrent runs of an agent.
+
+    Sessions are closed once the agent is done, not by the first run that
+    ends while another one still uses them.
+    """
+
+    def __init__(self, remote_manager):
+        self._remote_manager = remote_manager
+
+    def __getattr__(self, name):
+        return getattr(self._remote_manager, name)
+
+    def close_all_connections(self) -> None:
+        pass
+
+
+# pylint: disable=W0718
+class ShutdownAgent:
+    """
+    Shut down the ESXi servers a ``DistributedCoordinator`` assigns.
+
+    Every assignment runs as its own shard, at the same time as the ones
+    assigned earlier, and may include servers taken over from a lost agent.
+    If the coordinator is lost, the devices of other agents are no longer
+    waited for and the assigned servers are shut down on their own.
+    Every controller must share the same configuration file.
+    """
+
+    def __init__(self, config, remote_manager, name: str,
+                 max_workers: Optional[int] = None,
+                 per_host_workers: Optional[int] = None, settings=None):
+        """Initialize the shutdown agent.
+
+        Args:
+            config: A loaded ``ConfigManager`` instance
+            remote_manager: Object exposing the operations used by
+                ``InfrastructureManager``
+            name: Name of the agent, unique among the agents
+            max_workers: Limit of concurrent remote operations of every
+                assignment, defaults to the ``shutdown.max_workers`` setting
+            per_host_workers: Limit of concurrent VM operations per ESXi
+                server, defaults to the ``shutdown.per_host_workers`` setting
+            settings: ``DistributedConfig`` to use, defaults to the
+                ``distributed`` section of the configuration
+        """
+        self.config = config
+        self.remote_manager = remote_manager
+        self.name = name
+        self.max_workers = max_workers
+        self.per_host_workers = per_host_workers
+        self.settings = settings or config.distributed
+        self.results: List[bool] = []
+        self._graph: Dict = {}
+        self._connection: Optional[_Connection] = None
+        self._lock = threading.Lock()
+        # Devices of other agents relayed so far, and the links of the runs
+        self._known: List = []
+        self._links: set = set()
+        self._lost = False
+        self._runs: List[threading.Thread] = []
+        self._stop = threading.Event()
+
+    def send(self, message: Dict) -> None:
+        if self._connection is not None:
+            self._connection.send(message)
+
+    def connect(self, timeout: Optional[float] = None) -> bool:
+        """Connect to the coordinator, retrying until it listens.
+
+        Args:
+            timeout: Seconds to keep trying, forever if None
+
+        Returns:
+            bool: True once connected, False if the timeout expired
+        """
+        give_up = None if timeout is None else time.monotonic() + timeout
+        address = (self.settings.host, self.settings.port)
+        while not self._stop.is_set():
+            try:
+                sock = socket.create_connection(
+                    address, timeout=self.settings.heartbeat_interval)
+            except OSError:
+                if give_up is not None and time.monotonic() >= give_up:
+                    return False
+                self._stop.wait(self.settings.heartbeat_interval)
+                continue
+            # The coordinator sends heartbeats too, silence means it is lost
+            sock.settimeout(self.settings.agent_timeout)
+            self._connection = _Connection(sock, self.settings.secret)
+            return self._connection.send({'type': 'hello', 'agent': self.name})
+        return False
+
+    def serve(self, timeout: Optional[float] = None) -> bool:
+        """Run the assignments of the coordinator until it stops the agent.
+
+        Args:
+            timeout: Seconds to wait for the coordinator, forever if None
+
+        Returns:
+            bool: True if every assignment succeeded, False otherwise
+        """
+        if self.settings.secret is None:
+            logging.error("distributed.secret is not set, agent %s cannot "
+                          "join the coordinator.", self.name)
+            return False
+        if not self.connect(timeout):
+            logging.error("Agent %s could not reach the coordinator at %s:%s.",
+                          self.name, self.settings.host, self.settings.port)
+            return False
+        logging.info("Agent %s connected to the coordinator at %s:%s.",
+                     self.name, self.settings.host, self.settings.port)
+        self._graph = self.config.build_shutdown_graph()
+        threading.Thread(target=self._heartbeat, name="agent-heartbeat",
+                         daemon=True).start()
+        try:
+            while True:
+                message = self._connection.receive()
+                if message is None:
+                    logging.error("Agent %s lost the coordinator, shutting "
+                                  "its servers down on their own.", self.name)
+                    self._release_foreign()
+                    break
+                kind = message.get('type')
+                if kind == 'assign':
+                    run = threading.Thread(
+                        target=self._run_assignment, name="agent-run",
+                        args=(message['servers'],
+                              [_key(key) for key in message['off']],
+                              message['deadline']))
+                    run.start()
+                    self._runs.append(run)
+                elif kind == 'finished':
+                    self._relay(_key(message['key']))
+                elif kind == 'stop':
+                    break
+        finally:
+            for run in self._runs:
+                run.join()
+            self._stop.set()
+            self._connection.close()
+            self.remote_manager.close_all_connections()
+        return all(self.results)
+
+    def stop(self) -> None:
+        """Stop waiting for the coordinator."""
+        self._stop.set()
+
+    def _heartbeat(self) -> None:
+        while not self._stop.wait(self.settings.heartbeat_interval):
+            self.send({'type': 'heartbeat'})
+
+    def _relay(self, key) -> None:
+        with self._lock:
+            self._known.append(key)
+            for link in self._links:
+                link.inbox.put(key)
+
+    def _release_foreign(self) -> None:
+        """Stop waiting for the devices of other agents."""
+        with self._lock:
+            self._lost = True
+            for link in self._links:
+                for key in link.foreign:
+                    link.inbox.put(key)
+
+    def _run_assignment(self, servers: List[str], off: List,
+                        deadline: Optional[float]) -> None:
+        """Shut the assigned servers down as a shard of the whole run."""
+        names = set(servers)
+        shard_servers = [server for server in self.config.esxi_servers
+                         if server.name in names]
+        for name in names - {server.name for server in shard_servers}:
+            logging.error("ESXi server %s is not in the configuration of "
+                          "agent %s.", name, self.name)
+            self.send({'type': 'finished', 'key': [name, None],
+                       'success': False})
+
+        shard_config = copy.copy(self.config)
+        shard_config.esxi_servers = shard_servers
+        shard_graph = {key: prerequisites
+                       for key, prerequisites in self._graph.items()
+                       if key[0] in names}
+        link = _AgentLink(self, {prerequisite
+                                 for prerequisites in shard_graph.values()
+                                 for prerequisite in prerequisites
+                                 if prerequisite[0] not in names})
+        with self._lock:
+            for key in self._known:
+                link.inbox.put(key)
+            if self._lost:
+                for key in link.foreign:
+                    link.inbox.put(key)
+            self._links.add(link)
+
+        manager = InfrastructureManager(
+            shard_config, _SharedSessions(self.remote_manager),
+            max_workers=self.max_workers,
+            per_host_workers=self.per_host_workers,
+            shutdown_graph=shard_graph,
+            resumed_states={key: CONFIRMED_OFF for key in off})
+        success = False
+        try:
+            if shard_servers:
+                success = manager.shutdown(deadline=deadline, link=link)
+        except Exception as e:
+            logging.error("Unexpected error shutting down ESXi servers %s: %s",
+                          ", ".join(servers), str(e))
+            for key in shard_graph:
+                self.send({'type': 'finished', 'key': list(key),
+                           'success': False})
+        finally:
+            with self._lock:
+                self._links.discard(link)
+            # Lets the link thread of the run exit
+            link.inbox.put(None)
+        self.results.append(success)
+
+        report = manager.report.to_dict() if manager.report else None
+        self.send({
+            'type': 'done', 'servers': servers, 'success': success,
+            'poweroff_durations': manager.poweroff_durations,
+            'escalated_vms': manager.escalated_vms,
+            'report': None if report is None else {
+                'timestamp': report['timestamp'],
+                'devices': report['devices'], 'spans': report['spans']},
+        })
@@ -0,0 +1,1076 @@
+"""
+Module for orchestrating operations across the whole ESXi infrastructure.
+"""
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, List, Optional, Tuple
+
+from .journal import CONFIRMED_OFF, FAILED, PENDING, SENT
+from .retry import CircuitBreaker, RetryPolicy
+from .run_report import RunReport
+
+
+# Hypervisor outcomes meaning the VM accepted a shutdown or power-off
+_HYPERVISOR_SENT = ('shutdown', 'off')
+# Largest share of a deadline budget either reserve may take
+_MAX_RESERVE_SHARE = 0.25
+
+
+def critical_path(prerequisites: Dict, finished_at: Dict,
+                  started_at: float) -> List[Tuple[str, float]]:
+    """Return the chain of devices that gated the end of a run.
+
+    Starting from the device that went down last, each step goes back to the
+    prerequisite that went down last, as that is the one that held the device
+    back. Every device comes with the seconds between the end of its
+    predecessor on the path (or the start of the run) and its own.
+
+    Args:
+        prerequisites: The shutdown graph of the run
+        finished_at: Monotonic time every device went down at
+        started_at: Monotonic time the run started at
+    """
+    if not finished_at:
+        return []
+    path = []
+    key = max(finished_at, key=finished_at.get)
+    while key is not None:
+        done = [prerequisite for prerequisite in prerequisites.get(key, ())
+                if prerequisite in finished_at]
+        previous = max(done, key=finished_at.get) if done else None
+        since = finished_at[previous] if previous is not None else started_at
+        server_name, vm_name = key
+        device = f"VM {vm_name}" if vm_name else f"ESXi {server_name}"
+        path.append((device, max(finished_at[key] - since, 0.0)))
+        key = previous
+    return path[::-1]
+
+
+# pylint: disable=W0718
+class InfrastructureManager:
+    """
+    Run power operations against every ESXi server and VM of a configuration.
+
+    The remote manager is injected so the orchestration does not depend on a
+    particular transport; in production it is ``RemoteDeviceManager``. When
+    it exposes a ``timing`` span recorder, the spans of a run are part of
+    its report.
+    """
+
+    def __init__(self, config, remote_manager,
+                 max_workers: Optional[int] = None,
+                 per_host_workers: Optional[int] = None,
+                 shutdown_graph: Optional[Dict] = None,
+                 journal=None, resumed_states: Optional[Dict] = None):
+        """Initialize the infrastructure manager.
+
+        Args:
+            config: A loaded ``ConfigManager`` instance
+            remote_manager: Object exposing ``poweroff_ubuntu_vm`` and
+                ``poweroff_esxi_server``
+            max_workers: Global limit of concurrent remote operations,
+                defaults to the ``shutdown.max_workers`` setting
+            per_host_workers: Limit of concurrent VM operations per ESXi
+                server, defaults to the ``shutdown.per_host_workers`` setting
+            shutdown_graph: Dependency graph to follow, defaults to the one
+                of the configuration. The graph of a shard lists devices of
+                other shards as prerequisites, see ``shutdown(link=...)``
+            journal: A loaded ``ShutdownJournal`` to resume from and record
+                the run in, None to run without one
+            resumed_states: Journal states of devices known from elsewhere,
+                such as the devices a lost agent of a distributed shutdown
+                already shut down, resumed from like the journal's own
+        """
+        self.config = config
+        self.journal = journal
+        self.resumed_states = resumed_states or {}
+        self.shutdown_graph = shutdown_graph
+        self.remote_manager = remote_manager
+        self.max_workers = max_workers or config.shutdown.max_workers
+        self.per_host_workers = (per_host_workers
+                                 or config.shutdown.per_host_workers)
+        self.vm_poweroff_timeout = config.shutdown.vm_poweroff_timeout
+        self.poll_interval = config.shutdown.poll_interval
+        self.probe_mode = config.shutdown.probe_mode
+        self.probe_timeout = config.shutdown.probe_timeout
+        self.esxi_reserve = config.shutdown.esxi_reserve
+        self.hard_off_reserve = config.shutdown.hard_off_reserve
+        self.retry_policy = RetryPolicy(config.shutdown.retry_attempts,
+                                        config.shutdown.retry_base_delay,
+                                        config.shutdown.retry_max_delay)
+        self.breaker_threshold = config.shutdown.breaker_threshold
+        self.reachability: Dict = {}
+        # SSH port of every device, probed by TCP reachability sweeps
+        self.ports = {device.ip: device.port
+                      for server in config.esxi_servers
+                      for device in [server] + server.vms}
+        self.shutdown_results: List[Tuple[str, bool]] = []
+        # Seconds each VM took to be confirmed off after its poweroff command
+        # was sent, or None when it was still running at its deadline
+        self.poweroff_durations: Dict[str, Optional[float]] = {}
+        # VMs hard powered off from their ESXi server when a deadline hit
+        self.escalated_vms: List[str] = []
+        # Devices whose shutdown gated the end of the run, with the seconds
+        # each of them added to it
+        self.critical_path: List[Tuple[str, float]] = []
+        # Seconds taken by every stage of the last run, and its full report
+        self.phases: Dict[str, float] = {}
+        self.report: Optional[RunReport] = None
+
+    def _sweep(self, hosts) -> Dict:
+        """Probe the reachability of many hosts with a single sweep."""
+        return self.remote_manager.check_reachability(
+            hosts, timeout=self.probe_timeout, mode=self.probe_mode,
+            ports=self.ports)
+
+    def _is_online(self, host: str) -> Optional[bool]:
+        """Return the reachability of a host from the initial sweep."""
+        result = self.reachability.get(host)
+        return result.online if result is not None else None
+
+    def _resumed_states(self) -> Dict:
+        """Return the journal states of the devices, for resuming a run."""
+        states = dict(self.journal.states) if self.journal is not None else {}
+        states.update(self.resumed_states)
+        for server in self.config.esxi_servers:
+            if states.get((server.name, None)) == CONFIRMED_OFF:
+                # VMs cannot outlive their ESXi server
+                for vm in server.vms:
+                    states[(server.name, vm.name)] = CONFIRMED_OFF
+        return states
+
+    def _forget_answering(self, resumed: Dict, devices) -> None:
+        """Shut down again the devices confirmed off that answer the sweep.
+
+        A VM without a known IP is shut down again with its server.
+        """
+        for key, device in devices:
+            if (resumed.get(key) != CONFIRMED_OFF
+                    or not self._is_online(device.ip)):
+                continue
+            logging.warning("%s was confirmed off by an earlier run but "
+                            "answers again, shutting it down again.",
+                            device.name)
+            del resumed[key]
+            server_name, vm_name = key
+            if vm_name is None:
+                for vm_key, vm in devices:
+                    if (vm_key[0] == server_name and vm_key[1] is not None
+                            and vm.ip is None):
+                        resumed.pop(vm_key, None)
+
+    def _shutdown_vm(self, vm) -> bool:
+        """Send the poweroff command to a single VM."""
+        logging.info("Attempting to shutdown VM: %s (%s)", vm.name, vm.ip)
+        if vm.username is None:
+            logging.error("No guest credentials configured for VM %s.",
+                          vm.name)
+            return False
+
+        try:
+            success = self.remote_manager.poweroff_ubuntu_vm(
+                vm.ip, vm.username, vm.password, port=vm.port,
+                online=self._is_online(vm.ip)
+            )
+        except Exception as e:
+            logging.error("Unexpected error shutting down VM %s: %s",
+                          vm.name, str(e))
+            success = False
+
+        if not success:
+            logging.warning("Failed to shutdown VM: %s (%s)", vm.name, vm.ip)
+        return success
+
+    def _reprobe(self, host: str) -> None:
+        """Probe a host again before retrying it, as its verdict may be stale."""
+        try:
+            self.reachability.update(self._sweep([host]))
+        except Exception as e:
+            logging.error("Unexpected error probing %s: %s", host, str(e))
+            self.reachability.pop(host, None)
+
+    def _retry_vm(self, vm) -> bool:
+        """Send the poweroff command to a VM again after a failed attempt."""
+        self._reprobe(vm.ip)
+        return self._shutdown_vm(vm)
+
+    def _retry_esxi(self, server) -> bool:
+        """Send the poweroff command to an ESXi server again."""
+        self._reprobe(server.ip)
+        return self._shutdown_esxi(server)
+
+    def _running_vms(self, vms) -> set:
+        """Probe which of the given VMs are still up, in a single sweep."""
+        try:
+            sweep = self._sweep([vm.ip for vm in vms])
+            return {vm.ip for vm in vms if sweep[vm.ip].online}
+        except Exception as e:
+            logging.error("Unexpected error probing VMs: %s", str(e))
+            return {vm.ip for vm in vms}
+
+    def _shutdown_vms_from_esxi(self, target) -> Optional[Dict[str, str]]:
+        """Shutdown VMs of an ESXi server over its own session."""
+        server, vm_names, exclude = target
+        logging.info("Attempting to shutdown %s VMs from ESXi server: %s",
+                     "all" if vm_names is None else ", ".join(vm_names),
+                     server.name)
+        try:
+            return self.remote_manager.shutdown_esxi_vms(
+                server.ip, server.username, server.password, port=server.port,
+                vm_names=vm_names, exclude=exclude)
+        except Exception as e:
+            logging.error("Unexpected error shutting down VMs from %s: %s",
+                          server.name, str(e))
+            return None
+
+    def _esxi_vm_states(self, server) -> Optional[Dict[str, str]]:
+        """Query the power state of every VM of an ESXi server."""
+        try:
+            return self.remote_manager.get_esxi_vm_power_states(
+                server.ip, server.username, server.password, port=server.port)
+        except Exception as e:
+            logging.error("Unexpected error querying VM states on %s: %s",
+                          server.name, str(e))
+            return None
+
+    def _hard_poweroff_vms(self, target) -> Optional[Dict[str, str]]:
+        """Hard power off the given VMs from their ESXi server."""
+        server, vms = target
+        logging.warning("Hard powering off %s VMs from ESXi server %s: %s",
+                        len(vms), server.name,
+                        ", ".join(vm.name for vm in vms))
+        try:
+            return self.remote_manager.hard_poweroff_esxi_vms(
+                server.ip, server.username, server.password,
+                [vm.name for vm in vms], port=server.port)
+        except Exception as e:
+            logging.error("Unexpected error hard powering off VMs on %s: %s",
+                          server.name, str(e))
+            return None
+
+    def _shutdown_esxi(self, server) -> bool:
+        """Send the poweroff command to a single ESXi server."""
+        logging.info("Attempting to shutdown ESXi server: %s", server.name)
+        try:
+            success = self.remote_manager.poweroff_esxi_server(
+                server.ip, server.username, server.password, port=server.port,
+                online=self._is_online(server.ip)
+            )
+        except Exception as e:
+            logging.error("Unexpected error shutting down ESXi server %s: %s",
+                          server.name, str(e))
+            success = False
+
+        if not success:
+            logging.error("Failed to shutdown ESXi server: %s (%s)",
+                          server.name, server.ip)
+        return success
+
+    def shutdown(self, deadline: Optional[float] = None, link=None) -> bool:
+        """Shutdown all VMs and ESXi servers in the correct order.
+
+        Devices are shut down following the dependency graph of the
+        configuration (see ``ConfigManager.build_shutdown_graph``): each one
+        starts as soon as everything it must wait for is down and a worker is
+        free. Once the poweroff command has been sent to a VM, the VM is
+        polled until it is confirmed off or its deadline expires, and as soon
+        as all of its own VMs are down an ESXi server is powered off without
+        waiting for VMs on other servers. Ready VMs are queued per server and
+        dispatched round-robin so that a server with many guests cannot
+        starve the others of workers. Servers using the ``hypervisor``
+        strategy shut their ready VMs down in batches over their own session
+        instead, falling back to the guest path when that session cannot be
+        used; so does any server for the VMs without guest credentials, such
+        as VMs merged in from a discovery. A VM that failed or was given up on still releases the devices
+        waiting for it.
+
+        With a ``deadline`` the whole run must fit in that many seconds. The
+        end of the budget is kept for the ESXi servers (``esxi_reserve``) and,
+        just before it, for the VMs (``hard_off_reserve``): VMs still running
+        when the graceful phase is over are no longer waited for but hard
+        powered off from their ESXi server, and every ESXi server that has
+        not been powered off yet is sent its poweroff when its reserve starts.
+
+        With a ``journal``, the run resumes from the states recorded by
+        earlier runs: devices confirmed off are not contacted again, only
+        released in dependency order, and VMs that were already sent their
+        shutdown are only awaited. Devices confirmed off that
+        answer the reachability sweep again are shut down again. Every state
+        change of the run is recorded in turn.
+
+        A power-off command that failed is retried after a jittered
+        exponential backoff (see ``RetryPolicy``), on the scheduler's timers
+        so that no worker waits through it. A retry must be over before the
+        hard power-off of the VMs, or the end of the deadline for an ESXi
+        server, and a host that did not answer its probe on
+        ``breaker_threshold`` attempts in a row is not retried anymore. The
+        journal keeps such hosts across runs: the next run does not contact
+        them at all as long as they still do not answer the sweep.
+
+        A ``link`` connects the run to the other shards of a sharded
+        shutdown: ``link.finished(key, success, at)`` is called whenever one
+        of the devices of this run is down, and ``link.receive()`` blocks
+        until a device of another shard is down and returns its key, or
+        None once no more keys will come.
+
+        Args:
+            deadline: Seconds the whole shutdown may take, unlimited if None
+            link: Connection to the other shards, None for a standalone run
+
+        Returns:
+            bool: True if shutdown was successful, False if critical errors occurred
+        """
+        timestamp = time.time()
+        started = time.monotonic()
+        self.phases = {}
+        resumed = self._resumed_states()
+        devices = [((server.name, None), server)
+                   for server in self.config.esxi_servers]
+        devices += [((server.name, vm.name), vm)
+                    for server in self.config.esxi_servers
+                    for vm in server.vms]
+        if resumed:
+            logging.info(
+                "Resuming shutdown from the journal: %s devices already off, "
+                "%s VMs awaiting their shutdown.",
+                sum(resumed.get(key) == CONFIRMED_OFF for key, _ in devices),
+                sum(resumed.get(key) == SENT for key, _ in devices))
+        # Discovered VMs may have no known IP, only their server sees them.
+        # Devices confirmed off are probed too, they may be back on since.
+        hosts = [device.ip for _, device in devices if device.ip is not None]
+        logging.info("Probing reachability of %s devices...", len(hosts))
+        try:
+            self.reachability = self._sweep(hosts)
+        except Exception as e:
+            logging.error("Reachability sweep failed: %s", str(e))
+            self.reachability = {}
+        self._forget_answering(resumed, devices)
+        self.phases['sweep'] = time.monotonic() - started
+
+        logging.info(
+            "Starting pipelined shutdown sequence "
+            "(max_workers=%s, per_host_workers=%s)...",
+            self.max_workers, self.per_host_workers)
+
+        run = _ShutdownRun(self, resumed)
+        if deadline is not None:
+            esxi_reserve = min(self.esxi_reserve,
+                               deadline * _MAX_RESERVE_SHARE)
+            hard_off_reserve = min(self.hard_off_reserve,
+                                   deadline * _MAX_RESERVE_SHARE)
+            run.deadline_at = started + deadline
+            run.esxi_at = run.deadline_at - esxi_reserve
+            run.escalate_at = run.esxi_at - hard_off_reserve
+            logging.info(
+                "Deadline of %s seconds: hard power-off of VMs in %.1fs, "
+                "ESXi power-off in %.1fs at the latest.", deadline,
+                run.escalate_at - time.monotonic(),
+                run.esxi_at - time.monotonic())
+
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        # Work that must meet the deadline never queues behind the workers:
+        # at most one hard power-off and one ESXi power-off per server
+        urgent_executor = ThreadPoolExecutor(
+            max_workers=2 * len(self.config.esxi_servers) or 1)
+        if self.journal is not None:
+            self.journal.open()
+            for key, _ in devices:
+                if resumed.get(key) not in (SENT, CONFIRMED_OFF):
+                    self.journal.record(key, PENDING)
+        try:
+            run.execute(executor, urgent_executor, link)
+        finally:
+            # Past a deadline, operations still running are of no use anymore
+            for pool in (executor, urgent_executor):
+                pool.shutdown(wait=deadline is None, cancel_futures=True)
+            if self.journal is not None:
+                self.journal.close()
+        self.phases['shutdown'] = time.monotonic() - run.started_at
+        closing = time.monotonic()
+        self.remote_manager.close_all_connections()
+        self.phases['close_connections'] = time.monotonic() - closing
+        self.poweroff_durations = run.poweroff_durations
+        self.escalated_vms = run.escalated_vms
+        self.critical_path = run.critical_path()
+
+        self.shutdown_results = [
+            (f"VM {vm.name}", run.vm_results[(server.name, vm.name)])
+            for server in self.config.esxi_servers for vm in server.vms
+        ]
+        self.shutdown_results += [
+            (f"ESXi {server.name}", run.esxi_results[server.name])
+            for server in self.config.esxi_servers
+        ]
+        critical_error = not all(run.esxi_results.values())
+        if link is None:
+            # A shard only reports to the run that merges all of them
+            self._log_summary()
+
+        self.report = self._build_report(run, timestamp, started,
+                                         not critical_error)
+        return not critical_error
+
+    def _log_summary(self) -> None:
+        """Log the outcome of every device and the critical path."""
+        logging.info("\nShutdown Summary:")
+        for device, success in self.shutdown_results:
+            status = "SUCCESS" if success else "FAILED"
+            name = device.split(" ", 1)[1]
+            if device.startswith("VM ") and name in self.escalated_vms:
+                status += " (hard powered off at deadline)"
+            elif device.startswith("VM ") and name in self.poweroff_durations:
+                duration = self.poweroff_durations[name]
+                if duration is None:
+                    status += " (still running at deadline)"
+                else:
+                    status += f" (off after {duration:.1f}s)"
+            logging.info("%s: %s", device, status)
+        if self.critical_path:
+            logging.info("Critical path (%.1fs): %s",
+                         sum(seconds for _, seconds in self.critical_path),
+                         " -> ".join(f"{device} ({seconds:.1f}s)"
+                                     for device, seconds in self.critical_path))
+
+    def _build_report(self, run, timestamp: float, started: float,
+                      success: bool) -> RunReport:
+        """Collect the timings of a finished run into its report."""
+        def timeline(key, sent_at):
+            events = {'released': run.released_at, 'dispatched':
+                      run.dispatched_at, 'sent': sent_at,
+                      'down': run.finished_at}
+            return {event: times[key] - started if key in times else None
+                    for event, times in events.items()}
+
+        devices = []
+        for server in self.config.esxi_servers:
+            for vm in server.vms:
+                key = (server.name, vm.name)
+                devices.append({
+                    'device': f"VM {vm.name}", 'server': server.name,
+                    'ip': vm.ip, 'success': run.vm_results[key],
+                    'attempts': run.attempts.get(key, 0),
+                    'timeline': timeline(key, run.sent_at)})
+            # An ESXi server is done as soon as it accepted its poweroff
+            key = (server.name, None)
+            devices.append({
+                'device': f"ESXi {server.name}", 'server': server.name,
+                'ip': server.ip, 'success': run.esxi_results[server.name],
+                'attempts': run.attempts.get(key, 0),
+                'timeline': timeline(key, run.finished_at)})
+
+        timing = getattr(self.remote_manager, 'timing', None)
+        spans = list(timing.spans(since=started)) if timing is not None else []
+        return RunReport(success=success, timestamp=timestamp, origin=started,
+                         duration=time.monotonic() - started,
+                         phases=dict(self.phases), devices=devices,
+                         spans=spans, critical_path=list(self.critical_path))
+
+
+class _ShutdownRun:
+    """
+    State of a single shutdown, driven from one scheduler thread.
+
+    Remote operations run on the executor; their results, as well as timers
+    for polls and deferred work, are handled back on the scheduler thread so
+    the state needs no locking and no worker ever sleeps.
+    """
+
+    def __init__(self, manager: InfrastructureManager,
+                 resumed: Optional[Dict] = None):
+        self.manager = manager
+        # Journal states of the devices left by earlier runs
+        self.resumed = resumed or {}
+        self.servers = {server.name: server
+                        for server in manager.config.esxi_servers}
+        self.pending_vms: Dict[str, deque] = {}
+        self.in_flight = {name: 0 for name in self.servers}
+        # VMs of every server that are not down (or given up on) yet
+        self.outstanding = {name: {vm.name: vm for vm in server.vms}
+                            for name, server in self.servers.items()}
+        self.esxi_started: set = set()
+        # Devices are keyed (server name, VM name), with None for the server
+        self.prerequisites = (manager.shutdown_graph
+                              if manager.shutdown_graph is not None
+                              else manager.config.build_shutdown_graph())
+        self.blocked = {key: set(prerequisites)
+                        for key, prerequisites in self.prerequisites.items()}
+        self.dependents: Dict[Tuple[str, Optional[str]], list] = {
+            key: [] for key in self.prerequisites}
+        for key, prerequisites in self.prerequisites.items():
+            for prerequisite in prerequisites:
+                # Devices of other shards are only known as prerequisites
+                self.dependents.setdefault(prerequisite, []).append(key)
+        self.released: set = set()
+        # Monotonic times every device was released and handed to a worker
+        self.released_at: Dict[Tuple[str, Optional[str]], float] = {}
+        self.dispatched_at: Dict[Tuple[str, Optional[str]], float] = {}
+        self.started_at: Optional[float] = None
+        self.finished_at: Dict[Tuple[str, Optional[str]], float] = {}
+        # Released VMs of hypervisor servers waiting for the next batch
+        self.hypervisor_ready: Dict[str, list] = {}
+        self.batched_servers: set = set()
+        self.guest_fallback: set = set()
+        # Monotonic times at which a deadline escalates the run, if any
+        self.escalate_at: Optional[float] = None
+        self.esxi_at: Optional[float] = None
+        self.escalated = False
+        self.escalated_vms: List[str] = []
+        # End of the deadline budget, by which retries must be over
+        self.deadline_at: Optional[float] = None
+        # Power-off attempts of every device and when the last one started
+        self.attempts: Dict[Tuple[str, Optional[str]], int] = {}
+        self.attempted_at: Dict[Tuple[str, Optional[str]], float] = {}
+        self.breaker = CircuitBreaker(manager.breaker_threshold)
+        if manager.journal is not None:
+            # Hosts found dead by an earlier run stay so until they answer
+            for host in manager.journal.tripped:
+                self.breaker.trip(host)
+        # Timers are (ready_at, sequence, callback, args) entries of work
+        # that must not start before a given monotonic time
+        self.timers: list = []
+        self.sequence = itertools.count()
+        # Futures mapped to the callback handling their result
+        self.futures: Dict = {}
+        self.executor = None
+        self.urgent_executor = None
+        # Connection to the other shards, whose devices are received on a
+        # thread of their own so that waiting for them never takes a worker
+        self.link = None
+        self.link_executor = None
+        self.link_future = None
+        self.due_polls: List[Tuple[str, object]] = []
+        # VMs waiting for their ESXi server to report them powered off
+        self.hypervisor_waiting: Dict[str, Dict[str, object]] = {}
+        self.sent_at: Dict[Tuple[str, str], float] = {}
+        self.vm_results: Dict[Tuple[str, str], bool] = {}
+        self.esxi_results: Dict[str, bool] = {}
+        self.poweroff_durations: Dict[str, Optional[float]] = {}
+
+    @property
+    def has_capacity(self) -> bool:
+        return len(self.futures) < self.manager.max_workers
+
+    def schedule(self, delay: float, callback, *args) -> None:
+        """Run ``callback(*args)`` on the scheduler thread after ``delay``."""
+        heapq.heappush(self.timers, (time.monotonic() + delay,
+                                     next(self.sequence), callback, args))
+
+    def submit(self, function, argument, callback, *context,
+               urgent: bool = False) -> None:
+        """Run ``function(argument)`` on a worker, then ``callback``."""
+        executor = self.urgent_executor if urgent else self.executor
+        future = executor.submit(function, argument)
+        self.futures[future] = (callback, context)
+
+    def record(self, key, state: str) -> None:
+        """Record the new state of a device in the journal, if any."""
+        if self.manager.journal is not None:
+            self.manager.journal.record(key, state)
+
+    def is_outstanding(self, server_name: str, vm) -> bool:
+        """True while a VM is still handled by the graceful shutdown path."""
+        return (vm.name in self.outstanding[server_name]
+                and vm.name not in self.escalated_vms)
+
+    def execute(self, executor, urgent_executor=None, link=None) -> None:
+        """Run the scheduler loop until every server has been handled."""
+        self.executor = executor
+        self.urgent_executor = urgent_executor or executor
+        self.started_at = time.monotonic()
+        if link is not None:
+            self.link = link
+            self.link_executor = ThreadPoolExecutor(max_workers=1)
+            self.link_future = self.link_executor.submit(link.receive)
+        try:
+            self.run_loop()
+        finally:
+            if self.link_executor is not None:
+                self.link_executor.shutdown(wait=False)
+
+    def run_loop(self) -> None:
+        for key, prerequisites in self.prerequisites.items():
+            if not prerequisites:
+                self.release(key)
+
+        while (self.pending_vms or self.timers or self.futures
+               or self.due_polls or self.link_future is not None):
+            now = time.monotonic()
+            if len(self.esxi_results) == len(self.servers) and (
+                    self.esxi_at is not None or self.link is not None):
+                # Only stale work of a deadline run, or the wait for other
+                # shards, can be left
+                break
+            if self.esxi_at is not None:
+                if not self.escalated and now >= self.escalate_at:
+                    self.escalate()
+                if now >= self.esxi_at and len(self.esxi_started) < len(self.servers):
+                    self.force_esxi()
+
+            # Timed work goes first: ESXi servers are the last step of their
+            # pipeline and polls only gate them.
+            while self.timers and self.timers[0][0] <= now and self.has_capacity:
+                _, _, callback, args = heapq.heappop(self.timers)
+                callback(*args)
+
+            # All guest polls that are due share a single reachability sweep
+            if self.due_polls and self.has_capacity:
+                polls = [(server_name, vm) for server_name, vm in self.due_polls
+                         if self.is_outstanding(server_name, vm)]
+                self.due_polls.clear()
+                if polls:
+                    self.submit(self.manager._running_vms,
+                                [vm for _, vm in polls], self.on_polled,
+                                polls)
+
+            self.dispatch_vms()
+
+            # A due timer waits for a worker to finish, not for the clock
+            wakeups = ([self.timers[0][0]] if self.timers and (
+                self.has_capacity or self.timers[0][0] > now) else [])
+            if not self.escalated and self.escalate_at is not None:
+                wakeups.append(self.escalate_at)
+            elif self.esxi_at is not None and len(self.esxi_started) < len(self.servers):
+                wakeups.append(self.esxi_at)
+            timeout = max(0.0, min(wakeups) - now) if wakeups else None
+            waitables = list(self.futures)
+            if self.link_future is not None:
+                waitables.append(self.link_future)
+            if not waitables:
+                # Work handled in place, such as skipped hosts, may have been
+                # the last of the run
+                if timeout is not None:
+                    time.sleep(timeout)
+                continue
+
+            done, _ = wait(waitables, timeout=timeout,
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                if future is self.link_future:
+                    self.on_link_received(future.result())
+                    continue
+                callback, context = self.futures.pop(future)
+                callback(future.result(), *context)
+
+    def on_link_received(self, key) -> None:
+        """Handle a device of another shard being down."""
+        if key is None:
+            self.link_future = None
+            return
+        self.link_future = self.link_executor.submit(self.link.receive)
+        if key in self.dependents and key not in self.finished_at:
+            self.finish(key)
+
+    def dispatch_vms(self) -> None:
+        """Start guest shutdowns round-robin across the ESXi servers."""
+        for server_name in list(self.pending_vms):
+            if not self.has_capacity:
+                break
+            if self.in_flight[server_name] >= self.manager.per_host_workers:
+                continue
+            vm = self.pending_vms[server_name].popleft()
+            if not self.pending_vms[server_name]:
+                del self.pending_vms[server_name]
+            if not self.is_outstanding(server_name, vm):
+                continue
+            key = (server_name, vm.name)
+            if self.skipped(vm.ip):
+                self.vm_results[key] = False
+                self.vm_down(server_name, vm, confirmed=False)
+                continue
+            self.in_flight[server_name] += 1
+            self.dispatched_at.setdefault(key, time.monotonic())
+            function = (self.manager._retry_vm if key in self.attempts
+                        else self.manager._shutdown_vm)
+            self.attempt(key)
+            self.submit(function, vm, self.on_vm_sent, server_name, vm)
+
+    def vm_sent(self, server_name: str, vm) -> None:
+        """Record that a VM accepted its shutdown and must now be awaited."""
+        self.vm_results[(server_name, vm.name)] = True
+        self.sent_at[(server_name, vm.name)] = time.monotonic()
+        self.record((server_name, vm.name), SENT)
+
+    def vm_down(self, server_name: str, vm, confirmed: bool) -> None:
+        """Record that a VM is off (or given up on) and advance its server."""
+        if self.outstanding[server_name].pop(vm.name, None) is None:
+            return
+        self.record((server_name, vm.name),
+                    CONFIRMED_OFF if confirmed else FAILED)
+        if (server_name, vm.name) in self.sent_at:
+            elapsed = time.monotonic() - self.sent_at[(server_name, vm.name)]
+            if confirmed:
+                self.poweroff_durations[vm.name] = elapsed
+                logging.info("VM %s confirmed off after %.1f seconds.",
+                             vm.name, elapsed)
+            else:
+                self.poweroff_durations[vm.name] = None
+                logging.warning(
+                    "VM %s is still running %s seconds after its poweroff "
+                    "command, giving up waiting.",
+                    vm.name, self.manager.vm_poweroff_timeout)
+
+        self.finish((server_name, vm.name))
+
+    def release(self, key) -> None:
+        """Start the shutdown of a device that no longer waits for others."""
+        self.released.add(key)
+        self.released_at[key] = time.monotonic()
+        server_name, vm_name = key
+        if self.resumed.get(key) == CONFIRMED_OFF:
+            self.resume_off(key)
+            return
+        if vm_name is None:
+            logging.info("ESXi server %s is ready to be powered off.",
+                         server_name)
+            if self.escalated:
+                self.shutdown_esxi(server_name)
+            else:
+                self.schedule(0, self.shutdown_esxi, server_name)
+            return
+
+        vm = self.outstanding[server_name].get(vm_name)
+        if vm is None or self.escalated:
+            # Already handled, or covered by the hard power-off
+            return
+        if self.resumed.get(key) == SENT:
+            self.resume_sent(server_name, vm)
+            return
+        if self.from_hypervisor(server_name, vm):
+            ready = self.hypervisor_ready.setdefault(server_name, [])
+            if not ready:
+                self.schedule(0, self.shutdown_vms_from_esxi, server_name)
+            ready.append(vm)
+        else:
+            self.pending_vms.setdefault(server_name, deque()).append(vm)
+
+    def from_hypervisor(self, server_name: str, vm) -> bool:
+        """True if a VM is shut down from its ESXi server, not its guest.
+
+        Servers using the ``hypervisor`` strategy shut all their VMs down,
+        any server shuts down the VMs it has no guest credentials for, such
+        as discovered ones.
+        """
+        return ((self.servers[server_name].vm_shutdown_strategy == 'hypervisor'
+                 or vm.username is None)
+                and server_name not in self.guest_fallback)
+
+    def resume_off(self, key) -> None:
+        """Skip a device an earlier run confirmed off."""
+        server_name, vm_name = key
+        if vm_name is None:
+            logging.info("ESXi server %s was powered off by an earlier run.",
+                         server_name)
+            self.esxi_started.add(server_name)
+            self.esxi_results[server_name] = True
+        else:
+            logging.info("VM %s was confirmed off by an earlier run.", vm_name)
+            self.vm_results[key] = True
+            self.outstanding[server_name].pop(vm_name, None)
+        self.finish(key)
+
+    def resume_sent(self, server_name: str, vm) -> None:
+        """Await a VM an earlier run sent its shutdown, without resending it."""
+        logging.info("VM %s was sent its shutdown by an earlier run, waiting "
+                     "for it to be off.", vm.name)
+        self.dispatched_at.setdefault((server_name, vm.name), time.monotonic())
+        self.vm_sent(server_name, vm)
+        if self.from_hypervisor(server_name, vm):
+            if server_name in self.hypervisor_waiting:
+                self.hypervisor_waiting[server_name][vm.name] = vm
+            else:
+                self.hypervisor_waiting[server_name] = {vm.name: vm}
+                self.schedule(0, self.poll_esxi_vms, server_name)
+        else:
+            self.due_polls.append((server_name, vm))
+
+    def finish(self, key) -> None:
+        """Record that a device is down and release the devices it gated."""
+        self.finished_at[key] = time.monotonic()
+        if self.link is not None and key in self.prerequisites:
+            server_name, vm_name = key
+            success = (self.esxi_results.get(server_name) if vm_name is None
+                       else self.vm_results.get(key))
+            self.link.finished(key, bool(success), self.finished_at[key])
+        for dependent in self.dependents[key]:
+            blocked = self.blocked[dependent]
+            blocked.discard(key)
+            if not blocked and dependent not in self.released:
+                self.release(dependent)
+
+    def critical_path(self) -> List[Tuple[str, float]]:
+        """Return the chain of devices that gated the end of the run."""
+        return critical_path(self.prerequisites, self.finished_at,
+                             self.started_at)
+
+    def attempt(self, key) -> None:
+        """Count a power-off attempt of a device."""
+        self.attempts[key] = self.attempts.get(key, 0) + 1
+        self.attempted_at[key] = time.monotonic()
+
+    def skipped(self, host: Optional[str]) -> bool:
+        """True if a host's circuit is open and it still does not answer."""
+        if (host is None or not self.breaker.is_open(host)
+                or self.manager._is_online(host) is not False):
+            return False
+        logging.warning("%s did not answer an earlier run either, not "
+                        "contacting it.", host)
+        return True
+
+    def succeeded(self, host: str) -> None:
+        """Close the circuit of a host that accepted its power-off."""
+        if self.breaker.is_open(host) and self.manager.journal is not None:
+            self.manager.journal.record_breaker(host, tripped=False)
+        self.breaker.record(host, success=True)
+
+    def retry_later(self, key, host: str, limit: Optional[float],
+                    callback, *args) -> bool:
+        """Schedule ``callback(*args)`` to retry a failed power-off, if allowed.
+
+        Args:
+            key: The device whose attempt failed
+            host: Its address, which the circuit breaker is kept for
+            limit: Monotonic time by which the retry must be over, if any
+            callback: Called on the scheduler thread once the backoff is over
+
+        Returns:
+            bool: True if the retry was scheduled, False to give up
+        """
+        now = time.monotonic()
+        was_open = self.breaker.is_open(host)
+        self.breaker.record(host, success=False,
+                            hard=self.manager._is_online(host) is False)
+        if self.breaker.is_open(host):
+            if not was_open and self.manager.journal is not None:
+                self.manager.journal.record_breaker(host, tripped=True)
+            logging.warning("%s did not answer %s attempts in a row, not "
+                            "retrying it.", host, self.breaker.failures[host])
+            return False
+        delay = self.manager.retry_policy.next_delay(
+            self.attempts[key], now, now - self.attempted_at[key], limit)
+        if delay is None:
+            return False
+        logging.warning("Attempt %s to power off %s failed, retrying in "
+                        "%.1f seconds.", self.attempts[key], host, delay)
+        self.schedule(delay, callback, *args)
+        return True
+
+    def retry_vm(self, server_name: str, vm) -> None:
+        """Queue a VM for another attempt once its backoff is over."""
+        if self.escalated or not self.is_outstanding(server_name, vm):
+            return
+        self.pending_vms.setdefault(server_name, deque()).append(vm)
+
+    def timed_out(self, server_name: str, vm) -> bool:
+        elapsed = time.monotonic() - self.sent_at[(server_name, vm.name)]
+        return elapsed >= self.manager.vm_poweroff_timeout
+
+    def on_vm_sent(self, success: bool, server_name: str, vm) -> None:
+        self.in_flight[server_name] -= 1
+        if not self.is_outstanding(server_name, vm):
+            return
+        if not success:
+            # VMs without guest credentials cannot succeed on a retry
+            if vm.username is not None and self.retry_later(
+                    (server_name, vm.name), vm.ip, self.escalate_at,
+                    self.retry_vm, server_name, vm):
+                return
+            self.vm_results[(server_name, vm.name)] = False
+            self.vm_down(server_name, vm, confirmed=False)
+            return
+        self.succeeded(vm.ip)
+        self.vm_sent(server_name, vm)
+        self.schedule(self.manager.poll_interval, self.due_polls.append,
+                      (server_name, vm))
+
+    def on_polled(self, running: set, polls) -> None:
+        for server_name, vm in polls:
+            if not self.is_outstanding(server_name, vm):
+                continue
+            if vm.ip not in running:
+                self.vm_down(server_name, vm, confirmed=True)
+            elif self.timed_out(server_name, vm):
+                self.vm_down(server_name, vm, confirmed=False)
+            else:
+                self.schedule(self.manager.poll_interval,
+                              self.due_polls.append, (server_name, vm))
+
+    def shutdown_vms_from_esxi(self, server_name: str) -> None:
+        server = self.servers[server_name]
+        vms = [vm for vm in self.hypervisor_ready.pop(server_name, [])
+               if self.is_outstanding(server_name, vm)]
+        if not vms:
+            return
+        if server_name in self.guest_fallback:
+            self.pending_vms.setdefault(server_name, deque()).extend(vms)
+            return
+
+        batch = [vm.name for vm in vms]
+        for name in batch:
+            self.dispatched_at.setdefault((server_name, name),
+                                          time.monotonic())
+        if (server_name in self.batched_servers
+                or server.vm_shutdown_strategy != 'hypervisor'):
+            target = (server, batch, ())
+        else:
+            # The first batch also covers the VMs missing from the
+            # configuration, only configured VMs still blocked are left out
+            self.batched_servers.add(server_name)
+            target = (server, None,
+                      [vm.name for vm in server.vms if vm.name not in batch])
+        self.submit(self.manager._shutdown_vms_from_esxi, target,
+                    self.on_esxi_vms_sent, server_name, vms, target[1] is None)
+
+    def on_esxi_vms_sent(self, outcomes: Optional[Dict[str, str]],
+                         server_name: str, vms, first_batch: bool) -> None:
+        server = self.servers[server_name]
+        if self.escalated:
+            # The hard power-off has taken over these VMs
+            return
+        if outcomes is None:
+            logging.warning("Falling back to guest shutdown for the VMs of "
+                            "ESXi server %s.", server_name)
+            self.guest_fallback.add(server_name)
+            self.pending_vms.setdefault(server_name, deque()).extend(vms)
+            return
+
+        if first_batch:
+            configured = {vm.name for vm in server.vms}
+            for name in outcomes.keys() - configured:
+                logging.info("VM %s on ESXi server %s is not in the "
+                             "configuration, shut down from the host only.",
+                             name, server_name)
+
+        fallback = []
+        waiting = {}
+        for vm in vms:
+            outcome = outcomes.get(vm.name)
+            if outcome is None:
+                logging.warning("VM %s is not registered on ESXi server %s, "
+                                "falling back to guest shutdown.",
+                                vm.name, server_name)
+                fallback.append(vm)
+            elif outcome in _HYPERVISOR_SENT:
+                self.vm_sent(server_name, vm)
+                waiting[vm.name] = vm
+            else:
+                # "skipped" VMs were not running in the first place
+                self.vm_results[(server_name, vm.name)] = outcome == 'skipped'
+                self.vm_down(server_name, vm,
+                             confirmed=outcome == 'skipped')
+
+        if fallback:
+            self.pending_vms.setdefault(server_name, deque()).extend(fallback)
+        if waiting and server_name in self.hypervisor_waiting:
+            # Already polled for an earlier batch
+            self.hypervisor_waiting[server_name].update(waiting)
+        elif waiting:
+            self.hypervisor_waiting[server_name] = waiting
+            self.schedule(self.manager.poll_interval,
+                          self.poll_esxi_vms, server_name)
+
+    def poll_esxi_vms(self, server_name: str) -> None:
+        self.submit(self.manager._esxi_vm_states, self.servers[server_name],
+                    self.on_esxi_vms_polled, server_name)
+
+    def on_esxi_vms_polled(self, states: Optional[Dict[str, str]],
+                           server_name: str) -> None:
+        waiting = self.hypervisor_waiting.get(server_name)
+        if waiting is None:
+            return
+        for name, vm in list(waiting.items()):
+            if states is not None and states.get(name) != 'Powered on':
+                del waiting[name]
+                self.vm_down(server_name, vm, confirmed=True)
+            elif self.timed_out(server_name, vm):
+                del waiting[name]
+                self.vm_down(server_name, vm, confirmed=False)
+
+        if waiting:
+            self.schedule(self.manager.poll_interval,
+                          self.poll_esxi_vms, server_name)
+        else:
+            del self.hypervisor_waiting[server_name]
+
+    def escalate(self) -> None:
+        """Stop waiting for graceful shutdowns and hard power off the rest."""
+        self.escalated = True
+        self.pending_vms.clear()
+        self.hypervisor_waiting.clear()
+        for server_name, outstanding in self.outstanding.items():
+            if not outstanding:
+                continue
+            vms = list(outstanding.values())
+            logging.warning("Deadline reached with %s VMs still running on "
+                            "ESXi server %s, escalating to hard power-off.",
+                            len(vms), server_name)
+            for vm in vms:
+                self.escalated_vms.append(vm.name)
+                self.dispatched_at.setdefault((server_name, vm.name),
+                                              time.monotonic())
+                self.sent_at.setdefault((server_name, vm.name),
+                                        time.monotonic())
+            self.submit(self.manager._hard_poweroff_vms,
+                        (self.servers[server_name], vms), self.on_hard_off,
+                        server_name, vms, urgent=True)
+
+    def on_hard_off(self, outcomes: Optional[Dict[str, str]],
+                    server_name: str, vms) -> None:
+        for vm in vms:
+            outcome = (outcomes or {}).get(vm.name)
+            # "skipped" VMs went down on their own in the meantime
+            success = outcome in ('off', 'skipped')
+            self.vm_results[(server_name, vm.name)] = success
+            self.vm_down(server_name, vm, confirmed=success)
+
+    def force_esxi(self) -> None:
+        """Power off every ESXi server not started yet, whatever its VMs."""
+        for server_name in self.servers:
+            if server_name in self.esxi_started:
+                continue
+            outstanding = self.outstanding[server_name]
+            if outstanding:
+                logging.error("ESXi reserve reached, powering off ESXi server "
+                              "%s with VMs still running: %s", server_name,
+                              ", ".join(outstanding))
+                for name in outstanding:
+                    self.vm_results.setdefault((server_name, name), False)
+                    self.poweroff_durations[name] = None
+                    self.record((server_name, name), FAILED)
+                outstanding.clear()
+            self.shutdown_esxi(server_name)
+
+    def shutdown_esxi(self, server_name: str) -> None:
+        if server_name in self.esxi_started:
+            return
+        self.esxi_started.add(server_name)
+        self.dispatched_at[(server_name, None)] = time.monotonic()
+        if self.skipped(self.servers[server_name].ip):
+            self.esxi_results[server_name] = False
+            self.record((server_name, None), FAILED)
+            self.finish((server_name, None))
+            return
+        self.attempt((server_name, None))
+        self.submit(self.manager._shutdown_esxi, self.servers[server_name],
+                    self.on_esxi_done, server_name, urgent=self.escalated)
+
+    def retry_esxi(self, server_name: str) -> None:
+        """Send an ESXi server its poweroff again once its backoff is over."""
+        self.attempt((server_name, None))
+        self.submit(self.manager._retry_esxi, self.servers[server_name],
+                    self.on_esxi_done, server_name, urgent=self.escalated)
+
+    def on_esxi_done(self, success: bool, server_name: str) -> None:
+        server = self.servers[server_name]
+        if not success and self.retry_later(
+                (server_name, None), server.ip, self.deadline_at,
+                self.retry_esxi, server_name):
+            return
+        if success:
+            self.succeeded(server.ip)
+        self.esxi_results[server_name] = success
+        self.record((server_name, None), CONFIRMED_OFF if success else FAILED)
+        self.finish((server_name, None))
@@ -0,0 +1,278 @@
+"""
+Module for resuming an interrupted or repeated shutdown.
+"""
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Dict, Optional, Set, Tuple
+
+
+# States of a device in the journal
+PENDING = 'pending'
+SENT = 'sent'
+CONFIRMED_OFF = 'confirmed_off'
+FAILED = 'failed'
+JOURNAL_STATES = (PENDING, SENT, CONFIRMED_OFF, FAILED)
+
+DeviceKey = Tuple[str, Optional[str]]
+
+
+class ShutdownJournal:
+    """
+    Append-only journal of the state of every device of a shutdown.
+
+    Every state change is one JSON line. Lines are written by a background
+    thread that appends whatever has queued up in a single write followed by
+    an fsync, so the scheduler never waits for the disk and a crash loses at
+    most the last few milliseconds of progress.
+
+    A later run loads the journal and resumes: devices confirmed off are
+    skipped unless they answer again, and VMs that were sent their shutdown
+    are only awaited. Only an interrupted run is resumed: a run that
+    finished ends the journal with a completion line holding its result,
+    and a repeated trigger finds that result instead of shutting down again
+    devices that are already off. Hosts whose circuit breaker opened are
+    kept across completion lines. The journal is trusted for
+    ``resume_window`` seconds after its last line; past that, devices may
+    have been powered on again and it is started over.
+    """
+
+    def __init__(self, path: str, resume_window: float = 900):
+        """Initialize the journal.
+
+        Args:
+            path: Path of the journal file
+            resume_window: Seconds after its last line during which the
+                journal is resumed rather than started over
+        """
+        self.path = path
+        self.resume_window = resume_window
+        # Last state of every device of the journal being resumed
+        self.states: Dict[DeviceKey, str] = {}
+        # Hosts whose circuit breaker is open, whether or not a run finished
+        self.tripped: Set[str] = set()
+        # Result of the run that finished the journal, None if none did
+        self.completed: Optional[bool] = None
+        self._fd: Optional[int] = None
+        self._queue: Optional[queue.SimpleQueue] = None
+        self._writer: Optional[threading.Thread] = None
+
+    def load(self) -> Dict[DeviceKey, str]:
+        """Read the states left by earlier runs.
+
+        A journal last written more than ``resume_window`` seconds ago is
+        emptied, and states written before a completion line are dropped, as
+        the run they belong to finished; the hosts whose circuit breaker
+        opened are not. ``completed`` is the result of that run, unless a
+        later run started since. A truncated or unreadable line, as a crash in the
+        middle of a write leaves, is ignored.
+
+        Returns:
+            Dict[DeviceKey, str]: Last state of every device
+        """
+        states: Dict[DeviceKey, str] = {}
+        tripped: Set[str] = set()
+        completed = None
+        last_time = None
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        if entry.get('complete'):
+                            states = {}
+                            success = entry.get('success')
+                            completed = (success if isinstance(success, bool)
+                                         else None)
+                            last_time = float(entry['time'])
+                            continue
+                        if 'host' in entry:
+                            host = str(entry['host'])
+                            if entry.get('tripped'):
+                                tripped.add(host)
+                            else:
+                                tripped.discard(host)
+                            last_time = float(entry['time'])
+                            continue
+                        key = (entry['server'], entry['vm'])
+                        state = entry['state']
+                        entry_time = float(entry['time'])
+                    except (ValueError, KeyError, TypeError, AttributeError):
+                        continue
+                    if state in JOURNAL_STATES:
+                        states[key] = state
+                        completed = None
+                        last_time = entry_time
+        except FileNotFoundError:
+            pass
+
+        if last_time is not None and time.time() - last_time > self.resume_window:
+            logging.info("Shutdown journal %s is older than %s seconds, "
+                         "starting over.", self.path, self.resume_window)
+            states = {}
+            tripped = set()
+            completed = None
+            with open(self.path, 'w', encoding='utf-8'):
+                pass
+        self.states = states
+        self.tripped = tripped
+        self.completed = completed
+        return states
+
+    def reset(self) -> None:
+        """Empty the journal once the devices it lists are running again.
+
+        A shutdown right after a startup must contact every device, not
+        resume the shutdown that preceded the startup.
+        """
+        self.states = {}
+        self.tripped = set()
+        self.completed = None
+        try:
+            os.truncate(self.path, 0)
+        except FileNotFoundError:
+            pass
+
+    def complete(self, success: bool) -> None:
+        """Mark the run as finished, so that a repeated trigger does not
+        run it again.
+
+        Written only once a run returned: a run that died in the middle
+        leaves its journal to be resumed.
+
+        Args:
+            success: Result of the run, returned to repeated triggers
+        """
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            os.write(fd, (json.dumps({'time': time.time(), 'complete': True,
+                                      'success': success})
+                          + '\n').encode('utf-8'))
+            os.fsync(fd)
+        except OSError as e:
+            logging.error("Failed to complete shutdown journal %s: %s",
+                          self.path, str(e))
+        finally:
+            os.close(fd)
+        self.states = {}
+        self.completed = success
+
+    def open(self) -> None:
+        """Open the journal for appending and start its writer thread.
+
+        Called by the process that runs the shutdown, after a fork if any.
+        """
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                           0o600)
+        self._queue = queue.SimpleQueue()
+        self._writer = threading.Thread(target=self._write_loop,
+                                        name="shutdown-journal", daemon=True)
+        self._writer.start()
+
+    def record(self, key: DeviceKey, state: str) -> None:
+        """Queue the new state of a device for the journal."""
+        server_name, vm_name = key
+        self._queue.put(json.dumps({
+            'time': time.time(), 'server': server_name, 'vm': vm_name,
+            'state': state}) + '\n')
+
+    def record_breaker(self, host: str, tripped: bool) -> None:
+        """Queue that the circuit breaker of a host opened or closed."""
+        self._queue.put(json.dumps({
+            'time': time.time(), 'host': host, 'tripped': tripped}) + '\n')
+
+    def close(self) -> None:
+        """Write every queued state and close the journal."""
+        if self._writer is None:
+            return
+        self._queue.put(None)
+        self._writer.join()
+        os.close(self._fd)
+        self._fd = self._queue = self._writer = None
+
+    def _write_loop(self) -> None:
+        closing = False
+        while not closing:
+            lines = [self._queue.get()]
+            while not self._queue.empty():
+                lines.append(self._queue.get())
+            if lines[-1] is None:
+                closing = True
+                lines.pop()
+            if not lines:
+                continue
+            try:
+                os.write(self._fd, ''.join(lines).encode('utf-8'))
+                os.fsync(self._fd)
+            except OSError as e:
+                logging.error("Failed to write shutdown journal %s: %s",
+                              self.path, str(e))
+
+
+class RunLock:
+    """
+    Exclusive lock serializing shutdown runs across processes.
+
+    The lock is an ``flock`` on a lock file, so the kernel releases it when
+    its holder dies, however it dies. A run that finds the lock taken waits
+    for it, then reads the journal of the run that held it: it resumes that
+    run if its holder crashed, and finds its result if it finished.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fd: Optional[int] = None
+
+    def __enter__(self) -> "RunLock":
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logging.warning("Another shutdown run holds %s, waiting for it.",
+                            self.path)
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+
+
+@contextlib.contextmanager
+def serialized_run(settings):
+    """Hold the run lock for a shutdown run and load its journal.
+
+    A shutdown run marks the journal complete with its result once it
+    returned; an exception or the death of the process leaves it to be
+    resumed by the next run. A run must check ``journal.completed`` first:
+    a shutdown that already finished is not to be run again.
+
+    Args:
+        settings: The ``JournalConfig`` of the configuration
+
+    Yields:
+        Optional[ShutdownJournal]: The loaded journal, None without one
+    """
+    lock = (RunLock(settings.lock_file) if settings.lock_file is not None
+            else contextlib.nullcontext())
+    with lock:
+        journal = None
+        if settings.file is not None:
+            journal = ShutdownJournal(settings.file, settings.resume_window)
+            journal.load()
+        yield journal
@@ -0,0 +1,484 @@
+"""
+Module for predicting the duration of a shutdown without running it.
+"""
+import heapq
+import itertools
+import json
+import logging
+import math
+import statistics
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from .atomic_file import write_atomically
+from .infrastructure_manager import _MAX_RESERVE_SHARE, critical_path
+
+
+# Weight of the latest run in the averages of the latency history
+_HISTORY_WEIGHT = 0.3
+# Device stages whose latency is learned from earlier runs, see RunReport
+_HISTORY_STAGES = ('send', 'wait_off')
+# Run phases around the shutdown itself that are learned as well
+_HISTORY_PHASES = ('load_config', 'sweep', 'close_connections')
+# Seconds assumed for a stage no earlier run has timed on any device
+_DEFAULT_LATENCIES = {'send': 2.0, 'wait_off': 30.0}
+
+
+class LatencyHistory:
+    """
+    Latencies of every device over earlier shutdown runs, kept in a JSON file.
+
+    Every shutdown report updates an exponentially weighted average of the
+    seconds each device took to accept its shutdown (``send``) and then to
+    be off (``wait_off``), and of the run phases around the shutdown, so
+    the latest runs weigh most without a single slow one dominating.
+    """
+
+    def __init__(self, path: Optional[str]):
+        """Initialize the latency history.
+
+        Args:
+            path: Path of the history file, None for an empty history that
+                is never written
+        """
+        self.path = path
+        self.runs = 0
+        self.phases: Dict[str, float] = {}
+        # Average seconds of every stage, by device name as in the reports
+        self.devices: Dict[str, Dict[str, float]] = {}
+        self._load()
+
+    def _load(self) -> None:
+        if self.path is None:
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            runs = int(data.get('runs', 0))
+            phases = {name: float(seconds)
+                      for name, seconds in data.get('phases', {}).items()}
+            devices = {name: {stage: float(seconds)
+                              for stage, seconds in stages.items()}
+                       for name, stages in data.get('devices', {}).items()}
+        except FileNotFoundError:
+            return
+        except (ValueError, TypeError, AttributeError, OSError) as e:
+            logging.warning("Ignoring unreadable latency history %s: %s",
+                            self.path, str(e))
+            return
+        self.runs, self.phases, self.devices = runs, phases, devices
+
+    def latency(self, device: str, stage: str) -> Optional[float]:
+        """Return the average seconds a device spent in a stage, if known."""
+        return self.devices.get(device, {}).get(stage)
+
+    def typical(self, kind: str, stage: str) -> Optional[float]:
+        """Return the median latency of a stage over the devices of a kind.
+
+        Args:
+            kind: ``VM`` or ``ESXi``, the prefix of the device names
+            stage: Stage of the device timeline
+        """
+        known = [stages[stage] for name, stages in self.devices.items()
+                 if name.startswith(f"{kind} ") and stage in stages]
+        return statistics.median(known) if known else None
+
+    def update(self, report) -> None:
+        """Fold the timings of a finished shutdown run into the history.
+
+        Args:
+            report: The ``RunReport`` of the run
+        """
+        if report.kind != 'shutdown':
+            return
+        for device in report.devices:
+            stages = report.device_stages(device)
+            averages = self.devices.setdefault(device['device'], {})
+            for stage in _HISTORY_STAGES:
+                if stage in stages:
+                    averages[stage] = self._average(averages.get(stage),
+                                                    stages[stage])
+        for phase in _HISTORY_PHASES:
+            if phase in report.phases:
+                self.phases[phase] = self._average(self.phases.get(phase),
+                                                   report.phases[phase])
+        self.runs += 1
+        self._write()
+
+    @staticmethod
+    def _average(previous: Optional[float], seconds: float) -> float:
+        if previous is None:
+            return seconds
+        return previous + _HISTORY_WEIGHT * (seconds - previous)
+
+    def _write(self) -> None:
+        if self.path is None:
+            return
+        try:
+            write_atomically(self.path, json.dumps(
+                {'runs': self.runs, 'updated_at': time.time(),
+                 'phases': self.phases, 'devices': self.devices}, indent=2))
+        except OSError as e:
+            logging.error("Failed to write latency history %s: %s",
+                          self.path, str(e))
+
+
+@dataclass
+class ShutdownPlan:
+    """
+    Predicted course of a shutdown.
+
+    Device timelines use the offsets and events of a ``RunReport``, from
+    the start of the run. ``at_risk`` lists the devices a real run would
+    have to give up on or escalate, with the reason.
+    """
+    wall_time: float
+    phases: Dict[str, float] = field(default_factory=dict)
+    devices: List[Dict] = field(default_factory=list)
+    critical_path: List[Tuple[str, float]] = field(default_factory=list)
+    at_risk: List[Tuple[str, str]] = field(default_factory=list)
+    deadline: Optional[float] = None
+    # Earlier runs the latencies were learned from, and devices none timed
+    history_runs: int = 0
+    estimated_devices: int = 0
+
+    @property
+    def fits(self) -> Optional[bool]:
+        """Whether the shutdown ends within its deadline without escalating.
+
+        None without a deadline.
+        """
+        if self.deadline is None:
+            return None
+        return (self.phases.get('sweep', 0.0) + self.phases['shutdown']
+                <= self.deadline
+                and not any(reason != 'given up on' for _, reason
+                            in self.at_risk))
+
+    def to_dict(self) -> Dict:
+        """Return the plan as a JSON serializable mapping."""
+        return {
+            'predicted_wall_time_seconds': self.wall_time,
+            'deadline_seconds': self.deadline,
+            'fits': self.fits,
+            'phases': self.phases,
+            'critical_path': [{'device': device, 'seconds': seconds}
+                              for device, seconds in self.critical_path],
+            'at_risk': [{'device': device, 'reason': reason}
+                        for device, reason in self.at_risk],
+            'history_runs': self.history_runs,
+            'estimated_devices': self.estimated_devices,
+            'devices': self.devices,
+        }
+
+
+class ShutdownPlanner:
+    """
+    Simulate a shutdown under the configured concurrency, without the network.
+
+    The simulation follows the rules of ``InfrastructureManager.shutdown``:
+    the same dependency graph, the global and per ESXi server worker limits
+    (per shard with several processes), VMs of ``hypervisor`` servers and
+    VMs without guest credentials shut down in batches from their server,
+    and the confirmation of every VM at the first poll after it is off.
+    Polls are assumed to take no worker. The latency of every device comes
+    from the history of earlier runs, from the median of the devices of
+    the same kind when it was never timed, or from defaults.
+    """
+
+    def __init__(self, config, history: Optional[LatencyHistory] = None,
+                 max_workers: Optional[int] = None,
+                 per_host_workers: Optional[int] = None,
+                 processes: Optional[int] = None):
+        """Initialize the shutdown planner.
+
+        Args:
+            config: A loaded ``ConfigManager`` instance
+            history: Latencies of earlier runs, None to use defaults only
+            max_workers: Global limit of concurrent remote operations,
+                defaults to the ``shutdown.max_workers`` setting
+            per_host_workers: Limit of concurrent VM operations per ESXi
+                server, defaults to the ``shutdown.per_host_workers`` setting
+            processes: Number of worker processes, defaults to the
+                ``shutdown.processes`` setting
+        """
+        self.config = config
+        self.history = history or LatencyHistory(None)
+        self.max_workers = max_workers or config.shutdown.max_workers
+        self.per_host_workers = (per_host_workers
+                                 or config.shutdown.per_host_workers)
+        self.processes = processes or config.shutdown.processes
+        # Devices whose latencies are not their own measurements
+        self.estimated: set = set()
+
+    def latency(self, device: str, stage: str) -> float:
+        """Return the predicted seconds a device spends in a stage."""
+        seconds = self.history.latency(device, stage)
+        if seconds is not None:
+            return seconds
+        self.estimated.add(device)
+        kind = device.split(' ', 1)[0]
+        typical = self.history.typical(kind, stage)
+        if typical is not None:
+            return typical
+        return _DEFAULT_LATENCIES[stage]
+
+    def shards(self) -> Dict[str, int]:
+        """Return the shard every ESXi server is shut down from."""
+        if self.processes <= 1:
+            return {server.name: 0 for server in self.config.esxi_servers}
+        from .sharding import ShardedInfrastructureManager
+        shards = ShardedInfrastructureManager(
+            self.config, None, self.processes).plan_shards()
+        return {server.name: index
+                for index, shard in enumerate(shards) for server in shard}
+
+    def plan(self, deadline: Optional[float] = None) -> ShutdownPlan:
+        """Predict the shutdown of the configuration.
+
+        Args:
+            deadline: Seconds the whole shutdown may take, as given to
+                ``InfrastructureManager.shutdown``, None for unlimited
+
+        Returns:
+            ShutdownPlan: The predicted wall time, critical path and
+            devices at risk
+        """
+        self.estimated = set()
+        settings = self.config.shutdown
+        phases = {phase: self.history.phases.get(phase, 0.0)
+                  for phase in _HISTORY_PHASES}
+        # Offline hosts hold the sweep for the whole probe timeout
+        phases['sweep'] = self.history.phases.get('sweep',
+                                                  settings.probe_timeout)
+        run = _PlannedRun(self)
+        run.execute()
+        phases['shutdown'] = run.now
+        origin = phases['sweep']
+
+        devices = []
+        for key, device in run.devices():
+            devices.append({
+                'device': device, 'server': key[0],
+                'shard': run.shard_of[key[0]],
+                'estimated': device in self.estimated,
+                'timeline': {event: times[key] + origin if key in times
+                             else None for event, times in (
+                                 ('released', run.released_at),
+                                 ('dispatched', run.dispatched_at),
+                                 ('sent', run.sent_at),
+                                 ('down', run.finished_at))}})
+
+        at_risk = [(run.name(key), 'given up on')
+                   for key in run.given_up]
+        if deadline is not None:
+            esxi_at = deadline - min(settings.esxi_reserve,
+                                     deadline * _MAX_RESERVE_SHARE)
+            escalate_at = esxi_at - min(settings.hard_off_reserve,
+                                        deadline * _MAX_RESERVE_SHARE)
+            for device in devices:
+                down = device['timeline']['down']
+                if device['device'].startswith('VM ') and down > escalate_at:
+                    at_risk.append((device['device'], 'hard powered off'))
+                elif device['device'].startswith('ESXi '):
+                    if down > deadline:
+                        at_risk.append((device['device'], 'misses deadline'))
+                    elif device['timeline']['released'] > esxi_at:
+                        at_risk.append((device['device'],
+                                        'powered off with VMs running'))
+
+        finished_at = {key: at + origin for key, at in run.finished_at.items()}
+        plan = ShutdownPlan(
+            wall_time=sum(phases.values()), phases=phases, devices=devices,
+            critical_path=critical_path(run.prerequisites, finished_at, 0.0),
+            at_risk=at_risk, deadline=deadline,
+            history_runs=self.history.runs,
+            estimated_devices=len(self.estimated))
+        self._log_plan(plan)
+        return plan
+
+    @staticmethod
+    def _log_plan(plan: ShutdownPlan) -> None:
+        logging.info("Predicted shutdown: %.1f seconds (from %s earlier runs, "
+                     "%s devices estimated).", plan.wall_time,
+                     plan.history_runs, plan.estimated_devices)
+        if plan.critical_path:
+            logging.info("Predicted critical path: %s",
+                         " -> ".join(f"{device} ({seconds:.1f}s)"
+                                     for device, seconds in plan.critical_path))
+        for device, reason in plan.at_risk:
+            logging.warning("%s at risk: %s.", device, reason)
+        if plan.fits is not None:
+            logging.log(logging.INFO if plan.fits else logging.ERROR,
+                        "The shutdown %s within its deadline of %s seconds.",
+                        "fits" if plan.fits else "does not fit",
+                        plan.deadline)
+
+
+class _PlannedRun:
+    """
+    Discrete-event simulation of a single shutdown.
+
+    Mirrors ``_ShutdownRun`` on a simulated clock, in seconds from the end
+    of the reachability sweep: operations hold a worker of their shard for
+    their predicted latency, and the event heap replaces the executor.
+    """
+
+    def __init__(self, planner: ShutdownPlanner):
+        self.planner = planner
+        config = planner.config
+        self.servers = {server.name: server for server in config.esxi_servers}
+        self.vms = {(server.name, vm.name): vm
+                    for server in config.esxi_servers for vm in server.vms}
+        self.shard_of = planner.shards()
+        self.busy = {shard: 0 for shard in set(self.shard_of.values())}
+        self.now = 0.0
+        # Events are (at, sequence, callback, args) entries
+        self.events: list = []
+        self.sequence = itertools.count()
+        # Server power-offs and hypervisor batches, which take the next free
+        # worker before guest VMs do, as (keys, server name, seconds,
+        # callback, *args) entries
+        self.queued_work: Dict[int, deque] = {shard: deque()
+                                              for shard in self.busy}
+        self.pending_vms: Dict[str, deque] = {}
+        self.in_flight = {name: 0 for name in self.servers}
+        self.hypervisor_ready: Dict[str, list] = {}
+        self.prerequisites = config.build_shutdown_graph()
+        self.blocked = {key: set(prerequisites)
+                        for key, prerequisites in self.prerequisites.items()}
+        self.dependents: Dict = {key: [] for key in self.prerequisites}
+        for key, prerequisites in self.prerequisites.items():
+            for prerequisite in prerequisites:
+                self.dependents[prerequisite].append(key)
+        self.released_at: Dict = {}
+        self.dispatched_at: Dict = {}
+        self.sent_at: Dict = {}
+        self.finished_at: Dict = {}
+        self.given_up: List = []
+
+    @staticmethod
+    def name(key) -> str:
+        server_name, vm_name = key
+        return f"VM {vm_name}" if vm_name else f"ESXi {server_name}"
+
+    def devices(self):
+        """Yield the key and name of every device, in report order."""
+        for server_name, server in self.servers.items():
+            for vm in server.vms:
+                yield (server_name, vm.name), f"VM {vm.name}"
+            yield (server_name, None), f"ESXi {server_name}"
+
+    def at(self, delay: float, callback, *args) -> None:
+        heapq.heappush(self.events, (self.now + delay, next(self.sequence),
+                                     callback, args))
+
+    def start(self, server_name: str, seconds: float, callback, *args) -> None:
+        """Hold a worker of the shard of a server for ``seconds``."""
+        self.busy[self.shard_of[server_name]] += 1
+        self.at(seconds, self.complete, server_name, callback, args)
+
+    def complete(self, server_name: str, callback, args) -> None:
+        self.busy[self.shard_of[server_name]] -= 1
+        callback(*args)
+
+    def has_capacity(self, shard: int) -> bool:
+        return self.busy[shard] < self.planner.max_workers
+
+    def execute(self) -> None:
+        for key, prerequisites in self.prerequisites.items():
+            if not prerequisites:
+                self.release(key)
+        while True:
+            self.dispatch()
+            if not self.events:
+                break
+            self.now, _, callback, args = heapq.heappop(self.events)
+            callback(*args)
+
+    def dispatch(self) -> None:
+        """Start queued work, then guest VMs round-robin, while workers are free."""
+        for shard, work in self.queued_work.items():
+            while work and self.has_capacity(shard):
+                keys, server_name, seconds, callback, *args = work.popleft()
+                for key in keys:
+                    self.dispatched_at[key] = self.now
+                self.start(server_name, seconds, callback, *args)
+        progress = True
+        while progress:
+            progress = False
+            for server_name in list(self.pending_vms):
+                if not self.has_capacity(self.shard_of[server_name]):
+                    continue
+                if self.in_flight[server_name] >= self.planner.per_host_workers:
+                    continue
+                key = self.pending_vms[server_name].popleft()
+                if not self.pending_vms[server_name]:
+                    del self.pending_vms[server_name]
+                self.in_flight[server_name] += 1
+                self.dispatched_at[key] = self.now
+                self.start(server_name,
+                           self.planner.latency(self.name(key), 'send'),
+                           self.on_vm_sent, key)
+                progress = True
+
+    def release(self, key) -> None:
+        self.released_at[key] = self.now
+        server_name, vm_name = key
+        server = self.servers[server_name]
+        if vm_name is None:
+            self.queued_work[self.shard_of[server_name]].append((
+                [key], server_name, self.planner.latency(self.name(key), 'send'),
+                self.on_esxi_done, key))
+            return
+        vm = self.vms[key]
+        if server.vm_shutdown_strategy == 'hypervisor' or vm.username is None:
+            ready = self.hypervisor_ready.setdefault(server_name, [])
+            if not ready:
+                # VMs released at the same time share one batch
+                self.at(0, self.shutdown_vms_from_esxi, server_name)
+            ready.append(key)
+        else:
+            self.pending_vms.setdefault(server_name, deque()).append(key)
+
+    def shutdown_vms_from_esxi(self, server_name: str) -> None:
+        batch = self.hypervisor_ready.pop(server_name)
+        seconds = max(self.planner.latency(self.name(key), 'send')
+                      for key in batch)
+        self.queued_work[self.shard_of[server_name]].append((
+            batch, server_name, seconds, self.on_batch_sent, batch))
+
+    def on_vm_sent(self, key) -> None:
+        self.in_flight[key[0]] -= 1
+        self.await_off(key)
+
+    def on_batch_sent(self, batch) -> None:
+        for key in batch:
+            self.await_off(key)
+
+    def await_off(self, key) -> None:
+        """Finish a VM at the first poll that finds it off, or give up."""
+        self.sent_at[key] = self.now
+        settings = self.planner.config.shutdown
+        poll_interval = settings.poll_interval
+        wait_off = self.planner.latency(self.name(key), 'wait_off')
+        if wait_off >= settings.vm_poweroff_timeout:
+            self.given_up.append(key)
+            wait_off = settings.vm_poweroff_timeout
+        polls = max(1, math.ceil(wait_off / poll_interval))
+        self.at(polls * poll_interval, self.finish, key)
+
+    def on_esxi_done(self, key) -> None:
+        # An ESXi server is done as soon as it accepted its poweroff
+        self.sent_at[key] = self.now
+        self.finish(key)
+
+    def finish(self, key) -> None:
+        self.finished_at[key] = self.now
+        for dependent in self.dependents[key]:
+            blocked = self.blocked[dependent]
+            blocked.discard(key)
+            if not blocked:
+                self.release(dependent)
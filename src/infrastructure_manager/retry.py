@@ -0,0 +1,97 @@
+"""
+Module for retrying failed power-off commands within a shutdown budget.
+"""
+import random
+from typing import Dict, Optional
+
+
+class RetryPolicy:
+    """
+    Jittered exponential backoff, bounded by attempts and a time budget.
+
+    The policy only computes delays; the retries themselves are scheduled by
+    the shutdown run on its timers, so that no worker ever sleeps through a
+    backoff.
+    """
+
+    def __init__(self, attempts: int = 3, base_delay: float = 1.0,
+                 max_delay: float = 10.0, rng: Optional[random.Random] = None):
+        """Initialize the retry policy.
+
+        Args:
+            attempts: Attempts a device gets in total, 1 never retries
+            base_delay: Seconds of backoff after the first failed attempt,
+                doubled after every further one
+            max_delay: Upper bound of the backoff, in seconds
+            rng: Source of the jitter, a new ``random.Random`` if None
+        """
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.rng = rng or random.Random()
+
+    def backoff(self, failures: int) -> float:
+        """Return the backoff after a number of failed attempts.
+
+        Half of the exponential delay is kept and the other half is jitter,
+        so devices that failed together do not all retry at the same time.
+        """
+        ceiling = min(self.max_delay, self.base_delay * 2 ** (failures - 1))
+        return ceiling / 2 + self.rng.uniform(0, ceiling / 2)
+
+    def next_delay(self, failures: int, now: float, duration: float,
+                   limit: Optional[float] = None) -> Optional[float]:
+        """Return the delay before the next attempt, or None to give up.
+
+        Args:
+            failures: Attempts of the device that failed so far
+            now: Current monotonic time
+            duration: Seconds the failed attempt took, expected of the next
+            limit: Monotonic time by which the next attempt must be over,
+                unlimited if None. The backoff is shortened to fit and the
+                device is given up on when even an immediate attempt would
+                end past it.
+        """
+        if failures >= self.attempts:
+            return None
+        delay = self.backoff(failures)
+        if limit is not None:
+            delay = min(delay, limit - now - duration)
+            if delay < 0:
+                return None
+        return delay
+
+
+class CircuitBreaker:
+    """
+    Count of the consecutive hard failures of every host.
+
+    A hard failure is an attempt on a host that did not answer its
+    reachability probe. Once a host reaches ``threshold`` of them in a row
+    its circuit opens and it is not retried anymore; transient failures of a
+    host that answered leave the count as it is and any success resets it.
+    """
+
+    def __init__(self, threshold: int = 2):
+        """Initialize the circuit breaker.
+
+        Args:
+            threshold: Consecutive hard failures that open a host's circuit
+        """
+        self.threshold = threshold
+        self.failures: Dict[str, int] = {}
+
+    def record(self, host: str, success: bool, hard: bool = True) -> None:
+        """Record the outcome of an attempt on a host."""
+        if success:
+            self.failures.pop(host, None)
+        elif hard:
+            self.failures[host] = self.failures.get(host, 0) + 1
+
+    def trip(self, host: str) -> None:
+        """Open the circuit of a host, as an earlier run left it."""
+        self.failures[host] = max(self.failures.get(host, 0), self.threshold)
+
+    def is_open(self, host: str) -> bool:
+        """True if a host is not to be retried anymore."""
+        return self.failures.get(host, 0) >= self.threshold
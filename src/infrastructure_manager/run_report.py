@@ -0,0 +1,222 @@
+"""
+Module for reporting where the time of a shutdown or startup run went.
+"""
+import json
+import logging
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from .atomic_file import write_atomically
+
+
+# Stages of a device between its release and the end of its shutdown (or
+# startup), as (stage, start event, end event) of its timeline, by kind of run
+_DEVICE_STAGES = {
+    'shutdown': (
+        ('queued', 'released', 'dispatched'),
+        ('send', 'dispatched', 'sent'),
+        ('wait_off', 'sent', 'down'),
+    ),
+    'startup': (
+        ('queued', 'released', 'dispatched'),
+        ('power_on', 'dispatched', 'sent'),
+        ('wait_ready', 'sent', 'up'),
+    ),
+}
+_STAGE_HELP = {
+    'shutdown': 'Seconds the device spent queued, sending its shutdown and '
+                'waiting for it to be off.',
+    'startup': 'Seconds the device spent queued, being powered on and '
+               'waiting for it to accept SSH connections.',
+}
+
+
+def _escape_label(value: str) -> str:
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _labels(**labels) -> str:
+    return '{' + ','.join(f'{name}="{_escape_label(value)}"'
+                          for name, value in labels.items()) + '}'
+
+
+@dataclass
+class RunReport:
+    """
+    Timings of a single shutdown or startup run.
+
+    ``phases`` are the consecutive stages of the run itself. Every device
+    has a timeline of offsets, in seconds from the start of the run, at
+    which it was released by its dependencies, dispatched to a worker, had
+    its shutdown (or power-on) accepted and was down (or up and accepting
+    SSH connections). ``spans`` are the remote operations
+    timed by the remote manager, which may nest (a ``connect`` happens
+    inside the first command sent to a device).
+    """
+    success: bool
+    # Wall clock and monotonic times the run started at
+    timestamp: float
+    origin: float
+    duration: float
+    phases: Dict[str, float] = field(default_factory=dict)
+    devices: List[Dict] = field(default_factory=list)
+    spans: List = field(default_factory=list)
+    critical_path: List[Tuple[str, float]] = field(default_factory=list)
+    # "shutdown" or "startup", which names the timeline events and metrics
+    kind: str = 'shutdown'
+
+    def phase_totals(self) -> Dict[str, Dict[str, float]]:
+        """Aggregate the remote spans by phase.
+
+        Returns:
+            Dict[str, Dict[str, float]]: The ``count``, ``failures``, total
+            ``seconds`` and ``max_seconds`` of every phase
+        """
+        totals: Dict[str, Dict[str, float]] = {}
+        for span in self.spans:
+            total = totals.setdefault(span.phase, {
+                'count': 0, 'failures': 0, 'seconds': 0.0,
+                'max_seconds': 0.0})
+            total['count'] += 1
+            total['failures'] += not span.ok
+            total['seconds'] += span.duration
+            total['max_seconds'] = max(total['max_seconds'], span.duration)
+        return totals
+
+    def host_breakdown(self) -> Dict[str, Dict[str, float]]:
+        """Return the seconds every host spent in each remote phase."""
+        hosts: Dict[str, Dict[str, float]] = {}
+        for span in self.spans:
+            phases = hosts.setdefault(span.host, {})
+            phases[span.phase] = phases.get(span.phase, 0.0) + span.duration
+        return hosts
+
+    def device_stages(self, device: Dict) -> Dict[str, float]:
+        """Return the seconds a device spent in each of its stages."""
+        timeline = device['timeline']
+        return {stage: timeline[end] - timeline[start]
+                for stage, start, end in _DEVICE_STAGES[self.kind]
+                if timeline.get(start) is not None
+                and timeline.get(end) is not None}
+
+    def to_dict(self) -> Dict:
+        """Return the report as a JSON serializable mapping."""
+        breakdown = self.host_breakdown()
+        return {
+            'kind': self.kind,
+            'success': self.success,
+            'timestamp': self.timestamp,
+            'duration_seconds': self.duration,
+            'phases': self.phases,
+            'remote_phases': self.phase_totals(),
+            'critical_path': [{'device': device, 'seconds': seconds}
+                              for device, seconds in self.critical_path],
+            'devices': [
+                dict(device, stages=self.device_stages(device),
+                     remote_phases=breakdown.get(device['ip'], {}))
+                for device in self.devices
+            ],
+            'spans': [
+                {'host': span.host, 'phase': span.phase,
+                 'start': span.start - self.origin,
+                 'seconds': span.duration, 'ok': span.ok}
+                for span in self.spans
+            ],
+        }
+
+    def to_prometheus(self) -> str:
+        """Return the report in the Prometheus text exposition format."""
+        lines = []
+        kind = self.kind
+        final_event = _DEVICE_STAGES[kind][-1][2]
+
+        def metric(name, help_text, samples):
+            lines.append(f"# HELP esxi_{kind}_{name} {help_text}")
+            lines.append(f"# TYPE esxi_{kind}_{name} gauge")
+            for labels, value in samples:
+                lines.append(f"esxi_{kind}_{name}"
+                             f"{_labels(**labels) if labels else ''} {value}")
+
+        totals = self.phase_totals()
+        breakdown = self.host_breakdown()
+        metric('last_run_timestamp_seconds',
+               f'Wall clock time the last {kind} run started at.',
+               [({}, self.timestamp)])
+        metric('success', f'Whether the last {kind} run succeeded.',
+               [({}, int(self.success))])
+        metric('duration_seconds', f'Duration of the last {kind} run.',
+               [({}, self.duration)])
+        metric('phase_seconds', 'Duration of every stage of the run.',
+               [({'phase': phase}, seconds)
+                for phase, seconds in self.phases.items()])
+        metric('remote_phase_seconds',
+               'Total time spent in every phase of the remote operations.',
+               [({'phase': phase}, total['seconds'])
+                for phase, total in totals.items()])
+        metric('remote_phase_max_seconds',
+               'Longest single remote operation of every phase.',
+               [({'phase': phase}, total['max_seconds'])
+                for phase, total in totals.items()])
+        metric('remote_phase_count', 'Remote operations of every phase.',
+               [({'phase': phase}, total['count'])
+                for phase, total in totals.items()])
+        metric('remote_phase_failures',
+               'Failed remote operations of every phase.',
+               [({'phase': phase}, total['failures'])
+                for phase, total in totals.items()])
+        metric(f'device_{final_event}_seconds',
+               f'Seconds from the start of the run until the device was '
+               f'{final_event}.',
+               [({'device': device['device'], 'server': device['server']},
+                 device['timeline'][final_event])
+                for device in self.devices
+                if device['timeline'].get(final_event) is not None])
+        metric('device_stage_seconds', _STAGE_HELP[kind],
+               [({'device': device['device'], 'server': device['server'],
+                  'stage': stage}, seconds)
+                for device in self.devices
+                for stage, seconds in self.device_stages(device).items()])
+        devices_by_ip = {device['ip']: device['device']
+                         for device in self.devices}
+        metric('host_phase_seconds',
+               'Time every host spent in each phase of the remote operations.',
+               [({'host': host, 'device': devices_by_ip.get(host, ''),
+                  'phase': phase}, seconds)
+                for host, phases in breakdown.items()
+                for phase, seconds in phases.items()])
+        metric('critical_path_seconds',
+               'Seconds every device on the critical path added to the run.',
+               [({'position': position, 'device': device}, seconds)
+                for position, (device, seconds)
+                in enumerate(self.critical_path)])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, json_file: Optional[str],
+              prometheus_file: Optional[str]) -> None:
+        """Write the report as JSON and as a Prometheus textfile.
+
+        Each file is replaced atomically, so that a collector never reads a
+        partial report. Failures are logged, the report is only a byproduct
+        of the run.
+
+        Args:
+            json_file: Path of the JSON report, not written if None
+            prometheus_file: Path of the Prometheus textfile, not written
+                if None
+        """
+        for path, render in ((json_file, self._render_json),
+                             (prometheus_file, self.to_prometheus)):
+            if path is None:
+                continue
+            try:
+                # Collectors run as other users
+                write_atomically(path, render(), mode=0o644)
+                logging.info("%s report written to %s.",
+                             self.kind.capitalize(), path)
+            except Exception as e:
+                logging.error("Failed to write %s report %s: %s",
+                              self.kind, path, str(e))
+
+    def _render_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=2)
@@ -0,0 +1,294 @@
+"""
+Module for shutting down very large inventories from several processes.
+"""
+import copy
+import logging
+import logging.handlers
+import multiprocessing
+import queue
+import time
+from typing import Dict, List, Optional
+
+from .infrastructure_manager import InfrastructureManager, critical_path
+from .run_report import RunReport
+
+
+# Seconds a deadline run waits for its shards past the deadline
+_DEADLINE_GRACE = 5
+
+
+class _ShardLogHandler(logging.handlers.QueueHandler):
+    """Forward the log records of a shard to the parent process."""
+
+    def __init__(self, index: int, outbox):
+        super().__init__(outbox)
+        self.index = index
+
+    def enqueue(self, record):
+        self.queue.put(("log", self.index, record))
+
+
+class _ShardLink:
+    """Connection of a shard to the parent process, see ``shutdown(link=)``."""
+
+    def __init__(self, index: int, inbox, outbox):
+        self.index = index
+        self.inbox = inbox
+        self.outbox = outbox
+
+    def finished(self, key, success: bool, at: float) -> None:
+        self.outbox.put(("finished", self.index, key, success, at))
+
+    def receive(self):
+        return self.inbox.get()
+
+
+def _run_shard(index: int, manager: InfrastructureManager,
+               deadline: Optional[float], inbox, outbox) -> None:
+    """Shut a shard down in a worker process and report to the parent."""
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_ShardLogHandler(index, outbox))
+
+    result = None
+    try:
+        manager.shutdown(deadline=deadline,
+                         link=_ShardLink(index, inbox, outbox))
+        result = {
+            'shutdown_results': manager.shutdown_results,
+            'poweroff_durations': manager.poweroff_durations,
+            'escalated_vms': manager.escalated_vms,
+            'report': manager.report,
+        }
+    except Exception as e:
+        logging.error("Shard %s failed: %s", index, str(e))
+    outbox.put(("done", index, result))
+
+
+# pylint: disable=W0718
+class ShardedInfrastructureManager(InfrastructureManager):
+    """
+    Run the shutdown from several worker processes.
+
+    SSH handshakes are partly pure Python and hold the GIL, so a single
+    process stops scaling with hundreds of them in flight. The ESXi servers
+    are split into shards, each with its own VMs, and every shard is shut
+    down by its own process with its own workers, connection pool and
+    scheduler. Dependencies between devices of different shards, including
+    the ordering of the ESXi servers, are relayed by the parent process: a
+    shard streams every device that goes down to the parent, which forwards
+    it to the shards waiting for it, then merges the results of all shards.
+
+    Worker processes are forked, so this mode needs a platform with the
+    ``fork`` start method.
+    """
+
+    def __init__(self, config, remote_manager, processes: int,
+                 max_workers: Optional[int] = None,
+                 per_host_workers: Optional[int] = None,
+                 journal=None):
+        """Initialize the sharded infrastructure manager.
+
+        Args:
+            config: A loaded ``ConfigManager`` instance
+            remote_manager: Object exposing the operations used by
+                ``InfrastructureManager``
+            processes: Number of worker processes, at most one per ESXi server
+            max_workers: Limit of concurrent remote operations of every
+                process, defaults to the ``shutdown.max_workers`` setting
+            per_host_workers: Limit of concurrent VM operations per ESXi
+                server, defaults to the ``shutdown.per_host_workers`` setting
+            journal: A loaded ``ShutdownJournal``, shared by the shards,
+                which each append to it from their own process
+        """
+        super().__init__(config, remote_manager, max_workers=max_workers,
+                         per_host_workers=per_host_workers, journal=journal)
+        self.processes = max(1, min(processes, len(config.esxi_servers)))
+
+    def plan_shards(self) -> List[list]:
+        """Split the ESXi servers into shards of about the same size.
+
+        Servers are assigned, largest first, to the shard with the fewest
+        devices so far; every server stays with all of its VMs.
+
+        Returns:
+            List[list]: The ESXi servers of every shard, in configuration order
+        """
+        shards = [[] for _ in range(self.processes)]
+        sizes = [0] * self.processes
+        order = {id(server): position
+                 for position, server in enumerate(self.config.esxi_servers)}
+        for server in sorted(self.config.esxi_servers,
+                             key=lambda server: len(server.vms), reverse=True):
+            smallest = sizes.index(min(sizes))
+            shards[smallest].append(server)
+            sizes[smallest] += len(server.vms) + 1
+        return [sorted(shard, key=lambda server: order[id(server)])
+                for shard in shards if shard]
+
+    def _shard_manager(self, servers, graph) -> InfrastructureManager:
+        """Build the manager shutting a shard down."""
+        shard_config = copy.copy(self.config)
+        shard_config.esxi_servers = servers
+        shard_graph = {key: prerequisites
+                       for key, prerequisites in graph.items()
+                       if key[0] in {server.name for server in servers}}
+        return InfrastructureManager(
+            shard_config, self.remote_manager, max_workers=self.max_workers,
+            per_host_workers=self.per_host_workers,
+            shutdown_graph=shard_graph, journal=self.journal)
+
+    def shutdown(self, deadline: Optional[float] = None, link=None) -> bool:
+        """Shutdown all VMs and ESXi servers from several processes.
+
+        Args:
+            deadline: Seconds the whole shutdown may take, unlimited if None
+            link: Not supported, a sharded run cannot be a shard itself
+
+        Returns:
+            bool: True if shutdown was successful, False if critical errors occurred
+        """
+        if link is not None:
+            raise ValueError("A sharded shutdown cannot be linked to shards")
+        timestamp = time.time()
+        started = time.monotonic()
+        self.phases = {}
+        graph = self.config.build_shutdown_graph()
+        shards = self.plan_shards()
+        shard_of = {}
+        for index, servers in enumerate(shards):
+            for server in servers:
+                shard_of[server.name] = index
+        # Shards waiting for each device of another shard
+        relays: Dict = {}
+        for key, prerequisites in graph.items():
+            for prerequisite in prerequisites:
+                if shard_of[prerequisite[0]] != shard_of[key[0]]:
+                    relays.setdefault(prerequisite, set()).add(
+                        shard_of[key[0]])
+
+        logging.info("Starting sharded shutdown of %s ESXi servers in %s "
+                     "processes (max_workers=%s per process)...",
+                     len(self.config.esxi_servers), len(shards),
+                     self.max_workers)
+        context = multiprocessing.get_context("fork")
+        outbox = context.Queue()
+        inboxes = [context.Queue() for _ in shards]
+        workers = []
+        for index, servers in enumerate(shards):
+            # Shards start one after the other but share the same deadline
+            remaining = (None if deadline is None
+                         else deadline - (time.monotonic() - started))
+            worker = context.Process(
+                target=_run_shard, name=f"shard-{index}",
+                args=(index, self._shard_manager(servers, graph), remaining,
+                      inboxes[index], outbox),
+                daemon=True)
+            worker.start()
+            workers.append(worker)
+        self.phases['spawn'] = time.monotonic() - started
+
+        finished_at: Dict = {}
+        results: Dict[int, Optional[Dict]] = {}
+        while len(results) < len(shards):
+            try:
+                message = outbox.get(timeout=0.5)
+            except queue.Empty:
+                self._check_workers(workers, shards, results, finished_at,
+                                    relays, inboxes, started, deadline)
+                continue
+            kind, index = message[0], message[1]
+            if kind == "log":
+                record = message[2]
+                logging.getLogger(record.name).handle(record)
+            elif kind == "finished":
+                key, _, at = message[2:]
+                finished_at[key] = at
+                for target in relays.get(key, ()):
+                    inboxes[target].put(key)
+            elif kind == "done":
+                results[index] = message[2]
+                # Lets the shard exit, nothing more will be relayed to it
+                inboxes[index].put(None)
+
+        for worker in workers:
+            worker.join(timeout=_DEADLINE_GRACE)
+            if worker.is_alive():
+                worker.terminate()
+        self.phases['shutdown'] = time.monotonic() - started - self.phases['spawn']
+
+        self._merge(shards, results)
+        self.critical_path = critical_path(graph, finished_at, started)
+        critical_error = not all(
+            success for device, success in self.shutdown_results
+            if device.startswith("ESXi "))
+        self._log_summary()
+        self.report = self._merge_reports(results, timestamp, started,
+                                          not critical_error)
+        return not critical_error
+
+    def _check_workers(self, workers, shards, results, finished_at, relays,
+                       inboxes, started, deadline) -> None:
+        """Give up on shards whose process died or overran the deadline."""
+        overdue = (deadline is not None and time.monotonic()
+                   > started + deadline + _DEADLINE_GRACE)
+        for index, worker in enumerate(workers):
+            if index in results or (worker.is_alive() and not overdue):
+                continue
+            logging.error("Shard %s (%s) did not complete, its remaining "
+                          "devices count as failed.", index,
+                          ", ".join(server.name for server in shards[index]))
+            worker.terminate()
+            results[index] = None
+            # Devices waiting for the lost shard are not held back forever
+            now = time.monotonic()
+            for server in shards[index]:
+                for key in [(server.name, vm.name) for vm in server.vms] + [
+                        (server.name, None)]:
+                    if key in finished_at:
+                        continue
+                    finished_at[key] = now
+                    for target in relays.get(key, ()):
+                        inboxes[target].put(key)
+
+    def _merge(self, shards, results) -> None:
+        """Merge the results of every shard, in configuration order."""
+        outcomes = {}
+        for index, servers in enumerate(shards):
+            result = results.get(index)
+            if result is None:
+                continue
+            outcomes.update(result['shutdown_results'])
+            self.poweroff_durations.update(result['poweroff_durations'])
+            self.escalated_vms += result['escalated_vms']
+
+        self.shutdown_results = [
+            (f"VM {vm.name}", outcomes.get(f"VM {vm.name}", False))
+            for server in self.config.esxi_servers for vm in server.vms
+        ]
+        self.shutdown_results += [
+            (f"ESXi {server.name}", outcomes.get(f"ESXi {server.name}", False))
+            for server in self.config.esxi_servers
+        ]
+
+    def _merge_reports(self, results, timestamp: float, started: float,
+                       success: bool) -> RunReport:
+        """Merge the run reports of every shard into the report of the run."""
+        devices = []
+        spans = []
+        for result in results.values():
+            if result is None or result['report'] is None:
+                continue
+            report = result['report']
+            # Monotonic clocks are shared by the processes of a host
+            shift = report.origin - started
+            for device in report.devices:
+                timeline = {event: None if offset is None else offset + shift
+                            for event, offset in device['timeline'].items()}
+                devices.append(dict(device, timeline=timeline))
+            spans += report.spans
+        return RunReport(success=success, timestamp=timestamp, origin=started,
+                         duration=time.monotonic() - started,
+                         phases=dict(self.phases), devices=devices,
+                         spans=spans, critical_path=list(self.critical_path))
@@ -0,0 +1,402 @@
+"""
+Module for bringing the whole ESXi infrastructure back up after an outage.
+"""
+import heapq
+import itertools
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, List, Optional, Tuple
+
+from .infrastructure_manager import critical_path
+from .run_report import RunReport
+
+
+# Hypervisor outcomes meaning the VM is booting or was already running
+_POWERED_ON = ('on', 'skipped')
+
+
+# pylint: disable=W0718
+class StartupManager:
+    """
+    Power every ESXi server and VM of a configuration back on.
+
+    ESXi servers come back on their own when power returns; the run waits
+    for each of them to accept an SSH session, then powers its VMs on from
+    the server (``vim-cmd vmsvc/power.on``) in batches. Devices start in the
+    reverse order of the shutdown (see ``ConfigManager.build_startup_graph``),
+    each one as soon as every device it depends on is up, that is accepts
+    SSH connections again. Everything else runs in parallel.
+    """
+
+    def __init__(self, config, remote_manager,
+                 max_workers: Optional[int] = None):
+        """Initialize the startup manager.
+
+        Args:
+            config: A loaded ``ConfigManager`` instance
+            remote_manager: Object exposing ``is_ssh_ready``,
+                ``get_connection`` and ``poweron_esxi_vms``
+            max_workers: Limit of concurrent remote operations, defaults to
+                the ``shutdown.max_workers`` setting
+        """
+        self.config = config
+        self.remote_manager = remote_manager
+        self.max_workers = max_workers or config.shutdown.max_workers
+        self.host_timeout = config.startup.host_timeout
+        self.ready_timeout = config.startup.ready_timeout
+        self.poll_interval = config.startup.poll_interval
+        self.startup_results: List[Tuple[str, bool]] = []
+        # Seconds from the start of the run until the last device was up,
+        # None when some device never came up
+        self.recovery_time: Optional[float] = None
+        self.critical_path: List[Tuple[str, float]] = []
+        self.report: Optional[RunReport] = None
+
+    def _esxi_ready(self, server) -> bool:
+        """Open the session of an ESXi server once its SSH server is up."""
+        try:
+            if not self.remote_manager.is_ssh_ready(server.ip,
+                                                    port=server.port):
+                return False
+            return bool(self.remote_manager.get_connection(
+                server.ip, server.username, server.password, server.port))
+        except Exception as e:
+            logging.error("Unexpected error checking ESXi server %s: %s",
+                          server.name, str(e))
+            return False
+
+    def _vm_ready(self, vm) -> bool:
+        """Check that a VM accepts SSH connections."""
+        try:
+            return self.remote_manager.is_ssh_ready(vm.ip, port=vm.port)
+        except Exception as e:
+            logging.error("Unexpected error checking VM %s: %s",
+                          vm.name, str(e))
+            return False
+
+    def _power_on_vms(self, target) -> Optional[Dict[str, str]]:
+        """Power on VMs of an ESXi server over its own session."""
+        server, vms = target
+        logging.info("Powering on %s VMs from ESXi server %s: %s", len(vms),
+                     server.name, ", ".join(vm.name for vm in vms))
+        try:
+            return self.remote_manager.poweron_esxi_vms(
+                server.ip, server.username, server.password,
+                [vm.name for vm in vms], port=server.port)
+        except Exception as e:
+            logging.error("Unexpected error powering on VMs on %s: %s",
+                          server.name, str(e))
+            return None
+
+    def startup(self) -> bool:
+        """Bring every ESXi server and VM up in dependency order.
+
+        An ESXi server is waited for until it accepts an SSH session, for at
+        most ``startup.host_timeout`` seconds from the moment nothing holds
+        it back anymore. VMs released together on a server are powered on in
+        a single batched command, retried while the server cannot run it yet
+        (its management agents start after sshd), and are then probed every
+        ``startup.poll_interval`` seconds until they accept SSH connections,
+        for at most ``startup.ready_timeout`` seconds. A VM without a known
+        IP counts as up as soon as it is powered on. A device that does not
+        come up still releases the devices waiting for it, except for the
+        VMs of an ESXi server that is not up.
+
+        Returns:
+            bool: True if every device came back up, False otherwise
+        """
+        timestamp = time.time()
+        started = time.monotonic()
+        logging.info("Starting the infrastructure (max_workers=%s)...",
+                     self.max_workers)
+        run = _StartupRun(self)
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            run.execute(executor)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        duration = time.monotonic() - started
+        self.remote_manager.close_all_connections()
+
+        self.startup_results = [
+            (f"VM {vm.name}", run.results[(server.name, vm.name)])
+            for server in self.config.esxi_servers for vm in server.vms
+        ]
+        self.startup_results += [
+            (f"ESXi {server.name}", run.results[(server.name, None)])
+            for server in self.config.esxi_servers
+        ]
+        success = all(run.results.values())
+        up_at = [run.finished_at[key] for key, up in run.results.items() if up]
+        self.recovery_time = (max(up_at, default=started) - started
+                              if success else None)
+        self.critical_path = critical_path(run.prerequisites, run.finished_at,
+                                           run.started_at)
+        self._log_summary(run, duration)
+        self.report = self._build_report(run, timestamp, started, duration,
+                                         success)
+        return success
+
+    def _log_summary(self, run, duration: float) -> None:
+        """Log the outcome of every device and the time to recover."""
+        logging.info("\nStartup Summary:")
+        for device, success in self.startup_results:
+            status = "SUCCESS" if success else "FAILED"
+            logging.info("%s: %s", device, status)
+        if self.critical_path:
+            logging.info("Critical path (%.1fs): %s",
+                         sum(seconds for _, seconds in self.critical_path),
+                         " -> ".join(f"{device} ({seconds:.1f}s)"
+                                     for device, seconds in self.critical_path))
+        if self.recovery_time is not None:
+            logging.info("Infrastructure fully recovered in %.1f seconds.",
+                         self.recovery_time)
+        else:
+            logging.error("Recovery incomplete: %s of %s devices up after "
+                          "%.1f seconds.", sum(run.results.values()),
+                          len(run.results), duration)
+
+    def _build_report(self, run, timestamp: float, started: float,
+                      duration: float, success: bool) -> RunReport:
+        """Collect the timings of a finished run into its report."""
+        def timeline(key):
+            up_at = {key: run.finished_at[key]} if run.results.get(key) else {}
+            events = {'released': run.released_at,
+                      'dispatched': run.dispatched_at, 'sent': run.sent_at,
+                      'up': up_at}
+            return {event: times[key] - started if key in times else None
+                    for event, times in events.items()}
+
+        devices = []
+        for server in self.config.esxi_servers:
+            key = (server.name, None)
+            devices.append({
+                'device': f"ESXi {server.name}", 'server': server.name,
+                'ip': server.ip, 'success': run.results[key],
+                'timeline': timeline(key)})
+            for vm in server.vms:
+                key = (server.name, vm.name)
+                devices.append({
+                    'device': f"VM {vm.name}", 'server': server.name,
+                    'ip': vm.ip, 'success': run.results[key],
+                    'timeline': timeline(key)})
+
+        phases = {'startup': duration}
+        if self.recovery_time is not None:
+            phases['recovery'] = self.recovery_time
+        timing = getattr(self.remote_manager, 'timing', None)
+        spans = list(timing.spans(since=started)) if timing is not None else []
+        return RunReport(success=success, timestamp=timestamp, origin=started,
+                         duration=duration, phases=phases, devices=devices,
+                         spans=spans, critical_path=list(self.critical_path),
+                         kind='startup')
+
+
+class _StartupRun:
+    """
+    State of a single startup, driven from one scheduler thread.
+
+    Remote operations run on the executor and their results, as well as
+    timers for polls and retries, are handled back on the scheduler thread,
+    so no worker ever sleeps between two polls.
+    """
+
+    def __init__(self, manager: StartupManager):
+        self.manager = manager
+        config = manager.config
+        self.servers = {server.name: server for server in config.esxi_servers}
+        self.vms = {(server.name, vm.name): vm
+                    for server in config.esxi_servers for vm in server.vms}
+        # Devices are keyed (server name, VM name), with None for the server
+        self.prerequisites = config.build_startup_graph()
+        self.blocked = {key: set(prerequisites)
+                        for key, prerequisites in self.prerequisites.items()}
+        self.dependents: Dict[Tuple[str, Optional[str]], list] = {
+            key: [] for key in self.prerequisites}
+        for key, prerequisites in self.prerequisites.items():
+            for prerequisite in prerequisites:
+                self.dependents[prerequisite].append(key)
+        # Monotonic times every device was released, handed to a worker,
+        # had its power-on accepted, and was up or given up on
+        self.released_at: Dict[Tuple[str, Optional[str]], float] = {}
+        self.dispatched_at: Dict[Tuple[str, Optional[str]], float] = {}
+        self.sent_at: Dict[Tuple[str, Optional[str]], float] = {}
+        self.finished_at: Dict[Tuple[str, Optional[str]], float] = {}
+        self.results: Dict[Tuple[str, Optional[str]], bool] = {}
+        self.started_at: Optional[float] = None
+        # Released VMs of every server waiting for the next power-on batch
+        self.power_on_ready: Dict[str, list] = {}
+        # Timers are (ready_at, sequence, callback, args) entries of work
+        # that must not start before a given monotonic time
+        self.timers: list = []
+        self.sequence = itertools.count()
+        # Futures mapped to the callback handling their result
+        self.futures: Dict = {}
+        self.executor = None
+
+    def schedule(self, delay: float, callback, *args) -> None:
+        """Run ``callback(*args)`` on the scheduler thread after ``delay``."""
+        heapq.heappush(self.timers, (time.monotonic() + delay,
+                                     next(self.sequence), callback, args))
+
+    def submit(self, function, argument, callback, *context) -> None:
+        """Run ``function(argument)`` on a worker, then ``callback``."""
+        future = self.executor.submit(function, argument)
+        self.futures[future] = (callback, context)
+
+    def execute(self, executor) -> None:
+        """Run the scheduler loop until every device is up or given up on."""
+        self.executor = executor
+        self.started_at = time.monotonic()
+        for key, prerequisites in self.prerequisites.items():
+            if not prerequisites:
+                self.release(key)
+
+        while self.timers or self.futures:
+            now = time.monotonic()
+            while self.timers and self.timers[0][0] <= now:
+                _, _, callback, args = heapq.heappop(self.timers)
+                callback(*args)
+
+            timeout = (max(0.0, self.timers[0][0] - time.monotonic())
+                       if self.timers else None)
+            if not self.futures:
+                if timeout is not None:
+                    time.sleep(timeout)
+                continue
+            done, _ = wait(list(self.futures), timeout=timeout,
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                callback, context = self.futures.pop(future)
+                callback(future.result(), *context)
+
+    def release(self, key) -> None:
+        """Start a device whose prerequisites are all up or given up on."""
+        now = time.monotonic()
+        self.released_at[key] = now
+        server_name, vm_name = key
+        if vm_name is None:
+            logging.info("Waiting for ESXi server %s to accept SSH sessions.",
+                         server_name)
+            self.dispatched_at[key] = now
+            self.sent_at[key] = now
+            self.check_esxi(server_name)
+            return
+
+        if not self.results.get((server_name, None)):
+            logging.error("VM %s cannot be powered on, ESXi server %s is "
+                          "not up.", vm_name, server_name)
+            self.finish(key, False)
+            return
+        failed = [name or server for server, name in self.prerequisites[key]
+                  if not self.results.get((server, name))]
+        if failed:
+            logging.warning("Powering on VM %s although %s did not come up.",
+                            vm_name, ", ".join(failed))
+        ready = self.power_on_ready.setdefault(server_name, [])
+        if not ready:
+            self.schedule(0, self.power_on_vms, server_name)
+        ready.append(self.vms[key])
+
+    def finish(self, key, success: bool) -> None:
+        """Record that a device is up (or given up on) and release others."""
+        self.results[key] = success
+        self.finished_at[key] = time.monotonic()
+        for dependent in self.dependents[key]:
+            blocked = self.blocked[dependent]
+            blocked.discard(key)
+            if not blocked and dependent not in self.released_at:
+                self.release(dependent)
+
+    def check_esxi(self, server_name: str) -> None:
+        self.submit(self.manager._esxi_ready, self.servers[server_name],
+                    self.on_esxi_checked, server_name)
+
+    def on_esxi_checked(self, ready: bool, server_name: str) -> None:
+        key = (server_name, None)
+        elapsed = time.monotonic() - self.released_at[key]
+        if ready:
+            logging.info("ESXi server %s is up after %.1f seconds.",
+                         server_name, elapsed)
+            self.finish(key, True)
+        elif elapsed >= self.manager.host_timeout:
+            logging.error("ESXi server %s is still not accepting SSH sessions "
+                          "after %s seconds, giving up.", server_name,
+                          self.manager.host_timeout)
+            self.finish(key, False)
+        else:
+            self.schedule(self.manager.poll_interval, self.check_esxi,
+                          server_name)
+
+    def power_on_vms(self, server_name: str) -> None:
+        vms = self.power_on_ready.pop(server_name, [])
+        if not vms:
+            return
+        for vm in vms:
+            self.dispatched_at.setdefault((server_name, vm.name),
+                                          time.monotonic())
+        self.submit(self.manager._power_on_vms,
+                    (self.servers[server_name], vms), self.on_powered_on,
+                    server_name, vms)
+
+    def on_powered_on(self, outcomes: Optional[Dict[str, str]],
+                      server_name: str, vms) -> None:
+        now = time.monotonic()
+        if outcomes is None:
+            # The management agents of a server that just booted may not
+            # run commands yet: retry until the VMs' deadline
+            retry = []
+            for vm in vms:
+                key = (server_name, vm.name)
+                if now - self.dispatched_at[key] < self.manager.ready_timeout:
+                    retry.append(vm)
+                else:
+                    logging.error("Failed to power on VM %s from ESXi server "
+                                  "%s.", vm.name, server_name)
+                    self.finish(key, False)
+            if retry:
+                ready = self.power_on_ready.setdefault(server_name, [])
+                if not ready:
+                    self.schedule(self.manager.poll_interval,
+                                  self.power_on_vms, server_name)
+                ready.extend(retry)
+            return
+
+        for vm in vms:
+            key = (server_name, vm.name)
+            outcome = outcomes.get(vm.name)
+            if outcome not in _POWERED_ON:
+                logging.error("Failed to power on VM %s from ESXi server %s%s.",
+                              vm.name, server_name,
+                              "" if outcome else ": not registered on it")
+                self.finish(key, False)
+                continue
+            self.sent_at[key] = now
+            if vm.ip is None:
+                logging.info("VM %s has no known IP, up once powered on.",
+                             vm.name)
+                self.finish(key, True)
+            else:
+                # A VM that was already running may be up already
+                self.schedule(0 if outcome == 'skipped'
+                              else self.manager.poll_interval,
+                              self.check_vm, key)
+
+    def check_vm(self, key) -> None:
+        self.submit(self.manager._vm_ready, self.vms[key], self.on_vm_checked,
+                    key)
+
+    def on_vm_checked(self, ready: bool, key) -> None:
+        elapsed = time.monotonic() - self.sent_at[key]
+        if ready:
+            logging.info("VM %s is up %.1f seconds after its power-on.",
+                         key[1], elapsed)
+            self.finish(key, True)
+        elif elapsed >= self.manager.ready_timeout:
+            logging.error("VM %s is still not accepting SSH connections %s "
+                          "seconds after its power-on, giving up.", key[1],
+                          self.manager.ready_timeout)
+            self.finish(key, False)
+        else:
+            self.schedule(self.manager.poll_interval, self.check_vm, key)
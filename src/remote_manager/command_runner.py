@@ -0,0 +1,152 @@
+"""
+Module for running commands over SSH channels without blocking.
+"""
+import codecs
+import logging
+import select
+import socket
+import time
+from dataclasses import dataclass
+from typing import Callable, Iterable, Optional
+
+import paramiko
+
+
+_READ_SIZE = 32768
+
+
+@dataclass
+class CommandResult:
+    """Outcome of a command run with ``run_command``."""
+    exit_status: Optional[int] = None
+    stdout: str = ""
+    stderr: str = ""
+    # Success marker seen in the output that ended the wait early
+    matched: Optional[str] = None
+    # Stage ("exec" or "channel") whose deadline expired, if any
+    timed_out_stage: Optional[str] = None
+    error: Optional[str] = None
+    # The command was sent without waiting for any output
+    detached: bool = False
+
+    @property
+    def completed(self) -> bool:
+        """True if the command finished or reported a success marker."""
+        return (self.matched is not None or self.exit_status is not None
+                or self.detached)
+
+    @property
+    def ok(self) -> bool:
+        """True if the command reported a success marker, exited with 0 or
+        was sent detached, without any error."""
+        if self.error is not None or self.timed_out_stage is not None:
+            return False
+        return self.matched is not None or self.detached or self.exit_status == 0
+
+
+def run_command(ssh_client, command: str, stdin_data: Optional[str] = None,
+                success_markers: Iterable[str] = (),
+                timeout: float = 15.0, wait: bool = True,
+                on_output: Optional[Callable[[str, str], None]] = None
+                ) -> CommandResult:
+    """
+    Run a command on a new channel and collect its output without blocking.
+
+    Standard output and error are drained as data arrives. The wait ends as
+    soon as one of ``success_markers`` shows up in either stream, when the
+    command exits, or when ``timeout`` expires, whichever comes first.
+    Without ``wait``, it ends as soon as the command and its input were
+    sent. The channel is closed however the wait ends; the server still
+    delivers the input already sent, and a remote command that no longer
+    writes output keeps running without it (for example ``poweroff`` after
+    the sudo prompt).
+
+    Args:
+        ssh_client (paramiko.SSHClient): A connected client.
+        command (str): The command to execute.
+        stdin_data (str): Data written to the command's standard input.
+        success_markers (Iterable[str]): Strings that prove success.
+        timeout (float): Seconds allowed for opening the channel and running
+            the command.
+        wait (bool): Wait for the output of the command. Default is True.
+        on_output (Callable[[str, str], None]): Called with the stream name
+            ("stdout" or "stderr") and the decoded text of every chunk of
+            output as it arrives.
+
+    Returns:
+        CommandResult: The collected output and how the wait ended.
+    """
+    deadline = time.monotonic() + timeout
+    markers = tuple(success_markers)
+
+    channel = None
+    try:
+        try:
+            channel = ssh_client.get_transport().open_session(timeout=timeout)
+            channel.settimeout(max(deadline - time.monotonic(), 0.001))
+            channel.exec_command(command)
+            if stdin_data is not None:
+                channel.sendall(stdin_data.encode('utf-8'))
+        except (socket.timeout, TimeoutError):
+            return CommandResult(timed_out_stage="channel",
+                                 error="timed out opening channel")
+        except (paramiko.SSHException, OSError, AttributeError) as e:
+            return CommandResult(error=str(e))
+        if not wait:
+            return CommandResult(detached=True)
+        return _drain(channel, command, markers, deadline, timeout, on_output)
+    finally:
+        if channel is not None:
+            channel.close()
+
+
+def _drain(channel, command: str, markers, deadline: float, timeout: float,
+           on_output: Optional[Callable[[str, str], None]]) -> CommandResult:
+    """Collect the output of a command until a marker, its exit or the
+    deadline, see ``run_command``."""
+    stdout, stderr = [], []
+    # Incremental decoders keep multi-byte characters split across chunks
+    decoders = {name: codecs.getincrementaldecoder('utf-8')(errors='replace')
+                for name in ('stdout', 'stderr')}
+
+    def collect(name, chunks, data):
+        text = decoders[name].decode(data)
+        if text:
+            chunks.append(text)
+            if on_output is not None:
+                on_output(name, text)
+
+    result = CommandResult()
+    channel.setblocking(False)
+    while True:
+        while channel.recv_ready():
+            collect('stdout', stdout, channel.recv(_READ_SIZE))
+        while channel.recv_stderr_ready():
+            collect('stderr', stderr, channel.recv_stderr(_READ_SIZE))
+
+        result.stdout = ''.join(stdout)
+        result.stderr = ''.join(stderr)
+        result.matched = next((marker for marker in markers
+                               if marker in result.stdout
+                               or marker in result.stderr), None)
+        if result.matched is not None:
+            return result
+
+        if (channel.exit_status_ready() and not channel.recv_ready()
+                and not channel.recv_stderr_ready()):
+            result.exit_status = channel.recv_exit_status()
+            return result
+        if (channel.closed and not channel.recv_ready()
+                and not channel.recv_stderr_ready()):
+            # The session went away without an exit status, as happens when
+            # the remote device powers off underneath it
+            return result
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            result.timed_out_stage = "exec"
+            result.error = f"timed out after {timeout} seconds"
+            logging.warning("Command '%s' timed out after %s seconds.",
+                            command, timeout)
+            return result
+        select.select([channel], [], [], min(remaining, 0.5))
@@ -0,0 +1,178 @@
+"""
+Module for pooling SSH connections to remote devices.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Tuple
+
+
+# pylint: disable=W0718
+class SSHConnectionPool:
+    """
+    A thread-safe pool of authenticated SSH connections.
+
+    Connections are keyed by ``(host, port, username)`` and shared: paramiko
+    multiplexes every ``exec_command`` on its own channel over the same
+    transport, so concurrent callers reuse one handshake per device. Idle
+    connections are closed by a background reaper; a connection leased for a
+    running command is never idle, however long the command takes.
+    """
+
+    def __init__(self, connect: Callable, idle_timeout: float = 300):
+        """Initialize the connection pool.
+
+        Args:
+            connect: Callable ``(host, username, password, port)`` returning a
+                connected ``paramiko.SSHClient`` or False on failure
+            idle_timeout: Seconds after which an unused connection is closed
+        """
+        self.connect = connect
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._key_locks: Dict[Tuple[str, int, str], threading.Lock] = {}
+        # Pooled entries ``[client, last_used, leases]``: the monotonic time
+        # the client was last handed out or released, and how many callers
+        # are still running commands on it
+        self._clients: Dict[Tuple[str, int, str], list] = {}
+        self._reaper = None
+
+    @staticmethod
+    def is_alive(ssh_client) -> bool:
+        """Check whether the transport of a client is still usable."""
+        try:
+            transport = ssh_client.get_transport()
+            return transport is not None and transport.is_active()
+        except Exception:
+            return False
+
+    def acquire(self, host, username, password, port=22):
+        """
+        Get a live connection to a device, connecting only when needed.
+
+        Args:
+            host (str): The hostname or IP address of the remote device.
+            username (str): The SSH username.
+            password (str): The SSH password.
+            port (int): The SSH port. Default is 22.
+
+        Returns:
+            paramiko.SSHClient: A connected client or False if connection fails.
+        """
+        entry = self._acquire_entry(host, username, password, port)
+        return entry[0] if entry is not None else False
+
+    @contextmanager
+    def lease(self, host, username, password, port=22):
+        """
+        Hold a live connection to a device for the duration of a command.
+
+        The connection is acquired like ``acquire`` and is not closed by the
+        idle reaper until the ``with`` block exits; its idle time starts
+        counting from the release.
+
+        Args:
+            host (str): The hostname or IP address of the remote device.
+            username (str): The SSH username.
+            password (str): The SSH password.
+            port (int): The SSH port. Default is 22.
+
+        Yields:
+            paramiko.SSHClient: A connected client or False if connection fails.
+        """
+        entry = self._acquire_entry(host, username, password, port,
+                                    lease=True)
+        if entry is None:
+            yield False
+            return
+        try:
+            yield entry[0]
+        finally:
+            with self._lock:
+                entry[1] = time.monotonic()
+                entry[2] -= 1
+
+    def _acquire_entry(self, host, username, password, port, lease=False):
+        """Get the pool entry of a live connection, or None on failure."""
+        key = (host, port, username)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        # Only one handshake per key may be in progress; other callers for the
+        # same device wait for it and then share the connection.
+        with key_lock:
+            with self._lock:
+                entry = self._clients.get(key)
+            if entry is not None:
+                if self.is_alive(entry[0]):
+                    with self._lock:
+                        entry[1] = time.monotonic()
+                        entry[2] += int(lease)
+                    return entry
+                logging.info("Pooled connection to %s is dead, reconnecting.",
+                             host)
+                self.discard(host, username, port)
+
+            ssh_client = self.connect(host, username, password, port)
+            if not ssh_client:
+                return None
+
+            entry = [ssh_client, time.monotonic(), int(lease)]
+            with self._lock:
+                self._clients[key] = entry
+                self._start_reaper()
+            return entry
+
+    def discard(self, host, username, port=22) -> None:
+        """Close and forget the pooled connection to a device, if any."""
+        with self._lock:
+            entry = self._clients.pop((host, port, username), None)
+        if entry is not None:
+            self._close(entry[0])
+
+    def close_idle(self) -> None:
+        """Close every connection that has been idle for too long."""
+        deadline = time.monotonic() - self.idle_timeout
+        with self._lock:
+            idle = [key for key, (_, last_used, leases) in self._clients.items()
+                    if not leases and last_used <= deadline]
+            clients = [self._clients.pop(key)[0] for key in idle]
+        for ssh_client in clients:
+            self._close(ssh_client)
+
+    def close_all(self) -> None:
+        """Close every pooled connection."""
+        with self._lock:
+            clients = [entry[0] for entry in self._clients.values()]
+            self._clients.clear()
+        for ssh_client in clients:
+            self._close(ssh_client)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._clients)
+
+    @staticmethod
+    def _close(ssh_client) -> None:
+        try:
+            ssh_client.close()
+        except Exception as e:
+            logging.debug("Error closing pooled connection: %s", str(e))
+
+    def _start_reaper(self) -> None:
+        """Start the idle reaper thread; must be called with the lock held."""
+        if self._reaper is not None and self._reaper.is_alive():
+            return
+        self._reaper = threading.Thread(
+            target=self._reap, name="ssh-pool-reaper", daemon=True)
+        self._reaper.start()
+
+    def _reap(self) -> None:
+        while True:
+            time.sleep(max(self.idle_timeout / 2, 1))
+            self.close_idle()
+            with self._lock:
+                if not self._clients:
+                    self._reaper = None
+                    return
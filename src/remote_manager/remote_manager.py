@@ -1,9 +1,72 @@
 """
 Module for managing remote devices via SSH.
 """
+import errno
+import itertools
+import os
+import re
+import selectors
+import socket
+import struct
 import subprocess
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, Optional
 import paramiko
+from .command_runner import CommandResult, run_command
+from .connection_pool import SSHConnectionPool
+from .ssh_profile import check_algorithms, prepare_client
+from .timing import Span, recorder
+
+
+@dataclass
+class ReachabilityResult:
+    """Outcome of a reachability probe against a single host."""
+    online: bool
+    latency: Optional[float] = None
+
+
+@dataclass
+class DiscoveredVM:
+    """A VM registered on an ESXi server, as found by a discovery."""
+    name: str
+    power_state: str
+    # Primary guest IP reported by VMware Tools, None if unknown
+    ip: Optional[str] = None
+
+
+@dataclass
+class RemoteTarget:
+    """A device a command is run on, with its SSH credentials."""
+    host: str
+    username: str
+    password: Optional[str] = None
+    port: int = 22
+
+
+@dataclass
+class StageTimeouts:
+    """Deadlines, in seconds, of the stages of a remote operation."""
+    connect: float = 5.0
+    auth: float = 10.0
+    exec: float = 15.0
+
+
+# Connection errors that prove the host itself answered the probe
+_HOST_ANSWERED_ERRNOS = {0, errno.ECONNREFUSED, errno.ECONNRESET}
+_ICMP_ECHO_REQUEST = 8
+_ICMP_ECHO_REPLY = 0
+
+# A "vim-cmd vmsvc/getallvms" row: Vmid, Name, then "[datastore] path.vmx"
+_GETALLVMS_ROW = re.compile(r'^(\d+)\s+(.+?)\s+\[[^\]]*\]')
+_STATES_MARKER = '--- power states ---'
+_DISCOVERY_MARKER = '--- discovery ---'
+# Prompt printed by "sudo -S" before it reads the password from stdin
+_SUDO_PROMPT = re.compile(r'^\[sudo\] password for [^:]*: ?')
+_LIST_VM_IDS = "vim-cmd vmsvc/getallvms 2>/dev/null | sed -n 's/^\\([0-9][0-9]*\\) .*/\\1/p'"
+
 
 # pylint: disable=W0718
 class RemoteDeviceManager:
@@ -41,42 +104,363 @@ class RemoteDeviceManager:
                 "An unexpected error occurred while pinging %s: %s", host, str(e))
             return False
 
+    @staticmethod
+    def check_reachability(hosts: Iterable[str], port: int = 22,
+                           timeout: float = 1.0, mode: str = "tcp",
+                           max_sockets: int = 512,
+                           ports: Optional[Dict[str, int]] = None
+                           ) -> Dict[str, ReachabilityResult]:
+        """
+        Check the reachability of many devices at once, in-process.
+
+        In ``tcp`` mode a non-blocking connect to ``port`` is started for every
+        host and all of them are awaited together; a refused connection still
+        counts as online because the host answered. In ``icmp`` mode a single
+        ICMP socket sends an echo request to every host and collects replies;
+        it falls back to ``tcp`` when the process may not open ICMP sockets.
+
+        Args:
+            hosts (Iterable[str]): The hostnames or IP addresses to probe.
+            port (int): The TCP port probed in ``tcp`` mode. Default is 22.
+            timeout (float): Seconds to wait for all answers. Default is 1.0.
+            mode (str): ``tcp`` or ``icmp``. Default is ``tcp``.
+            max_sockets (int): Maximum number of TCP probes in flight.
+            ports (Dict[str, int]): Per host TCP ports overriding ``port``.
+
+        Returns:
+            Dict[str, ReachabilityResult]: The result of every host, with the
+            round-trip latency in seconds for hosts that answered.
+        """
+        hosts = list(dict.fromkeys(hosts))
+        started = time.monotonic()
+        results = None
+        if mode == "icmp":
+            try:
+                results = RemoteDeviceManager._icmp_sweep(hosts, timeout)
+            except OSError as e:
+                logging.warning(
+                    "ICMP sweep unavailable (%s), falling back to TCP.", str(e))
+        elif mode != "tcp":
+            raise ValueError(f"Unknown reachability mode: {mode}")
+        if results is None:
+            results = RemoteDeviceManager._tcp_sweep(
+                hosts, port, timeout, max_sockets, ports or {})
+
+        # Hosts that did not answer held the sweep until it gave up
+        elapsed = time.monotonic() - started
+        for host, result in results.items():
+            recorder.add(Span(host, "probe", started,
+                              result.latency if result.online else elapsed,
+                              result.online))
+        return results
+
+    @staticmethod
+    def _tcp_sweep(hosts, port, timeout, max_sockets, ports):
+        """Probe hosts with concurrent non-blocking TCP connects."""
+        results = {host: ReachabilityResult(False) for host in hosts}
+        queue = iter(hosts)
+        selector = selectors.DefaultSelector()
+        deadline = time.monotonic() + timeout
+
+        def start_next():
+            for host in queue:
+                try:
+                    family, socktype, proto, _, address = socket.getaddrinfo(
+                        host, ports.get(host, port), type=socket.SOCK_STREAM)[0]
+                    sock = socket.socket(family, socktype, proto)
+                    sock.setblocking(False)
+                    started = time.monotonic()
+                    code = sock.connect_ex(address)
+                except OSError as e:
+                    logging.warning("Reachability probe failed for %s: %s",
+                                    host, str(e))
+                    continue
+                if code in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    selector.register(sock, selectors.EVENT_WRITE,
+                                      (host, started))
+                    return
+                sock.close()
+                if code in _HOST_ANSWERED_ERRNOS:
+                    results[host] = ReachabilityResult(
+                        True, time.monotonic() - started)
+
+        try:
+            for _ in range(max_sockets):
+                start_next()
+            while selector.get_map():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                for key, _ in selector.select(remaining):
+                    host, started = key.data
+                    sock = key.fileobj
+                    code = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    selector.unregister(sock)
+                    sock.close()
+                    if code in _HOST_ANSWERED_ERRNOS:
+                        results[host] = ReachabilityResult(
+                            True, time.monotonic() - started)
+                    start_next()
+        finally:
+            for key in list(selector.get_map().values()):
+                key.fileobj.close()
+            selector.close()
+
+        for host, result in results.items():
+            if not result.online:
+                logging.warning("TCP probe to %s:%s failed.", host,
+                                ports.get(host, port))
+        return results
+
+    @staticmethod
+    def _icmp_checksum(data: bytes) -> int:
+        """Compute the internet checksum of an ICMP packet."""
+        if len(data) % 2:
+            data += b"\0"
+        total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+        total = (total >> 16) + (total & 0xFFFF)
+        total += total >> 16
+        return ~total & 0xFFFF
+
+    @staticmethod
+    def _icmp_sweep(hosts, timeout):
+        """Probe hosts with ICMP echo requests sent from a single socket."""
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                                 socket.IPPROTO_ICMP)
+            has_ip_header = False
+        except PermissionError:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_RAW,
+                                 socket.IPPROTO_ICMP)
+            has_ip_header = True
+
+        results = {host: ReachabilityResult(False) for host in hosts}
+        identifier = os.getpid() & 0xFFFF
+        sent_at = {}
+        by_address = {}
+        try:
+            sock.setblocking(False)
+            for sequence, host in zip(itertools.count(1), hosts):
+                try:
+                    address = socket.gethostbyname(host)
+                    header = struct.pack("!BBHHH", _ICMP_ECHO_REQUEST, 0, 0,
+                                         identifier, sequence & 0xFFFF)
+                    checksum = RemoteDeviceManager._icmp_checksum(header)
+                    packet = struct.pack("!BBHHH", _ICMP_ECHO_REQUEST, 0,
+                                         checksum, identifier,
+                                         sequence & 0xFFFF)
+                    sock.sendto(packet, (address, 0))
+                except OSError as e:
+                    logging.warning("ICMP probe failed for %s: %s",
+                                    host, str(e))
+                    continue
+                sent_at[host] = time.monotonic()
+                by_address.setdefault(address, []).append(host)
+
+            deadline = time.monotonic() + timeout
+            selector = selectors.DefaultSelector()
+            selector.register(sock, selectors.EVENT_READ)
+            try:
+                while by_address:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not selector.select(remaining):
+                        break
+                    try:
+                        packet, (address, _) = sock.recvfrom(1024)
+                    except BlockingIOError:
+                        continue
+                    if has_ip_header:
+                        packet = packet[(packet[0] & 0x0F) * 4:]
+                    if (len(packet) < 8 or packet[0] != _ICMP_ECHO_REPLY
+                            or address not in by_address):
+                        continue
+                    for host in by_address.pop(address):
+                        results[host] = ReachabilityResult(
+                            True, time.monotonic() - sent_at[host])
+            finally:
+                selector.close()
+        finally:
+            sock.close()
+
+        for host, result in results.items():
+            if not result.online:
+                logging.warning("ICMP probe to %s failed.", host)
+        return results
+
+    @staticmethod
+    def is_ssh_ready(host, port=22, timeout=None):
+        """
+        Check that a device accepts SSH connections, without logging in.
+
+        The device is ready once its SSH server sends its banner, which a
+        booting host does only when sshd is up, unlike a mere TCP connect
+        that its firewall or hypervisor may already accept.
+
+        Args:
+            host (str): The hostname or IP address of the remote device.
+            port (int): The SSH port. Default is 22.
+            timeout (float): Seconds to wait for the banner, the connect
+                stage deadline if None.
+
+        Returns:
+            bool: True if the device sent an SSH banner, False otherwise.
+        """
+        if timeout is None:
+            timeout = RemoteDeviceManager.timeouts.connect
+        with recorder.span(host, "ssh_ready") as span:
+            try:
+                with socket.create_connection((host, port),
+                                              timeout=timeout) as sock:
+                    banner = b""
+                    while b"\n" not in banner and len(banner) < 256:
+                        data = sock.recv(256)
+                        if not data:
+                            break
+                        banner += data
+            except OSError:
+                banner = b""
+            # Servers may send other lines before the version line
+            span.ok = any(line.startswith(b"SSH-")
+                          for line in banner.splitlines())
+        return span.ok
+
+    @staticmethod
+    def configure_timeouts(connect=None, auth=None, exec_timeout=None):
+        """
+        Set the per-stage deadlines used by every remote operation.
+
+        Args:
+            connect (float): Seconds for the TCP connect and SSH banner.
+            auth (float): Seconds for the authentication exchange.
+            exec_timeout (float): Seconds for opening a channel and running a command.
+        """
+        timeouts = RemoteDeviceManager.timeouts
+        RemoteDeviceManager.timeouts = StageTimeouts(
+            connect=connect if connect is not None else timeouts.connect,
+            auth=auth if auth is not None else timeouts.auth,
+            exec=exec_timeout if exec_timeout is not None else timeouts.exec)
+
+    @staticmethod
+    def configure_ssh_profiles(profiles):
+        """
+        Set the SSH profile of every device.
+
+        Args:
+            profiles (dict): ``SSHProfile`` of the configuration by
+                ``(host, port)``; devices without one authenticate with their
+                password and paramiko's default algorithms.
+
+        Raises:
+            ValueError: If a profile lists an algorithm paramiko does not support.
+        """
+        for profile in profiles.values():
+            check_algorithms(profile)
+        RemoteDeviceManager.ssh_profiles = dict(profiles)
+
     @staticmethod
     def ssh_connect(host, username, password, port=22):
         """
             Establish an SSH connection to the remote device.
 
+        Every stage (TCP connect and banner, authentication, channel
+        requests) is bounded by ``RemoteDeviceManager.timeouts`` and the
+        stage that timed out is logged. The SSH profile of the device, if
+        any, sets its key, algorithms, compression and known hosts.
+
+        The TCP connect, the key exchange and the authentication (with the
+        host key check before it) are timed as the ``tcp``, ``kex`` and
+        ``auth`` spans of the host.
+
         Args:
             host (str): The hostname or IP address of the remote device.
             username (str): The SSH username.
-            password (str): The SSH password.
+            password (str): The SSH password, None to authenticate with the
+                profile key only.
             port (int): The SSH port. Default is 22.
 
         Returns:
             paramiko.SSHClient: The SSH client instance or False if connection fails.
         """
+        timeouts = RemoteDeviceManager.timeouts
+        profile = RemoteDeviceManager.ssh_profiles.get((host, port))
+        # Started once the key exchange is over, see timed_transport
+        auth_span = []
         try:
             ssh_client = paramiko.SSHClient()
-            ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            if profile is None:
+                options = {}
+                ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            else:
+                options = prepare_client(ssh_client, host, port, profile)
+            transport_factory = options.pop('transport_factory',
+                                            paramiko.Transport)
+
+            def timed_transport(sock, **kwargs):
+                transport = transport_factory(sock, **kwargs)
+                start_client = transport.start_client
+
+                def timed_start_client(*args, **start_kwargs):
+                    with recorder.span(host, "kex"):
+                        start_client(*args, **start_kwargs)
+                    auth_span.append(Span(host, "auth", time.monotonic()))
+                transport.start_client = timed_start_client
+                return transport
 
-            ssh_client.connect(hostname=host, port=port, username=username,
-                               password=password, allow_agent=False, look_for_keys=False)
+            with recorder.span(host, "tcp"):
+                sock = socket.create_connection((host, port),
+                                                timeout=timeouts.connect)
+            try:
+                ssh_client.connect(hostname=host, port=port, username=username,
+                                   password=password, allow_agent=False,
+                                   look_for_keys=False, sock=sock,
+                                   timeout=timeouts.connect,
+                                   banner_timeout=timeouts.connect,
+                                   auth_timeout=timeouts.auth,
+                                   channel_timeout=timeouts.exec,
+                                   transport_factory=timed_transport,
+                                   **options)
+            except BaseException:
+                sock.close()
+                if auth_span:
+                    auth_span[0].ok = False
+                raise
+            finally:
+                if auth_span:
+                    auth_span[0].duration = (time.monotonic()
+                                             - auth_span[0].start)
+                    recorder.add(auth_span[0])
             return ssh_client
-        except paramiko.AuthenticationException:
-            logging.error(
-                "Failed to connect to %s: Authentication failed.", host)
+        except paramiko.AuthenticationException as e:
+            if 'timeout' in str(e).lower():
+                logging.error("Failed to connect to %s: timed out during auth "
+                              "stage after %s seconds.", host, timeouts.auth)
+            else:
+                logging.error(
+                    "Failed to connect to %s: Authentication failed.", host)
+            return False
+        except (socket.timeout, TimeoutError):
+            logging.error("Failed to connect to %s: timed out during connect "
+                          "stage after %s seconds.", host, timeouts.connect)
             return False
         except paramiko.SSHException as e:
-            logging.error("Failed to connect to %s: %s", host, str(e))
+            if 'banner' in str(e).lower():
+                logging.error("Failed to connect to %s: timed out during banner "
+                              "stage after %s seconds.", host, timeouts.connect)
+            else:
+                logging.error("Failed to connect to %s: %s", host, str(e))
             return False
         except Exception as e:
             logging.error("Failed to connect to %s: %s", host, str(e))
             return False
 
     @staticmethod
-    def poweroff_ubuntu_vm(host, username, password, port=22):  # pylint: disable=R0911
+    def get_connection(host, username, password, port=22):
         """
-        Power off the remote server.
+        Get a pooled SSH connection to the remote device.
+
+        The connection is shared with every other caller for the same
+        ``(host, port, username)`` and only established when no live one is
+        pooled, so a device pays the handshake cost once per run.
 
         Args:
             host (str): The hostname or IP address of the remote device.
@@ -85,49 +469,439 @@ class RemoteDeviceManager:
             port (int): The SSH port. Default is 22.
 
         Returns:
-            bool: True if the poweroff command was sent successfully, False otherwise.
+            paramiko.SSHClient: The SSH client instance or False if connection fails.
         """
-        if not RemoteDeviceManager.is_device_online(host):
-            logging.warning(
-                "%s is offline. Cannot proceed with power off.", host)
-            return False
+        return RemoteDeviceManager.connection_pool.acquire(
+            host, username, password, port)
+
+    @staticmethod
+    def close_all_connections():
+        """Close every pooled SSH connection."""
+        RemoteDeviceManager.connection_pool.close_all()
+
+    @staticmethod
+    def run_esxi_command(host, username, password, command, port=22,
+                         phase="esxi_command"):
+        """
+        Run a shell command on an ESXi server over its pooled session.
+
+        Args:
+            host (str): The hostname or IP address of the ESXi server.
+            username (str): The SSH username.
+            password (str): The SSH password.
+            command (str): The shell command to run.
+            port (int): The SSH port. Default is 22.
+            phase (str): Name of the span timing the command.
 
+        Returns:
+            str: The standard output of the command, or None if it could not run.
+        """
         try:
-            ssh_client = RemoteDeviceManager.ssh_connect(
-                host, username, password, port)
-            if not ssh_client:
-                return False
+            with RemoteDeviceManager.connection_pool.lease(
+                    host, username, password, port) as ssh_client:
+                if not ssh_client:
+                    return None
 
-            stdin, _, stderr = ssh_client.exec_command('sudo -S poweroff')
+                with recorder.span(host, phase) as span:
+                    result = run_command(
+                        ssh_client, command,
+                        timeout=RemoteDeviceManager.timeouts.exec)
+                    span.ok = not (result.timed_out_stage or result.error)
+            if result.timed_out_stage:
+                logging.error("Command on %s timed out during %s stage.",
+                              host, result.timed_out_stage)
+                return None
+            if result.error:
+                logging.error("Failed to run command on %s: %s",
+                              host, result.error)
+                RemoteDeviceManager.connection_pool.discard(
+                    host, username, port)
+                return None
+            return result.stdout
 
-            stdin.write(password + '\n')
-            stdin.flush()
+        except paramiko.SSHException as e:
+            logging.error("Failed to run command on %s: %s", host, str(e))
+            RemoteDeviceManager.connection_pool.discard(host, username, port)
+            return None
+        except Exception as e:
+            logging.error("Failed to run command on %s: %s", host, str(e))
+            return None
 
-            error = stderr.read().decode('utf-8')
+    @staticmethod
+    def run_many(targets: Iterable, command: str, max_workers: int = 16,
+                 sudo: bool = False, success_markers: Iterable[str] = (),
+                 on_output: Optional[Callable[[str, str, str], None]] = None,
+                 timeout: Optional[float] = None, wait: bool = True,
+                 close: bool = False,
+                 phase: str = "command") -> Dict[str, CommandResult]:
+        """
+        Run a shell command on many devices concurrently.
 
-            if '[sudo] password for' in error:
-                logging.info("%s poweroff command sent successfully.", host)
-                ssh_client.close()
-                return True
+        Every device runs the command over its pooled session, at most
+        ``max_workers`` of them at a time. A device whose session could not
+        be established or broke gets a result with an ``error`` and its
+        pooled connection is discarded; the other devices are not affected.
 
-            logging.error(
-                "Error executing poweroff command on %s: %s", host, error.strip())
-            ssh_client.close()
-            return False
+        Args:
+            targets (Iterable): The devices, as ``RemoteTarget`` instances or
+                ``(host, username, password[, port])`` tuples.
+            command (str): The shell command to run.
+            max_workers (int): Limit of devices running the command at once.
+            sudo (bool): Run the command through ``sudo -S`` with the password
+                of the device on its standard input. The password prompt is
+                removed from the collected standard error.
+            success_markers (Iterable[str]): Strings that prove success and
+                end the wait of a device early, see ``run_command``.
+            on_output (Callable[[str, str, str], None]): Called from the
+                worker threads with the host, the stream name ("stdout" or
+                "stderr") and the text of every chunk of output as it arrives.
+            timeout (float): Seconds allowed for running the command on each
+                device. Default is the exec stage timeout.
+            wait (bool): Wait for the output of the command. When False the
+                command is only sent. Default is True.
+            close (bool): Discard the pooled connection of every device after
+                the command, for example when it goes down. Default is False.
+            phase (str): Name of the span timing the command on each device.
+
+        Returns:
+            Dict[str, CommandResult]: The result of every device keyed by its
+            host, in the order of ``targets``.
+        """
+        targets = [target if isinstance(target, RemoteTarget)
+                   else RemoteTarget(*target) for target in targets]
+        if not targets:
+            return {}
+        if sudo:
+            command = f"sudo -S {command}"
+        if timeout is None:
+            timeout = RemoteDeviceManager.timeouts.exec
+
+        def run(target):
+            return RemoteDeviceManager._run_on_target(
+                target, command, sudo, tuple(success_markers), on_output,
+                timeout, wait, close, phase)
+
+        if len(targets) == 1:
+            return {targets[0].host: run(targets[0])}
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(targets)),
+                                thread_name_prefix="run-many") as executor:
+            results = list(executor.map(run, targets))
+        return {target.host: result
+                for target, result in zip(targets, results)}
+
+    @staticmethod
+    def _run_on_target(target, command, sudo, success_markers, on_output,
+                       timeout, wait, close, phase):
+        """Run a command of ``run_many`` on one device."""
+        host, username, port = target.host, target.username, target.port
+        # Output is reported per target, tagged with its host
+        forward = (None if on_output is None else
+                   lambda name, text: on_output(host, name, text))
+        try:
+            with RemoteDeviceManager.connection_pool.lease(
+                    host, username, target.password, port) as ssh_client:
+                if not ssh_client:
+                    return CommandResult(error="could not connect")
+
+                with recorder.span(host, phase) as span:
+                    result = run_command(
+                        ssh_client, command,
+                        stdin_data=((target.password or '') + '\n'
+                                    if sudo else None),
+                        success_markers=success_markers, timeout=timeout,
+                        wait=wait, on_output=forward)
+                    span.ok = result.ok
+            if sudo:
+                result.stderr = _SUDO_PROMPT.sub('', result.stderr)
+            if (result.error and not result.timed_out_stage) or close:
+                RemoteDeviceManager.connection_pool.discard(
+                    host, username, port)
+            return result
 
-        except paramiko.AuthenticationException:
-            logging.error(
-                "Failed to connect to %s: Authentication failed.", host)
-            return False
         except paramiko.SSHException as e:
-            logging.error("Failed to connect to %s: %s", host, str(e))
-            return False
+            RemoteDeviceManager.connection_pool.discard(host, username, port)
+            return CommandResult(error=str(e))
         except Exception as e:
-            logging.error("Failed to power off %s: %s", host, str(e))
+            return CommandResult(error=str(e))
+
+    @staticmethod
+    def parse_getallvms(output):
+        """
+        Parse the output of ``vim-cmd vmsvc/getallvms``.
+
+        Args:
+            output (str): The command output.
+
+        Returns:
+            Dict[str, str]: The Vmid of every registered VM keyed by its name.
+        """
+        vm_ids = {}
+        for line in output.splitlines():
+            match = _GETALLVMS_ROW.match(line)
+            if match:
+                vm_ids[match.group(2)] = match.group(1)
+        return vm_ids
+
+    @staticmethod
+    def get_esxi_vm_power_states(host, username, password, port=22):
+        """
+        Get the power state of every VM registered on an ESXi server.
+
+        The VMs are listed and their states queried in a single command.
+
+        Args:
+            host (str): The hostname or IP address of the ESXi server.
+            username (str): The SSH username.
+            password (str): The SSH password.
+            port (int): The SSH port. Default is 22.
+
+        Returns:
+            Dict[str, str]: The power state (for example ``Powered on``) of
+            every VM keyed by its name, or None if the query failed.
+        """
+        output = RemoteDeviceManager.run_esxi_command(
+            host, username, password,
+            f"vim-cmd vmsvc/getallvms 2>/dev/null; echo '{_STATES_MARKER}'; "
+            f"{_LIST_VM_IDS} | while read id; do "
+            "echo \"$id $(vim-cmd vmsvc/power.getstate $id | tail -n 1)\"; done",
+            port, phase="vm_states")
+        if output is None or _STATES_MARKER not in output:
+            return None
+
+        listing, states = output.split(_STATES_MARKER, 1)
+        state_by_id = dict(line.split(' ', 1) for line in states.splitlines()
+                           if ' ' in line)
+        return {name: state_by_id.get(vm_id, 'Unknown')
+                for name, vm_id in
+                RemoteDeviceManager.parse_getallvms(listing).items()}
+
+    @staticmethod
+    def discover_esxi_vms(host, username, password, port=22):
+        """
+        Discover every VM registered on an ESXi server with its power state
+        and guest IP.
+
+        The VMs are listed and queried in a single command, the queries of
+        all VMs running concurrently on the server.
+
+        Args:
+            host (str): The hostname or IP address of the ESXi server.
+            username (str): The SSH username.
+            password (str): The SSH password.
+            port (int): The SSH port. Default is 22.
+
+        Returns:
+            Dict[str, DiscoveredVM]: Every registered VM keyed by its name,
+            or None if the discovery failed.
+        """
+        output = RemoteDeviceManager.run_esxi_command(
+            host, username, password,
+            f"vim-cmd vmsvc/getallvms 2>/dev/null; echo '{_DISCOVERY_MARKER}'; "
+            f"{_LIST_VM_IDS} | {{ while read id; do ( "
+            "echo \"$id|$(vim-cmd vmsvc/power.getstate $id | tail -n 1)|"
+            "$(vim-cmd vmsvc/get.guest $id 2>/dev/null | "
+            "sed -n 's/^ *ipAddress = \"\\([^\"]*\\)\".*/\\1/p' | head -n 1)\" "
+            ") & done; wait; }",
+            port, phase="discovery")
+        if output is None or _DISCOVERY_MARKER not in output:
+            return None
+
+        listing, details = output.split(_DISCOVERY_MARKER, 1)
+        details_by_id = {}
+        for line in details.splitlines():
+            fields = line.split('|')
+            if len(fields) == 3:
+                details_by_id[fields[0]] = (fields[1] or 'Unknown',
+                                            fields[2] or None)
+        vms = {}
+        for name, vm_id in RemoteDeviceManager.parse_getallvms(listing).items():
+            power_state, ip = details_by_id.get(vm_id, ('Unknown', None))
+            vms[name] = DiscoveredVM(name, power_state, ip)
+        return vms
+
+    @staticmethod
+    def _power_esxi_vms(host, username, password, hard, vm_names, port,
+                        exclude=()):
+        """List the VMs of an ESXi server and power them down in one batch."""
+        listing = RemoteDeviceManager.run_esxi_command(
+            host, username, password, "vim-cmd vmsvc/getallvms", port,
+            phase="vm_list")
+        if listing is None:
+            return None
+        vm_ids = RemoteDeviceManager.parse_getallvms(listing)
+        vm_ids = {name: vm_id for name, vm_id in vm_ids.items()
+                  if (vm_names is None or name in vm_names)
+                  and name not in exclude}
+        if not vm_ids:
+            return {}
+
+        graceful = ("elif vim-cmd vmsvc/power.shutdown $id >/dev/null 2>&1; "
+                    "then echo \"$id shutdown\"; ")
+        output = RemoteDeviceManager.run_esxi_command(
+            host, username, password,
+            f"for id in {' '.join(vm_ids.values())}; do ( "
+            "if [ \"$(vim-cmd vmsvc/power.getstate $id | tail -n 1)\" != 'Powered on' ]; "
+            "then echo \"$id skipped\"; "
+            f"{'' if hard else graceful}"
+            "elif vim-cmd vmsvc/power.off $id >/dev/null 2>&1; "
+            "then echo \"$id off\"; "
+            "else echo \"$id failed\"; fi ) & done; wait",
+            port, phase="vm_hard_off" if hard else "vm_shutdown")
+        if output is None:
+            return None
+
+        outcome_by_id = dict(line.split(' ', 1) for line in output.splitlines()
+                             if ' ' in line)
+        outcomes = {name: outcome_by_id.get(vm_id, 'failed')
+                    for name, vm_id in vm_ids.items()}
+        for name, outcome in outcomes.items():
+            logging.info("%s: VM %s %s.", host, name, outcome)
+        return outcomes
+
+    @staticmethod
+    def shutdown_esxi_vms(host, username, password, port=22, vm_names=None,
+                          exclude=()):
+        """
+        Shutdown the running VMs of an ESXi server over a single session.
+
+        A guest shutdown is sent to all powered-on VMs in one batched command;
+        VMs that refuse it (for example without VMware Tools) are hard
+        powered off instead.
+
+        Args:
+            host (str): The hostname or IP address of the ESXi server.
+            username (str): The SSH username.
+            password (str): The SSH password.
+            port (int): The SSH port. Default is 22.
+            vm_names (Iterable[str]): Names of the VMs to shut down, every
+                registered VM if None.
+            exclude (Iterable[str]): Names of VMs to leave running.
+
+        Returns:
+            Dict[str, str]: The outcome of every selected VM keyed by its
+            name: ``shutdown``, ``off`` (hard power-off), ``skipped`` (was not
+            running) or ``failed``; None if the ESXi server could not be used.
+        """
+        return RemoteDeviceManager._power_esxi_vms(
+            host, username, password, False,
+            None if vm_names is None else set(vm_names), port, set(exclude))
+
+    @staticmethod
+    def hard_poweroff_esxi_vms(host, username, password, vm_names, port=22):
+        """
+        Hard power off the given VMs of an ESXi server in one batched command.
+
+        Args:
+            host (str): The hostname or IP address of the ESXi server.
+            username (str): The SSH username.
+            password (str): The SSH password.
+            vm_names (Iterable[str]): Names of the VMs to power off.
+            port (int): The SSH port. Default is 22.
+
+        Returns:
+            Dict[str, str]: The outcome of every requested VM registered on the
+            server keyed by its name: ``off``, ``skipped`` (was not running) or
+            ``failed``; None if the ESXi server could not be used.
+        """
+        return RemoteDeviceManager._power_esxi_vms(
+            host, username, password, True, set(vm_names), port)
+
+    @staticmethod
+    def poweron_esxi_vms(host, username, password, vm_names, port=22):
+        """
+        Power on the given VMs of an ESXi server in one batched command.
+
+        Args:
+            host (str): The hostname or IP address of the ESXi server.
+            username (str): The SSH username.
+            password (str): The SSH password.
+            vm_names (Iterable[str]): Names of the VMs to power on.
+            port (int): The SSH port. Default is 22.
+
+        Returns:
+            Dict[str, str]: The outcome of every requested VM registered on the
+            server keyed by its name: ``on``, ``skipped`` (was already
+            running) or ``failed``; None if the ESXi server could not be used.
+        """
+        listing = RemoteDeviceManager.run_esxi_command(
+            host, username, password, "vim-cmd vmsvc/getallvms", port,
+            phase="vm_list")
+        if listing is None:
+            return None
+        vm_names = set(vm_names)
+        vm_ids = {name: vm_id for name, vm_id in
+                  RemoteDeviceManager.parse_getallvms(listing).items()
+                  if name in vm_names}
+        if not vm_ids:
+            return {}
+
+        output = RemoteDeviceManager.run_esxi_command(
+            host, username, password,
+            f"for id in {' '.join(vm_ids.values())}; do ( "
+            "if [ \"$(vim-cmd vmsvc/power.getstate $id | tail -n 1)\" = 'Powered on' ]; "
+            "then echo \"$id skipped\"; "
+            "elif vim-cmd vmsvc/power.on $id >/dev/null 2>&1; "
+            "then echo \"$id on\"; "
+            "else echo \"$id failed\"; fi ) & done; wait",
+            port, phase="vm_power_on")
+        if output is None:
+            return None
+
+        outcome_by_id = dict(line.split(' ', 1) for line in output.splitlines()
+                             if ' ' in line)
+        outcomes = {name: outcome_by_id.get(vm_id, 'failed')
+                    for name, vm_id in vm_ids.items()}
+        for name, outcome in outcomes.items():
+            logging.info("%s: VM %s %s.", host, name,
+                         "powered on" if outcome == 'on' else outcome)
+        return outcomes
+
+    @staticmethod
+    def poweroff_ubuntu_vm(host, username, password, port=22, online=None):
+        """
+        Power off the remote server.
+
+        Args:
+            host (str): The hostname or IP address of the remote device.
+            username (str): The SSH username.
+            password (str): The SSH password.
+            port (int): The SSH port. Default is 22.
+            online (bool): Precomputed reachability of the device, for example
+                from ``check_reachability``. Probed when None.
+
+        Returns:
+            bool: True if the poweroff command was sent successfully, False otherwise.
+        """
+        if online is None:
+            online = RemoteDeviceManager.is_device_online(host)
+        if not online:
+            logging.warning(
+                "%s is offline. Cannot proceed with power off.", host)
             return False
 
+        # Returns as soon as the sudo prompt shows up instead of waiting for
+        # the channel to close when the device goes down.
+        result = RemoteDeviceManager.run_many(
+            [RemoteTarget(host, username, password, port)], 'poweroff',
+            sudo=True, success_markers=('[sudo] password for',),
+            phase="guest_poweroff")[host]
+
+        if result.matched:
+            logging.info("%s poweroff command sent successfully.", host)
+            return True
+
+        if result.timed_out_stage:
+            logging.error(
+                "Poweroff command on %s timed out during %s stage.",
+                host, result.timed_out_stage)
+        else:
+            logging.error(
+                "Error executing poweroff command on %s: %s", host,
+                (result.error or result.stderr).strip())
+        return False
+
     @staticmethod
-    def poweroff_esxi_server(host, username, password, port=22):  # pylint: disable=R0911
+    def poweroff_esxi_server(host, username, password, port=22, online=None):
         """
             Power off the remote server.
 
@@ -136,34 +910,41 @@ class RemoteDeviceManager:
                 username (str): The SSH username.
                 password (str): The SSH password.
                 port (int): The SSH port. Default is 22.
+                online (bool): Precomputed reachability of the device, for
+                    example from ``check_reachability``. Probed when None.
 
             Returns:
                 bool: True if the poweroff command was sent successfully, False otherwise.
             """
-        if not RemoteDeviceManager.is_device_online(host):
+        if online is None:
+            online = RemoteDeviceManager.is_device_online(host)
+        if not online:
             logging.warning(
                 "%s is offline. Cannot proceed with power off.", host)
             return False
 
-        try:
-            ssh_client = RemoteDeviceManager.ssh_connect(
-                host, username, password, port)
-            if not ssh_client:
-                return False
+        # The server drops its sessions as it goes down, so the command is
+        # only sent and the pooled connection closed right away.
+        result = RemoteDeviceManager.run_many(
+            [RemoteTarget(host, username, password, port)], 'poweroff',
+            wait=False, close=True, phase="esxi_poweroff")[host]
 
-            ssh_client.exec_command('poweroff')
+        if not result.ok:
+            logging.error("Failed to power off %s: %s", host, result.error)
+            return False
+        logging.info("%s poweroff command sent successfully.", host)
+        return True
 
-            logging.info("%s poweroff command sent successfully.", host)
-            ssh_client.close()
-            return True
+RemoteDeviceManager.timeouts = StageTimeouts()
 
-        except paramiko.AuthenticationException:
-            logging.error(
-                "Failed to connect to %s: Authentication failed.", host)
-            return False
-        except paramiko.SSHException as e:
-            logging.error("Failed to connect to %s: %s", host, str(e))
-            return False
-        except Exception as e:
-            logging.error("Failed to power off %s: %s", host, str(e))
-            return False
+# SSH profiles by (host, port), see configure_ssh_profiles
+RemoteDeviceManager.ssh_profiles = {}
+
+# Spans of every stage of the remote operations, for the run report
+RemoteDeviceManager.timing = recorder
+
+# Shared by every caller in the process; resolved through the class so that
+# ``ssh_connect`` can be replaced (for example by tests) after import.
+RemoteDeviceManager.connection_pool = SSHConnectionPool(
+    lambda host, username, password, port:
+        RemoteDeviceManager.ssh_connect(host, username, password, port))
@@ -0,0 +1,208 @@
+"""
+Module for the SSH profiles of remote devices: authentication keys, preferred
+algorithms, compression and the persisted known-hosts cache.
+"""
+import logging
+import os
+import socket
+import threading
+from typing import Callable, Dict, Optional, Tuple
+
+import paramiko
+
+
+# Transport security options set from every profile field
+_SECURITY_OPTIONS = {
+    'kex': 'kex',
+    'ciphers': 'ciphers',
+    'macs': 'digests',
+    'key_types': 'key_types',
+}
+
+
+def check_algorithms(profile) -> None:
+    """Check that paramiko supports every algorithm listed by a profile.
+
+    The algorithms are set one by one on the security options of an unused
+    transport, which reject the names paramiko does not implement.
+
+    Args:
+        profile: An ``SSHProfile`` of the configuration
+
+    Raises:
+        ValueError: If an algorithm is unknown to paramiko
+    """
+    with socket.socket() as sock:
+        transport = paramiko.Transport(sock)
+        try:
+            options = transport.get_security_options()
+            for field_name, option in _SECURITY_OPTIONS.items():
+                for name in getattr(profile, field_name):
+                    try:
+                        setattr(options, option, (name,))
+                    except ValueError:
+                        raise ValueError(f"Unsupported {field_name} "
+                                         f"algorithm: {name}") from None
+        finally:
+            transport.close()
+
+
+def transport_factory(profile) -> Callable:
+    """Return a transport factory negotiating the algorithms of a profile.
+
+    Listed algorithms are the only ones offered, in the listed order, so a
+    profile that only offers what the servers support best settles the key
+    exchange in a single round trip, and leaving out group exchange kex
+    saves the extra round trip of its group request.
+
+    Every transport also disables Nagle's algorithm: the handshake is a
+    series of small packets, several of which paramiko writes back to back,
+    and each would otherwise wait for the delayed ACK of the previous one.
+
+    Args:
+        profile: An ``SSHProfile`` of the configuration
+
+    Returns:
+        Callable: Factory for ``SSHClient.connect``
+    """
+    preferred = {option: tuple(getattr(profile, field_name))
+                 for field_name, option in _SECURITY_OPTIONS.items()
+                 if getattr(profile, field_name)}
+
+    def factory(sock, **kwargs):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        transport = paramiko.Transport(sock, **kwargs)
+        options = transport.get_security_options()
+        for option, names in preferred.items():
+            setattr(options, option, names)
+        return transport
+    return factory
+
+
+_keys: Dict[Tuple[str, Optional[str]], paramiko.PKey] = {}
+_keys_lock = threading.Lock()
+
+
+def load_private_key(path: str, passphrase: Optional[str] = None) -> paramiko.PKey:
+    """Load a private key file once per process.
+
+    Decrypting an OpenSSH key runs its bcrypt key derivation, which takes
+    longer than the handshake itself; the key is kept for every later
+    connection.
+
+    Args:
+        path: Path of the private key, in OpenSSH or PEM format
+        passphrase: Passphrase of an encrypted key
+
+    Returns:
+        paramiko.PKey: The loaded key
+    """
+    path = os.path.expanduser(path)
+    with _keys_lock:
+        key = _keys.get((path, passphrase))
+        if key is None:
+            key = paramiko.PKey.from_path(path, passphrase)
+            _keys[(path, passphrase)] = key
+        return key
+
+
+class KnownHostsCache:
+    """
+    Host keys of a known_hosts file, shared by every connection of the process.
+
+    The file is read once; host keys learned afterwards are added to the
+    cache and appended to the file, so the next run verifies them instead of
+    learning them again. Every client only gets the keys of the host it
+    connects to, which spares it parsing and copying the whole file.
+    """
+
+    def __init__(self, path: str):
+        self.path = os.path.expanduser(path)
+        self._lock = threading.Lock()
+        self._host_keys = paramiko.HostKeys()
+        if os.path.exists(self.path):
+            self._host_keys.load(self.path)
+
+    def lookup(self, name: str) -> Dict[str, paramiko.PKey]:
+        """Return the keys of a host by key type, empty if it is unknown.
+
+        Args:
+            name: Host name as paramiko looks it up, ``[host]:port`` for a
+                port other than 22
+        """
+        with self._lock:
+            return dict(self._host_keys.lookup(name) or {})
+
+    def learn(self, name: str, key: paramiko.PKey) -> None:
+        """Add the key of a host to the cache and to the file."""
+        with self._lock:
+            self._host_keys.add(name, key.get_name(), key)
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, 'a') as f:
+                f.write(f"{name} {key.get_name()} {key.get_base64()}\n")
+
+    def apply(self, client: paramiko.SSHClient, name: str) -> None:
+        """Give a client the known keys of the host it connects to."""
+        host_keys = client.get_host_keys()
+        for key_type, key in self.lookup(name).items():
+            host_keys.add(name, key_type, key)
+
+
+class _LearningPolicy(paramiko.MissingHostKeyPolicy):
+    """Persist the key of an unknown host, or reject it if strict."""
+
+    def __init__(self, cache: KnownHostsCache, strict: bool):
+        self.cache = cache
+        self.strict = strict
+
+    def missing_host_key(self, client, hostname, key):
+        if self.strict:
+            raise paramiko.SSHException(
+                f"Unknown host key for {hostname} ({key.get_name()})")
+        logging.info("Learned the %s host key of %s.", key.get_name(), hostname)
+        self.cache.learn(hostname, key)
+
+
+_known_hosts: Dict[str, KnownHostsCache] = {}
+_known_hosts_lock = threading.Lock()
+
+
+def known_hosts_cache(path: str) -> KnownHostsCache:
+    """Return the process-wide cache of a known_hosts file."""
+    with _known_hosts_lock:
+        cache = _known_hosts.get(path)
+        if cache is None:
+            cache = _known_hosts[path] = KnownHostsCache(path)
+        return cache
+
+
+def prepare_client(client: paramiko.SSHClient, host: str, port: int,
+                   profile) -> Dict:
+    """Set a client up for a profile before it connects.
+
+    Args:
+        client: The client about to connect
+        host (str): The hostname or IP address of the remote device.
+        port (int): The SSH port.
+        profile: The ``SSHProfile`` of the device
+
+    Returns:
+        Dict: Extra keyword arguments of ``SSHClient.connect``
+    """
+    if profile.known_hosts is None:
+        # Host keys are learned again by every connection
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    else:
+        cache = known_hosts_cache(profile.known_hosts)
+        cache.apply(client, host if port == 22 else f"[{host}]:{port}")
+        client.set_missing_host_key_policy(
+            _LearningPolicy(cache, profile.strict_host_keys))
+
+    options = {'compress': profile.compress,
+               'transport_factory': transport_factory(profile)}
+    if profile.key_file is not None:
+        options['pkey'] = load_private_key(profile.key_file,
+                                           profile.key_passphrase)
+    return options
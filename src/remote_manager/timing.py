@@ -0,0 +1,72 @@
+"""
+Module for timing the stages of remote operations.
+"""
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import List, Optional
+
+
+@dataclass
+class Span:
+    """A timed stage of an operation against a single host."""
+    host: str
+    phase: str
+    # Monotonic time the stage started at
+    start: float
+    duration: float = 0.0
+    ok: bool = True
+
+
+class SpanRecorder:
+    """
+    Collect the spans of operations running on any number of threads.
+
+    Recording only appends to a list under a lock, so it adds no measurable
+    cost to the operations it times. The oldest spans are dropped past
+    ``max_spans``, which bounds the memory of a long-running daemon.
+    """
+
+    def __init__(self, max_spans: int = 100000):
+        self._spans = deque(maxlen=max_spans)
+        self._lock = threading.Lock()
+
+    def add(self, span: Span) -> None:
+        """Record a finished span."""
+        with self._lock:
+            self._spans.append(span)
+
+    @contextmanager
+    def span(self, host: str, phase: str):
+        """Time the enclosed block as a ``phase`` against ``host``.
+
+        The span is yielded so that the block can mark it failed; it is also
+        marked failed when the block raises.
+        """
+        span = Span(host, phase, time.monotonic())
+        try:
+            yield span
+        except BaseException:
+            span.ok = False
+            raise
+        finally:
+            span.duration = time.monotonic() - span.start
+            self.add(span)
+
+    def spans(self, since: Optional[float] = None) -> List[Span]:
+        """Return the recorded spans, only those started at or after the
+        monotonic time ``since`` if given."""
+        with self._lock:
+            return [span for span in self._spans
+                    if since is None or span.start >= since]
+
+    def clear(self) -> None:
+        """Forget every recorded span."""
+        with self._lock:
+            self._spans.clear()
+
+
+# Shared by every remote operation in the process
+recorder = SpanRecorder()
@@ -0,0 +1,151 @@
+import unittest
+from unittest.mock import MagicMock, patch
+from src.remote_manager.command_runner import run_command
+
+
+class FakeChannel:
+    """Channel replaying scripted output, one chunk per poll."""
+
+    def __init__(self, stdout=(), stderr=(), exit_status=None):
+        self.stdout = list(stdout)
+        self.stderr = list(stderr)
+        self.exit_status = exit_status
+        self.closed = False
+        self.sent = b''
+        self.command = None
+
+    def settimeout(self, timeout):
+        pass
+
+    def setblocking(self, blocking):
+        pass
+
+    def exec_command(self, command):
+        self.command = command
+
+    def sendall(self, data):
+        self.sent += data
+
+    def recv_ready(self):
+        return bool(self.stdout) and self.stdout[0] is not None
+
+    def recv(self, size):
+        return self.stdout.pop(0)
+
+    def recv_stderr_ready(self):
+        return bool(self.stderr) and self.stderr[0] is not None
+
+    def recv_stderr(self, size):
+        return self.stderr.pop(0)
+
+    def exit_status_ready(self):
+        return (self.exit_status is not None
+                and not self.stdout and not self.stderr)
+
+    def recv_exit_status(self):
+        return self.exit_status
+
+    def close(self):
+        self.closed = True
+
+    def advance(self):
+        # A None entry stands for "no data yet"; drop one per poll
+        for stream in (self.stdout, self.stderr):
+            if stream and stream[0] is None:
+                stream.pop(0)
+
+
+def client_for(channel):
+    client = MagicMock()
+    client.get_transport.return_value.open_session.return_value = channel
+    return client
+
+
+def fake_select(readable, *_):
+    for channel in readable:
+        channel.advance()
+    return readable, [], []
+
+
+@patch('src.remote_manager.command_runner.select.select', side_effect=fake_select)
+class TestRunCommand(unittest.TestCase):
+    def test_collects_output_and_exit_status(self, _):
+        channel = FakeChannel(stdout=[b'hello ', None, b'world'], stderr=[b'warn'],
+                              exit_status=0)
+        result = run_command(client_for(channel), 'echo hello world')
+
+        self.assertEqual(result.stdout, 'hello world')
+        self.assertEqual(result.stderr, 'warn')
+        self.assertEqual(result.exit_status, 0)
+        self.assertTrue(result.completed)
+        self.assertTrue(channel.closed)
+
+    def test_returns_early_on_success_marker(self, _):
+        channel = FakeChannel(stderr=[None, b'[sudo] password for admin:'])
+        result = run_command(client_for(channel), 'sudo -S poweroff',
+                             stdin_data='secret\n',
+                             success_markers=('[sudo] password for',))
+
+        self.assertEqual(result.matched, '[sudo] password for')
+        self.assertIsNone(result.exit_status)
+        self.assertEqual(channel.sent, b'secret\n')
+        # Closed only once the password was sent
+        self.assertTrue(channel.closed)
+
+    def test_streams_output_as_it_arrives(self, _):
+        # "é" is split across two chunks
+        channel = FakeChannel(stdout=[b'caf\xc3', None, b'\xa9\n'],
+                              stderr=[b'warn'], exit_status=3)
+        chunks = []
+        result = run_command(client_for(channel), 'cat menu',
+                             on_output=lambda *chunk: chunks.append(chunk))
+
+        self.assertEqual(chunks, [('stdout', 'caf'), ('stderr', 'warn'),
+                                  ('stdout', '\u00e9\n')])
+        self.assertEqual(result.stdout, 'caf\u00e9\n')
+        self.assertEqual(result.exit_status, 3)
+        self.assertFalse(result.ok)
+
+    def test_detached_command_is_only_sent(self, _):
+        channel = FakeChannel(stdout=[b'never read'])
+        result = run_command(client_for(channel), 'poweroff', wait=False)
+
+        self.assertEqual(channel.command, 'poweroff')
+        self.assertTrue(result.ok)
+        self.assertEqual(result.stdout, '')
+        self.assertTrue(channel.closed)
+
+    def test_exec_timeout(self, _):
+        channel = FakeChannel(stdout=[None] * 1000)
+        result = run_command(client_for(channel), 'sleep 60', timeout=0.05)
+
+        self.assertEqual(result.timed_out_stage, 'exec')
+        self.assertFalse(result.completed)
+        self.assertTrue(channel.closed)
+
+    def test_channel_open_timeout(self, _):
+        client = MagicMock()
+        client.get_transport.return_value.open_session.side_effect = TimeoutError()
+        result = run_command(client, 'uptime')
+
+        self.assertEqual(result.timed_out_stage, 'channel')
+
+    def test_channel_failing_after_open_is_closed(self, _):
+        channel = FakeChannel()
+        channel.exec_command = MagicMock(side_effect=OSError("broken pipe"))
+        result = run_command(client_for(channel), 'uptime')
+
+        self.assertEqual(result.error, 'broken pipe')
+        self.assertTrue(channel.closed)
+
+    def test_remote_closed_without_status(self, _):
+        channel = FakeChannel()
+        channel.closed = True
+        result = run_command(client_for(channel), 'poweroff', timeout=5)
+
+        self.assertIsNone(result.timed_out_stage)
+        self.assertIsNone(result.exit_status)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,3 +1,6 @@
+import json
+import os
+import tempfile
 import unittest
 from unittest.mock import mock_open, patch
 from src.config_manager.config_manager import ConfigManager, VMConfig, ESXiConfig
@@ -40,6 +43,285 @@ class TestConfigManager(unittest.TestCase):
         with self.assertRaises(ValueError):
             config_manager.load_config()
 
+    @patch('builtins.open', new_callable=mock_open, read_data='{"shutdown": {"max_workers": 16, "per_host_workers": 2}, "esxi_servers": []}')
+    def test_load_config_with_shutdown_settings(self, mock_file):
+        config_manager = ConfigManager('conf/conf.json')
+        config_manager.load_config()
+        self.assertEqual(config_manager.shutdown.max_workers, 16)
+        self.assertEqual(config_manager.shutdown.per_host_workers, 2)
+
+    @patch('builtins.open', new_callable=mock_open, read_data='{"report": {"json_file": null, "prometheus_file": "/var/lib/node_exporter/esxi.prom"}, "esxi_servers": []}')
+    def test_load_config_with_report_settings(self, mock_file):
+        config_manager = ConfigManager('conf/conf.json')
+        config_manager.load_config()
+        self.assertIsNone(config_manager.report.json_file)
+        self.assertEqual(config_manager.report.prometheus_file,
+                         '/var/lib/node_exporter/esxi.prom')
+        self.assertEqual(config_manager.report.history_file,
+                         'run/latency_history.json')
+
+    @patch('builtins.open', new_callable=mock_open, read_data='{"journal": {"file": "/var/lib/esxi/journal.jsonl", "lock_file": null, "resume_window": 300}, "esxi_servers": []}')
+    def test_load_config_with_journal_settings(self, mock_file):
+        config_manager = ConfigManager('conf/conf.json')
+        config_manager.load_config()
+        self.assertEqual(config_manager.journal.file, '/var/lib/esxi/journal.jsonl')
+        self.assertIsNone(config_manager.journal.lock_file)
+        self.assertEqual(config_manager.journal.resume_window, 300)
+
+    @patch('builtins.open', new_callable=mock_open, read_data='{"logging": {"format": "json", "levels": {"infrastructure_manager": "info"}}, "esxi_servers": []}')
+    def test_load_config_with_logging_settings(self, mock_file):
+        config_manager = ConfigManager('conf/conf.json')
+        config_manager.load_config()
+        self.assertEqual(config_manager.logging.format, 'json')
+        self.assertEqual(config_manager.logging.levels,
+                         {'paramiko': 'WARNING', 'infrastructure_manager': 'INFO'})
+
+    @patch('builtins.open', new_callable=mock_open, read_data='{"logging": {"levels": {"paramiko": "LOUD"}}, "esxi_servers": []}')
+    def test_load_config_with_invalid_logging_level(self, mock_file):
+        config_manager = ConfigManager('conf/conf.json')
+        with self.assertRaises(ValueError):
+            config_manager.load_config()
+
+    @patch('builtins.open', new_callable=mock_open, read_data='{"shutdown": {"max_workers": 0}, "esxi_servers": []}')
+    def test_load_config_with_invalid_shutdown_settings(self, mock_file):
+        config_manager = ConfigManager('conf/conf.json')
+        with self.assertRaises(ValueError):
+            config_manager.load_config()
+
+    @patch('builtins.open', new_callable=mock_open, read_data='{"shutdown": {"retry_base_delay": 5, "retry_max_delay": 2}, "esxi_servers": []}')
+    def test_load_config_with_invalid_retry_delays(self, mock_file):
+        config_manager = ConfigManager('conf/conf.json')
+        with self.assertRaisesRegex(ValueError, "retry_max_delay"):
+            config_manager.load_config()
+
+    @patch('builtins.open', new_callable=mock_open, read_data='{"esxi_servers": [{"name": "prod-esxi-01", "ip": "192.168.1.100", "username": "admin", "password": "esxi_password", "vm_shutdown_strategy": "hypervisor", "vms": [{"name": "web-server-01", "ip": "192.168.1.101"}]}]}')
+    def test_load_config_hypervisor_strategy_without_vm_credentials(self, mock_file):
+        config_manager = ConfigManager('conf/conf.json')
+        config_manager.load_config()
+        esxi_server = config_manager.esxi_servers[0]
+        self.assertEqual(esxi_server.vm_shutdown_strategy, "hypervisor")
+        self.assertIsNone(esxi_server.vms[0].username)
+
+    @patch('builtins.open', new_callable=mock_open, read_data='{"ssh_profiles": {"fast": {"key_file": "~/.ssh/id_ed25519", "kex": ["curve25519-sha256"], "ciphers": ["aes128-gcm@openssh.com"], "known_hosts": "run/known_hosts"}}, "esxi_servers": [{"name": "esxi-01", "ip": "10.0.0.1", "port": 2222, "username": "root", "ssh_profile": "fast", "vms": [{"name": "app", "ip": "10.0.0.10", "username": "u", "password": "p"}]}]}')
+    def test_load_config_with_ssh_profiles(self, mock_file):
+        config_manager = ConfigManager('conf/conf.json')
+        config_manager.load_config()
+        server = config_manager.esxi_servers[0]
+        # Key authentication needs no password
+        self.assertIsNone(server.password)
+        fast = config_manager.ssh_profiles['fast']
+        self.assertEqual(fast.kex, ['curve25519-sha256'])
+        self.assertFalse(fast.compress)
+        profiles = config_manager.ssh_profiles_by_address()
+        self.assertIs(profiles[('10.0.0.1', 2222)], fast)
+        self.assertIs(profiles[('10.0.0.10', 22)],
+                      config_manager.ssh_profiles['default'])
+
+    @patch('builtins.open', new_callable=mock_open, read_data='{"esxi_servers": [{"name": "esxi-01", "ip": "10.0.0.1", "username": "root", "password": "pw", "ssh_profile": "fast", "vms": []}]}')
+    def test_load_config_with_unknown_ssh_profile(self, mock_file):
+        config_manager = ConfigManager('conf/conf.json')
+        with self.assertRaisesRegex(ValueError, "Unknown ssh_profile"):
+            config_manager.load_config()
+
+    @patch('builtins.open', new_callable=mock_open, read_data='{"ssh_profiles": {"strict": {"strict_host_keys": true}}, "esxi_servers": []}')
+    def test_load_config_strict_ssh_profile_without_known_hosts(self, mock_file):
+        config_manager = ConfigManager('conf/conf.json')
+        with self.assertRaisesRegex(ValueError, "requires known_hosts"):
+            config_manager.load_config()
+
+    @patch('builtins.open', new_callable=mock_open, read_data='{"esxi_servers": [{"name": "prod-esxi-01", "ip": "192.168.1.100", "username": "admin", "password": "esxi_password", "vm_shutdown_strategy": "magic", "vms": []}]}')
+    def test_load_config_invalid_strategy(self, mock_file):
+        config_manager = ConfigManager('conf/conf.json')
+        with self.assertRaises(ValueError):
+            config_manager.load_config()
+
+
+    @patch('builtins.open', new_callable=mock_open, read_data='{"esxi_servers": [{"name": "esxi-01", "ip": "10.0.0.1", "username": "root", "password": "pw", "vms": [{"name": "app", "ip": "10.0.0.10", "username": "u", "password": "p", "depends_on": ["db"]}, {"name": "db", "ip": "10.0.0.11", "username": "u", "password": "p"}, {"name": "monitoring", "ip": "10.0.0.12", "username": "u", "password": "p", "priority": 10}]}]}')
+    def test_load_config_with_dependencies(self, mock_file):
+        config_manager = ConfigManager('conf/conf.json')
+        config_manager.load_config()
+        self.assertEqual(config_manager.esxi_servers[0].vms[0].depends_on, ["db"])
+        graph = config_manager.build_shutdown_graph()
+        self.assertEqual(graph[("esxi-01", "app")], set())
+        self.assertEqual(graph[("esxi-01", "db")], {("esxi-01", "app")})
+        self.assertEqual(graph[("esxi-01", "monitoring")],
+                         {("esxi-01", "app"), ("esxi-01", "db")})
+        self.assertEqual(graph[("esxi-01", None)], {
+            ("esxi-01", "app"), ("esxi-01", "db"), ("esxi-01", "monitoring")})
+        startup = config_manager.build_startup_graph()
+        self.assertEqual(startup[("esxi-01", None)], set())
+        self.assertEqual(startup[("esxi-01", "db")],
+                         {("esxi-01", None), ("esxi-01", "monitoring")})
+        self.assertEqual(startup[("esxi-01", "app")], {
+            ("esxi-01", None), ("esxi-01", "db"), ("esxi-01", "monitoring")})
+
+    @patch('builtins.open', new_callable=mock_open, read_data='{"esxi_servers": [{"name": "esxi-01", "ip": "10.0.0.1", "username": "root", "password": "pw", "vms": [{"name": "app", "ip": "10.0.0.10", "username": "u", "password": "p", "depends_on": ["db"]}, {"name": "db", "ip": "10.0.0.11", "username": "u", "password": "p", "depends_on": ["app"]}]}]}')
+    def test_load_config_with_circular_dependencies(self, mock_file):
+        config_manager = ConfigManager('conf/conf.json')
+        with self.assertRaisesRegex(ValueError, "Circular"):
+            config_manager.load_config()
+
+    @patch('builtins.open', new_callable=mock_open, read_data='{"esxi_servers": [{"name": "esxi-01", "ip": "10.0.0.1", "username": "root", "password": "pw", "vms": [{"name": "app", "ip": "10.0.0.10", "username": "u", "password": "p", "depends_on": ["nas"]}]}]}')
+    def test_load_config_with_unknown_dependency(self, mock_file):
+        config_manager = ConfigManager('conf/conf.json')
+        with self.assertRaisesRegex(ValueError, "Unknown dependency"):
+            config_manager.load_config()
+
+    @patch('builtins.open', new_callable=mock_open, read_data='{"esxi_servers": [{"name": "esxi-01", "ip": "10.0.0.1", "username": "root", "password": "pw", "vms": [{"name": "app", "ip": "10.0.0.10", "username": "u", "password": "p"}]}]}')
+    def test_lookup_indexes(self, mock_file):
+        config_manager = ConfigManager('conf/conf.json')
+        config_manager.load_config()
+        server = config_manager.esxi_servers[0]
+        self.assertIs(config_manager.get_server_by_name("esxi-01"), server)
+        self.assertIs(config_manager.get_vm_by_name("esxi-01", "app"), server.vms[0])
+        self.assertIsNone(config_manager.get_vm_by_name("esxi-02", "app"))
+        self.assertIs(config_manager.get_host_of_vm("app"), server)
+        self.assertIs(config_manager.get_device_by_ip("10.0.0.10"), server.vms[0])
+        self.assertIs(config_manager.get_device_by_ip("10.0.0.1"), server)
+        self.assertFalse(hasattr(server.vms[0], '__dict__'))
+        self.assertEqual((server.port, server.vms[0].port), (22, 22))
+
+    @patch('builtins.open', new_callable=mock_open, read_data='{"startup": {"host_timeout": 600, "poll_interval": 2}, "report": {"startup_json_file": null}, "esxi_servers": []}')
+    def test_load_config_with_startup_settings(self, mock_file):
+        config_manager = ConfigManager('conf/conf.json')
+        config_manager.load_config()
+        self.assertEqual(config_manager.startup.host_timeout, 600)
+        self.assertEqual(config_manager.startup.ready_timeout, 300)
+        self.assertEqual(config_manager.startup.poll_interval, 2)
+        self.assertIsNone(config_manager.report.startup_json_file)
+        self.assertEqual(config_manager.report.startup_prometheus_file,
+                         'run/startup_report.prom')
+
+    @patch('builtins.open', new_callable=mock_open, read_data='{"discovery": {"enabled": true, "cache_file": "/var/lib/esxi/inventory.json", "ttl": 600}, "esxi_servers": []}')
+    def test_load_config_with_discovery_settings(self, mock_file):
+        config_manager = ConfigManager('conf/conf.json')
+        config_manager.load_config()
+        self.assertTrue(config_manager.discovery.enabled)
+        self.assertEqual(config_manager.discovery.cache_file, '/var/lib/esxi/inventory.json')
+        self.assertEqual(config_manager.discovery.ttl, 600)
+        self.assertEqual(config_manager.discovery.refresh_interval, 300)
+
+    @patch('builtins.open', new_callable=mock_open, read_data='{"distributed": {"host": "0.0.0.0", "agents": 3, "agent_timeout": 5}, "esxi_servers": []}')
+    def test_load_config_with_distributed_settings(self, mock_file):
+        config_manager = ConfigManager('conf/conf.json')
+        config_manager.load_config()
+        self.assertEqual(config_manager.distributed.host, '0.0.0.0')
+        self.assertEqual(config_manager.distributed.port, 7420)
+        self.assertEqual(config_manager.distributed.agents, 3)
+        self.assertEqual(config_manager.distributed.agent_timeout, 5)
+        self.assertIsNone(config_manager.distributed.secret)
+
+    @patch('builtins.open', new_callable=mock_open, read_data='{"distributed": {"secret": ""}, "esxi_servers": []}')
+    def test_load_config_with_empty_distributed_secret(self, mock_file):
+        config_manager = ConfigManager('conf/conf.json')
+        with self.assertRaises(ValueError):
+            config_manager.load_config()
+
+    @patch('builtins.open', new_callable=mock_open, read_data='{"distributed": {"heartbeat_interval": 10, "agent_timeout": 5}, "esxi_servers": []}')
+    def test_load_config_with_heartbeat_longer_than_agent_timeout(self, mock_file):
+        config_manager = ConfigManager('conf/conf.json')
+        with self.assertRaises(ValueError):
+            config_manager.load_config()
+
+    @patch('builtins.open', new_callable=mock_open, read_data='{"esxi_servers": [{"name": "esxi-01", "ip": "10.0.0.1", "username": "root", "password": "pw", "vms": [{"name": "app", "ip": "10.0.0.10", "username": "u", "password": "p"}, {"name": "db", "ip": "10.0.0.11", "username": "u", "password": "p", "depends_on": ["app"]}]}, {"name": "esxi-02", "ip": "10.0.0.2", "username": "root", "password": "pw", "vms": []}]}')
+    def test_merge_inventory(self, mock_file):
+        config_manager = ConfigManager('conf/conf.json')
+        config_manager.load_config()
+        # "db" moved to esxi-02, "new" is missing from the configuration
+        config_manager.merge_inventory({
+            "esxi-01": {"app": "10.0.0.10", "new": "10.0.0.12"},
+            "esxi-02": {"db": "10.0.2.11", "other": None}})
+        first, second = config_manager.esxi_servers
+        self.assertEqual([vm.name for vm in first.vms], ["app", "new"])
+        self.assertEqual([vm.name for vm in second.vms], ["db", "other"])
+        # Configured VMs keep their settings, discovered ones have no credentials
+        self.assertEqual((second.vms[0].ip, second.vms[0].username), ("10.0.0.11", "u"))
+        self.assertIsNone(first.vms[1].username)
+        self.assertIs(config_manager.get_host_of_vm("db"), second)
+        self.assertIn(("esxi-02", "db"),
+                      config_manager.build_shutdown_graph()[("esxi-01", "app")])
+
+        # A later merge starts over from the configuration file
+        config_manager.merge_inventory({"esxi-01": {"app": None, "db": None}})
+        self.assertEqual([[vm.name for vm in server.vms]
+                          for server in config_manager.esxi_servers],
+                         [["app", "db"], []])
+
+    @patch('builtins.open', new_callable=mock_open, read_data='{"esxi_servers": [{"name": "esxi-01", "ip": "10.0.0.1", "username": "root", "password": "pw", "vms": [{"name": "app", "ip": "10.0.0.10", "username": "u", "password": "p", "depends_on": ["esxi-02"]}]}, {"name": "esxi-02", "ip": "10.0.0.2", "username": "root", "password": "pw", "vms": []}]}')
+    def test_merge_inventory_keeps_inventory_on_invalid_graph(self, mock_file):
+        config_manager = ConfigManager('conf/conf.json')
+        config_manager.load_config()
+        servers = config_manager.esxi_servers
+        # A discovered VM named like a server makes a dependency ambiguous
+        with self.assertRaises(ValueError):
+            config_manager.merge_inventory({"esxi-01": {"app": None, "esxi-02": None}})
+        self.assertIs(config_manager.esxi_servers, servers)
+
+
+class TestConfigCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.config_path = os.path.join(self.tmp_dir.name, 'conf.json')
+        self.cache_path = os.path.join(self.tmp_dir.name, 'run', 'conf.cache')
+        self.write_config("app")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write_config(self, vm_name):
+        with open(self.config_path, 'w') as f:
+            json.dump({"esxi_servers": [{
+                "name": "esxi-01", "ip": "10.0.0.1", "username": "root",
+                "password": "pw", "vms": [{"name": vm_name, "ip": "10.0.0.10",
+                                           "username": "u", "password": "p"}]}]}, f)
+
+    def load(self):
+        config_manager = ConfigManager(self.config_path, cache_path=self.cache_path)
+        config_manager.load_config()
+        return config_manager
+
+    def test_unchanged_config_is_not_parsed_again(self):
+        self.load()
+        self.assertEqual(os.stat(self.cache_path).st_mode & 0o777, 0o600)
+        with patch('src.config_manager.config_manager.json.loads') as loads:
+            config_manager = self.load()
+        loads.assert_not_called()
+        self.assertEqual(config_manager.esxi_servers[0].vms[0].name, "app")
+        self.assertIn(("esxi-01", None), config_manager.build_shutdown_graph())
+
+    def test_cache_writable_by_others_is_ignored(self):
+        self.load()
+        for path, mode in ((self.cache_path, 0o666),
+                           (os.path.dirname(self.cache_path), 0o777)):
+            os.chmod(path, mode)
+            with patch('src.config_manager.config_manager.pickle.load') as load, \
+                    self.assertLogs(level='WARNING'):
+                self.assertEqual(self.load().esxi_servers[0].vms[0].name, "app")
+            load.assert_not_called()
+            os.chmod(path, 0o700)
+
+    def test_cache_of_another_user_is_ignored(self):
+        self.load()
+        with patch('src.config_manager.config_manager.os.geteuid',
+                   return_value=os.geteuid() + 1), \
+                patch('src.config_manager.config_manager.pickle.load') as load, \
+                self.assertLogs(level='WARNING'):
+            self.load()
+        load.assert_not_called()
+
+    def test_touched_config_is_matched_by_hash(self):
+        self.load()
+        os.utime(self.config_path, ns=(0, 0))
+        with patch('src.config_manager.config_manager.json.loads') as loads:
+            self.load()
+        loads.assert_not_called()
+
+    def test_changed_config_is_parsed_again(self):
+        self.load()
+        self.write_config("db")
+        os.utime(self.config_path, ns=(0, 0))
+        self.assertEqual(self.load().esxi_servers[0].vms[0].name, "db")
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,119 @@
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock
+from src.remote_manager.connection_pool import SSHConnectionPool
+
+
+def make_client(alive=True):
+    client = MagicMock()
+    client.get_transport.return_value.is_active.return_value = alive
+    return client
+
+
+class TestSSHConnectionPool(unittest.TestCase):
+    def test_acquire_reuses_live_connection(self):
+        connect = MagicMock(side_effect=lambda *_: make_client())
+        pool = SSHConnectionPool(connect)
+
+        first = pool.acquire('10.0.0.1', 'root', 'pw')
+        second = pool.acquire('10.0.0.1', 'root', 'pw')
+
+        self.assertIs(first, second)
+        connect.assert_called_once_with('10.0.0.1', 'root', 'pw', 22)
+
+    def test_acquire_keys_by_host_port_and_user(self):
+        connect = MagicMock(side_effect=lambda *_: make_client())
+        pool = SSHConnectionPool(connect)
+
+        pool.acquire('10.0.0.1', 'root', 'pw')
+        pool.acquire('10.0.0.1', 'admin', 'pw')
+        pool.acquire('10.0.0.1', 'root', 'pw', port=2222)
+
+        self.assertEqual(connect.call_count, 3)
+        self.assertEqual(len(pool), 3)
+
+    def test_acquire_replaces_dead_connection(self):
+        dead = make_client(alive=False)
+        fresh = make_client()
+        connect = MagicMock(side_effect=[dead, fresh])
+        pool = SSHConnectionPool(connect)
+
+        pool.acquire('10.0.0.1', 'root', 'pw')
+        self.assertIs(pool.acquire('10.0.0.1', 'root', 'pw'), fresh)
+        dead.close.assert_called_once()
+
+    def test_acquire_failure_is_not_pooled(self):
+        connect = MagicMock(return_value=False)
+        pool = SSHConnectionPool(connect)
+
+        self.assertFalse(pool.acquire('10.0.0.1', 'root', 'pw'))
+        self.assertEqual(len(pool), 0)
+
+    def test_concurrent_acquire_handshakes_once(self):
+        def slow_connect(*_):
+            time.sleep(0.05)
+            return make_client()
+
+        connect = MagicMock(side_effect=slow_connect)
+        pool = SSHConnectionPool(connect)
+        threads = [threading.Thread(target=pool.acquire,
+                                    args=('10.0.0.1', 'root', 'pw'))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        connect.assert_called_once()
+
+    def test_close_idle(self):
+        client = make_client()
+        pool = SSHConnectionPool(MagicMock(return_value=client),
+                                 idle_timeout=0.01)
+        pool.acquire('10.0.0.1', 'root', 'pw')
+        time.sleep(0.02)
+
+        pool.close_idle()
+        self.assertEqual(len(pool), 0)
+        client.close.assert_called_once()
+
+    def test_close_idle_keeps_leased_connection(self):
+        client = make_client()
+        pool = SSHConnectionPool(MagicMock(return_value=client),
+                                 idle_timeout=0.01)
+        with pool.lease('10.0.0.1', 'root', 'pw') as leased:
+            self.assertIs(leased, client)
+            time.sleep(0.02)
+            pool.close_idle()
+            self.assertEqual(len(pool), 1)
+
+        # The idle time counts from the release, not from the acquisition
+        pool.close_idle()
+        self.assertEqual(len(pool), 1)
+        time.sleep(0.02)
+        pool.close_idle()
+        self.assertEqual(len(pool), 0)
+        client.close.assert_called_once()
+
+    def test_lease_failure_yields_false(self):
+        pool = SSHConnectionPool(MagicMock(return_value=False))
+        with pool.lease('10.0.0.1', 'root', 'pw') as leased:
+            self.assertFalse(leased)
+        self.assertEqual(len(pool), 0)
+
+    def test_discard_and_close_all(self):
+        clients = [make_client(), make_client()]
+        pool = SSHConnectionPool(MagicMock(side_effect=clients))
+        pool.acquire('10.0.0.1', 'root', 'pw')
+        pool.acquire('10.0.0.2', 'root', 'pw')
+
+        pool.discard('10.0.0.1', 'root')
+        clients[0].close.assert_called_once()
+        pool.close_all()
+        clients[1].close.assert_called_once()
+        self.assertEqual(len(pool), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock
+from src.config_manager.config_manager import ConfigManager, VMConfig, ESXiConfig, ShutdownConfig, ReportConfig, JournalConfig
+from src.infrastructure_manager.daemon import ShutdownDaemon, send_daemon_command
+from src.remote_manager.remote_manager import ReachabilityResult
+
+
+def build_config():
+    config = ConfigManager('conf/conf.json')
+    config.shutdown = ShutdownConfig(poll_interval=0.01, vm_poweroff_timeout=1)
+    config.esxi_servers = [
+        ESXiConfig(name="esxi-0", ip="10.0.0.1", username="root", password="pw",
+                   vms=[VMConfig(name="vm-0", ip="10.0.0.10",
+                                 username="user", password="pw")])
+    ]
+    return config
+
+
+def build_remote():
+    remote = MagicMock()
+    remote.check_reachability.side_effect = lambda hosts, **_: {
+        host: ReachabilityResult(False, None) for host in hosts}
+    remote.poweroff_ubuntu_vm.return_value = True
+    remote.poweroff_esxi_server.return_value = True
+    return remote
+
+
+class TestShutdownDaemon(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.socket_path = os.path.join(self.tmp_dir.name, 'run', 'daemon.sock')
+        self.remote = build_remote()
+        config = build_config()
+        config.report = ReportConfig(
+            json_file=os.path.join(self.tmp_dir.name, 'run', 'report.json'),
+            prometheus_file=os.path.join(self.tmp_dir.name, 'metrics', 'report.prom'),
+            history_file=os.path.join(self.tmp_dir.name, 'run', 'history.json'))
+        config.journal = JournalConfig(
+            file=os.path.join(self.tmp_dir.name, 'run', 'journal.jsonl'),
+            lock_file=os.path.join(self.tmp_dir.name, 'run', 'shutdown.lock'))
+        self.daemon = ShutdownDaemon(config, self.remote, self.socket_path)
+        self.thread = threading.Thread(target=self.daemon.serve_forever)
+        self.thread.start()
+        for _ in range(100):
+            if os.path.exists(self.socket_path):
+                break
+            time.sleep(0.01)
+
+    def tearDown(self):
+        self.daemon.stop()
+        self.thread.join(timeout=5)
+        self.tmp_dir.cleanup()
+
+    def test_warm_up_opens_session_to_every_device(self):
+        self.assertEqual(send_daemon_command(self.socket_path, 'PING'), 'PONG')
+        for _ in range(100):
+            if self.remote.get_connection.call_count >= 2:
+                break
+            time.sleep(0.01)
+        hosts = {call.args[0] for call in self.remote.get_connection.call_args_list}
+        self.assertEqual(hosts, {"10.0.0.1", "10.0.0.10"})
+        self.remote.get_connection.return_value.get_transport.return_value \
+            .set_keepalive.assert_called_with(30)
+
+    def test_shutdown_trigger(self):
+        self.assertEqual(send_daemon_command(self.socket_path, 'SHUTDOWN'), 'OK')
+        self.remote.poweroff_ubuntu_vm.assert_called_once()
+        self.remote.poweroff_esxi_server.assert_called_once()
+        # The daemon stops once the infrastructure has been shut down
+        self.thread.join(timeout=5)
+        self.assertFalse(self.thread.is_alive())
+        self.assertFalse(os.path.exists(self.socket_path))
+        with open(os.path.join(self.tmp_dir.name, 'run', 'report.json')) as f:
+            self.assertTrue(json.load(f)['success'])
+        self.assertTrue(os.path.exists(
+            os.path.join(self.tmp_dir.name, 'metrics', 'report.prom')))
+
+    def test_repeated_trigger_returns_the_finished_result(self):
+        self.assertEqual(send_daemon_command(self.socket_path, 'SHUTDOWN'), 'OK')
+        self.thread.join(timeout=5)
+
+        # A duplicate UPS trigger reaching a restarted daemon
+        repeat = build_remote()
+        daemon = ShutdownDaemon(self.daemon.config, repeat,
+                                os.path.join(self.tmp_dir.name, 'other.sock'))
+        self.assertTrue(daemon.trigger_shutdown())
+        repeat.poweroff_ubuntu_vm.assert_not_called()
+        repeat.poweroff_esxi_server.assert_not_called()
+
+    def test_shutdown_trigger_with_deadline(self):
+        self.daemon.trigger_shutdown = MagicMock(return_value=True)
+        self.assertEqual(send_daemon_command(self.socket_path, 'SHUTDOWN 90'), 'OK')
+        self.daemon.trigger_shutdown.assert_called_once_with(90.0)
+
+    def test_unknown_command(self):
+        self.assertEqual(send_daemon_command(self.socket_path, 'REBOOT'), 'ERROR')
+        self.assertEqual(send_daemon_command(self.socket_path, 'SHUTDOWN soon'), 'ERROR')
+
+    def test_no_daemon_listening(self):
+        missing = os.path.join(self.tmp_dir.name, 'missing.sock')
+        self.assertIsNone(send_daemon_command(missing, 'PING'))
+
+    def test_daemon_that_never_answers(self):
+        hung = os.path.join(self.tmp_dir.name, 'hung.sock')
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as listener:
+            listener.bind(hung)
+            listener.listen(1)
+            # Connected from the backlog, then never read nor answered
+            started = time.monotonic()
+            with self.assertLogs(level='ERROR'):
+                self.assertIsNone(send_daemon_command(hung, 'SHUTDOWN 30',
+                                                      timeout=0.2))
+            self.assertLess(time.monotonic() - started, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
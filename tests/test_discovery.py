@@ -0,0 +1,121 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+from src.config_manager.config_manager import DiscoveryConfig
+from src.infrastructure_manager.daemon import ShutdownDaemon
+from src.infrastructure_manager.discovery import InventoryCache, apply_inventory
+from src.infrastructure_manager.infrastructure_manager import InfrastructureManager
+from src.remote_manager.remote_manager import DiscoveredVM
+from tests.test_infrastructure_manager import build_config, build_remote
+
+
+class TestInventoryCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'run', 'inventory.json')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_refresh_keeps_servers_that_failed(self):
+        config = build_config()
+        remote = build_remote()
+        remote.discover_esxi_vms.side_effect = lambda ip, *_, **__: {
+            'vm-0-0': DiscoveredVM('vm-0-0', 'Powered on', '10.0.0.10'),
+            'new': DiscoveredVM('new', 'Powered off')}
+        cache = InventoryCache(self.path)
+        self.assertEqual(set(cache.refresh(config, remote)), {'esxi-0', 'esxi-1'})
+
+        remote.discover_esxi_vms.side_effect = lambda ip, *_, **__: (
+            None if ip == '10.0.1.1' else {})
+        self.assertEqual(set(cache.refresh(config, remote)), {'esxi-0'})
+        self.assertEqual(cache.load(), {
+            'esxi-0': {},
+            'esxi-1': {'vm-0-0': '10.0.0.10', 'new': None}})
+        self.assertEqual(
+            cache.read()['esxi-1']['vms']['vm-0-0']['power_state'], 'Powered on')
+
+    def test_failed_write_leaves_no_temporary_file(self):
+        remote = build_remote()
+        remote.discover_esxi_vms.return_value = {}
+        with patch('src.infrastructure_manager.atomic_file.os.replace',
+                   side_effect=OSError("disk full")):
+            with self.assertLogs(level='ERROR'):
+                InventoryCache(self.path).refresh(build_config(), remote)
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), [])
+
+    def test_stale_servers_are_not_loaded(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as f:
+            json.dump({'servers': {
+                'esxi-0': {'discovered_at': 0, 'vms': {'old': {'ip': None}}},
+                'esxi-1': {'discovered_at': 1e12, 'vms': {}}}}, f)
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(InventoryCache(self.path, ttl=60).load(),
+                             {'esxi-1': {}})
+
+    def test_unreadable_snapshot_is_empty(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as f:
+            f.write('{"servers": ')
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(InventoryCache(self.path).load(), {})
+
+
+class TestDiscoveredShutdown(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'inventory.json')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_discovered_vms_are_shut_down_from_their_server(self):
+        config = build_config(servers=1)
+        config.discovery = DiscoveryConfig(enabled=True, cache_file=self.path)
+        remote = build_remote()
+        remote.discover_esxi_vms.return_value = {
+            name: DiscoveredVM(name, 'Powered on')
+            for name in ('vm-0-0', 'vm-0-1', 'new')}
+        InventoryCache(self.path).refresh(config, remote)
+        self.assertTrue(apply_inventory(config))
+
+        remote.shutdown_esxi_vms.return_value = {'new': 'shutdown'}
+        remote.get_esxi_vm_power_states.return_value = {'new': 'Powered off'}
+        manager = InfrastructureManager(config, remote)
+        self.assertTrue(manager.shutdown())
+        # Configured VMs still go through their guest, only the discovered
+        # one is shut down from the server, and without an IP it is not probed
+        self.assertEqual(remote.poweroff_ubuntu_vm.call_count, 2)
+        self.assertEqual(remote.shutdown_esxi_vms.call_args.kwargs['vm_names'],
+                         ['new'])
+        self.assertNotIn(None, remote.check_reachability.call_args_list[0].args[0])
+        self.assertIn(("VM new", True), manager.shutdown_results)
+
+    def test_daemon_merges_its_discoveries(self):
+        config = build_config(servers=1)
+        config.discovery = DiscoveryConfig(enabled=True, cache_file=self.path)
+        remote = build_remote()
+        remote.discover_esxi_vms.return_value = {
+            'new': DiscoveredVM('new', 'Powered on', '10.0.0.99')}
+        daemon = ShutdownDaemon(config, remote,
+                                os.path.join(self.tmp_dir.name, 'daemon.sock'))
+        daemon.discover()
+        self.assertEqual([vm.name for vm in config.esxi_servers[0].vms],
+                         ['vm-0-0', 'vm-0-1', 'new'])
+
+        # No session is kept to a VM without guest credentials
+        daemon.warm_up()
+        self.assertNotIn('10.0.0.99', [call.args[0] for call in
+                                       remote.get_connection.call_args_list])
+
+    def test_disabled_discovery_is_not_applied(self):
+        config = build_config(servers=1)
+        config.discovery = DiscoveryConfig(cache_file=self.path)
+        self.assertFalse(apply_inventory(config))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,196 @@
+import json
+import socket
+import threading
+import time
+import unittest
+from src.config_manager.config_manager import DistributedConfig
+from src.infrastructure_manager.distributed import (
+    DistributedCoordinator, HashRing, ShutdownAgent, _Connection)
+from tests.test_infrastructure_manager import build_config, build_remote
+
+
+def build_settings(**settings):
+    settings.setdefault('port', 0)
+    settings.setdefault('agents', 2)
+    settings.setdefault('join_timeout', 5)
+    settings.setdefault('heartbeat_interval', 0.05)
+    settings.setdefault('agent_timeout', 0.5)
+    settings.setdefault('secret', 'test-secret')
+    return DistributedConfig(**settings)
+
+
+class TestHashRing(unittest.TestCase):
+    def test_removing_a_node_only_moves_its_keys(self):
+        ring = HashRing(['a', 'b', 'c'])
+        keys = [f"esxi-{index}" for index in range(200)]
+        before = {key: ring.node_for(key) for key in keys}
+        self.assertEqual(set(before.values()), {'a', 'b', 'c'})
+
+        ring.remove('b')
+        after = {key: ring.node_for(key) for key in keys}
+        self.assertEqual(
+            {key for key in keys if before[key] != after[key]},
+            {key for key in keys if before[key] == 'b'})
+        self.assertIsNone(HashRing().node_for('esxi-0'))
+
+
+class TestDistributedShutdown(unittest.TestCase):
+    def setUp(self):
+        self.threads = []
+
+    def tearDown(self):
+        for thread in self.threads:
+            thread.join(timeout=5)
+
+    def start_agent(self, agent):
+        thread = threading.Thread(target=agent.serve, kwargs={'timeout': 5})
+        thread.start()
+        self.threads.append(thread)
+
+    def test_agents_split_the_servers_and_relay_dependencies(self):
+        config = build_config(servers=4)
+        # vm-1-0 needs vm-0-0 running, wherever each of them is shut down
+        config.esxi_servers[1].vms[0].depends_on = ['vm-0-0']
+        coordinator = DistributedCoordinator(config, settings=build_settings())
+        coordinator.listen()
+        settings = build_settings(port=coordinator.address[1])
+        events = []
+        remotes = {}
+        for name in ('site-a', 'site-b'):
+            remote = build_remote()
+            remote.poweroff_ubuntu_vm.side_effect = (
+                lambda ip, *_, name=name, **__: events.append((name, ip))
+                or True)
+            remotes[name] = remote
+            self.start_agent(ShutdownAgent(config, remote, name,
+                                           settings=settings))
+
+        self.assertTrue(coordinator.shutdown())
+        self.assertEqual(len(coordinator.shutdown_results), 12)
+        self.assertTrue(all(success for _, success
+                            in coordinator.shutdown_results))
+        hosts = [ip for _, ip in events]
+        self.assertEqual(sorted(hosts), sorted(
+            vm.ip for server in config.esxi_servers for vm in server.vms))
+        self.assertLess(hosts.index('10.0.1.10'), hosts.index('10.0.0.10'))
+        # Each agent shut down the servers the hash ring gave it
+        ring = HashRing(['site-a', 'site-b'])
+        for name, remote in remotes.items():
+            self.assertEqual(
+                {call.args[0] for call
+                 in remote.poweroff_esxi_server.call_args_list},
+                {server.ip for server in config.esxi_servers
+                 if ring.node_for(server.name) == name})
+        self.assertEqual(len(coordinator.report.devices), 12)
+
+    def test_servers_of_a_quiet_agent_are_reassigned(self):
+        config = build_config(servers=4)
+        coordinator = DistributedCoordinator(config, settings=build_settings())
+        coordinator.listen()
+        settings = build_settings(port=coordinator.address[1])
+        remote = build_remote()
+        self.start_agent(ShutdownAgent(config, remote, 'site-a',
+                                       settings=settings))
+        # An agent that joins, then never says anything again
+        quiet = socket.create_connection(coordinator.address)
+        _Connection(quiet, 'test-secret').send({'type': 'hello',
+                                                'agent': 'site-b'})
+        lost = [server.name for server in config.esxi_servers
+                if HashRing(['site-a', 'site-b']).node_for(server.name)
+                == 'site-b']
+        self.assertTrue(lost)
+
+        started = time.monotonic()
+        try:
+            self.assertTrue(coordinator.shutdown())
+        finally:
+            quiet.close()
+        self.assertGreater(time.monotonic() - started, 0.5)
+        self.assertEqual(coordinator.reassigned, lost)
+        self.assertEqual(remote.poweroff_esxi_server.call_count, 4)
+        self.assertEqual(remote.poweroff_ubuntu_vm.call_count, 8)
+
+    def test_devices_fail_when_no_agent_joins(self):
+        config = build_config(servers=1)
+        coordinator = DistributedCoordinator(
+            config, settings=build_settings(join_timeout=0.1))
+
+        self.assertEqual(coordinator.wait_for_agents(), 0)
+        self.assertFalse(coordinator.shutdown())
+        self.assertFalse(any(success for _, success
+                             in coordinator.shutdown_results))
+
+    def test_agent_finishes_its_servers_without_the_coordinator(self):
+        config = build_config(servers=2)
+        # vm-0-0 needs vm-1-0 running, so vm-1-0 waits for it to be down
+        config.esxi_servers[0].vms[0].depends_on = ['vm-1-0']
+        listener = socket.create_server(('127.0.0.1', 0))
+        settings = build_settings(port=listener.getsockname()[1])
+        remote = build_remote()
+        agent = ShutdownAgent(config, remote, 'site-a', settings=settings)
+        self.start_agent(agent)
+
+        connection, _ = listener.accept()
+        connection.recv(1024)
+        # Assigned esxi-1 only, whose vm-1-0 waits for a device of esxi-0
+        _Connection(connection, 'test-secret').send({
+            'type': 'assign', 'servers': ['esxi-1'], 'off': [],
+            'deadline': None})
+        time.sleep(0.2)
+        self.assertEqual(remote.poweroff_ubuntu_vm.call_count, 1)
+        connection.close()
+        listener.close()
+
+        self.threads[0].join(timeout=5)
+        self.assertEqual(remote.poweroff_ubuntu_vm.call_count, 2)
+        self.assertEqual(agent.results, [True])
+
+    def test_agents_without_the_secret_are_rejected(self):
+        coordinator = DistributedCoordinator(
+            build_config(servers=1),
+            settings=build_settings(agents=1, join_timeout=0.5))
+        coordinator.listen()
+        unsigned = socket.create_connection(coordinator.address)
+        forged = socket.create_connection(coordinator.address)
+        try:
+            with self.assertLogs(level='WARNING'):
+                unsigned.sendall(json.dumps({'type': 'hello',
+                                             'agent': 'site-a'})
+                                 .encode() + b'\n')
+                _Connection(forged, 'wrong-secret').send({'type': 'hello',
+                                                          'agent': 'site-b'})
+                self.assertEqual(coordinator.wait_for_agents(), 0)
+            # The coordinator hung up on both
+            self.assertEqual(unsigned.recv(1024), b'')
+            self.assertEqual(forged.recv(1024), b'')
+        finally:
+            unsigned.close()
+            forged.close()
+            coordinator.close()
+
+    def test_agent_ignores_an_unsigned_assignment(self):
+        listener = socket.create_server(('127.0.0.1', 0))
+        settings = build_settings(port=listener.getsockname()[1])
+        remote = build_remote()
+        agent = ShutdownAgent(build_config(servers=1), remote, 'site-a',
+                              settings=settings)
+        self.start_agent(agent)
+
+        connection, _ = listener.accept()
+        hello = _Connection(connection, 'test-secret').receive()
+        self.assertEqual(hello, {'type': 'hello', 'agent': 'site-a'})
+        with self.assertLogs(level='WARNING'):
+            connection.sendall(json.dumps({
+                'type': 'assign', 'servers': ['esxi-0'], 'off': [],
+                'deadline': None}).encode() + b'\n')
+            self.threads[0].join(timeout=5)
+        connection.close()
+        listener.close()
+        self.assertFalse(self.threads[0].is_alive())
+        remote.poweroff_ubuntu_vm.assert_not_called()
+        remote.poweroff_esxi_server.assert_not_called()
+        self.assertEqual(agent.results, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
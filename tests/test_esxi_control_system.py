@@ -0,0 +1,70 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+
+LOGGING_SCRIPT = '''
+import logging, sys, threading
+sys.path.insert(0, {src_dir!r})
+import esxi_control_system
+from config_manager.config_manager import LoggingConfig
+
+esxi_control_system.configure_logging()
+esxi_control_system.apply_logging_settings(
+    LoggingConfig(format="json", max_bytes=2000, backup_count=2))
+logging.getLogger("paramiko.transport").debug("kex details")
+logging.getLogger("paramiko.transport").warning("connection dropped")
+threads = [threading.Thread(target=logging.info, args=("worker %s", n))
+           for n in range(40)]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+'''
+
+
+class TestStartup(unittest.TestCase):
+    def test_import_does_not_load_heavy_modules(self):
+        heavy = ['paramiko', 'cryptography', 'tabulate',
+                 'config_manager.config_manager', 'remote_manager.remote_manager',
+                 'infrastructure_manager.infrastructure_manager']
+        result = subprocess.run(
+            [sys.executable, '-c',
+             'import sys, esxi_control_system; '
+             f'print([name for name in {heavy!r} if name in sys.modules])'],
+            cwd=SRC_DIR, capture_output=True, text=True, check=True)
+        self.assertEqual(result.stdout.strip(), '[]')
+
+
+class TestLogging(unittest.TestCase):
+    def test_queued_json_logging_with_rotation(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.makedirs(os.path.join(tmp_dir, 'logs'))
+            subprocess.run(
+                [sys.executable, '-c', LOGGING_SCRIPT.format(src_dir=SRC_DIR)],
+                cwd=tmp_dir, capture_output=True, text=True, check=True)
+
+            log_files = sorted(os.listdir(os.path.join(tmp_dir, 'logs')))
+            entries = []
+            for name in log_files:
+                with open(os.path.join(tmp_dir, 'logs', name)) as f:
+                    entries += [json.loads(line) for line in f]
+
+        self.assertEqual(log_files, ['esxi_control_system.logs',
+                                     'esxi_control_system.logs.1',
+                                     'esxi_control_system.logs.2'])
+        messages = [entry['message'] for entry in entries]
+        # paramiko is quiet below WARNING by default
+        self.assertNotIn('kex details', messages)
+        self.assertIn('worker 39', messages)
+        self.assertEqual(entries[-1]['logger'], 'root')
+        self.assertEqual(entries[-1]['level'], 'INFO')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,330 @@
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+from src.config_manager.config_manager import ConfigManager, VMConfig, ESXiConfig, ShutdownConfig
+from src.infrastructure_manager import infrastructure_manager
+from src.infrastructure_manager.infrastructure_manager import InfrastructureManager
+from src.remote_manager.remote_manager import ReachabilityResult
+from src.remote_manager.timing import Span
+
+
+def build_config(vms_per_server=2, servers=2, strategy='guest', **shutdown):
+    shutdown.setdefault('poll_interval', 0.01)
+    shutdown.setdefault('vm_poweroff_timeout', 1)
+    shutdown.setdefault('retry_base_delay', 0.01)
+    config = ConfigManager('conf/conf.json')
+    config.shutdown = ShutdownConfig(**shutdown)
+    config.esxi_servers = [
+        ESXiConfig(
+            name=f"esxi-{s}", ip=f"10.0.{s}.1", username="root", password="pw",
+            vms=[VMConfig(name=f"vm-{s}-{v}", ip=f"10.0.{s}.{v + 10}",
+                          username="user", password="pw")
+                 for v in range(vms_per_server)],
+            vm_shutdown_strategy=strategy
+        )
+        for s in range(servers)
+    ]
+    return config
+
+
+def build_remote(is_online=lambda ip: False):
+    remote = MagicMock()
+    remote.check_reachability.side_effect = lambda hosts, **_: {
+        host: ReachabilityResult(is_online(host), 0.001) for host in hosts}
+    remote.poweroff_ubuntu_vm.return_value = True
+    remote.poweroff_esxi_server.return_value = True
+    return remote
+
+
+class TestInfrastructureManager(unittest.TestCase):
+    def test_shutdown_success(self):
+        remote = build_remote()
+        manager = InfrastructureManager(build_config(), remote)
+
+        self.assertTrue(manager.shutdown())
+        self.assertEqual(remote.poweroff_ubuntu_vm.call_count, 4)
+        self.assertEqual(remote.poweroff_esxi_server.call_count, 2)
+        self.assertEqual(
+            [device for device, _ in manager.shutdown_results],
+            ["VM vm-0-0", "VM vm-0-1", "VM vm-1-0", "VM vm-1-1",
+             "ESXi esxi-0", "ESXi esxi-1"])
+
+    def test_shutdown_vm_failure_is_not_critical(self):
+        remote = build_remote()
+        remote.poweroff_ubuntu_vm.side_effect = lambda ip, *_: ip != "10.0.0.10"
+        remote.poweroff_esxi_server.return_value = True
+        manager = InfrastructureManager(build_config(), remote)
+
+        self.assertTrue(manager.shutdown())
+        self.assertIn(("VM vm-0-0", False), manager.shutdown_results)
+
+    def test_shutdown_esxi_failure_is_critical(self):
+        remote = build_remote()
+        remote.poweroff_ubuntu_vm.return_value = True
+        remote.poweroff_esxi_server.return_value = False
+        manager = InfrastructureManager(build_config(), remote)
+
+        self.assertFalse(manager.shutdown())
+
+    def test_shutdown_respects_concurrency_limits(self):
+        lock = threading.Lock()
+        active = {"total": 0, "peak": 0, "per_host": {}, "host_peak": 0}
+
+        def poweroff(ip, *_, **__):
+            host = ip.rsplit('.', 1)[0]
+            with lock:
+                active["total"] += 1
+                active["per_host"][host] = active["per_host"].get(host, 0) + 1
+                active["peak"] = max(active["peak"], active["total"])
+                active["host_peak"] = max(active["host_peak"],
+                                          active["per_host"][host])
+            time.sleep(0.02)
+            with lock:
+                active["total"] -= 1
+                active["per_host"][host] -= 1
+            return True
+
+        remote = build_remote()
+        remote.poweroff_ubuntu_vm.side_effect = poweroff
+        remote.poweroff_esxi_server.return_value = True
+        config = build_config(vms_per_server=6, servers=3,
+                              max_workers=4, per_host_workers=2)
+        manager = InfrastructureManager(config, remote)
+
+        self.assertTrue(manager.shutdown())
+        self.assertEqual(remote.poweroff_ubuntu_vm.call_count, 18)
+        self.assertLessEqual(active["peak"], 4)
+        self.assertGreater(active["peak"], 1)
+        self.assertLessEqual(active["host_peak"], 2)
+
+    def test_due_timer_does_not_spin_while_workers_are_busy(self):
+        def poweroff(ip, *_, **__):
+            # vm-0-1 holds the only worker while the poll of vm-0-0 is due
+            if ip == "10.0.0.11":
+                time.sleep(0.3)
+            return True
+
+        remote = build_remote()
+        remote.poweroff_ubuntu_vm.side_effect = poweroff
+        manager = InfrastructureManager(
+            build_config(servers=1, max_workers=1), remote)
+        waits = []
+        original_wait = infrastructure_manager.wait
+
+        def counted_wait(*args, **kwargs):
+            waits.append(kwargs.get('timeout'))
+            return original_wait(*args, **kwargs)
+
+        with patch.object(infrastructure_manager, 'wait', counted_wait):
+            self.assertTrue(manager.shutdown())
+        self.assertLess(len(waits), 50)
+
+    def test_shutdown_pipelines_each_esxi_server(self):
+        events = []
+        lock = threading.Lock()
+
+        def poweroff_vm(ip, *_, **__):
+            if ip.startswith("10.0.1."):
+                time.sleep(0.3)
+            with lock:
+                events.append(("vm", ip))
+            return True
+
+        def poweroff_esxi(ip, *_, **__):
+            with lock:
+                events.append(("esxi", ip))
+            return True
+
+        remote = build_remote()
+        remote.poweroff_ubuntu_vm.side_effect = poweroff_vm
+        remote.poweroff_esxi_server.side_effect = poweroff_esxi
+        manager = InfrastructureManager(build_config(), remote)
+
+        self.assertTrue(manager.shutdown())
+        # The fast server is powered off before the slow server's VMs finish
+        self.assertLess(events.index(("esxi", "10.0.0.1")),
+                        events.index(("vm", "10.0.1.10")))
+        self.assertEqual(events[-1], ("esxi", "10.0.1.1"))
+
+    def test_shutdown_waits_until_vms_are_off(self):
+        probes = {}
+        lock = threading.Lock()
+
+        def is_online(ip):
+            with lock:
+                probes[ip] = probes.get(ip, 0) + 1
+                return probes[ip] <= 3
+
+        probes_at_esxi_poweroff = {}
+
+        def poweroff_esxi(ip, *_, **__):
+            with lock:
+                probes_at_esxi_poweroff[ip] = dict(probes)
+            return True
+
+        remote = build_remote(is_online)
+        remote.poweroff_esxi_server.side_effect = poweroff_esxi
+        manager = InfrastructureManager(build_config(), remote)
+
+        self.assertTrue(manager.shutdown())
+        # One probe from the initial sweep, then polls until the VM is off
+        self.assertEqual(probes_at_esxi_poweroff["10.0.0.1"]["10.0.0.10"], 4)
+        self.assertEqual(probes_at_esxi_poweroff["10.0.1.1"]["10.0.1.11"], 4)
+        self.assertEqual(len(manager.poweroff_durations), 4)
+        for duration in manager.poweroff_durations.values():
+            self.assertGreaterEqual(duration, 0.03)
+
+    def test_shutdown_gives_up_on_vm_at_deadline(self):
+        remote = build_remote(lambda ip: ip == "10.0.0.10")
+        config = build_config(vm_poweroff_timeout=0.1)
+        manager = InfrastructureManager(config, remote)
+
+        started = time.monotonic()
+        self.assertTrue(manager.shutdown())
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertIsNone(manager.poweroff_durations["vm-0-0"])
+        self.assertIsNotNone(manager.poweroff_durations["vm-0-1"])
+        self.assertEqual(remote.poweroff_esxi_server.call_count, 2)
+    def test_deadline_escalates_to_hard_poweroff(self):
+        remote = build_remote(lambda ip: ip == "10.0.0.10")
+        remote.hard_poweroff_esxi_vms.return_value = {"vm-0-0": "off"}
+        config = build_config(vm_poweroff_timeout=60, esxi_reserve=0.2,
+                              hard_off_reserve=0.2)
+        manager = InfrastructureManager(config, remote)
+
+        started = time.monotonic()
+        self.assertTrue(manager.shutdown(deadline=1))
+        self.assertLess(time.monotonic() - started, 1)
+        remote.hard_poweroff_esxi_vms.assert_called_once_with(
+            "10.0.0.1", "root", "pw", ["vm-0-0"], port=22)
+        self.assertEqual(manager.escalated_vms, ["vm-0-0"])
+        self.assertIn(("VM vm-0-0", True), manager.shutdown_results)
+        self.assertEqual(remote.poweroff_esxi_server.call_count, 2)
+
+    def test_deadline_powers_off_esxi_in_time(self):
+        release = threading.Event()
+        remote = build_remote(lambda ip: True)
+        # Neither the guest shutdown nor the hard power-off gets anywhere
+        remote.poweroff_ubuntu_vm.side_effect = lambda *_, **__: release.wait(5)
+        remote.hard_poweroff_esxi_vms.side_effect = lambda *_, **__: release.wait(5)
+        config = build_config(esxi_reserve=0.2, hard_off_reserve=0.2)
+        manager = InfrastructureManager(config, remote)
+
+        started = time.monotonic()
+        try:
+            self.assertTrue(manager.shutdown(deadline=1))
+            self.assertLess(time.monotonic() - started, 1)
+        finally:
+            release.set()
+        self.assertEqual(remote.poweroff_esxi_server.call_count, 2)
+        self.assertIn(("VM vm-0-0", False), manager.shutdown_results)
+
+    def test_shutdown_follows_dependencies(self):
+        events = []
+        lock = threading.Lock()
+
+        def poweroff_vm(ip, *_, **__):
+            time.sleep(0.05 if ip == "10.0.0.10" else 0.01)
+            with lock:
+                events.append(ip)
+            return True
+
+        remote = build_remote()
+        remote.poweroff_ubuntu_vm.side_effect = poweroff_vm
+        config = build_config(vms_per_server=3)
+        # vm-0-0 needs vm-1-0 running, vm-0-2 (monitoring) goes down last
+        config.esxi_servers[0].vms[0].depends_on = ["vm-1-0"]
+        config.esxi_servers[0].vms[2].priority = 1
+        manager = InfrastructureManager(config, remote)
+
+        self.assertTrue(manager.shutdown())
+        self.assertLess(events.index("10.0.0.10"), events.index("10.0.1.10"))
+        self.assertEqual(events[-1], "10.0.0.12")
+        self.assertEqual(
+            [device for device, _ in manager.critical_path],
+            ["VM vm-0-0", "VM vm-1-0", "VM vm-0-2", "ESXi esxi-0"])
+
+    def test_shutdown_from_hypervisor_in_dependency_order(self):
+        remote = build_remote()
+        remote.shutdown_esxi_vms.side_effect = lambda ip, *_, vm_names, **__: {
+            name: "off" for name in (vm_names or ["vm-0-0"])}
+        remote.get_esxi_vm_power_states.return_value = {}
+        config = build_config(servers=1, strategy='hypervisor')
+        config.esxi_servers[0].vms[0].depends_on = ["vm-0-1"]
+        manager = InfrastructureManager(config, remote)
+
+        self.assertTrue(manager.shutdown())
+        first, second = remote.shutdown_esxi_vms.call_args_list
+        self.assertEqual(first.kwargs, {"port": 22, "vm_names": None, "exclude": ["vm-0-1"]})
+        self.assertEqual(second.kwargs, {"port": 22, "vm_names": ["vm-0-1"], "exclude": ()})
+
+    def test_shutdown_from_hypervisor(self):
+        remote = build_remote()
+        remote.shutdown_esxi_vms.side_effect = lambda ip, *_, **__: {
+            "vm-0-0": "shutdown", "vm-0-1": "skipped", "unlisted": "off",
+        } if ip == "10.0.0.1" else {"vm-1-0": "off", "vm-1-1": "failed"}
+        remote.get_esxi_vm_power_states.return_value = {
+            "vm-0-0": "Powered off", "vm-1-0": "Powered off"}
+        manager = InfrastructureManager(build_config(strategy='hypervisor'), remote)
+
+        self.assertTrue(manager.shutdown())
+        remote.poweroff_ubuntu_vm.assert_not_called()
+        self.assertEqual(remote.shutdown_esxi_vms.call_count, 2)
+        self.assertEqual(remote.poweroff_esxi_server.call_count, 2)
+        self.assertEqual(dict(manager.shutdown_results), {
+            "VM vm-0-0": True, "VM vm-0-1": True, "VM vm-1-0": True,
+            "VM vm-1-1": False, "ESXi esxi-0": True, "ESXi esxi-1": True})
+        self.assertIsNotNone(manager.poweroff_durations["vm-0-0"])
+
+    def test_shutdown_from_hypervisor_waits_for_power_state(self):
+        remote = build_remote()
+        remote.shutdown_esxi_vms.return_value = {"vm-0-0": "shutdown"}
+        remote.get_esxi_vm_power_states.side_effect = [
+            {"vm-0-0": "Powered on"}, {"vm-0-0": "Powered on"},
+            {"vm-0-0": "Powered off"}]
+        manager = InfrastructureManager(
+            build_config(vms_per_server=1, servers=1, strategy='hypervisor'),
+            remote)
+
+        self.assertTrue(manager.shutdown())
+        self.assertEqual(remote.get_esxi_vm_power_states.call_count, 3)
+
+    def test_shutdown_from_hypervisor_falls_back_to_guest(self):
+        remote = build_remote()
+        remote.shutdown_esxi_vms.side_effect = lambda ip, *_, **__: (
+            None if ip == "10.0.0.1" else {"vm-1-0": "shutdown"})
+        remote.get_esxi_vm_power_states.return_value = {}
+        manager = InfrastructureManager(build_config(strategy='hypervisor'), remote)
+
+        self.assertTrue(manager.shutdown())
+        guest_ips = {call.args[0] for call in remote.poweroff_ubuntu_vm.call_args_list}
+        # The whole first server and the VM missing from the second one
+        self.assertEqual(guest_ips, {"10.0.0.10", "10.0.0.11", "10.0.1.11"})
+
+    def test_shutdown_report(self):
+        remote = build_remote()
+        remote.timing.spans.return_value = [
+            Span("10.0.0.10", "guest_poweroff", time.monotonic(), 0.1)]
+        manager = InfrastructureManager(build_config(servers=1), remote)
+
+        self.assertTrue(manager.shutdown())
+        report = manager.report
+        self.assertTrue(report.success)
+        self.assertEqual(list(report.phases),
+                         ["sweep", "shutdown", "close_connections"])
+        self.assertEqual([device["device"] for device in report.devices],
+                         ["VM vm-0-0", "VM vm-0-1", "ESXi esxi-0"])
+        vm = report.devices[0]["timeline"]
+        esxi = report.devices[2]["timeline"]
+        self.assertLessEqual(vm["released"], vm["dispatched"])
+        self.assertLessEqual(vm["sent"], vm["down"])
+        # The ESXi server is released once both of its VMs are down
+        self.assertGreaterEqual(esxi["released"], vm["down"])
+        self.assertEqual(report.host_breakdown(),
+                         {"10.0.0.10": {"guest_poweroff": 0.1}})
+        self.assertEqual(report.critical_path, manager.critical_path)
+
+
+if __name__ == '__main__':
+    unittest.main()
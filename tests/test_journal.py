@@ -0,0 +1,263 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from src.config_manager.config_manager import JournalConfig
+from src.infrastructure_manager.infrastructure_manager import InfrastructureManager
+from src.infrastructure_manager.journal import (CONFIRMED_OFF, FAILED, PENDING,
+                                                SENT, RunLock, ShutdownJournal,
+                                                serialized_run)
+from tests.test_infrastructure_manager import build_config, build_remote
+
+
+class TestShutdownJournal(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'run', 'journal.jsonl')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write_journal(self, entries, age=0.0):
+        journal = ShutdownJournal(self.path)
+        journal.open()
+        for key, state in entries:
+            journal.record(key, state)
+        journal.close()
+        if age:
+            with open(self.path) as f:
+                lines = [json.loads(line) for line in f]
+            with open(self.path, 'w') as f:
+                for line in lines:
+                    line['time'] -= age
+                    f.write(json.dumps(line) + '\n')
+
+    def test_load_keeps_the_last_state_of_every_device(self):
+        self.write_journal([(('esxi-0', 'vm-0-0'), PENDING),
+                            (('esxi-0', 'vm-0-0'), SENT),
+                            (('esxi-0', 'vm-0-1'), FAILED),
+                            (('esxi-0', 'vm-0-0'), CONFIRMED_OFF)])
+        # A crash in the middle of a write leaves a partial line
+        with open(self.path, 'a') as f:
+            f.write('{"time": 1, "server": "esxi-0", "vm": null, "sta')
+
+        self.assertEqual(ShutdownJournal(self.path).load(), {
+            ('esxi-0', 'vm-0-0'): CONFIRMED_OFF,
+            ('esxi-0', 'vm-0-1'): FAILED})
+
+    def test_stale_journal_starts_over(self):
+        self.write_journal([(('esxi-0', None), CONFIRMED_OFF)], age=60)
+
+        self.assertEqual(ShutdownJournal(self.path, resume_window=30).load(), {})
+        self.assertEqual(os.path.getsize(self.path), 0)
+
+    def test_missing_journal_is_empty(self):
+        self.assertEqual(ShutdownJournal(self.path).load(), {})
+
+    def test_reset_forgets_every_state(self):
+        self.write_journal([(('esxi-0', None), CONFIRMED_OFF)])
+        journal = ShutdownJournal(self.path)
+        journal.load()
+        journal.reset()
+        self.assertEqual(journal.states, {})
+        self.assertEqual(ShutdownJournal(self.path).load(), {})
+
+    def test_completion_drops_the_states_before_it(self):
+        self.write_journal([(('esxi-0', None), CONFIRMED_OFF)])
+        ShutdownJournal(self.path).complete(False)
+        journal = ShutdownJournal(self.path)
+        self.assertEqual(journal.load(), {})
+        self.assertIs(journal.completed, False)
+
+        # A run started since: the completion is not the last word anymore
+        journal.open()
+        journal.record(('esxi-1', None), SENT)
+        journal.close()
+        self.assertEqual(journal.load(), {('esxi-1', None): SENT})
+        self.assertIsNone(journal.completed)
+
+    def test_run_lock_serializes_runs(self):
+        lock_file = os.path.join(self.tmp_dir.name, 'run', 'shutdown.lock')
+        acquired = []
+
+        def second_run():
+            with RunLock(lock_file):
+                acquired.append(time.monotonic())
+
+        with RunLock(lock_file):
+            thread = threading.Thread(target=second_run)
+            with self.assertLogs(level='WARNING'):
+                thread.start()
+                time.sleep(0.1)
+            released = time.monotonic()
+        thread.join()
+        self.assertGreaterEqual(acquired[0], released)
+
+
+class TestResumedShutdown(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'journal.jsonl')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def run_shutdown(self, remote, config=None):
+        journal = ShutdownJournal(self.path)
+        journal.load()
+        manager = InfrastructureManager(config or build_config(), remote,
+                                        journal=journal)
+        return manager.shutdown()
+
+    def test_retry_resumes_only_outstanding_work(self):
+        remote = build_remote()
+        remote.poweroff_ubuntu_vm.side_effect = \
+            lambda ip, *_, **__: ip != "10.0.1.10"
+        remote.poweroff_esxi_server.side_effect = \
+            lambda ip, *_, **__: ip != "10.0.1.1"
+        self.assertFalse(self.run_shutdown(remote))
+        self.assertEqual(ShutdownJournal(self.path).load(), {
+            ('esxi-0', 'vm-0-0'): CONFIRMED_OFF,
+            ('esxi-0', 'vm-0-1'): CONFIRMED_OFF,
+            ('esxi-0', None): CONFIRMED_OFF,
+            ('esxi-1', 'vm-1-0'): FAILED,
+            ('esxi-1', 'vm-1-1'): CONFIRMED_OFF,
+            ('esxi-1', None): FAILED})
+
+        # The failed hosts answer again, or their open circuit skips them
+        retry = build_remote(is_online=lambda ip: ip in ("10.0.1.10",
+                                                         "10.0.1.1"))
+        self.assertTrue(self.run_shutdown(retry))
+        self.assertEqual(
+            [call.args[0] for call in retry.poweroff_ubuntu_vm.call_args_list],
+            ["10.0.1.10"])
+        self.assertEqual(
+            [call.args[0] for call in retry.poweroff_esxi_server.call_args_list],
+            ["10.0.1.1"])
+        # Devices confirmed off are probed again, in case they came back
+        self.assertEqual(len(retry.check_reachability.call_args_list[0].args[0]),
+                         6)
+
+    def test_finished_run_leaves_its_result(self):
+        settings = JournalConfig(file=self.path, lock_file=None)
+        with serialized_run(settings) as journal:
+            self.assertIsNone(journal.completed)
+            journal.complete(InfrastructureManager(
+                build_config(), build_remote(), journal=journal).shutdown())
+
+        # A repeated trigger finds the result instead of running again
+        with serialized_run(settings) as journal:
+            self.assertEqual(journal.states, {})
+            self.assertIs(journal.completed, True)
+            # A startup brings the devices back: the next trigger runs
+            journal.reset()
+        with serialized_run(settings) as journal:
+            self.assertIsNone(journal.completed)
+
+    def test_tripped_host_is_skipped_on_the_next_trigger(self):
+        settings = JournalConfig(file=self.path, lock_file=None)
+        config = build_config(servers=1, retry_attempts=5, breaker_threshold=2)
+
+        def trigger(remote):
+            # Runs that are not marked complete, as if killed at the end;
+            # esxi-0 fails too, or its VMs would count as off with it
+            remote.poweroff_ubuntu_vm.side_effect = lambda ip, *_, **__: (
+                ip != '10.0.0.10')
+            remote.poweroff_esxi_server.return_value = False
+            with serialized_run(settings) as journal:
+                InfrastructureManager(config, remote,
+                                      journal=journal).shutdown()
+            return [call.args[0]
+                    for call in remote.poweroff_ubuntu_vm.call_args_list]
+
+        self.assertEqual(trigger(build_remote()),
+                         ['10.0.0.10', '10.0.0.11', '10.0.0.10'])
+        self.assertEqual(ShutdownJournal(self.path).load()[('esxi-0', 'vm-0-0')],
+                         FAILED)
+
+        # Still dead on the next trigger: not contacted at all
+        with self.assertLogs(level='WARNING') as logs:
+            self.assertEqual(trigger(build_remote()), [])
+        self.assertIn("did not answer an earlier run", "\n".join(logs.output))
+
+        # Back online: contacted again, and its circuit closes once it is off
+        online = build_remote(is_online=lambda ip: ip == '10.0.0.10')
+        online.poweroff_ubuntu_vm.side_effect = None
+        with serialized_run(settings) as journal:
+            self.assertEqual(journal.tripped, {'10.0.0.1', '10.0.0.10'})
+            InfrastructureManager(config, online, journal=journal).shutdown()
+        self.assertIn('10.0.0.10', [call.args[0] for call
+                                    in online.poweroff_ubuntu_vm.call_args_list])
+        journal = ShutdownJournal(self.path)
+        journal.load()
+        self.assertEqual(journal.tripped, {'10.0.0.1'})
+
+    def test_interrupted_run_is_resumed(self):
+        settings = JournalConfig(file=self.path, lock_file=None)
+        with self.assertRaises(KeyboardInterrupt):
+            with serialized_run(settings) as journal:
+                journal.open()
+                journal.record(('esxi-0', 'vm-0-0'), CONFIRMED_OFF)
+                journal.close()
+                raise KeyboardInterrupt()
+
+        with serialized_run(settings) as journal:
+            self.assertEqual(journal.states,
+                             {('esxi-0', 'vm-0-0'): CONFIRMED_OFF})
+
+    def test_confirmed_off_device_that_answers_is_shut_down_again(self):
+        journal = ShutdownJournal(self.path)
+        journal.open()
+        journal.record(('esxi-0', None), CONFIRMED_OFF)
+        journal.record(('esxi-1', 'vm-1-0'), CONFIRMED_OFF)
+        journal.close()
+
+        # esxi-0 and vm-1-0 were powered on again, the VMs of esxi-0 not
+        remote = build_remote(is_online=lambda ip: ip in ("10.0.0.1",
+                                                           "10.0.1.10"))
+        with self.assertLogs(level='WARNING'):
+            self.assertTrue(self.run_shutdown(remote))
+        self.assertEqual(
+            sorted(call.args[0] for call
+                   in remote.poweroff_ubuntu_vm.call_args_list),
+            ["10.0.1.10", "10.0.1.11"])
+        self.assertEqual(
+            sorted(call.args[0] for call
+                   in remote.poweroff_esxi_server.call_args_list),
+            ["10.0.0.1", "10.0.1.1"])
+
+    def test_vm_sent_its_shutdown_is_only_awaited(self):
+        journal = ShutdownJournal(self.path)
+        journal.open()
+        journal.record(('esxi-0', 'vm-0-0'), SENT)
+        journal.close()
+
+        remote = build_remote()
+        config = build_config(servers=1)
+        self.assertTrue(self.run_shutdown(remote, config))
+        self.assertEqual(
+            [call.args[0] for call in remote.poweroff_ubuntu_vm.call_args_list],
+            ["10.0.0.11"])
+        self.assertEqual(ShutdownJournal(self.path).load()[('esxi-0', 'vm-0-0')],
+                         CONFIRMED_OFF)
+
+    def test_vm_sent_from_hypervisor_is_polled_on_its_server(self):
+        journal = ShutdownJournal(self.path)
+        journal.open()
+        journal.record(('esxi-0', 'vm-0-0'), SENT)
+        journal.close()
+
+        remote = build_remote()
+        remote.get_esxi_vm_power_states.return_value = {
+            'vm-0-0': 'Powered off'}
+        remote.shutdown_esxi_vms.return_value = {'vm-0-1': 'shutdown'}
+        config = build_config(servers=1, strategy='hypervisor')
+        self.assertTrue(self.run_shutdown(remote, config))
+        self.assertEqual(remote.shutdown_esxi_vms.call_args.kwargs['exclude'],
+                         ['vm-0-0'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+from src.infrastructure_manager.plan import LatencyHistory, ShutdownPlanner
+from src.infrastructure_manager.run_report import RunReport
+from tests.test_infrastructure_manager import build_config
+
+
+def write_history(path, devices, phases=None):
+    with open(path, 'w') as f:
+        json.dump({'runs': 3, 'phases': phases or {'sweep': 0.5},
+                   'devices': devices}, f)
+    return LatencyHistory(path)
+
+
+class TestLatencyHistory(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'run', 'history.json')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_update_averages_the_stages_of_every_run(self):
+        def report(wait_off):
+            return RunReport(
+                success=True, timestamp=0.0, origin=0.0, duration=10.0,
+                phases={'sweep': 1.0, 'shutdown': 9.0},
+                devices=[{'device': 'VM web', 'server': 'esxi-0',
+                          'ip': '10.0.0.10', 'success': True,
+                          'timeline': {'released': 1.0, 'dispatched': 1.0,
+                                       'sent': 2.0, 'down': 2.0 + wait_off}}])
+
+        LatencyHistory(self.path).update(report(10.0))
+        history = LatencyHistory(self.path)
+        history.update(report(20.0))
+
+        history = LatencyHistory(self.path)
+        self.assertEqual(history.runs, 2)
+        self.assertEqual(history.latency('VM web', 'send'), 1.0)
+        self.assertAlmostEqual(history.latency('VM web', 'wait_off'), 13.0)
+        self.assertEqual(history.phases, {'sweep': 1.0})
+        self.assertIsNone(history.latency('VM db', 'send'))
+
+    def test_unreadable_history_is_empty(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as f:
+            f.write('{"devices": ')
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(LatencyHistory(self.path).runs, 0)
+
+
+    def test_failed_write_leaves_no_temporary_file(self):
+        report = RunReport(success=True, timestamp=0.0, origin=0.0,
+                           duration=1.0, phases={'sweep': 1.0})
+        with patch('src.infrastructure_manager.atomic_file.os.replace',
+                   side_effect=OSError("disk full")):
+            with self.assertLogs(level='ERROR'):
+                LatencyHistory(self.path).update(report)
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), [])
+
+class TestShutdownPlanner(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'history.json')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_plan_follows_the_workers_and_the_dependencies(self):
+        config = build_config(servers=1, poll_interval=1,
+                              vm_poweroff_timeout=60, max_workers=1)
+        history = write_history(self.path, {
+            'VM vm-0-0': {'send': 1.0, 'wait_off': 5.0},
+            'VM vm-0-1': {'send': 1.0, 'wait_off': 4.5},
+            'ESXi esxi-0': {'send': 2.0, 'wait_off': 0.0}})
+
+        plan = ShutdownPlanner(config, history).plan()
+        # A single worker sends both shutdowns in turn, and the server goes
+        # once both VMs were found off by their polls
+        self.assertEqual(plan.phases['shutdown'], 9.0)
+        self.assertEqual(plan.wall_time, 9.5)
+        self.assertEqual(plan.critical_path,
+                         [("VM vm-0-1", 7.5), ("ESXi esxi-0", 2.0)])
+        self.assertIsNone(plan.fits)
+        self.assertEqual(plan.at_risk, [])
+        self.assertEqual(plan.estimated_devices, 0)
+        esxi = plan.devices[-1]
+        self.assertEqual(esxi['timeline'], {
+            'released': 7.5, 'dispatched': 7.5, 'sent': 9.5, 'down': 9.5})
+
+    def test_plan_flags_the_devices_that_put_the_deadline_at_risk(self):
+        config = build_config(servers=1, poll_interval=1,
+                              vm_poweroff_timeout=60, max_workers=1)
+        history = write_history(self.path, {
+            'VM vm-0-0': {'send': 1.0, 'wait_off': 5.0},
+            'ESXi esxi-0': {'send': 2.0}})
+
+        planner = ShutdownPlanner(config, history)
+        self.assertTrue(planner.plan(deadline=60).fits)
+
+        plan = planner.plan(deadline=10)
+        # The VMs would still be running when the hard power-off starts
+        self.assertFalse(plan.fits)
+        self.assertEqual(plan.at_risk, [("VM vm-0-0", 'hard powered off'),
+                                        ("VM vm-0-1", 'hard powered off')])
+        # vm-0-1 was never timed and gets the latencies of vm-0-0
+        self.assertEqual(plan.estimated_devices, 1)
+
+    def test_vms_past_their_poweroff_timeout_are_given_up_on(self):
+        config = build_config(servers=1, vms_per_server=1, poll_interval=1,
+                              vm_poweroff_timeout=10)
+        plan = ShutdownPlanner(config).plan()
+
+        # Without history every latency is a default, and guests take
+        # longer to go down than they are waited for
+        self.assertEqual(plan.estimated_devices, 2)
+        self.assertEqual(plan.at_risk, [("VM vm-0-0", 'given up on')])
+        self.assertEqual(plan.phases['shutdown'], 2.0 + 10 + 2.0)
+
+    def test_hypervisor_vms_share_a_batch_and_shards_run_in_parallel(self):
+        config = build_config(servers=2, strategy='hypervisor',
+                              poll_interval=1, vm_poweroff_timeout=60,
+                              max_workers=1, processes=2)
+        history = write_history(self.path, {
+            'VM vm-0-0': {'send': 1.0, 'wait_off': 3.0},
+            'VM vm-0-1': {'send': 1.5, 'wait_off': 3.0},
+            'ESXi esxi-0': {'send': 2.0}})
+
+        plan = ShutdownPlanner(config, history).plan()
+        # One batch per server, as long as its slowest VM, and each shard
+        # with its own worker; esxi-1 gets the median latencies of esxi-0
+        self.assertEqual(plan.phases['shutdown'], 1.5 + 3.0 + 2.0)
+        self.assertEqual({device['shard'] for device in plan.devices}, {0, 1})
+        self.assertEqual(
+            {(device['server'], device['timeline']['sent'])
+             for device in plan.devices if device['device'].startswith('VM ')},
+            {('esxi-0', 2.0), ('esxi-1', 1.75)})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,12 @@
 import unittest
+import paramiko
 from unittest.mock import patch, MagicMock
+import socket
 import subprocess
-from src.remote_manager.remote_manager import RemoteDeviceManager
+import threading
+import time
+from src.remote_manager.command_runner import CommandResult
+from src.remote_manager.remote_manager import RemoteDeviceManager, RemoteTarget
 
 
 class TestRemoteDeviceManager(unittest.TestCase):
@@ -20,23 +25,173 @@ class TestRemoteDeviceManager(unittest.TestCase):
         mock_subprocess.side_effect = subprocess.CalledProcessError(1, 'ping')
         self.assertFalse(RemoteDeviceManager.is_device_online('192.168.1.100'))
 
+    def test_check_reachability_tcp(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen()
+        port = listener.getsockname()[1]
+        try:
+            results = RemoteDeviceManager.check_reachability(
+                ['127.0.0.1'], port=port, timeout=1.0)
+        finally:
+            listener.close()
+        self.assertTrue(results['127.0.0.1'].online)
+        self.assertIsNotNone(results['127.0.0.1'].latency)
+
+    def test_is_ssh_ready_waits_for_the_banner(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen()
+        port = listener.getsockname()[1]
+
+        def answer():
+            conn, _ = listener.accept()
+            conn.sendall(b"SSH-2.0-OpenSSH_9.6\r\n")
+            conn.close()
+
+        try:
+            # Accepted by the kernel but silent, as while sshd is starting
+            self.assertFalse(RemoteDeviceManager.is_ssh_ready(
+                '127.0.0.1', port=port, timeout=0.1))
+            listener.accept()[0].close()
+            thread = threading.Thread(target=answer)
+            thread.start()
+            self.assertTrue(RemoteDeviceManager.is_ssh_ready(
+                '127.0.0.1', port=port, timeout=1.0))
+            thread.join()
+        finally:
+            listener.close()
+
+    def test_check_reachability_refused_counts_as_online(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        port = listener.getsockname()[1]
+        listener.close()
+        results = RemoteDeviceManager.check_reachability(
+            ['127.0.0.1'], port=port, timeout=1.0)
+        self.assertTrue(results['127.0.0.1'].online)
+
+    def test_check_reachability_unresolvable_host(self):
+        results = RemoteDeviceManager.check_reachability(
+            ['invalid host name'], timeout=0.2)
+        self.assertFalse(results['invalid host name'].online)
+        self.assertIsNone(results['invalid host name'].latency)
+
+    def test_check_reachability_records_probe_spans(self):
+        started = time.monotonic()
+        RemoteDeviceManager.check_reachability(
+            ['invalid host name'], timeout=0.2)
+        span, = [span for span in RemoteDeviceManager.timing.spans(since=started)
+                 if span.host == 'invalid host name']
+        self.assertEqual(span.phase, 'probe')
+        self.assertFalse(span.ok)
+
+    def test_check_reachability_invalid_mode(self):
+        with self.assertRaises(ValueError):
+            RemoteDeviceManager.check_reachability(['127.0.0.1'], mode='udp')
+
+    @patch('socket.create_connection')
     @patch('paramiko.SSHClient')
-    def test_ssh_connect_success(self, mock_ssh_client):
+    def test_ssh_connect_success(self, mock_ssh_client, mock_create_connection):
         ssh_client = RemoteDeviceManager.ssh_connect(
             '192.168.1.100', 'admin', 'password')
         self.assertIsInstance(ssh_client, MagicMock)
+        self.assertIs(mock_ssh_client.return_value.connect.call_args.kwargs['sock'],
+                      mock_create_connection.return_value)
+
+    @patch('socket.create_connection')
+    @patch('paramiko.SSHClient')
+    def test_ssh_connect_passes_stage_timeouts(self, mock_ssh_client,
+                                               mock_create_connection):
+        RemoteDeviceManager.ssh_connect('192.168.1.100', 'admin', 'password')
+        kwargs = mock_ssh_client.return_value.connect.call_args.kwargs
+        timeouts = RemoteDeviceManager.timeouts
+        self.assertEqual(mock_create_connection.call_args.kwargs['timeout'],
+                         timeouts.connect)
+        self.assertEqual(kwargs['timeout'], timeouts.connect)
+        self.assertEqual(kwargs['banner_timeout'], timeouts.connect)
+        self.assertEqual(kwargs['auth_timeout'], timeouts.auth)
+        self.assertEqual(kwargs['channel_timeout'], timeouts.exec)
+
+    @patch('socket.create_connection')
+    @patch('paramiko.SSHClient')
+    def test_ssh_connect_timeout(self, mock_ssh_client, mock_create_connection):
+        mock_create_connection.side_effect = socket.timeout()
+        with self.assertLogs(level='ERROR') as logs:
+            self.assertFalse(RemoteDeviceManager.ssh_connect(
+                '192.168.1.100', 'admin', 'password'))
+        self.assertIn('connect stage', logs.output[0])
+        mock_ssh_client.return_value.connect.assert_not_called()
+
+    @patch('socket.create_connection')
+    @patch('paramiko.SSHClient')
+    def test_ssh_connect_records_failed_span(self, mock_ssh_client,
+                                             mock_create_connection):
+        mock_create_connection.side_effect = socket.timeout()
+        started = time.monotonic()
+        with self.assertLogs(level='ERROR'):
+            RemoteDeviceManager.ssh_connect('192.168.1.77', 'admin', 'password')
+        span, = [span for span in RemoteDeviceManager.timing.spans(since=started)
+                 if span.host == '192.168.1.77']
+        self.assertEqual(span.phase, 'tcp')
+        self.assertFalse(span.ok)
+
+    @patch('paramiko.Transport')
+    @patch('socket.create_connection')
+    @patch('paramiko.SSHClient')
+    def test_ssh_connect_times_tcp_kex_and_auth(self, mock_ssh_client,
+                                                mock_create_connection,
+                                                mock_transport):
+        def connect(**kwargs):
+            # What SSHClient.connect does with its transport factory
+            transport = kwargs['transport_factory'](kwargs['sock'])
+            transport.start_client(timeout=kwargs['timeout'])
+            time.sleep(0.01)
+            raise paramiko.AuthenticationException('Authentication failed.')
+        mock_ssh_client.return_value.connect.side_effect = connect
+        started = time.monotonic()
+
+        with self.assertLogs(level='ERROR'):
+            self.assertFalse(RemoteDeviceManager.ssh_connect(
+                '192.168.1.78', 'admin', 'password'))
+        spans = [span for span in RemoteDeviceManager.timing.spans(since=started)
+                 if span.host == '192.168.1.78']
+        self.assertEqual([(span.phase, span.ok) for span in spans],
+                         [('tcp', True), ('kex', True), ('auth', False)])
+        self.assertGreaterEqual(spans[2].duration, 0.01)
+        mock_transport.assert_called_once_with(mock_create_connection.return_value)
+        mock_create_connection.return_value.close.assert_called_once()
 
     @patch('src.remote_manager.remote_manager.RemoteDeviceManager.is_device_online')
     @patch('src.remote_manager.remote_manager.RemoteDeviceManager.ssh_connect')
-    def test_poweroff_ubuntu_vm_success(self, mock_ssh_connect, mock_is_device_online):
+    @patch('src.remote_manager.remote_manager.run_command')
+    def test_poweroff_ubuntu_vm_success(self, mock_run_command, mock_ssh_connect, mock_is_device_online):
         mock_is_device_online.return_value = True
         mock_ssh_client = MagicMock()
         mock_ssh_connect.return_value = mock_ssh_client
-        mock_ssh_client.exec_command.return_value = (
-            MagicMock(), MagicMock(), MagicMock(read=lambda: b'[sudo] password for'))
+        mock_run_command.return_value = CommandResult(
+            stderr='[sudo] password for admin:', matched='[sudo] password for')
 
-        self.assertTrue(RemoteDeviceManager.poweroff_ubuntu_vm(
-            '192.168.1.101', 'admin', 'password'))
+        try:
+            self.assertTrue(RemoteDeviceManager.poweroff_ubuntu_vm(
+                '192.168.1.101', 'admin', 'password'))
+        finally:
+            RemoteDeviceManager.close_all_connections()
+        self.assertEqual(mock_run_command.call_args.kwargs['stdin_data'], 'password\n')
+
+    @patch('src.remote_manager.remote_manager.RemoteDeviceManager.is_device_online')
+    @patch('src.remote_manager.remote_manager.RemoteDeviceManager.ssh_connect')
+    @patch('src.remote_manager.remote_manager.run_command')
+    def test_poweroff_ubuntu_vm_exec_timeout(self, mock_run_command, mock_ssh_connect, mock_is_device_online):
+        mock_is_device_online.return_value = True
+        mock_ssh_connect.return_value = MagicMock()
+        mock_run_command.return_value = CommandResult(timed_out_stage='exec')
+
+        try:
+            self.assertFalse(RemoteDeviceManager.poweroff_ubuntu_vm(
+                '192.168.1.101', 'admin', 'password'))
+        finally:
+            RemoteDeviceManager.close_all_connections()
 
     @patch('src.remote_manager.remote_manager.RemoteDeviceManager.is_device_online')
     @patch('src.remote_manager.remote_manager.RemoteDeviceManager.ssh_connect')
@@ -62,6 +217,173 @@ class TestRemoteDeviceManager(unittest.TestCase):
         self.assertFalse(RemoteDeviceManager.poweroff_esxi_server(
             '192.168.1.100', 'admin', 'password'))
 
+    @patch('src.remote_manager.remote_manager.RemoteDeviceManager.is_device_online')
+    @patch('src.remote_manager.remote_manager.RemoteDeviceManager.ssh_connect')
+    def test_poweroff_esxi_server_precomputed_offline(self, mock_ssh_connect, mock_is_device_online):
+        self.assertFalse(RemoteDeviceManager.poweroff_esxi_server(
+            '192.168.1.100', 'admin', 'password', online=False))
+        mock_is_device_online.assert_not_called()
+        mock_ssh_connect.assert_not_called()
+
+    @patch('src.remote_manager.remote_manager.RemoteDeviceManager.ssh_connect')
+    @patch('src.remote_manager.remote_manager.run_command')
+    def test_run_many_limits_concurrency_and_keeps_per_host_results(
+            self, mock_run_command, mock_ssh_connect):
+        clients = {f'10.0.0.{index}': MagicMock() for index in range(6)}
+        mock_ssh_connect.side_effect = (
+            lambda host, *_: clients[host] if host != '10.0.0.5' else False)
+        hosts = {client: host for host, client in clients.items()}
+        lock = threading.Lock()
+        running, peak, streamed = [0], [0], []
+
+        def run(client, command, **kwargs):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.02)
+            kwargs['on_output']('stdout', 'synced\n')
+            with lock:
+                running[0] -= 1
+            host = hosts[client]
+            return CommandResult(
+                exit_status=0 if host != '10.0.0.3' else 1,
+                stdout='synced\n', stderr='[sudo] password for admin: warn')
+        mock_run_command.side_effect = run
+
+        targets = [(host, 'admin', 'pw') for host in clients]
+        try:
+            results = RemoteDeviceManager.run_many(
+                targets, 'sync', max_workers=2, sudo=True,
+                on_output=lambda *chunk: streamed.append(chunk))
+        finally:
+            RemoteDeviceManager.close_all_connections()
+
+        self.assertEqual(list(results), list(clients))
+        self.assertEqual(peak[0], 2)
+        self.assertEqual({host: result.exit_status
+                          for host, result in results.items()},
+                         {'10.0.0.0': 0, '10.0.0.1': 0, '10.0.0.2': 0,
+                          '10.0.0.3': 1, '10.0.0.4': 0, '10.0.0.5': None})
+        self.assertEqual(results['10.0.0.5'].error, 'could not connect')
+        self.assertEqual(results['10.0.0.0'].stderr, 'warn')
+        self.assertEqual(len(streamed), 5)
+        self.assertIn(('10.0.0.4', 'stdout', 'synced\n'), streamed)
+        self.assertEqual(mock_run_command.call_args.args[1], 'sudo -S sync')
+        self.assertEqual(mock_run_command.call_args.kwargs['stdin_data'], 'pw\n')
+
+    @patch('src.remote_manager.remote_manager.RemoteDeviceManager.ssh_connect')
+    @patch('src.remote_manager.remote_manager.run_command')
+    def test_run_many_discards_broken_sessions(self, mock_run_command,
+                                               mock_ssh_connect):
+        mock_ssh_connect.side_effect = lambda *_: MagicMock()
+        mock_run_command.return_value = CommandResult(error='channel closed')
+        target = RemoteTarget('192.168.1.100', 'root', 'pw')
+        try:
+            result, = RemoteDeviceManager.run_many([target], 'uptime').values()
+            RemoteDeviceManager.run_many([target], 'uptime')
+        finally:
+            RemoteDeviceManager.close_all_connections()
+
+        self.assertFalse(result.ok)
+        self.assertEqual(mock_ssh_connect.call_count, 2)
+        self.assertEqual(RemoteDeviceManager.run_many([], 'uptime'), {})
+
+    @patch('src.remote_manager.remote_manager.RemoteDeviceManager.ssh_connect')
+    def test_get_connection_reuses_pooled_client(self, mock_ssh_connect):
+        mock_ssh_connect.return_value = MagicMock()
+        try:
+            first = RemoteDeviceManager.get_connection(
+                '192.168.1.100', 'admin', 'password')
+            second = RemoteDeviceManager.get_connection(
+                '192.168.1.100', 'admin', 'password')
+        finally:
+            RemoteDeviceManager.close_all_connections()
+        self.assertIs(first, second)
+        mock_ssh_connect.assert_called_once()
+
+    def test_parse_getallvms(self):
+        output = (
+            "Vmid   Name             File                      Guest OS       Version   Annotation\n"
+            "1      web server 01    [datastore1] web/web.vmx  ubuntu64Guest  vmx-13\n"
+            "12     db-server-01     [datastore1] db/db.vmx    ubuntu64Guest  vmx-13    note\n")
+        self.assertEqual(RemoteDeviceManager.parse_getallvms(output),
+                         {'web server 01': '1', 'db-server-01': '12'})
+
+    @patch('src.remote_manager.remote_manager.RemoteDeviceManager.run_esxi_command')
+    def test_shutdown_esxi_vms(self, mock_run):
+        mock_run.side_effect = [
+            "Vmid Name File\n1 web [ds1] web/web.vmx\n2 db [ds1] db/db.vmx\n3 old [ds1] o/o.vmx\n",
+            "2 off\n1 shutdown\n3 skipped\n",
+        ]
+        self.assertEqual(
+            RemoteDeviceManager.shutdown_esxi_vms('192.168.1.100', 'root', 'pw'),
+            {'web': 'shutdown', 'db': 'off', 'old': 'skipped'})
+        self.assertIn('for id in 1 2 3;', mock_run.call_args_list[1].args[3])
+
+    @patch('src.remote_manager.remote_manager.RemoteDeviceManager.run_esxi_command')
+    def test_shutdown_esxi_vms_session_failure(self, mock_run):
+        mock_run.return_value = None
+        self.assertIsNone(
+            RemoteDeviceManager.shutdown_esxi_vms('192.168.1.100', 'root', 'pw'))
+
+    @patch('src.remote_manager.remote_manager.RemoteDeviceManager.run_esxi_command')
+    def test_hard_poweroff_esxi_vms(self, mock_run):
+        mock_run.side_effect = [
+            "Vmid Name File\n1 web [ds1] web/web.vmx\n2 db [ds1] db/db.vmx\n",
+            "2 off\n",
+        ]
+        self.assertEqual(
+            RemoteDeviceManager.hard_poweroff_esxi_vms(
+                '192.168.1.100', 'root', 'pw', ['db', 'missing']),
+            {'db': 'off'})
+        command = mock_run.call_args_list[1].args[3]
+        self.assertIn('for id in 2;', command)
+        self.assertNotIn('power.shutdown', command)
+
+    @patch('src.remote_manager.remote_manager.RemoteDeviceManager.run_esxi_command')
+    def test_get_esxi_vm_power_states(self, mock_run):
+        mock_run.return_value = (
+            "Vmid Name File\n1 web [ds1] web/web.vmx\n2 db [ds1] db/db.vmx\n"
+            "--- power states ---\n1 Powered off\n2 Powered on\n")
+        self.assertEqual(
+            RemoteDeviceManager.get_esxi_vm_power_states('192.168.1.100', 'root', 'pw'),
+            {'web': 'Powered off', 'db': 'Powered on'})
+
+
+    @patch('src.remote_manager.remote_manager.RemoteDeviceManager.run_esxi_command')
+    def test_discover_esxi_vms(self, mock_run):
+        mock_run.return_value = (
+            "Vmid Name File\n1 web [ds1] web/web.vmx\n2 db [ds1] db/db.vmx\n"
+            "3 new [ds1] new/new.vmx\n"
+            "--- discovery ---\n2|Powered off|\n1|Powered on|10.0.0.5\n")
+        vms = RemoteDeviceManager.discover_esxi_vms('192.168.1.100', 'root', 'pw')
+        self.assertEqual(
+            {name: (vm.power_state, vm.ip) for name, vm in vms.items()},
+            {'web': ('Powered on', '10.0.0.5'), 'db': ('Powered off', None),
+             'new': ('Unknown', None)})
+        self.assertEqual(mock_run.call_args.kwargs['phase'], 'discovery')
+
+    @patch('src.remote_manager.remote_manager.RemoteDeviceManager.run_esxi_command')
+    def test_discover_esxi_vms_session_failure(self, mock_run):
+        mock_run.return_value = None
+        self.assertIsNone(
+            RemoteDeviceManager.discover_esxi_vms('192.168.1.100', 'root', 'pw'))
+
+
+    @patch('src.remote_manager.remote_manager.RemoteDeviceManager.run_esxi_command')
+    def test_poweron_esxi_vms(self, mock_run):
+        mock_run.side_effect = [
+            "Vmid Name File\n1 web [ds1] web/web.vmx\n2 db [ds1] db/db.vmx\n",
+            "2 on\n",
+        ]
+        self.assertEqual(
+            RemoteDeviceManager.poweron_esxi_vms(
+                '192.168.1.100', 'root', 'pw', ['db', 'missing']),
+            {'db': 'on'})
+        command = mock_run.call_args_list[1].args[3]
+        self.assertIn('for id in 2;', command)
+        self.assertIn('vim-cmd vmsvc/power.on $id', command)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,113 @@
+import random
+import unittest
+from src.infrastructure_manager.infrastructure_manager import InfrastructureManager
+from src.infrastructure_manager.retry import CircuitBreaker, RetryPolicy
+from tests.test_infrastructure_manager import build_config, build_remote
+
+
+def build_flaky_remote(failures):
+    """Remote whose hosts answer until they accepted their power-off, which
+    fails the given number of times per host first."""
+    down = set()
+    remote = build_remote(is_online=lambda ip: ip not in down)
+
+    def poweroff(ip, *_, **__):
+        failures[ip] = failures.get(ip, 0) - 1
+        if failures[ip] < 0:
+            down.add(ip)
+        return failures[ip] < 0
+    remote.poweroff_ubuntu_vm.side_effect = poweroff
+    remote.poweroff_esxi_server.side_effect = poweroff
+    return remote
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def test_backoff_doubles_with_jitter_up_to_the_maximum(self):
+        policy = RetryPolicy(attempts=10, base_delay=1, max_delay=5,
+                             rng=random.Random(7))
+        for failures, ceiling in ((1, 1), (2, 2), (3, 4), (4, 5), (8, 5)):
+            delays = {policy.backoff(failures) for _ in range(20)}
+            self.assertTrue(all(ceiling / 2 <= delay <= ceiling
+                                for delay in delays))
+            self.assertGreater(len(delays), 1)
+
+    def test_next_delay_fits_the_attempts_and_the_limit(self):
+        policy = RetryPolicy(attempts=3, base_delay=4, max_delay=4,
+                             rng=random.Random(7))
+        self.assertGreaterEqual(policy.next_delay(1, 100.0, 1.0), 2)
+        self.assertIsNone(policy.next_delay(3, 100.0, 1.0))
+        # Shortened so that the attempt is over by the limit
+        self.assertEqual(policy.next_delay(1, 100.0, 1.0, limit=102.5), 1.5)
+        self.assertIsNone(policy.next_delay(1, 100.0, 3.0, limit=102.5))
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_opens_after_consecutive_hard_failures(self):
+        breaker = CircuitBreaker(threshold=2)
+        breaker.record('10.0.0.10', success=False)
+        breaker.record('10.0.0.10', success=False, hard=False)
+        self.assertFalse(breaker.is_open('10.0.0.10'))
+        breaker.record('10.0.0.10', success=True)
+        breaker.record('10.0.0.10', success=False)
+        self.assertFalse(breaker.is_open('10.0.0.10'))
+        breaker.record('10.0.0.10', success=False)
+        self.assertTrue(breaker.is_open('10.0.0.10'))
+        self.assertFalse(breaker.is_open('10.0.0.11'))
+
+
+class TestShutdownRetries(unittest.TestCase):
+    def test_transient_failures_are_retried(self):
+        remote = build_flaky_remote({'10.0.0.10': 2, '10.0.0.1': 1})
+        manager = InfrastructureManager(build_config(servers=1), remote)
+
+        self.assertTrue(manager.shutdown())
+        self.assertTrue(all(success for _, success in manager.shutdown_results))
+        self.assertEqual(
+            {device['device']: device['attempts']
+             for device in manager.report.devices},
+            {'VM vm-0-0': 3, 'VM vm-0-1': 1, 'ESXi esxi-0': 2})
+
+    def test_unreachable_hosts_open_their_circuit(self):
+        remote = build_remote()
+        remote.poweroff_ubuntu_vm.side_effect = lambda ip, *_, **__: (
+            ip != '10.0.0.10')
+        manager = InfrastructureManager(
+            build_config(servers=1, retry_attempts=5, breaker_threshold=2),
+            remote)
+
+        self.assertTrue(manager.shutdown())
+        self.assertIn(("VM vm-0-0", False), manager.shutdown_results)
+        self.assertEqual(manager.report.devices[0]['attempts'], 2)
+        # The retry probed the host again instead of trusting the sweep
+        self.assertIn((['10.0.0.10'],), [call.args for call
+                                          in remote.check_reachability.call_args_list])
+
+    def test_backoff_does_not_hold_a_worker(self):
+        remote = build_flaky_remote({'10.0.0.10': 1})
+        manager = InfrastructureManager(
+            build_config(servers=1, max_workers=1, retry_base_delay=0.2),
+            remote)
+
+        self.assertTrue(manager.shutdown())
+        # The single worker served vm-0-1 during the backoff of vm-0-0
+        self.assertEqual(
+            [call.args[0] for call in remote.poweroff_ubuntu_vm.call_args_list],
+            ['10.0.0.10', '10.0.0.11', '10.0.0.10'])
+
+    def test_retries_end_with_the_deadline_budget(self):
+        remote = build_remote(is_online=lambda ip: True)
+        remote.poweroff_esxi_server.return_value = False
+        manager = InfrastructureManager(
+            build_config(servers=1, vms_per_server=0, retry_attempts=100,
+                         retry_base_delay=0.1, retry_max_delay=0.1),
+            remote)
+
+        self.assertFalse(manager.shutdown(deadline=0.5))
+        # The last attempt is over about when the budget is
+        self.assertLess(manager.phases['shutdown'], 0.6)
+        self.assertGreater(remote.poweroff_esxi_server.call_count, 1)
+        self.assertLess(remote.poweroff_esxi_server.call_count, 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import json
+import os
+import tempfile
+import unittest
+from src.infrastructure_manager.run_report import RunReport
+from src.remote_manager.timing import Span, SpanRecorder
+
+
+def build_report():
+    return RunReport(
+        success=True, timestamp=1700000000.0, origin=100.0, duration=12.5,
+        phases={'sweep': 0.5, 'shutdown': 11.5},
+        devices=[
+            {'device': 'VM web "01"', 'server': 'esxi-0', 'ip': '10.0.0.10',
+             'success': True,
+             'timeline': {'released': 0.5, 'dispatched': 1.0, 'sent': 2.0,
+                          'down': 8.0}},
+            {'device': 'ESXi esxi-0', 'server': 'esxi-0', 'ip': '10.0.0.1',
+             'success': True,
+             'timeline': {'released': 8.0, 'dispatched': 8.0, 'sent': 9.0,
+                          'down': 9.0}},
+        ],
+        spans=[Span('10.0.0.10', 'connect', 101.0, 0.75),
+               Span('10.0.0.10', 'guest_poweroff', 101.75, 0.25),
+               Span('10.0.0.1', 'connect', 108.0, 0.5, ok=False),
+               Span('10.0.0.1', 'connect', 108.5, 0.5)],
+        critical_path=[('VM web "01"', 8.0), ('ESXi esxi-0', 1.0)])
+
+
+class TestSpanRecorder(unittest.TestCase):
+    def test_span_marks_exceptions_failed(self):
+        recorder = SpanRecorder()
+        with recorder.span('10.0.0.1', 'connect'):
+            pass
+        with self.assertRaises(OSError):
+            with recorder.span('10.0.0.2', 'connect'):
+                raise OSError('refused')
+
+        first, second = recorder.spans()
+        self.assertTrue(first.ok)
+        self.assertFalse(second.ok)
+        self.assertGreaterEqual(second.duration, 0)
+
+    def test_spans_since_and_bounded_history(self):
+        recorder = SpanRecorder(max_spans=2)
+        for start in (1.0, 2.0, 3.0):
+            recorder.add(Span('10.0.0.1', 'probe', start))
+
+        self.assertEqual([span.start for span in recorder.spans()], [2.0, 3.0])
+        self.assertEqual([span.start for span in recorder.spans(since=3.0)],
+                         [3.0])
+
+
+class TestRunReport(unittest.TestCase):
+    def test_phase_totals_and_host_breakdown(self):
+        report = build_report()
+
+        self.assertEqual(report.phase_totals()['connect'],
+                         {'count': 3, 'failures': 1, 'seconds': 1.75,
+                          'max_seconds': 0.75})
+        self.assertEqual(report.host_breakdown()['10.0.0.1'], {'connect': 1.0})
+
+    def test_to_dict(self):
+        data = build_report().to_dict()
+
+        web = data['devices'][0]
+        self.assertEqual(web['stages'],
+                         {'queued': 0.5, 'send': 1.0, 'wait_off': 6.0})
+        self.assertEqual(web['remote_phases'],
+                         {'connect': 0.75, 'guest_poweroff': 0.25})
+        self.assertEqual(data['spans'][0]['start'], 1.0)
+        self.assertEqual(data['critical_path'][1],
+                         {'device': 'ESXi esxi-0', 'seconds': 1.0})
+
+    def test_to_prometheus(self):
+        text = build_report().to_prometheus()
+
+        self.assertTrue(text.endswith('\n'))
+        self.assertIn('esxi_shutdown_success 1\n', text)
+        self.assertIn('esxi_shutdown_phase_seconds{phase="sweep"} 0.5\n', text)
+        self.assertIn('esxi_shutdown_remote_phase_failures{phase="connect"} 1\n',
+                      text)
+        self.assertIn('esxi_shutdown_device_stage_seconds{device="VM web \\"01\\"",'
+                      'server="esxi-0",stage="wait_off"} 6.0\n', text)
+        self.assertIn('esxi_shutdown_host_phase_seconds{host="10.0.0.1",'
+                      'device="ESXi esxi-0",phase="connect"} 1.0\n', text)
+        self.assertIn('esxi_shutdown_critical_path_seconds{position="1",'
+                      'device="ESXi esxi-0"} 1.0\n', text)
+
+    def test_write(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            json_file = os.path.join(tmp_dir, 'run', 'report.json')
+            prometheus_file = os.path.join(tmp_dir, 'textfile', 'report.prom')
+            build_report().write(json_file, prometheus_file)
+
+            with open(json_file) as f:
+                self.assertEqual(json.load(f)['duration_seconds'], 12.5)
+            with open(prometheus_file) as f:
+                self.assertIn('esxi_shutdown_duration_seconds 12.5', f.read())
+            self.assertEqual(os.stat(prometheus_file).st_mode & 0o777, 0o644)
+            self.assertEqual(sorted(os.listdir(os.path.join(tmp_dir, 'run'))),
+                             ['report.json'])
+
+
+if __name__ == '__main__':
+    unittest.main()
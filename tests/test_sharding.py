@@ -0,0 +1,87 @@
+import os
+import tempfile
+import time
+import unittest
+from src.infrastructure_manager.journal import CONFIRMED_OFF, ShutdownJournal
+from src.infrastructure_manager.sharding import ShardedInfrastructureManager
+from tests.test_infrastructure_manager import build_config, build_remote
+
+
+def timelines(manager):
+    return {device['device']: device['timeline']
+            for device in manager.report.devices}
+
+
+class TestShardedInfrastructureManager(unittest.TestCase):
+    def test_plan_shards_keeps_servers_whole_and_balanced(self):
+        config = build_config(vms_per_server=2, servers=5)
+        config.esxi_servers[0].vms *= 3
+        manager = ShardedInfrastructureManager(config, build_remote(), 2)
+
+        shards = manager.plan_shards()
+        self.assertEqual([[server.name for server in shard] for shard in shards],
+                         [["esxi-0", "esxi-4"], ["esxi-1", "esxi-2", "esxi-3"]])
+        self.assertEqual(
+            ShardedInfrastructureManager(config, build_remote(), 10).processes, 5)
+
+    def test_shutdown_relays_dependencies_between_shards(self):
+        remote = build_remote()
+        remote.poweroff_ubuntu_vm.side_effect = \
+            lambda ip, *_, **__: time.sleep(0.05) or True
+        config = build_config(vms_per_server=3)
+        # vm-0-0 needs vm-1-0 running, vm-0-2 (monitoring) goes down last
+        config.esxi_servers[0].vms[0].depends_on = ["vm-1-0"]
+        config.esxi_servers[0].vms[2].priority = 1
+        config.esxi_servers[1].priority = 1
+        manager = ShardedInfrastructureManager(config, remote, 2)
+
+        self.assertTrue(manager.shutdown())
+        self.assertTrue(all(success for _, success in manager.shutdown_results))
+        self.assertEqual(len(manager.shutdown_results), 8)
+        timeline = timelines(manager)
+        self.assertLessEqual(timeline["VM vm-0-0"]["down"],
+                             timeline["VM vm-1-0"]["dispatched"])
+        self.assertLessEqual(timeline["VM vm-1-1"]["down"],
+                             timeline["VM vm-0-2"]["dispatched"])
+        # ESXi servers are ordered across shards too
+        self.assertLessEqual(timeline["ESXi esxi-0"]["down"],
+                             timeline["ESXi esxi-1"]["dispatched"])
+        self.assertEqual(
+            [device for device, _ in manager.critical_path],
+            ["VM vm-0-0", "VM vm-1-0", "VM vm-0-2", "ESXi esxi-0", "ESXi esxi-1"])
+        self.assertEqual(list(manager.report.phases), ["spawn", "shutdown"])
+
+    def test_lost_shard_does_not_block_the_others(self):
+        def poweroff_vm(ip, *_, **__):
+            if ip.startswith("10.0.1."):
+                os._exit(1)
+            return True
+
+        remote = build_remote()
+        remote.poweroff_ubuntu_vm.side_effect = poweroff_vm
+        config = build_config()
+        config.esxi_servers[0].vms[0].depends_on = ["vm-1-0"]
+        manager = ShardedInfrastructureManager(config, remote, 2)
+
+        self.assertFalse(manager.shutdown())
+        results = dict(manager.shutdown_results)
+        self.assertTrue(results["VM vm-0-0"])
+        self.assertTrue(results["ESXi esxi-0"])
+        self.assertFalse(results["ESXi esxi-1"])
+
+    def test_shards_record_the_journal(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'journal.jsonl')
+            journal = ShutdownJournal(path)
+            journal.load()
+            manager = ShardedInfrastructureManager(
+                build_config(), build_remote(), 2, journal=journal)
+
+            self.assertTrue(manager.shutdown())
+            states = ShutdownJournal(path).load()
+            self.assertEqual(len(states), 6)
+            self.assertEqual(set(states.values()), {CONFIRMED_OFF})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+import io
+import os
+import socket
+import tempfile
+import threading
+import unittest
+import paramiko
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519
+from src.config_manager.config_manager import SSHProfile
+from src.remote_manager.remote_manager import RemoteDeviceManager
+from src.remote_manager.ssh_profile import (KnownHostsCache, check_algorithms,
+                                            load_private_key, transport_factory)
+
+
+def ed25519_key_text():
+    return ed25519.Ed25519PrivateKey.generate().private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.OpenSSH,
+        serialization.NoEncryption()).decode()
+
+
+class _KeyOnlyServer(paramiko.ServerInterface):
+    def __init__(self, client_key):
+        self.client_key = client_key
+
+    def get_allowed_auths(self, username):
+        return "publickey"
+
+    def check_auth_publickey(self, username, key):
+        if key == self.client_key:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+
+class TestSSHProfile(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.key_file = os.path.join(self.tmp_dir.name, 'id_ed25519')
+        with open(self.key_file, 'w') as f:
+            f.write(ed25519_key_text())
+        self.host_key = paramiko.Ed25519Key(file_obj=io.StringIO(
+            ed25519_key_text()))
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen()
+        self.port = self.listener.getsockname()[1]
+        self.transports = []
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def tearDown(self):
+        self.listener.close()
+        RemoteDeviceManager.ssh_profiles = {}
+        self.tmp_dir.cleanup()
+
+    def serve(self):
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(sock)
+            transport.add_server_key(self.host_key)
+            server = _KeyOnlyServer(load_private_key(self.key_file))
+            self.transports.append(transport)
+            try:
+                transport.start_server(server=server)
+            except (paramiko.SSHException, EOFError, OSError):
+                transport.close()
+
+    def connect(self, profile):
+        RemoteDeviceManager.configure_ssh_profiles(
+            {('127.0.0.1', self.port): profile})
+        with self.assertNoLogs(level='ERROR'):
+            client = RemoteDeviceManager.ssh_connect(
+                '127.0.0.1', 'admin', None, self.port)
+        client.close()
+        return client
+
+    def test_key_auth_with_preferred_algorithms(self):
+        self.connect(SSHProfile(key_file=self.key_file,
+                                kex=['curve25519-sha256@libssh.org'],
+                                ciphers=['aes128-ctr'],
+                                macs=['hmac-sha2-256-etm@openssh.com'],
+                                key_types=['ssh-ed25519']))
+        transport, = self.transports
+        self.assertEqual((transport.host_key_type, transport.local_cipher,
+                          transport.local_mac),
+                         ('ssh-ed25519', 'aes128-ctr',
+                          'hmac-sha2-256-etm@openssh.com'))
+
+    def test_host_keys_are_learned_then_verified(self):
+        known_hosts = os.path.join(self.tmp_dir.name, 'run', 'known_hosts')
+        self.connect(SSHProfile(key_file=self.key_file,
+                                known_hosts=known_hosts))
+        with open(known_hosts) as f:
+            self.assertEqual(f.read().split(), [
+                f'[127.0.0.1]:{self.port}', 'ssh-ed25519',
+                self.host_key.get_base64()])
+
+        # A later run trusts the persisted key only
+        self.assertEqual(KnownHostsCache(known_hosts).lookup(
+            f'[127.0.0.1]:{self.port}'), {'ssh-ed25519': self.host_key})
+        self.connect(SSHProfile(key_file=self.key_file,
+                                known_hosts=known_hosts,
+                                strict_host_keys=True))
+
+    def test_strict_profile_rejects_unknown_hosts(self):
+        known_hosts = os.path.join(self.tmp_dir.name, 'empty_known_hosts')
+        RemoteDeviceManager.configure_ssh_profiles(
+            {('127.0.0.1', self.port): SSHProfile(
+                key_file=self.key_file, known_hosts=known_hosts,
+                strict_host_keys=True)})
+        with self.assertLogs(level='ERROR') as logs:
+            self.assertFalse(RemoteDeviceManager.ssh_connect(
+                '127.0.0.1', 'admin', None, self.port))
+        self.assertIn('Unknown host key', logs.output[0])
+        self.assertFalse(os.path.exists(known_hosts))
+
+    def test_private_keys_are_loaded_once(self):
+        self.assertIs(load_private_key(self.key_file),
+                      load_private_key(self.key_file))
+
+    def test_transports_disable_nagle_and_keep_default_algorithms(self):
+        # Not the SSH server, which would fail on a connection that never
+        # starts its handshake
+        listener = socket.create_server(('127.0.0.1', 0))
+        self.addCleanup(listener.close)
+        sock = socket.create_connection(listener.getsockname())
+        transport = transport_factory(SSHProfile(kex=['ecdh-sha2-nistp256']))(sock)
+        try:
+            self.assertTrue(sock.getsockopt(socket.IPPROTO_TCP,
+                                            socket.TCP_NODELAY))
+            options = transport.get_security_options()
+            self.assertEqual(options.kex, ('ecdh-sha2-nistp256',))
+            self.assertEqual(options.ciphers, paramiko.Transport._preferred_ciphers)
+        finally:
+            transport.close()
+
+    def test_unsupported_algorithm_is_rejected(self):
+        check_algorithms(SSHProfile(
+            kex=['curve25519-sha256@libssh.org'], ciphers=['aes128-ctr'],
+            macs=['hmac-sha2-256'], key_types=['ssh-ed25519']))
+        with self.assertRaisesRegex(ValueError, 'ciphers algorithm: rc4'):
+            check_algorithms(SSHProfile(ciphers=['rc4']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import unittest
+from unittest.mock import MagicMock
+from src.config_manager.config_manager import StartupConfig
+from src.infrastructure_manager.startup import StartupManager
+from tests.test_infrastructure_manager import build_config
+
+
+def build_startup_config(**startup):
+    startup.setdefault('poll_interval', 0.01)
+    startup.setdefault('host_timeout', 1)
+    startup.setdefault('ready_timeout', 1)
+    config = build_config()
+    config.startup = StartupConfig(**startup)
+    return config
+
+
+def build_remote(esxi_up=lambda ip: True, vm_up=lambda ip: True):
+    remote = MagicMock()
+    events = []
+    servers = {'10.0.0.1', '10.0.1.1'}
+
+    def is_ssh_ready(ip, **_):
+        up = esxi_up(ip) if ip in servers else vm_up(ip)
+        if up:
+            events.append(('up', ip))
+        return up
+
+    def poweron_esxi_vms(ip, username, password, vm_names, **_):
+        events.append(('power_on', ip, list(vm_names)))
+        return {name: 'on' for name in vm_names}
+
+    remote.is_ssh_ready.side_effect = is_ssh_ready
+    remote.poweron_esxi_vms.side_effect = poweron_esxi_vms
+    remote.events = events
+    return remote
+
+
+class TestStartupManager(unittest.TestCase):
+    def test_startup_follows_the_reverse_shutdown_order(self):
+        config = build_startup_config()
+        # vm-1-0 needs vm-0-0 running: it goes down first, and up last
+        config.esxi_servers[1].vms[0].depends_on = ['vm-0-0']
+        remote = build_remote()
+        manager = StartupManager(config, remote)
+
+        self.assertTrue(manager.startup())
+        events = remote.events
+        # Every server is up before its VMs are powered on, in one batch
+        self.assertLess(events.index(('up', '10.0.0.1')),
+                        events.index(('power_on', '10.0.0.1',
+                                      ['vm-0-0', 'vm-0-1'])))
+        # A dependent VM is powered on once what it needs accepts SSH
+        self.assertLess(events.index(('up', '10.0.0.10')),
+                        events.index(('power_on', '10.0.1.1', ['vm-1-0'])))
+        self.assertEqual(len(manager.startup_results), 6)
+        self.assertIsNotNone(manager.recovery_time)
+        self.assertEqual(manager.critical_path[-1][0], "VM vm-1-0")
+
+        report = manager.report.to_dict()
+        self.assertEqual(report['kind'], 'startup')
+        self.assertIn('recovery', report['phases'])
+        vm = next(device for device in report['devices']
+                  if device['device'] == "VM vm-1-0")
+        self.assertEqual(set(vm['stages']), {'queued', 'power_on', 'wait_ready'})
+        self.assertIn('esxi_startup_device_up_seconds',
+                      manager.report.to_prometheus())
+
+    def test_vms_of_a_server_that_stays_down_are_not_powered_on(self):
+        config = build_startup_config(host_timeout=0.05)
+        remote = build_remote(esxi_up=lambda ip: ip != '10.0.1.1')
+        manager = StartupManager(config, remote)
+
+        self.assertFalse(manager.startup())
+        self.assertIsNone(manager.recovery_time)
+        self.assertEqual(
+            [call.args[0] for call in remote.poweron_esxi_vms.call_args_list],
+            ['10.0.0.1'])
+        self.assertIn(("ESXi esxi-1", False), manager.startup_results)
+        self.assertIn(("VM vm-1-0", False), manager.startup_results)
+        self.assertIn(("VM vm-0-0", True), manager.startup_results)
+
+    def test_power_on_is_retried_until_the_server_runs_commands(self):
+        config = build_startup_config()
+        remote = build_remote()
+        outcomes = [None, None]
+        default = remote.poweron_esxi_vms.side_effect
+        remote.poweron_esxi_vms.side_effect = lambda *args, **kwargs: (
+            outcomes.pop() if outcomes and args[0] == '10.0.0.1'
+            else default(*args, **kwargs))
+        manager = StartupManager(config, remote)
+
+        self.assertTrue(manager.startup())
+        self.assertEqual(
+            [call.args[0] for call in remote.poweron_esxi_vms.call_args_list
+             ].count('10.0.0.1'), 3)
+
+    def test_vm_that_never_accepts_ssh_is_given_up_on(self):
+        config = build_startup_config(ready_timeout=0.05)
+        remote = build_remote(vm_up=lambda ip: ip != '10.0.0.11')
+        manager = StartupManager(config, remote)
+
+        self.assertFalse(manager.startup())
+        self.assertIn(("VM vm-0-1", False), manager.startup_results)
+        self.assertIn(("ESXi esxi-1", True), manager.startup_results)
+
+    def test_vm_without_ip_is_up_once_powered_on(self):
+        config = build_startup_config()
+        config.esxi_servers[0].vms[0].ip = None
+        remote = build_remote()
+        manager = StartupManager(config, remote)
+
+        self.assertTrue(manager.startup())
+        self.assertNotIn(None, [call.args[0] for call in
+                                remote.is_ssh_ready.call_args_list])
+
+
+if __name__ == '__main__':
+    unittest.main()